@@ -20,13 +20,18 @@ import urlparse
 
 from webob import exc
 
+from nova.api.openstack import common
 from nova.api.openstack import extensions
 from nova.api.openstack import wsgi
 from nova.api.openstack import xmlutil
 from nova.compute import api
+from nova.compute import utils as compute_utils
 from nova import exception
 from nova.openstack.common import timeutils
 
+# Number of instances read from the database at a time
+USAGE_PAGE_SIZE = 1000
+
 authorize_show = extensions.extension_authorizer('compute',
                                                  'simple_tenant_usage:show')
 authorize_list = extensions.extension_authorizer('compute',
@@ -96,93 +101,180 @@ class SimpleTenantUsageController(object):
                 stop = period_stop
             dt = stop - start
             seconds = (dt.days * 3600 * 24 + dt.seconds +
-                       dt.microseconds / 100000.0)
+                       dt.microseconds / 1000000.0)
 
             return seconds / 3600.0
         else:
             # instance hasn't launched, so no charge
             return 0
 
-    def _tenant_usages_for_period(self, context, period_start,
-                                  period_stop, tenant_id=None, detailed=True):
-
+    def _instances_for_period(self, context, period_start, period_stop,
+                              tenant_id=None):
+        """Yield the usage fields of the instances active in the period,
+        reading them a page at a time.
+        """
         compute_api = api.API()
-        instances = compute_api.get_active_by_window(context,
-                                                     period_start,
-                                                     period_stop,
-                                                     tenant_id)
-        rval = {}
-        flavors = {}
-
-        for instance in instances:
-            info = {}
-            info['hours'] = self._hours_for(instance,
-                                            period_start,
-                                            period_stop)
-            flavor_type = instance['instance_type_id']
+        marker = None
+        while True:
+            instances = compute_api.get_active_usage_by_window(
+                context, period_start, period_stop, tenant_id,
+                marker=marker, limit=USAGE_PAGE_SIZE)
+            for instance in instances:
+                yield instance
+            if len(instances) < USAGE_PAGE_SIZE:
+                return
+            marker = instances[-1]['id']
 
-            if not flavors.get(flavor_type):
-                try:
-                    it_ref = compute_api.get_instance_type(context,
-                                                           flavor_type)
-                    flavors[flavor_type] = it_ref
-                except exception.InstanceTypeNotFound:
-                    # can't bill if there is no instance type
-                    continue
+    def _server_usage(self, instance, flavor, hours, now):
+        info = {}
+        info['hours'] = hours
 
-            flavor = flavors[flavor_type]
+        info['instance_id'] = instance['uuid']
+        info['name'] = instance['display_name']
 
-            info['instance_id'] = instance['uuid']
-            info['name'] = instance['display_name']
+        info['memory_mb'] = flavor['memory_mb']
+        info['local_gb'] = flavor['root_gb'] + flavor['ephemeral_gb']
+        info['vcpus'] = flavor['vcpus']
 
-            info['memory_mb'] = flavor['memory_mb']
-            info['local_gb'] = flavor['root_gb'] + flavor['ephemeral_gb']
-            info['vcpus'] = flavor['vcpus']
+        info['tenant_id'] = instance['project_id']
 
-            info['tenant_id'] = instance['project_id']
+        info['flavor'] = flavor['name']
 
-            info['flavor'] = flavor['name']
+        info['started_at'] = instance['launched_at']
 
-            info['started_at'] = instance['launched_at']
+        info['ended_at'] = instance['terminated_at']
 
-            info['ended_at'] = instance['terminated_at']
+        if info['ended_at']:
+            info['state'] = 'terminated'
+        else:
+            info['state'] = instance['vm_state']
 
-            if info['ended_at']:
-                info['state'] = 'terminated'
-            else:
-                info['state'] = instance['vm_state']
+        if info['state'] == 'terminated':
+            delta = info['ended_at'] - info['started_at']
+        else:
+            delta = now - info['started_at']
 
-            now = timeutils.utcnow()
+        info['uptime'] = delta.days * 24 * 3600 + delta.seconds
+        return info
 
-            if info['state'] == 'terminated':
-                delta = info['ended_at'] - info['started_at']
-            else:
-                delta = now - info['started_at']
+    def _tenant_usages_for_period(self, context, period_start,
+                                  period_stop, tenant_id=None, detailed=True,
+                                  marker=None, limit=None):
+        """Sum up the usage of each tenant over the period.
+
+        Hours are added up per tenant and flavor, and only multiplied out
+        by the flavor's resources at the end.  The totals of the whole days
+        of the period are read from the usage rollups when they have all
+        been rolled up, and only those of the partial days from the
+        instances.  With detailed, the usage of each server over the period
+        is listed too, or just those after the marker (an instance uuid) up
+        to the limit.
+        """
+        compute_api = api.API()
+        now = timeutils.utcnow()
+        rval = {}
+        flavors = {}
+        flavor_hours = {}
+        listing = marker is None
+        listed = 0
 
-            info['uptime'] = delta.days * 24 * 3600 + delta.seconds
+        def get_flavor(flavor_type):
+            if flavor_type not in flavors:
+                try:
+                    flavors[flavor_type] = compute_api.get_instance_type(
+                        context, flavor_type)
+                except exception.InstanceTypeNotFound:
+                    flavors[flavor_type] = None
+            return flavors[flavor_type]
 
-            if info['tenant_id'] not in rval:
+        def add_hours(project_id, flavor_type, hours):
+            if project_id not in rval:
                 summary = {}
-                summary['tenant_id'] = info['tenant_id']
+                summary['tenant_id'] = project_id
                 if detailed:
                     summary['server_usages'] = []
-                summary['total_local_gb_usage'] = 0
-                summary['total_vcpus_usage'] = 0
-                summary['total_memory_mb_usage'] = 0
                 summary['total_hours'] = 0
                 summary['start'] = period_start
                 summary['stop'] = period_stop
-                rval[info['tenant_id']] = summary
+                rval[project_id] = summary
+                flavor_hours[project_id] = {}
+
+            summary = rval[project_id]
+            summary['total_hours'] += hours
+            tenant_hours = flavor_hours[project_id]
+            tenant_hours.setdefault(flavor_type, 0)
+            tenant_hours[flavor_type] += hours
+            return summary
+
+        # The windows whose totals are read from the instances
+        windows = [(period_start, period_stop)]
+        rollups = []
+        periods = compute_utils.usage_rollup_periods(period_start,
+                                                     period_stop)
+        if periods:
+            rolled_start = periods[0]
+            rolled_stop = periods[-1] + compute_utils.USAGE_ROLLUP_PERIOD
+            rollups = compute_api.get_usage_rollups_by_window(
+                context, rolled_start, rolled_stop, tenant_id)
+            if rollups is None:
+                rollups = []
+            else:
+                windows = [(start, stop) for start, stop in
+                           [(period_start, rolled_start),
+                            (rolled_stop, period_stop)] if start < stop]
+
+        # Listing servers takes all the instances of the period
+        scans = windows
+        if detailed:
+            scans = [(period_start, period_stop)]
+
+        for scan_start, scan_stop in scans:
+            for instance in self._instances_for_period(context, scan_start,
+                                                       scan_stop, tenant_id):
+                flavor = get_flavor(instance['instance_type_id'])
+                if flavor is None:
+                    # can't bill if there is no instance type
+                    continue
 
-            summary = rval[info['tenant_id']]
-            summary['total_local_gb_usage'] += info['local_gb'] * info['hours']
-            summary['total_vcpus_usage'] += info['vcpus'] * info['hours']
-            summary['total_memory_mb_usage'] += (info['memory_mb'] *
-                                                 info['hours'])
+                if detailed:
+                    hours = self._hours_for(instance, period_start,
+                                            period_stop)
+                    billed = sum(self._hours_for(instance, start, stop)
+                                 for start, stop in windows)
+                else:
+                    hours = billed = self._hours_for(instance, scan_start,
+                                                     scan_stop)
+                summary = add_hours(instance['project_id'],
+                                    instance['instance_type_id'], billed)
+
+                if detailed and listing and (limit is None or listed < limit):
+                    summary['server_usages'].append(
+                        self._server_usage(instance, flavor, hours, now))
+                    listed += 1
+                elif instance['uuid'] == marker:
+                    listing = True
+
+        for rollup in rollups:
+            if get_flavor(rollup['instance_type_id']) is None:
+                continue
+            add_hours(rollup['project_id'], rollup['instance_type_id'],
+                      rollup['hours'])
+
+        if not listing:
+            msg = _('marker [%s] not found') % marker
+            raise exc.HTTPBadRequest(explanation=msg)
 
-            summary['total_hours'] += info['hours']
-            if detailed:
-                summary['server_usages'].append(info)
+        for project_id, summary in rval.iteritems():
+            summary['total_local_gb_usage'] = 0
+            summary['total_vcpus_usage'] = 0
+            summary['total_memory_mb_usage'] = 0
+            for flavor_type, hours in flavor_hours[project_id].iteritems():
+                flavor = flavors[flavor_type]
+                summary['total_local_gb_usage'] += (
+                    (flavor['root_gb'] + flavor['ephemeral_gb']) * hours)
+                summary['total_vcpus_usage'] += flavor['vcpus'] * hours
+                summary['total_memory_mb_usage'] += (flavor['memory_mb'] *
+                                                     hours)
 
         return rval.values()
 
@@ -225,10 +317,14 @@ class SimpleTenantUsageController(object):
         now = timeutils.utcnow()
         if period_stop > now:
             period_stop = now
+        params = {}
+        if detailed:
+            params = common.get_pagination_params(req)
         usages = self._tenant_usages_for_period(context,
                                                 period_start,
                                                 period_stop,
-                                                detailed=detailed)
+                                                detailed=detailed,
+                                                **params)
         return {'tenant_usages': usages}
 
     @wsgi.serializers(xml=SimpleTenantUsageTemplate)
@@ -243,11 +339,13 @@ class SimpleTenantUsageController(object):
         now = timeutils.utcnow()
         if period_stop > now:
             period_stop = now
+        params = common.get_pagination_params(req)
         usage = self._tenant_usages_for_period(context,
                                                period_start,
                                                period_stop,
                                                tenant_id=tenant_id,
-                                               detailed=True)
+                                               detailed=True,
+                                               **params)
         if len(usage):
             usage = usage[0]
         else:
@@ -23,19 +23,37 @@ import httplib
 import math
 import re
 import time
+import urllib
 
+from oslo.config import cfg
 import webob.dec
 import webob.exc
 
 from nova.api.openstack.compute.views import limits as limits_views
 from nova.api.openstack import wsgi
 from nova.api.openstack import xmlutil
+from nova.common import memorycache
 from nova.openstack.common import importutils
 from nova.openstack.common import jsonutils
+from nova.openstack.common import log as logging
 from nova import quota
 from nova import wsgi as base_wsgi
 
 
+rate_limit_opts = [
+    cfg.IntOpt('osapi_rate_limit_max_users',
+               default=10000,
+               help='Maximum number of users whose rate limit state is kept '
+                    'in memory by each API worker; the least recently seen '
+                    'users are forgotten first'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(rate_limit_opts)
+CONF.import_opt('memcached_servers', 'nova.common.memorycache')
+
+LOG = logging.getLogger(__name__)
+
 QUOTAS = quota.QUOTAS
 
 
@@ -156,6 +174,14 @@ class Limit(object):
         if self.verb != verb or not re.match(self.regex, url):
             return
 
+        return self.consume()
+
+    def consume(self):
+        """
+        Record a request which has already been matched against this limit.
+
+        @return: Delay in seconds before the request may be made, or None
+        """
         now = self._get_time()
 
         if self.last_request is None:
@@ -218,8 +244,10 @@ DEFAULT_LIMITS = [
 
 class RateLimitingMiddleware(base_wsgi.Middleware):
     """
-    Rate-limits requests passing through this middleware. All limit information
-    is stored in memory for this implementation.
+    Rate-limits requests passing through this middleware. By default all limit
+    information is stored in the memory of each API worker; set the `limiter`
+    option to `nova.api.openstack.compute.limits.SharedLimiter` to share it
+    between workers through the memcached at `memcached_servers`.
     """
 
     def __init__(self, application, limits=None, limiter=None, **kwargs):
@@ -241,6 +269,14 @@ class RateLimitingMiddleware(base_wsgi.Middleware):
         else:
             limiter = importutils.import_class(limiter)
 
+        if issubclass(limiter, SharedLimiter) and not CONF.memcached_servers:
+            # The in-process stand-in for memcached would keep the counters
+            # per worker anyway, and scans every key on each lookup.
+            LOG.warn(_("memcached_servers is not set, so rate limits cannot "
+                       "be shared between API workers; keeping them in the "
+                       "memory of each worker instead"))
+            limiter = Limiter
+
         # Parse the limits, if any are provided
         if limits is not None:
             limits = limiter.parse_limits(limits)
@@ -278,6 +314,84 @@ class RateLimitingMiddleware(base_wsgi.Middleware):
         return self.application
 
 
+class LimitRoutes(object):
+    """
+    Finds the limits relevant to a request.  The regexes of all limits for
+    one HTTP verb are combined into a single pattern of optional lookaheads,
+    so a request costs one regex match however many limits are configured.
+    """
+
+    def __init__(self, limits):
+        """
+        Initialize the new `LimitRoutes`.
+
+        @param limits: List of `Limit` objects
+        """
+        by_verb = collections.defaultdict(list)
+        for index, limit in enumerate(limits):
+            by_verb[limit.verb].append(index)
+
+        self.routes = {}
+        for verb, indexes in by_verb.items():
+            self.routes[verb] = self._compile(limits, indexes)
+
+    @staticmethod
+    def _compile(limits, indexes):
+        regexes = [re.compile(limits[i].regex) for i in indexes]
+
+        # Groups in a limit's own regex would be renumbered by the extra
+        # groups, silently changing any backreferences, so leave those
+        # limits to be matched one at a time.
+        if any(regex.groups for regex in regexes):
+            return None, zip(regexes, indexes)
+
+        parts = ['(?:(?=(%s)))?' % limits[i].regex for i in indexes]
+        return re.compile(''.join(parts)), indexes
+
+    def match(self, verb, url):
+        """
+        Return the indexes of the limits which apply to the given request.
+        """
+        route = self.routes.get(verb)
+        if route is None:
+            return []
+
+        pattern, indexes = route
+        if pattern is None:
+            return [i for regex, i in indexes if regex.match(url)]
+
+        groups = pattern.match(url).groups()
+        return [i for i, group in zip(indexes, groups) if group is not None]
+
+
+class LimitLevels(object):
+    """
+    Per-user copies of the limits, holding at most `max_users` entries.  The
+    least recently used entry is evicted to make room for a new user.
+    """
+
+    def __init__(self, factory, max_users):
+        self.factory = factory
+        self.max_users = max_users
+        self._levels = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._levels)
+
+    def __contains__(self, username):
+        return username in self._levels
+
+    def __getitem__(self, username):
+        try:
+            levels = self._levels.pop(username)
+        except KeyError:
+            levels = self.factory(username)
+            if self.max_users > 0 and len(self._levels) >= self.max_users:
+                self._levels.popitem(last=False)
+        self._levels[username] = levels
+        return levels
+
+
 class Limiter(object):
     """
     Rate-limit checking class which handles limits in memory.
@@ -290,13 +404,28 @@ class Limiter(object):
         @param limits: List of `Limit` objects
         """
         self.limits = copy.deepcopy(limits)
-        self.levels = collections.defaultdict(lambda: copy.deepcopy(limits))
+        self.routes = LimitRoutes(self.limits)
+        self.user_limits = {}
+        self.user_routes = {}
 
         # Pick up any per-user limit information
         for key, value in kwargs.items():
             if key.startswith('user:'):
                 username = key[5:]
-                self.levels[username] = self.parse_limits(value)
+                self.user_limits[username] = self.parse_limits(value)
+                self.user_routes[username] = LimitRoutes(
+                        self.user_limits[username])
+
+        self.levels = LimitLevels(self._new_levels,
+                                  CONF.osapi_rate_limit_max_users)
+
+    def _new_levels(self, username):
+        limits = self.user_limits.get(username, self.limits)
+        return [copy.copy(limit) for limit in limits]
+
+    def _match(self, verb, url, username):
+        routes = self.user_routes.get(username, self.routes)
+        return routes.match(verb, url)
 
     def get_limits(self, username=None):
         """
@@ -312,8 +441,10 @@ class Limiter(object):
         """
         delays = []
 
-        for limit in self.levels[username]:
-            delay = limit(verb, url)
+        levels = self.levels[username]
+        for index in self._match(verb, url, username):
+            limit = levels[index]
+            delay = limit.consume()
             if delay:
                 delays.append((delay, limit.error_message))
 
@@ -384,6 +515,99 @@ class Limiter(object):
         return result
 
 
+class SharedLimiter(Limiter):
+    """
+    Rate-limit checking class which keeps its counters in memcached, so the
+    limits hold across every API worker sharing the `memcached_servers`.
+
+    Requests are counted in windows one unit long with atomic increments.  A
+    request is allowed while the count for the current window, plus the
+    previous window's count weighted by how much of it a sliding window of
+    one unit still overlaps, stays within the limit.  Counters expire after
+    two units, so memcached evicts the state of idle users by itself.
+    """
+
+    def __init__(self, limits, **kwargs):
+        super(SharedLimiter, self).__init__(limits, **kwargs)
+        self._cache = memorycache.get_client()
+
+    def _key(self, username, index, window):
+        return 'ratelimit:%s:%d:%d' % (urllib.quote(username or '', safe=''),
+                                       index, window)
+
+    def _usage(self, limit, username, index, now):
+        window = int(now // limit.unit)
+        elapsed = now - window * limit.unit
+        key = self._key(username, index, window)
+        current = int(self._cache.get(key) or 0)
+        previous = int(self._cache.get(
+                self._key(username, index, window - 1)) or 0)
+        return key, elapsed, current, previous
+
+    def _delay(self, limit, elapsed, current, previous):
+        allowed = limit.value - 1
+        used = previous * (1.0 - elapsed / limit.unit) + current
+        if used <= allowed:
+            return None
+        if current <= allowed:
+            # Wait for the previous window to slide far enough away
+            ratio = float(allowed - current) / previous
+            return limit.unit * (1.0 - ratio) - elapsed
+        # Wait for this window to become the previous one, and then slide
+        ratio = float(allowed) / current
+        return limit.unit - elapsed + limit.unit * (1.0 - ratio)
+
+    def _incr(self, key, limit):
+        if self._cache.incr(key) is None:
+            if not self._cache.add(key, '1', time=2 * limit.unit):
+                # Another worker created the counter first
+                self._cache.incr(key)
+
+    def get_limits(self, username=None):
+        """
+        Return the limits for a given user.
+        """
+        limits = self.user_limits.get(username, self.limits)
+        result = []
+        for index, limit in enumerate(limits):
+            now = limit._get_time()
+            key, elapsed, current, previous = self._usage(
+                    limit, username, index, now)
+            used = previous * (1.0 - elapsed / limit.unit) + current
+            delay = self._delay(limit, elapsed, current, previous) or 0
+            display = limit.display()
+            display['remaining'] = max(int(limit.value - used), 0)
+            display['resetTime'] = int(now + delay)
+            result.append(display)
+        return result
+
+    def check_for_delay(self, verb, url, username=None):
+        """
+        Check the given verb/user/user triplet for limit.
+
+        @return: Tuple of delay (in seconds) and error message (or None, None)
+        """
+        limits = self.user_limits.get(username, self.limits)
+        delays = []
+
+        for index in self._match(verb, url, username):
+            limit = limits[index]
+            now = limit._get_time()
+            key, elapsed, current, previous = self._usage(
+                    limit, username, index, now)
+            delay = self._delay(limit, elapsed, current, previous)
+            if delay:
+                delays.append((delay, limit.error_message))
+            else:
+                self._incr(key, limit)
+
+        if delays:
+            delays.sort()
+            return delays[0]
+
+        return None, None
+
+
 class WsgiLimiter(object):
     """
     Rate-limit checking from a WSGI application. Uses an in-memory `Limiter`.
@@ -17,8 +17,11 @@
 Cells Service Manager
 """
 import datetime
+import math
+import os
 import time
 
+from eventlet import greenthread
 from oslo.config import cfg
 
 from nova.cells import messaging
@@ -28,8 +31,11 @@ from nova import context
 from nova import exception
 from nova import manager
 from nova.openstack.common import importutils
+from nova.openstack.common import jsonutils
 from nova.openstack.common import log as logging
 from nova.openstack.common import timeutils
+from nova import paths
+from nova import utils
 
 cell_manager_opts = [
         cfg.StrOpt('driver',
@@ -41,7 +47,41 @@ cell_manager_opts = [
                         "or deleted to continue to update cells"),
         cfg.IntOpt("instance_update_num_instances",
                 default=1,
-                help="Number of instances to update per periodic task run")
+                help="Number of instances to update per periodic task run"),
+        cfg.IntOpt("instance_update_batch_interval",
+                default=0,
+                help="Seconds for which instance updates are collected "
+                        "before being sent to parent cells together, "
+                        "keeping only the latest update of each instance "
+                        "(0 sends each update as it happens)"),
+        cfg.IntOpt("instance_update_batch_size",
+                default=100,
+                help="Maximum number of instances updated by one message "
+                        "to parent cells"),
+        cfg.BoolOpt("instance_update_batch_message",
+                default=False,
+                help="Send the instances of a batched update or a bulk "
+                        "heal to parent cells in one "
+                        "instance_update_at_top_batch message.  Only enable "
+                        "this once every parent cell understands that "
+                        "message; otherwise each instance is sent in an "
+                        "instance_update_at_top message of its own"),
+        cfg.IntOpt("instance_heal_batch_size",
+                default=0,
+                help="Number of instances read and sent to parent cells "
+                        "together when healing instances in bulk (0 heals "
+                        "instance_update_num_instances instances one at a "
+                        "time on each periodic task run)"),
+        cfg.IntOpt("instance_heal_sweep_time",
+                default=3600,
+                help="Seconds a sweep through all instances should take "
+                        "when healing in bulk, going by the number of "
+                        "instances the previous sweep found (0 heals one "
+                        "batch per periodic task run)"),
+        cfg.StrOpt("instance_heal_cursor_file",
+                default=paths.state_path_def('cells_heal_cursor'),
+                help="File recording how far the bulk healing sweep has "
+                        "got, so a restart carries on from there"),
 ]
 
 
@@ -80,6 +120,20 @@ class CellsManager(manager.Manager):
                 CONF.cells.driver)
         self.driver = cells_driver_cls()
         self.instances_to_heal = iter([])
+        # Instance updates waiting for the next flush, by uuid, with the
+        # time the first of them was made.
+        self._pending_instance_updates = {}
+        # Instances destroyed while the pending updates are being sent
+        self._destroyed_while_flushing = None
+        self._flush_timer = None
+        self.instance_update_stats = {'updates': 0, 'instances': 0,
+                                      'messages': 0, 'total_lag': 0.0,
+                                      'max_lag': 0.0}
+        self._heal_cursor = None
+        self._last_heal_run = None
+        self.heal_stats = {'instances': 0, 'messages': 0, 'sweeps': 0,
+                           'last_sweep_instances': 0,
+                           'last_sweep_seconds': 0.0}
 
     def post_start_hook(self):
         """Have the driver start its consumers for inter-cell communication.
@@ -93,12 +147,25 @@ class CellsManager(manager.Manager):
         # stopping, so we have no way to stop consumers cleanly.
         self.driver.start_consumers(self.msg_runner)
         ctxt = context.get_admin_context()
+        interval = CONF.cells.instance_update_batch_interval
+        if interval > 0:
+            self._flush_timer = utils.FixedIntervalLoopingCall(
+                    self._flush_instance_updates, ctxt)
+            self._flush_timer.start(interval=interval,
+                                    initial_delay=interval)
         if self.state_manager.get_child_cells():
             self.msg_runner.ask_children_for_capabilities(ctxt)
             self.msg_runner.ask_children_for_capacities(ctxt)
         else:
             self._update_our_parents(ctxt)
 
+    def cleanup_host(self):
+        """Send the instance updates still waiting to parent cells."""
+        if self._flush_timer is not None:
+            self._flush_timer.stop()
+            self._flush_timer = None
+        self._flush_instance_updates(context.get_admin_context())
+
     @manager.periodic_task
     def _update_our_parents(self, ctxt):
         """Update our parent cells with our capabilities and capacity
@@ -123,12 +190,19 @@ class CellsManager(manager.Manager):
         setting defines the maximum number of seconds old the updated_at
         can be.  Ie, a threshold of 3600 means to only update instances
         that have modified in the last hour.
+
+        If CONF.cells.instance_heal_batch_size is set, instances are
+        healed in bulk instead.  See _heal_instances_in_bulk().
         """
 
         if not self.state_manager.get_parent_cells():
             # No need to sync up if we have no parents.
             return
 
+        if CONF.cells.instance_heal_batch_size > 0:
+            self._heal_instances_in_bulk(ctxt)
+            return
+
         info = {'updated_list': False}
 
         def _next_instance():
@@ -169,6 +243,108 @@ class CellsManager(manager.Manager):
                 self._sync_instance(ctxt, instance)
                 break
 
+    def _load_heal_cursor(self):
+        if self._heal_cursor is None:
+            self._heal_cursor = {}
+            path = CONF.cells.instance_heal_cursor_file
+            try:
+                if path and os.path.exists(path):
+                    with open(path) as f:
+                        self._heal_cursor = jsonutils.loads(f.read())
+            except (IOError, ValueError) as e:
+                LOG.warn(_("Starting a new healing sweep, could not read "
+                           "%(path)s: %(e)s"), locals())
+        return self._heal_cursor
+
+    def _save_heal_cursor(self):
+        path = CONF.cells.instance_heal_cursor_file
+        if not path:
+            return
+        try:
+            with open(path + '.tmp', 'w') as f:
+                f.write(jsonutils.dumps(self._heal_cursor))
+            os.rename(path + '.tmp', path)
+        except (IOError, OSError) as e:
+            LOG.warn(_("Could not record the healing sweep in %(path)s: "
+                       "%(e)s"), locals())
+
+    def _heal_instances_in_bulk(self, ctxt):
+        """Sweep through the instances to sync, ordered by id, reading
+        CONF.cells.instance_heal_batch_size of them at a time and sending
+        the ones not deleted to parent cells in one message.
+
+        Each run reads as many batches as it takes to get through as
+        many instances as the previous sweep found within
+        CONF.cells.instance_heal_sweep_time seconds.  Where the sweep has
+        got to is kept in CONF.cells.instance_heal_cursor_file.
+        """
+        batch_size = CONF.cells.instance_heal_batch_size
+        sweep_time = CONF.cells.instance_heal_sweep_time
+        cursor = self._load_heal_cursor()
+        now = time.time()
+        if not cursor.get('started_at'):
+            cursor.update(marker=None, started_at=now, healed=0)
+
+        wanted = batch_size
+        last_sweep = cursor.get('last_sweep_instances')
+        if sweep_time > 0 and last_sweep and self._last_heal_run:
+            wanted = max(batch_size, int(math.ceil(
+                    last_sweep * (now - self._last_heal_run) / sweep_time)))
+        self._last_heal_run = now
+
+        filters = {}
+        threshold = CONF.cells.instance_updated_at_threshold
+        if threshold > 0:
+            filters['changes-since'] = timeutils.utcnow() - \
+                    datetime.timedelta(seconds=threshold)
+        rd_context = ctxt.elevated(read_deleted='yes')
+
+        healed = 0
+        while healed < wanted:
+            try:
+                instances = self.db.instance_get_all_by_filters(rd_context,
+                        filters, 'id', 'asc', limit=batch_size,
+                        marker=cursor['marker'])
+            except exception.MarkerNotFound:
+                # The last instance healed is gone, carry on from the start
+                cursor['marker'] = None
+                continue
+
+            updates = []
+            for instance in instances:
+                if instance['deleted']:
+                    self.instance_destroy_at_top(ctxt, instance)
+                else:
+                    updates.append(instance)
+            if updates:
+                self.heal_stats['messages'] += \
+                        self._send_instance_updates(ctxt, updates)
+            healed += len(instances)
+            self.heal_stats['instances'] += len(instances)
+            cursor['healed'] += len(instances)
+
+            if len(instances) < batch_size:
+                self._finish_heal_sweep(cursor, time.time())
+                break
+            cursor['marker'] = instances[-1]['uuid']
+            # Yield to other greenthreads
+            greenthread.sleep(0)
+
+        self._save_heal_cursor()
+
+    def _finish_heal_sweep(self, cursor, now):
+        seconds = now - cursor['started_at']
+        count = cursor['healed']
+        self.heal_stats['sweeps'] += 1
+        self.heal_stats['last_sweep_instances'] = count
+        self.heal_stats['last_sweep_seconds'] = seconds
+        LOG.info(_("Healed %(count)d instances in %(seconds)d seconds "
+                   "(%(rate).1f per second)"),
+                 {'count': count, 'seconds': seconds,
+                  'rate': count / max(seconds, 1)})
+        cursor.update(marker=None, started_at=None, healed=0,
+                      last_sweep_instances=count)
+
     def _sync_instance(self, ctxt, instance):
         """Broadcast an instance_update or instance_destroy message up to
         parent cells.
@@ -202,10 +378,103 @@ class CellsManager(manager.Manager):
 
     def instance_update_at_top(self, ctxt, instance):
         """Update an instance at the top level cell."""
-        self.msg_runner.instance_update_at_top(ctxt, instance)
+        if CONF.cells.instance_update_batch_interval <= 0:
+            self.msg_runner.instance_update_at_top(ctxt, instance)
+            return
+        update = dict(instance.iteritems())
+        # Held back until the next flush, an info cache could overwrite
+        # a newer one sent to the top in the meantime, so it goes now.
+        info_cache = update.pop('info_cache', None)
+        if info_cache is not None:
+            self.msg_runner.instance_update_at_top(ctxt,
+                    {'uuid': update['uuid'], 'info_cache': info_cache})
+            if len(update) == 1:
+                return
+        self._queue_instance_update(update, time.time())
+        self.instance_update_stats['updates'] += 1
+
+    def _queue_instance_update(self, update, queued_at):
+        # Only one update per instance needs to be sent. Some updates
+        # carry just the fields that changed, so later ones are merged
+        # into the update already waiting rather than replacing it.
+        pending = self._pending_instance_updates
+        if update['uuid'] in pending:
+            pending[update['uuid']][0].update(update)
+        else:
+            pending[update['uuid']] = (update, queued_at)
+
+    def _send_instance_updates(self, ctxt, instances):
+        """Send updates for a number of instances to parent cells and
+        return the number of messages it took.
+        """
+        if CONF.cells.instance_update_batch_message:
+            self.msg_runner.instance_update_at_top_batch(ctxt, instances)
+            return 1
+        for instance in instances:
+            self.msg_runner.instance_update_at_top(ctxt, instance)
+        return len(instances)
+
+    def _flush_instance_updates(self, ctxt):
+        """Send the collected instance updates to parent cells in batches
+        of at most CONF.cells.instance_update_batch_size instances.
+
+        Updates that could not be sent are queued again, beneath any
+        update made to the same instance in the meantime.
+        """
+        if not self._pending_instance_updates:
+            return
+        pending = self._pending_instance_updates.values()
+        self._pending_instance_updates = {}
+        self._destroyed_while_flushing = set()
+        pending.sort(key=lambda update: update[1])
+        batch_size = max(1, CONF.cells.instance_update_batch_size)
+
+        stats = self.instance_update_stats
+        try:
+            for i in xrange(0, len(pending), batch_size):
+                batch = pending[i:i + batch_size]
+                try:
+                    stats['messages'] += self._send_instance_updates(
+                            ctxt, [instance for instance, queued_at in batch])
+                except Exception:
+                    LOG.exception(_("Failed to send %d instance updates to "
+                                    "parent cells, will retry"),
+                                  len(pending) - i)
+                    self._requeue_instance_updates(pending[i:])
+                    return
+                stats['instances'] += len(batch)
+                now = time.time()
+                for instance, queued_at in batch:
+                    lag = now - queued_at
+                    stats['total_lag'] += lag
+                    stats['max_lag'] = max(stats['max_lag'], lag)
+        finally:
+            self._destroyed_while_flushing = None
+
+        LOG.debug(_("Sent %(count)d instance updates to parent cells; "
+                    "%(saved)d of %(updates)d messages saved so far, "
+                    "propagation lag %(lag).2fs on average and %(max).2fs "
+                    "at most"),
+                  {'count': len(pending), 'updates': stats['updates'],
+                   'saved': stats['updates'] - stats['messages'],
+                   'lag': stats['total_lag'] / stats['instances'],
+                   'max': stats['max_lag']})
+
+    def _requeue_instance_updates(self, unsent):
+        newer = self._pending_instance_updates.values()
+        self._pending_instance_updates = {}
+        for instance, queued_at in unsent:
+            if instance['uuid'] not in self._destroyed_while_flushing:
+                self._queue_instance_update(instance, queued_at)
+        for instance, queued_at in newer:
+            self._queue_instance_update(instance, queued_at)
 
     def instance_destroy_at_top(self, ctxt, instance):
         """Destroy an instance at the top level cell."""
+        # An update sent after this would bring the instance back
+        self._pending_instance_updates.pop(instance['uuid'], None)
+        if self._destroyed_while_flushing is not None:
+            self._destroyed_while_flushing.add(instance['uuid'])
         self.msg_runner.instance_destroy_at_top(ctxt, instance)
 
     def instance_delete_everywhere(self, ctxt, instance, delete_type):
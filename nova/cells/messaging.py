@@ -614,7 +614,7 @@ class _BaseMessageMethods(base.Base):
                                              period_ending,
                                              host=host,
                                              state=state)
-        return jsonutils.to_primitive(task_logs)
+        return utils.to_primitive(task_logs)
 
 
 class _ResponseMessageMethods(_BaseMessageMethods):
@@ -699,7 +699,7 @@ class _TargetedMessageMethods(_BaseMessageMethods):
         """Return the service entry for a compute host."""
         service = self.db.service_get_by_compute_host(message.ctxt,
                                                       host_name)
-        return jsonutils.to_primitive(service)
+        return utils.to_primitive(service)
 
     def proxy_rpc_to_manager(self, message, host_name, rpc_message,
                              topic, timeout):
@@ -715,7 +715,7 @@ class _TargetedMessageMethods(_BaseMessageMethods):
         """Get compute node by ID."""
         compute_node = self.db.compute_node_get(message.ctxt,
                                                 compute_id)
-        return jsonutils.to_primitive(compute_node)
+        return utils.to_primitive(compute_node)
 
 
 class _BroadcastMessageMethods(_BaseMessageMethods):
@@ -726,10 +726,10 @@ class _BroadcastMessageMethods(_BaseMessageMethods):
         """Are we the API level?"""
         return not self.state_manager.get_parent_cells()
 
-    def instance_update_at_top(self, message, instance, **kwargs):
-        """Update an instance in the DB if we're a top level cell."""
-        if not self._at_the_top():
-            return
+    def _instance_update_values(self, message, instance):
+        """Turn an instance sent up by a child cell into the uuid, the
+        values to update the instance with and its info_cache.
+        """
         instance_uuid = instance['uuid']
 
         # Remove things that we can't update in the top level cells.
@@ -756,24 +756,63 @@ class _BroadcastMessageMethods(_BaseMessageMethods):
                     for md in instance['system_metadata']])
             instance['system_metadata'] = sys_metadata
 
+        return instance_uuid, instance, info_cache
+
+    def _apply_instance_update(self, ctxt, instance_uuid, instance,
+                               info_cache):
         LOG.debug(_("Got update for instance %(instance_uuid)s: "
                 "%(instance)s") % locals())
 
         # It's possible due to some weird condition that the instance
         # was already set as deleted... so we'll attempt to update
         # it with permissions that allows us to read deleted.
-        with utils.temporary_mutation(message.ctxt, read_deleted="yes"):
+        with utils.temporary_mutation(ctxt, read_deleted="yes"):
             try:
-                self.db.instance_update(message.ctxt, instance_uuid,
+                self.db.instance_update(ctxt, instance_uuid,
                         instance, update_cells=False)
             except exception.NotFound:
                 # FIXME(comstud): Strange.  Need to handle quotas here,
                 # if we actually want this code to remain..
-                self.db.instance_create(message.ctxt, instance)
+                self.db.instance_create(ctxt, instance)
         if info_cache:
-            self.db.instance_info_cache_update(message.ctxt, instance_uuid,
+            self.db.instance_info_cache_update(ctxt, instance_uuid,
                     info_cache, update_cells=False)
 
+    def instance_update_at_top(self, message, instance, **kwargs):
+        """Update an instance in the DB if we're a top level cell."""
+        if not self._at_the_top():
+            return
+        self._apply_instance_update(message.ctxt,
+                *self._instance_update_values(message, instance))
+
+    def instance_update_at_top_batch(self, message, instances, **kwargs):
+        """Update a batch of instances in the DB in one transaction if
+        we're a top level cell.
+        """
+        if not self._at_the_top():
+            return
+        updates = [self._instance_update_values(message, instance)
+                   for instance in instances]
+        LOG.debug(_("Got updates for %d instances"), len(updates))
+
+        try:
+            with utils.temporary_mutation(message.ctxt, read_deleted="yes"):
+                not_found = set(self.db.instance_update_batch(message.ctxt,
+                                                              updates))
+        except Exception:
+            LOG.exception(_("Failed to update %d instances together, "
+                            "updating them one at a time"), len(updates))
+            not_found = None
+
+        for update in updates:
+            # Instances not known here yet are created one at a time
+            if not_found is None or update[0] in not_found:
+                try:
+                    self._apply_instance_update(message.ctxt, *update)
+                except Exception:
+                    LOG.exception(_("Failed to update instance %s"),
+                                  update[0])
+
     def instance_destroy_at_top(self, message, instance, **kwargs):
         """Destroy an instance from the DB if we're a top level cell."""
         if not self._at_the_top():
@@ -846,7 +885,7 @@ class _BroadcastMessageMethods(_BaseMessageMethods):
         services = self.db.service_get_all(message.ctxt, disabled=disabled)
         ret_services = []
         for service in services:
-            service = jsonutils.to_primitive(service)
+            service = utils.to_primitive(service)
             for key, val in filters.iteritems():
                 if service[key] != val:
                     break
@@ -861,7 +900,7 @@ class _BroadcastMessageMethods(_BaseMessageMethods):
                     hypervisor_match)
         else:
             nodes = self.db.compute_node_get_all(message.ctxt)
-        return jsonutils.to_primitive(nodes)
+        return utils.to_primitive(nodes)
 
     def compute_node_stats(self, message):
         """Return compute node stats from this cell."""
@@ -1059,6 +1098,14 @@ class MessageRunner(object):
                                     run_locally=False)
         message.process()
 
+    def instance_update_at_top_batch(self, ctxt, instances):
+        """Update a batch of instances at the top level cell."""
+        message = _BroadcastMessage(self, ctxt,
+                                    'instance_update_at_top_batch',
+                                    dict(instances=instances), 'up',
+                                    run_locally=False)
+        message.process()
+
     def instance_destroy_at_top(self, ctxt, instance):
         """Destroy an instance at the top level cell."""
         message = _BroadcastMessage(self, ctxt, 'instance_destroy_at_top',
@@ -24,9 +24,9 @@ messging module.
 
 from oslo.config import cfg
 
-from nova.openstack.common import jsonutils
 from nova.openstack.common import log as logging
 from nova.openstack.common.rpc import proxy as rpc_proxy
+from nova import utils
 
 LOG = logging.getLogger(__name__)
 
@@ -86,7 +86,7 @@ class CellsAPI(rpc_proxy.RpcProxy):
         if not CONF.cells.enable:
             return
         # Make sure we have a dict, not a SQLAlchemy model
-        instance_p = jsonutils.to_primitive(instance)
+        instance_p = utils.to_primitive(instance)
         self.cast(ctxt, self.make_msg('instance_update_at_top',
                                       instance=instance_p))
 
@@ -94,7 +94,7 @@ class CellsAPI(rpc_proxy.RpcProxy):
         """Destroy instance at API level."""
         if not CONF.cells.enable:
             return
-        instance_p = jsonutils.to_primitive(instance)
+        instance_p = utils.to_primitive(instance)
         self.cast(ctxt, self.make_msg('instance_destroy_at_top',
                                       instance=instance_p))
 
@@ -105,7 +105,7 @@ class CellsAPI(rpc_proxy.RpcProxy):
         """
         if not CONF.cells.enable:
             return
-        instance_p = jsonutils.to_primitive(instance)
+        instance_p = utils.to_primitive(instance)
         self.cast(ctxt, self.make_msg('instance_delete_everywhere',
                                       instance=instance_p,
                                       delete_type=delete_type))
@@ -114,7 +114,7 @@ class CellsAPI(rpc_proxy.RpcProxy):
         """Create an instance fault at the top."""
         if not CONF.cells.enable:
             return
-        instance_fault_p = jsonutils.to_primitive(instance_fault)
+        instance_fault_p = utils.to_primitive(instance_fault)
         self.cast(ctxt, self.make_msg('instance_fault_create_at_top',
                                       instance_fault=instance_fault_p))
 
@@ -138,7 +138,7 @@ class CellsAPI(rpc_proxy.RpcProxy):
         """Broadcast up that an instance's info_cache has changed."""
         if not CONF.cells.enable:
             return
-        iicache = jsonutils.to_primitive(instance_info_cache)
+        iicache = utils.to_primitive(instance_info_cache)
         instance = {'uuid': iicache['instance_uuid'],
                     'info_cache': iicache}
         self.cast(ctxt, self.make_msg('instance_update_at_top',
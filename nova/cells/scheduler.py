@@ -133,8 +133,9 @@ class CellsScheduler(base.Base):
                             {'uuid': instance_uuid,
                              'vm_state': vm_states.ERROR})
                 try:
-                    self.db.instance_update(ctxt,
-                                            instance_uuid,
-                                            {'vm_state': vm_states.ERROR})
+                    self.db.instance_update_lean(ctxt,
+                                                 instance_uuid,
+                                                 {'vm_state': vm_states.ERROR},
+                                                 update_cells=False)
                 except Exception:
                     pass
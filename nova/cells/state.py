@@ -16,6 +16,7 @@
 """
 CellState Manager
 """
+import collections
 import copy
 import datetime
 import functools
@@ -117,6 +118,13 @@ class CellStateManager(base.Base):
         self.parent_cells = {}
         self.child_cells = {}
         self.last_cell_db_check = datetime.datetime.min
+        # Kept between syncs so only the compute nodes whose free space
+        # changed need their units counted again: the flavor sizes, the
+        # free ram and disk of each host and the units they add up to.
+        self._flavor_sizes = None
+        self._host_free = {}
+        self._ram_mb_free_units = {}
+        self._disk_mb_free_units = {}
         self._cell_db_sync()
         my_cell_capabs = {}
         for cap in CONF.cells.capabilities:
@@ -174,6 +182,8 @@ class CellStateManager(base.Base):
         <units_dictionary> contains the number of units that we can
         build for every instance_type that we have.  This number is
         computed by looking at room available on every compute_node.
+        Between syncs, only the compute_nodes whose free ram or disk
+        changed are looked at again.
 
         Take the following instance_types as an example:
 
@@ -197,27 +207,51 @@ class CellStateManager(base.Base):
         """
 
         compute_hosts = {}
+        compute_nodes = self.db.compute_node_get_all(context)
+        for compute in compute_nodes:
+            service = compute['service']
+            if not service or service['disabled']:
+                continue
+            compute_hosts[service['host']] = (compute['free_ram_mb'],
+                                              compute['free_disk_gb'] * 1024)
 
-        def _get_compute_hosts():
-            compute_nodes = self.db.compute_node_get_all(context)
-            for compute in compute_nodes:
-                service = compute['service']
-                if not service or service['disabled']:
-                    continue
-                host = service['host']
-                compute_hosts[host] = {
-                        'free_ram_mb': compute['free_ram_mb'],
-                        'free_disk_mb': compute['free_disk_gb'] * 1024}
-
-        _get_compute_hosts()
         if not compute_hosts:
+            self._flavor_sizes = None
+            self._host_free = {}
             self.my_cell_state.update_capacities({})
             return
 
-        ram_mb_free_units = {}
-        disk_mb_free_units = {}
-        total_ram_mb_free = 0
-        total_disk_mb_free = 0
+        # The units of a size are counted once per instance_type of that
+        # size.
+        ram_sizes = collections.defaultdict(int)
+        disk_sizes = collections.defaultdict(int)
+        for instance_type in self.db.instance_type_get_all(context):
+            ram_sizes[instance_type['memory_mb']] += 1
+            disk_sizes[(instance_type['root_gb'] +
+                        instance_type['ephemeral_gb']) * 1024] += 1
+        flavor_sizes = (ram_sizes, disk_sizes)
+        if flavor_sizes != self._flavor_sizes:
+            self._flavor_sizes = flavor_sizes
+            self._host_free = {}
+            self._ram_mb_free_units = dict.fromkeys(ram_sizes, 0)
+            self._disk_mb_free_units = dict.fromkeys(disk_sizes, 0)
+
+        # Take away what the hosts that changed counted for before and add
+        # what they count for now, once per distinct amount free.
+        ram_free_hosts = collections.defaultdict(int)
+        disk_free_hosts = collections.defaultdict(int)
+        for host in set(self._host_free) | set(compute_hosts):
+            old = self._host_free.get(host)
+            new = compute_hosts.get(host)
+            if old == new:
+                continue
+            if old is not None:
+                ram_free_hosts[old[0]] -= 1
+                disk_free_hosts[old[1]] -= 1
+            if new is not None:
+                ram_free_hosts[new[0]] += 1
+                disk_free_hosts[new[1]] += 1
+        self._host_free = compute_hosts
 
         def _free_units(tot, per_inst):
             if per_inst:
@@ -225,26 +259,22 @@ class CellStateManager(base.Base):
             else:
                 return 0
 
-        def _update_from_values(values, instance_type):
-            memory_mb = instance_type['memory_mb']
-            disk_mb = (instance_type['root_gb'] +
-                    instance_type['ephemeral_gb']) * 1024
-            ram_mb_free_units.setdefault(str(memory_mb), 0)
-            disk_mb_free_units.setdefault(str(disk_mb), 0)
-            ram_free_units = _free_units(compute_values['free_ram_mb'],
-                    memory_mb)
-            disk_free_units = _free_units(compute_values['free_disk_mb'],
-                    disk_mb)
-            ram_mb_free_units[str(memory_mb)] += ram_free_units
-            disk_mb_free_units[str(disk_mb)] += disk_free_units
-
-        instance_types = self.db.instance_type_get_all(context)
-
-        for compute_values in compute_hosts.values():
-            total_ram_mb_free += compute_values['free_ram_mb']
-            total_disk_mb_free += compute_values['free_disk_mb']
-            for instance_type in instance_types:
-                _update_from_values(compute_values, instance_type)
+        def _add_units(units, sizes, free_hosts):
+            for free, hosts in free_hosts.iteritems():
+                if not hosts:
+                    continue
+                for size, count in sizes.iteritems():
+                    units[size] += hosts * count * _free_units(free, size)
+
+        _add_units(self._ram_mb_free_units, ram_sizes, ram_free_hosts)
+        _add_units(self._disk_mb_free_units, disk_sizes, disk_free_hosts)
+
+        total_ram_mb_free = sum(free[0] for free in compute_hosts.values())
+        total_disk_mb_free = sum(free[1] for free in compute_hosts.values())
+        ram_mb_free_units = dict([(str(size), units) for size, units in
+                                  self._ram_mb_free_units.iteritems()])
+        disk_mb_free_units = dict([(str(size), units) for size, units in
+                                   self._disk_mb_free_units.iteritems()])
 
         capacities = {'ram_free': {'total_mb': total_ram_mb_free,
                                    'units_by_mb': ram_mb_free_units},
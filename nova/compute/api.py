@@ -424,6 +424,12 @@ class API(base.Base):
         return options_from_image
 
     def _apply_instance_name_template(self, context, instance, index):
+        updates = self._instance_name_template_updates(instance, index)
+        instance = self.db.instance_update(context,
+                instance['uuid'], updates)
+        return instance
+
+    def _instance_name_template_updates(self, instance, index):
         params = {
             'uuid': instance['uuid'],
             'name': instance['display_name'],
@@ -439,9 +445,7 @@ class API(base.Base):
         updates = {'display_name': new_name}
         if not instance.get('hostname'):
             updates['hostname'] = utils.sanitize_hostname(new_name)
-        instance = self.db.instance_update(context,
-                instance['uuid'], updates)
-        return instance
+        return updates
 
     def _validate_and_provision_instance(self, context, instance_type,
                                          image_href, kernel_id, ramdisk_id,
@@ -593,14 +597,18 @@ class API(base.Base):
                 check_policy(context, 'create:forced_host', {})
                 filter_properties['force_hosts'] = [forced_host]
 
-            for i in xrange(num_instances):
-                options = base_options.copy()
-                instance = self.create_db_entry_for_new_instance(
-                        context, instance_type, image, options,
-                        security_group, block_device_mapping, num_instances, i)
+            if num_instances > 1:
+                instances = self._create_db_entries_for_new_instances(
+                        context, instance_type, image, base_options,
+                        security_group, block_device_mapping, num_instances)
+            else:
+                instances = [self.create_db_entry_for_new_instance(
+                        context, instance_type, image, base_options.copy(),
+                        security_group, block_device_mapping, 1, 0)]
 
-                instances.append(instance)
-                instance_uuids.append(instance['uuid'])
+            # Every row exists now, so every one is cleaned up on failure
+            instance_uuids.extend(instance['uuid'] for instance in instances)
+            for instance in instances:
                 self._validate_bdm(context, instance)
                 # send a state update notification for the initial create to
                 # show it going from non-existent to BUILDING
@@ -900,6 +908,37 @@ class API(base.Base):
 
         return instance
 
+    def _create_db_entries_for_new_instances(self, context, instance_type,
+            image, base_options, security_group, block_device_mapping,
+            num_instances):
+        """Create the entries in the DB for num_instances new instances,
+        as create_db_entry_for_new_instance() does for one, but with all
+        the instances written together.
+        """
+        instances = []
+        for i in xrange(num_instances):
+            instance = self._populate_instance_for_create(
+                    base_options.copy(), image, security_group)
+            self._populate_instance_names(instance, num_instances)
+            self._populate_instance_shutdown_terminate(instance, image,
+                                                       block_device_mapping)
+            instance.update(self._instance_name_template_updates(instance,
+                                                                 i))
+            instances.append(instance)
+
+        self.security_group_api.ensure_default(context)
+        instances = self.db.instance_create_bulk(context, instances)
+
+        try:
+            for instance in instances:
+                self._populate_instance_for_bdm(context, instance,
+                        instance_type, image, block_device_mapping)
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                for instance in instances:
+                    self.db.instance_destroy(context, instance['uuid'])
+        return instances
+
     def _check_create_policies(self, context, availability_zone,
             requested_networks, block_device_mapping):
         """Check policies for create()."""
@@ -1300,6 +1339,29 @@ class API(base.Base):
         return self.db.instance_get_active_by_window_joined(context, begin,
                                                      end, project_id)
 
+    def get_active_usage_by_window(self, context, begin, end=None,
+                                   project_id=None, marker=None, limit=None):
+        """Get the usage fields of instances active over a window, a page
+        at a time.
+        """
+        return self.db.instance_get_active_by_window_usage(context, begin,
+                                                           end, project_id,
+                                                           marker, limit)
+
+    def get_usage_rollups_by_window(self, context, begin, end,
+                                    project_id=None):
+        """Get the rolled up usage of the days from begin to end.
+
+        Returns None unless every one of those days has been rolled up.
+        """
+        periods = compute_utils.usage_rollup_periods(begin, end)
+        rolled_up = self.db.instance_usage_rollup_get_periods(context, begin,
+                                                              end)
+        if not periods or set(rolled_up) != set(periods):
+            return None
+        return self.db.instance_usage_rollup_get_by_window(context, begin,
+                                                           end, project_id)
+
     #NOTE(bcwaldon): this doesn't really belong in this class
     def get_instance_type(self, context, instance_type_id):
         """Get an instance type by instance type id."""
@@ -30,6 +30,7 @@ terminating it.
 import base64
 import contextlib
 import functools
+import random
 import socket
 import sys
 import time
@@ -96,6 +97,12 @@ compute_opts = [
     cfg.BoolOpt('instance_usage_audit',
                default=False,
                help="Generate periodic compute.instance.exists notifications"),
+    cfg.IntOpt('instance_usage_audit_jitter',
+               default=0,
+               help="Maximum number of seconds to wait after an audit period "
+                    "ends before running the instance usage audit. Each "
+                    "host waits a random time up to this, so that they do "
+                    "not all audit at once"),
     cfg.IntOpt('live_migration_retry_count',
                default=30,
                help="Number of 1 second retries needed in live_migration"),
@@ -330,6 +337,7 @@ class ComputeManager(manager.SchedulerDependentManager):
         self._last_bw_usage_poll = 0
         self._last_vol_usage_poll = 0
         self._last_info_cache_heal = 0
+        self._usage_audit_delay = None
         self.compute_api = compute.API()
         self.compute_rpcapi = compute_rpcapi.ComputeAPI()
         self.scheduler_rpcapi = scheduler_rpcapi.SchedulerAPI()
@@ -371,6 +379,24 @@ class ComputeManager(manager.SchedulerDependentManager):
 
         return instance_ref
 
+    def _instance_update_lean(self, context, instance, **kwargs):
+        """Update an instance in the database using kwargs as value, for
+        callers that do not need the updated instance back.
+
+        The caller's copy of the instance, with kwargs applied, is used to
+        update the resource tracker instead.
+        """
+        self.conductor_api.instance_update_lean(context, instance['uuid'],
+                                                **kwargs)
+        if (instance['host'] == self.host and
+            instance['node'] in self.driver.get_available_nodes()):
+
+            instance_ref = dict(instance.iteritems())
+            instance_ref.update(kwargs)
+            instance_ref.pop('expected_task_state', None)
+            rt = self._get_resource_tracker(instance_ref.get('node'))
+            rt.update_usage(context, instance_ref)
+
     def _set_instance_error_state(self, context, instance_uuid):
         try:
             self._instance_update(context, instance_uuid,
@@ -988,11 +1014,11 @@ class ComputeManager(manager.SchedulerDependentManager):
         """Save the host and launched_on fields and log appropriately."""
         LOG.audit(_('Starting instance...'), context=context,
                   instance=instance)
-        self._instance_update(context, instance['uuid'],
-                              vm_state=vm_states.BUILDING,
-                              task_state=None,
-                              expected_task_state=(task_states.SCHEDULING,
-                                                   None))
+        self._instance_update_lean(context, instance,
+                                   vm_state=vm_states.BUILDING,
+                                   task_state=None,
+                                   expected_task_state=(
+                                       task_states.SCHEDULING, None))
 
     def _allocate_network(self, context, instance, requested_networks, macs,
                           security_groups):
@@ -1688,10 +1714,10 @@ class ComputeManager(manager.SchedulerDependentManager):
         expected_state = power_state.RUNNING
 
         if current_power_state != expected_state:
-            self._instance_update(context, instance['uuid'],
-                                  task_state=None,
-                                  expected_task_state=task_states.
-                                  UPDATING_PASSWORD)
+            self._instance_update_lean(context, instance,
+                                       task_state=None,
+                                       expected_task_state=task_states.
+                                       UPDATING_PASSWORD)
             _msg = _('Failed to set admin password. Instance %s is not'
                      ' running') % instance["uuid"]
             raise exception.InstancePasswordSetFailed(
@@ -1700,20 +1726,20 @@ class ComputeManager(manager.SchedulerDependentManager):
             try:
                 self.driver.set_admin_password(instance, new_pass)
                 LOG.audit(_("Root password set"), instance=instance)
-                self._instance_update(context,
-                                      instance['uuid'],
-                                      task_state=None,
-                                      expected_task_state=task_states.
-                                      UPDATING_PASSWORD)
+                self._instance_update_lean(context,
+                                           instance,
+                                           task_state=None,
+                                           expected_task_state=task_states.
+                                           UPDATING_PASSWORD)
             except NotImplementedError:
                 _msg = _('set_admin_password is not implemented '
                          'by this driver or guest instance.')
                 LOG.warn(_msg, instance=instance)
-                self._instance_update(context,
-                                      instance['uuid'],
-                                      task_state=None,
-                                      expected_task_state=task_states.
-                                      UPDATING_PASSWORD)
+                self._instance_update_lean(context,
+                                           instance,
+                                           task_state=None,
+                                           expected_task_state=task_states.
+                                           UPDATING_PASSWORD)
                 raise NotImplementedError(_msg)
             except exception.UnexpectedTaskStateError:
                 # interrupted by another (most likely delete) task
@@ -1799,13 +1825,13 @@ class ComputeManager(manager.SchedulerDependentManager):
                                rescue_image_meta, admin_password)
 
         current_power_state = self._get_power_state(context, instance)
-        self._instance_update(context,
-                              instance['uuid'],
-                              vm_state=vm_states.RESCUED,
-                              task_state=None,
-                              power_state=current_power_state,
-                              launched_at=timeutils.utcnow(),
-                              expected_task_state=task_states.RESCUING)
+        self._instance_update_lean(context,
+                                   instance,
+                                   vm_state=vm_states.RESCUED,
+                                   task_state=None,
+                                   power_state=current_power_state,
+                                   launched_at=timeutils.utcnow(),
+                                   expected_task_state=task_states.RESCUING)
 
     @exception.wrap_exception(notifier=notifier, publisher_id=publisher_id())
     @reverts_task_state
@@ -1823,12 +1849,12 @@ class ComputeManager(manager.SchedulerDependentManager):
                                  self._legacy_nw_info(network_info))
 
         current_power_state = self._get_power_state(context, instance)
-        self._instance_update(context,
-                              instance['uuid'],
-                              vm_state=vm_states.ACTIVE,
-                              task_state=None,
-                              expected_task_state=task_states.UNRESCUING,
-                              power_state=current_power_state)
+        self._instance_update_lean(context,
+                                   instance,
+                                   vm_state=vm_states.ACTIVE,
+                                   task_state=None,
+                                   expected_task_state=task_states.UNRESCUING,
+                                   power_state=current_power_state)
 
     @exception.wrap_exception(notifier=notifier, publisher_id=publisher_id())
     @reverts_task_state
@@ -2359,12 +2385,12 @@ class ComputeManager(manager.SchedulerDependentManager):
         self.driver.pause(instance)
 
         current_power_state = self._get_power_state(context, instance)
-        self._instance_update(context,
-                              instance['uuid'],
-                              power_state=current_power_state,
-                              vm_state=vm_states.PAUSED,
-                              task_state=None,
-                              expected_task_state=task_states.PAUSING)
+        self._instance_update_lean(context,
+                                   instance,
+                                   power_state=current_power_state,
+                                   vm_state=vm_states.PAUSED,
+                                   task_state=None,
+                                   expected_task_state=task_states.PAUSING)
 
     @exception.wrap_exception(notifier=notifier, publisher_id=publisher_id())
     @reverts_task_state
@@ -2377,12 +2403,12 @@ class ComputeManager(manager.SchedulerDependentManager):
         self.driver.unpause(instance)
 
         current_power_state = self._get_power_state(context, instance)
-        self._instance_update(context,
-                              instance['uuid'],
-                              power_state=current_power_state,
-                              vm_state=vm_states.ACTIVE,
-                              task_state=None,
-                              expected_task_state=task_states.UNPAUSING)
+        self._instance_update_lean(context,
+                                   instance,
+                                   power_state=current_power_state,
+                                   vm_state=vm_states.ACTIVE,
+                                   task_state=None,
+                                   expected_task_state=task_states.UNPAUSING)
 
     @exception.wrap_exception(notifier=notifier, publisher_id=publisher_id())
     def host_power_action(self, context, host=None, action=None):
@@ -3254,13 +3280,34 @@ class ComputeManager(manager.SchedulerDependentManager):
                             "Will retry later.")
                     LOG.error(msg % locals(), instance=instance)
 
+    def _usage_audit_delayed(self, end):
+        """Whether to hold off auditing the period which ended at `end`."""
+        jitter = CONF.instance_usage_audit_jitter
+        if jitter <= 0:
+            return False
+        if not self._usage_audit_delay or self._usage_audit_delay[0] != end:
+            self._usage_audit_delay = (end, random.uniform(0, jitter))
+        return not timeutils.is_older_than(end, self._usage_audit_delay[1])
+
+    def _usage_audit_bw_usages(self, context, instances, begin):
+        """Fetch the bandwidth usage of the instances in one query."""
+        bw_usages = dict((instance['uuid'], []) for instance in instances)
+        if bw_usages:
+            capi = self.conductor_api
+            for usage in capi.bw_usage_get_by_uuids(context, bw_usages.keys(),
+                                                    begin):
+                bw_usages[usage['uuid']].append(usage)
+        return bw_usages
+
     @manager.periodic_task
     def _instance_usage_audit(self, context):
         if CONF.instance_usage_audit:
+            begin, end = utils.last_completed_audit_period()
+            if self._usage_audit_delayed(end):
+                return
             if not compute_utils.has_audit_been_run(context,
                                                     self.conductor_api,
                                                     self.host):
-                begin, end = utils.last_completed_audit_period()
                 capi = self.conductor_api
                 instances = capi.instance_get_active_by_window_joined(
                     context, begin, end, host=self.host)
@@ -3279,11 +3326,24 @@ class ComputeManager(manager.SchedulerDependentManager):
                                               self.conductor_api,
                                               begin, end,
                                               self.host, num_instances)
+                # Instances without cached network info have to be looked up
+                # and their cache updated, which is left to the conductor.
+                cached = [i for i in instances
+                          if i.get('info_cache') and
+                          i['info_cache'].get('network_info') is not None]
+                bw_usages = self._usage_audit_bw_usages(context, cached,
+                                                        begin)
                 for instance in instances:
                     try:
-                        self.conductor_api.notify_usage_exists(
-                            context, instance,
-                            ignore_missing_network_data=False)
+                        if instance['uuid'] in bw_usages:
+                            compute_utils.notify_usage_exists(
+                                context, instance,
+                                ignore_missing_network_data=False,
+                                bw_usages=bw_usages[instance['uuid']])
+                        else:
+                            self.conductor_api.notify_usage_exists(
+                                context, instance,
+                                ignore_missing_network_data=False)
                         successes += 1
                     except Exception:
                         LOG.exception(_('Failed to generate usage '
@@ -3459,49 +3519,108 @@ class ComputeManager(manager.SchedulerDependentManager):
     def _sync_power_states(self, context):
         """Align power states between the database and the hypervisor.
 
-        To sync power state data we make a DB call to get the number of
-        virtual machines known by the hypervisor and if the number matches the
-        number of virtual machines known by the database, we proceed in a lazy
-        loop, one database record at a time, checking if the hypervisor has the
-        same power state as is in the database.
+        To sync power state data we make a DB call to get the instances on
+        the host and one driver call to get the power states of the virtual
+        machines known by the hypervisor, and compare the two. Only the
+        instances whose states do not agree are looked at more closely, and
+        they are re-read from the database together.
+
+        Drivers without get_power_states() are asked for the power state of
+        each instance in turn instead.
         """
         db_instances = self.conductor_api.instance_get_all_by_host(context,
                                                                    self.host)
 
-        num_vm_instances = self.driver.get_num_instances()
+        try:
+            vm_power_states = self.driver.get_power_states()
+            num_vm_instances = len(vm_power_states)
+        except NotImplementedError:
+            vm_power_states = None
+            num_vm_instances = self.driver.get_num_instances()
         num_db_instances = len(db_instances)
 
         if num_vm_instances != num_db_instances:
             LOG.warn(_("Found %(num_db_instances)s in the database and "
                        "%(num_vm_instances)s on the hypervisor.") % locals())
 
+        out_of_sync = []
         for db_instance in db_instances:
             if db_instance['task_state'] is not None:
                 LOG.info(_("During sync_power_state the instance has a "
                            "pending task. Skip."), instance=db_instance)
                 continue
             # No pending tasks. Now try to figure out the real vm_power_state.
-            try:
-                vm_instance = self.driver.get_info(db_instance)
-                vm_power_state = vm_instance['state']
-            except exception.InstanceNotFound:
-                vm_power_state = power_state.NOSTATE
-            # Note(maoy): the above get_info call might take a long time,
-            # for example, because of a broken libvirt driver.
+            if vm_power_states is not None:
+                vm_power_state = vm_power_states.get(db_instance['name'],
+                                                     power_state.NOSTATE)
+            else:
+                try:
+                    vm_instance = self.driver.get_info(db_instance)
+                    vm_power_state = vm_instance['state']
+                except exception.InstanceNotFound:
+                    vm_power_state = power_state.NOSTATE
+            if not self._power_state_in_sync(db_instance, vm_power_state):
+                out_of_sync.append((db_instance, vm_power_state))
+
+        if not out_of_sync:
+            return
+
+        # Note(maoy): the above driver calls might take a long time, for
+        # example, because of a broken libvirt driver, so re-read the
+        # instances to minimize (not eliminate) race conditions. Filtering
+        # on deleted would also drop the SOFT_DELETED ones, which the host
+        # listing includes, so only the context's read_deleted applies.
+        filters = {'uuid': [db_instance['uuid']
+                            for db_instance, vm_power_state in out_of_sync]}
+        current_instances = dict(
+            (instance['uuid'], instance) for instance in
+            self.conductor_api.instance_get_all_by_filters(context, filters))
+        for db_instance, vm_power_state in out_of_sync:
+            current_instance = current_instances.get(db_instance['uuid'])
+            if current_instance is None:
+                # Deleted since we listed the instances on the host
+                continue
             self._sync_instance_power_state(context,
                                             db_instance,
-                                            vm_power_state)
+                                            vm_power_state,
+                                            current_instance=current_instance)
+
+    @staticmethod
+    def _power_state_in_sync(db_instance, vm_power_state):
+        """Whether _sync_instance_power_state() would have nothing to do
+        for an instance with the given power state on the hypervisor.
+        """
+        if db_instance['power_state'] != vm_power_state:
+            return False
+        vm_state = db_instance['vm_state']
+        if vm_state == vm_states.ACTIVE:
+            return vm_power_state == power_state.RUNNING
+        elif vm_state == vm_states.STOPPED:
+            return vm_power_state in (power_state.NOSTATE,
+                                      power_state.SHUTDOWN,
+                                      power_state.CRASHED)
+        elif vm_state in (vm_states.SOFT_DELETED,
+                          vm_states.DELETED):
+            return vm_power_state in (power_state.NOSTATE,
+                                      power_state.SHUTDOWN)
+        return True
 
-    def _sync_instance_power_state(self, context, db_instance, vm_power_state):
+    def _sync_instance_power_state(self, context, db_instance, vm_power_state,
+                                   current_instance=None):
         """Align instance power state between the database and hypervisor.
 
         If the instance is not found on the hypervisor, but is in the database,
-        then a stop() API will be called on the instance."""
+        then a stop() API will be called on the instance.
+
+        current_instance is the instance as just read from the database, if
+        the caller has already done so."""
 
         # We re-query the DB to get the latest instance info to minimize
         # (not eliminate) race condition.
-        u = self.conductor_api.instance_get_by_uuid(context,
-                                                    db_instance['uuid'])
+        u = current_instance
+        if u is None:
+            u = self.conductor_api.instance_get_by_uuid(context,
+                                                        db_instance['uuid'])
         db_power_state = u["power_state"]
         vm_state = u['vm_state']
 
@@ -16,6 +16,7 @@
 
 """Compute-related Utilities and helpers."""
 
+import datetime
 import re
 import string
 import traceback
@@ -24,6 +25,7 @@ from oslo.config import cfg
 
 from nova import block_device
 from nova.compute import instance_types
+from nova import db
 from nova import exception
 from nova.network import model as network_model
 from nova import notifications
@@ -179,7 +181,8 @@ def _get_unused_letter(used_letters):
 
 def notify_usage_exists(context, instance_ref, current_period=False,
                         ignore_missing_network_data=True,
-                        system_metadata=None, extra_usage_info=None):
+                        system_metadata=None, extra_usage_info=None,
+                        bw_usages=None):
     """Generates 'exists' notification for an instance for usage auditing
     purposes.
 
@@ -194,12 +197,14 @@ def notify_usage_exists(context, instance_ref, current_period=False,
         potential custom modifications.
     :param extra_usage_info: Dictionary containing extra values to add or
         override in the notification if not None.
+    :param bw_usages: the instance's bandwidth usage records for the audit
+        period if already fetched, see notifications.bandwidth_usage().
     """
 
     audit_start, audit_end = notifications.audit_period_bounds(current_period)
 
     bw = notifications.bandwidth_usage(instance_ref, audit_start,
-            ignore_missing_network_data)
+            ignore_missing_network_data, bw_usages)
 
     if system_metadata is None:
         system_metadata = utils.metadata_to_dict(
@@ -278,6 +283,54 @@ def finish_instance_usage_audit(context, conductor, begin, end, host, errors,
                                 host, errors, message)
 
 
+USAGE_ROLLUP_PERIOD = datetime.timedelta(days=1)
+
+
+def usage_rollup_periods(begin, end):
+    """Return the beginnings of the rollup periods, whole UTC days, that
+    lie entirely between begin and end.
+    """
+    period = begin.replace(hour=0, minute=0, second=0, microsecond=0)
+    if period < begin:
+        period += USAGE_ROLLUP_PERIOD
+    periods = []
+    while period + USAGE_ROLLUP_PERIOD <= end:
+        periods.append(period)
+        period += USAGE_ROLLUP_PERIOD
+    return periods
+
+
+def roll_up_usage(context, period_beginning):
+    """Roll up the instance hours of one period from the instances."""
+    rollups = db.instance_usage_rollup_compute(
+        context, period_beginning, period_beginning + USAGE_ROLLUP_PERIOD)
+    db.instance_usage_rollup_replace(context, period_beginning, rollups)
+    return rollups
+
+
+def check_usage_rollup(context, period_beginning, tolerance=0.001):
+    """Compare the stored rollup of a period with rolling it up afresh.
+
+    :returns: a list of (project_id, instance_type_id, stored hours,
+              recomputed hours) for each tenant and flavor that differ
+              by more than tolerance hours.
+    """
+    period_ending = period_beginning + USAGE_ROLLUP_PERIOD
+    stored = dict(((r['project_id'], r['instance_type_id']), r['hours'])
+                  for r in db.instance_usage_rollup_get_by_window(
+                      context, period_beginning, period_ending))
+    actual = dict(((r['project_id'], r['instance_type_id']), r['hours'])
+                  for r in db.instance_usage_rollup_compute(
+                      context, period_beginning, period_ending))
+    mismatches = []
+    for key in sorted(set(stored) | set(actual)):
+        hours = stored.get(key, 0.0)
+        actual_hours = actual.get(key, 0.0)
+        if abs(hours - actual_hours) > tolerance:
+            mismatches.append(key + (hours, actual_hours))
+    return mismatches
+
+
 def usage_volume_info(vol_usage):
     def null_safe_str(s):
         return str(s) if s else ''
@@ -64,6 +64,13 @@ class LocalAPI(object):
         return self._manager.instance_update(context, instance_uuid,
                                              updates, 'compute')
 
+    def instance_update_lean(self, context, instance_uuid, **updates):
+        """Perform an instance update in the database, without getting
+        the updated instance back.
+        """
+        return self._manager.instance_update_lean(context, instance_uuid,
+                                                  updates, 'compute')
+
     def instance_get(self, context, instance_id):
         return self._manager.instance_get(context, instance_id)
 
@@ -164,6 +171,10 @@ class LocalAPI(object):
     def bw_usage_get(self, context, uuid, start_period, mac):
         return self._manager.bw_usage_update(context, uuid, mac, start_period)
 
+    def bw_usage_get_by_uuids(self, context, uuids, start_period):
+        return self._manager.bw_usage_get_by_uuids(context, uuids,
+                                                   start_period)
+
     def bw_usage_update(self, context, uuid, mac, start_period,
                         bw_in, bw_out, last_ctr_in, last_ctr_out,
                         last_refreshed=None):
@@ -279,6 +290,12 @@ class LocalAPI(object):
     def service_update(self, context, service, values):
         return self._manager.service_update(context, service, values)
 
+    def service_heartbeat(self, context, service, report_count):
+        # NOTE: there is nothing to batch against in the local case, so
+        # the heartbeat is written straight away.
+        return self._manager.service_update(context, service,
+                                            {'report_count': report_count})
+
     def task_log_get(self, context, task_name, begin, end, host, state=None):
         return self._manager.task_log_get(context, task_name, begin, end,
                                           host, state)
@@ -376,6 +393,13 @@ class API(object):
         return self.conductor_rpcapi.instance_update(context, instance_uuid,
                                                      updates, 'conductor')
 
+    def instance_update_lean(self, context, instance_uuid, **updates):
+        """Perform an instance update in the database, without getting
+        the updated instance back.
+        """
+        return self.conductor_rpcapi.instance_update_lean(context,
+                instance_uuid, updates, 'conductor')
+
     def instance_destroy(self, context, instance):
         return self.conductor_rpcapi.instance_destroy(context, instance)
 
@@ -486,6 +510,10 @@ class API(object):
         return self.conductor_rpcapi.bw_usage_update(context, uuid, mac,
                                                      start_period)
 
+    def bw_usage_get_by_uuids(self, context, uuids, start_period):
+        return self.conductor_rpcapi.bw_usage_get_by_uuids(context, uuids,
+                                                           start_period)
+
     def bw_usage_update(self, context, uuid, mac, start_period,
                         bw_in, bw_out, last_ctr_in, last_ctr_out,
                         last_refreshed=None):
@@ -608,6 +636,18 @@ class API(object):
     def service_update(self, context, service, values):
         return self.conductor_rpcapi.service_update(context, service, values)
 
+    def service_heartbeat(self, context, service, report_count):
+        """Send a heartbeat, which the conductor writes out in a batch.
+
+        Unlike service_update() this does not wait for the database, so
+        the caller's copy of the service is updated and returned instead.
+        """
+        self.conductor_rpcapi.service_heartbeat(context, service['id'],
+                                                report_count)
+        service = dict(service)
+        service['report_count'] = report_count
+        return service
+
     def task_log_get(self, context, task_name, begin, end, host, state=None):
         return self.conductor_rpcapi.task_log_get(context, task_name, begin,
                                                   end, host, state)
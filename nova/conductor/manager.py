@@ -14,19 +14,47 @@
 
 """Handles database requests from other nova services."""
 
+from oslo.config import cfg
+
 from nova.api.ec2 import ec2utils
 from nova.compute import api as compute_api
 from nova.compute import utils as compute_utils
+from nova import context as nova_context
 from nova import exception
 from nova import manager
 from nova import network
 from nova.network.security_group import openstack_driver
 from nova import notifications
-from nova.openstack.common import jsonutils
 from nova.openstack.common import log as logging
 from nova.openstack.common.rpc import common as rpc_common
 from nova.openstack.common import timeutils
 from nova import quota
+from nova import utils
+
+heartbeat_opts = [
+    cfg.IntOpt('heartbeat_flush_interval',
+               default=3,
+               help='Seconds for which service heartbeats are collected '
+                    'before being written to the database together '
+                    '(0 writes each heartbeat as it arrives)'),
+]
+
+usage_rollup_opts = [
+    cfg.IntOpt('usage_rollup_interval',
+               default=3600,
+               help='Seconds between checks for days whose instance usage '
+                    'has not been rolled up yet'),
+    cfg.IntOpt('usage_rollup_days',
+               default=7,
+               help='Number of past days to roll instance usage up for '
+                    '(0 disables usage rollups)'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(heartbeat_opts, group='conductor')
+CONF.register_opts(usage_rollup_opts, group='conductor')
+CONF.import_opt('notify_on_any_change', 'nova.notifications')
+CONF.import_opt('notify_on_state_change', 'nova.notifications')
 
 LOG = logging.getLogger(__name__)
 
@@ -49,7 +77,7 @@ datetime_fields = ['launched_at', 'terminated_at']
 class ConductorManager(manager.SchedulerDependentManager):
     """Mission: TBD."""
 
-    RPC_API_VERSION = '1.43'
+    RPC_API_VERSION = '1.46'
 
     def __init__(self, *args, **kwargs):
         super(ConductorManager, self).__init__(service_name='conductor',
@@ -59,6 +87,30 @@ class ConductorManager(manager.SchedulerDependentManager):
         self._network_api = None
         self._compute_api = None
         self.quotas = quota.QUOTAS
+        # Heartbeats waiting for the next flush, by service id
+        self._pending_heartbeats = {}
+        self._heartbeat_timer = None
+
+    def post_start_hook(self):
+        """Start writing the collected service heartbeats.
+
+        They are written from a timer of their own, not a periodic task,
+        so a long usage rollup or a slow periodic task cannot hold them up
+        until the services show as down.
+        """
+        interval = CONF.conductor.heartbeat_flush_interval
+        if interval > 0:
+            self._heartbeat_timer = utils.FixedIntervalLoopingCall(
+                    self._flush_heartbeats, nova_context.get_admin_context())
+            self._heartbeat_timer.start(interval=interval,
+                                        initial_delay=interval)
+
+    def cleanup_host(self):
+        """Write the service heartbeats still waiting."""
+        if self._heartbeat_timer is not None:
+            self._heartbeat_timer.stop()
+            self._heartbeat_timer = None
+        self._flush_heartbeats(nova_context.get_admin_context())
 
     @property
     def network_api(self):
@@ -76,7 +128,7 @@ class ConductorManager(manager.SchedulerDependentManager):
         return self._compute_api
 
     def ping(self, context, arg):
-        return jsonutils.to_primitive({'service': 'conductor', 'arg': arg})
+        return utils.to_primitive({'service': 'conductor', 'arg': arg})
 
     @rpc_common.client_exceptions(KeyError, ValueError,
                                   exception.InvalidUUID,
@@ -84,6 +136,26 @@ class ConductorManager(manager.SchedulerDependentManager):
                                   exception.UnexpectedTaskStateError)
     def instance_update(self, context, instance_uuid,
                         updates, service=None):
+        self._check_instance_updates(instance_uuid, updates)
+        old_ref, instance_ref = self.db.instance_update_and_get_original(
+            context, instance_uuid, updates)
+        notifications.send_update(context, old_ref, instance_ref, service)
+        return utils.to_primitive(instance_ref)
+
+    @rpc_common.client_exceptions(KeyError, ValueError,
+                                  exception.InvalidUUID,
+                                  exception.InstanceNotFound,
+                                  exception.UnexpectedTaskStateError)
+    def instance_update_lean(self, context, instance_uuid,
+                             updates, service=None):
+        if CONF.notify_on_any_change or CONF.notify_on_state_change:
+            # The update notification needs the instance before and after
+            self.instance_update(context, instance_uuid, updates, service)
+            return
+        self._check_instance_updates(instance_uuid, updates)
+        self.db.instance_update_lean(context, instance_uuid, updates)
+
+    def _check_instance_updates(self, instance_uuid, updates):
         for key, value in updates.iteritems():
             if key not in allowed_updates:
                 LOG.error(_("Instance update attempted for "
@@ -92,23 +164,18 @@ class ConductorManager(manager.SchedulerDependentManager):
             if key in datetime_fields and isinstance(value, basestring):
                 updates[key] = timeutils.parse_strtime(value)
 
-        old_ref, instance_ref = self.db.instance_update_and_get_original(
-            context, instance_uuid, updates)
-        notifications.send_update(context, old_ref, instance_ref, service)
-        return jsonutils.to_primitive(instance_ref)
-
     @rpc_common.client_exceptions(exception.InstanceNotFound)
     def instance_get(self, context, instance_id):
-        return jsonutils.to_primitive(
+        return utils.to_primitive(
             self.db.instance_get(context, instance_id))
 
     @rpc_common.client_exceptions(exception.InstanceNotFound)
     def instance_get_by_uuid(self, context, instance_uuid):
-        return jsonutils.to_primitive(
+        return utils.to_primitive(
             self.db.instance_get_by_uuid(context, instance_uuid))
 
     def instance_get_all(self, context):
-        return jsonutils.to_primitive(self.db.instance_get_all(context))
+        return utils.to_primitive(self.db.instance_get_all(context))
 
     def instance_get_all_by_host(self, context, host, node=None):
         if node is not None:
@@ -116,47 +183,47 @@ class ConductorManager(manager.SchedulerDependentManager):
                 context.elevated(), host, node)
         else:
             result = self.db.instance_get_all_by_host(context.elevated(), host)
-        return jsonutils.to_primitive(result)
+        return utils.to_primitive(result)
 
     @rpc_common.client_exceptions(exception.MigrationNotFound)
     def migration_get(self, context, migration_id):
         migration_ref = self.db.migration_get(context.elevated(),
                                               migration_id)
-        return jsonutils.to_primitive(migration_ref)
+        return utils.to_primitive(migration_ref)
 
     def migration_get_unconfirmed_by_dest_compute(self, context,
                                                   confirm_window,
                                                   dest_compute):
         migrations = self.db.migration_get_unconfirmed_by_dest_compute(
             context, confirm_window, dest_compute)
-        return jsonutils.to_primitive(migrations)
+        return utils.to_primitive(migrations)
 
     def migration_get_in_progress_by_host_and_node(self, context,
                                                    host, node):
         migrations = self.db.migration_get_in_progress_by_host_and_node(
             context, host, node)
-        return jsonutils.to_primitive(migrations)
+        return utils.to_primitive(migrations)
 
     def migration_create(self, context, instance, values):
         values.update({'instance_uuid': instance['uuid'],
                        'source_compute': instance['host'],
                        'source_node': instance['node']})
         migration_ref = self.db.migration_create(context.elevated(), values)
-        return jsonutils.to_primitive(migration_ref)
+        return utils.to_primitive(migration_ref)
 
     @rpc_common.client_exceptions(exception.MigrationNotFound)
     def migration_update(self, context, migration, status):
         migration_ref = self.db.migration_update(context.elevated(),
                                                  migration['id'],
                                                  {'status': status})
-        return jsonutils.to_primitive(migration_ref)
+        return utils.to_primitive(migration_ref)
 
     @rpc_common.client_exceptions(exception.AggregateHostExists)
     def aggregate_host_add(self, context, aggregate, host):
         host_ref = self.db.aggregate_host_add(context.elevated(),
                 aggregate['id'], host)
 
-        return jsonutils.to_primitive(host_ref)
+        return utils.to_primitive(host_ref)
 
     @rpc_common.client_exceptions(exception.AggregateHostNotFound)
     def aggregate_host_delete(self, context, aggregate, host):
@@ -166,19 +233,19 @@ class ConductorManager(manager.SchedulerDependentManager):
     @rpc_common.client_exceptions(exception.AggregateNotFound)
     def aggregate_get(self, context, aggregate_id):
         aggregate = self.db.aggregate_get(context.elevated(), aggregate_id)
-        return jsonutils.to_primitive(aggregate)
+        return utils.to_primitive(aggregate)
 
     def aggregate_get_by_host(self, context, host, key=None):
         aggregates = self.db.aggregate_get_by_host(context.elevated(),
                                                    host, key)
-        return jsonutils.to_primitive(aggregates)
+        return utils.to_primitive(aggregates)
 
     def aggregate_metadata_add(self, context, aggregate, metadata,
                                set_delete=False):
         new_metadata = self.db.aggregate_metadata_add(context.elevated(),
                                                       aggregate['id'],
                                                       metadata, set_delete)
-        return jsonutils.to_primitive(new_metadata)
+        return utils.to_primitive(new_metadata)
 
     @rpc_common.client_exceptions(exception.AggregateMetadataNotFound)
     def aggregate_metadata_delete(self, context, aggregate, key):
@@ -188,7 +255,7 @@ class ConductorManager(manager.SchedulerDependentManager):
     def aggregate_metadata_get_by_host(self, context, host,
                                        key='availability_zone'):
         result = self.db.aggregate_metadata_get_by_host(context, host, key)
-        return jsonutils.to_primitive(result)
+        return utils.to_primitive(result)
 
     def bw_usage_update(self, context, uuid, mac, start_period,
                         bw_in=None, bw_out=None,
@@ -199,7 +266,11 @@ class ConductorManager(manager.SchedulerDependentManager):
                                     bw_in, bw_out, last_ctr_in, last_ctr_out,
                                     last_refreshed)
         usage = self.db.bw_usage_get(context, uuid, start_period, mac)
-        return jsonutils.to_primitive(usage)
+        return utils.to_primitive(usage)
+
+    def bw_usage_get_by_uuids(self, context, uuids, start_period):
+        usages = self.db.bw_usage_get_by_uuids(context, uuids, start_period)
+        return utils.to_primitive(usages)
 
     def get_backdoor_port(self, context):
         return self.backdoor_port
@@ -207,21 +278,21 @@ class ConductorManager(manager.SchedulerDependentManager):
     def security_group_get_by_instance(self, context, instance):
         group = self.db.security_group_get_by_instance(context,
                                                        instance['id'])
-        return jsonutils.to_primitive(group)
+        return utils.to_primitive(group)
 
     def security_group_rule_get_by_security_group(self, context, secgroup):
         rules = self.db.security_group_rule_get_by_security_group(
             context, secgroup['id'])
-        return jsonutils.to_primitive(rules, max_depth=4)
+        return utils.to_primitive(rules, max_depth=4)
 
     def provider_fw_rule_get_all(self, context):
         rules = self.db.provider_fw_rule_get_all(context)
-        return jsonutils.to_primitive(rules)
+        return utils.to_primitive(rules)
 
     def agent_build_get_by_triple(self, context, hypervisor, os, architecture):
         info = self.db.agent_build_get_by_triple(context, hypervisor, os,
                                                  architecture)
-        return jsonutils.to_primitive(info)
+        return utils.to_primitive(info)
 
     def block_device_mapping_update_or_create(self, context, values,
                                               create=None):
@@ -235,7 +306,7 @@ class ConductorManager(manager.SchedulerDependentManager):
     def block_device_mapping_get_all_by_instance(self, context, instance):
         bdms = self.db.block_device_mapping_get_all_by_instance(
             context, instance['uuid'])
-        return jsonutils.to_primitive(bdms)
+        return utils.to_primitive(bdms)
 
     def block_device_mapping_destroy(self, context, bdms=None,
                                      instance=None, volume_id=None,
@@ -258,24 +329,24 @@ class ConductorManager(manager.SchedulerDependentManager):
                                     sort_dir):
         result = self.db.instance_get_all_by_filters(context, filters,
                                                      sort_key, sort_dir)
-        return jsonutils.to_primitive(result)
+        return utils.to_primitive(result)
 
     def instance_get_all_hung_in_rebooting(self, context, timeout):
         result = self.db.instance_get_all_hung_in_rebooting(context, timeout)
-        return jsonutils.to_primitive(result)
+        return utils.to_primitive(result)
 
     def instance_get_active_by_window(self, context, begin, end=None,
                                       project_id=None, host=None):
         # Unused, but cannot remove until major RPC version bump
         result = self.db.instance_get_active_by_window(context, begin, end,
                                                        project_id, host)
-        return jsonutils.to_primitive(result)
+        return utils.to_primitive(result)
 
     def instance_get_active_by_window_joined(self, context, begin, end=None,
                                              project_id=None, host=None):
         result = self.db.instance_get_active_by_window_joined(
             context, begin, end, project_id, host)
-        return jsonutils.to_primitive(result)
+        return utils.to_primitive(result)
 
     def instance_destroy(self, context, instance):
         self.db.instance_destroy(context, instance['uuid'])
@@ -289,15 +360,15 @@ class ConductorManager(manager.SchedulerDependentManager):
 
     def instance_type_get(self, context, instance_type_id):
         result = self.db.instance_type_get(context, instance_type_id)
-        return jsonutils.to_primitive(result)
+        return utils.to_primitive(result)
 
     def instance_fault_create(self, context, values):
         result = self.db.instance_fault_create(context, values)
-        return jsonutils.to_primitive(result)
+        return utils.to_primitive(result)
 
     def vol_get_usage_by_time(self, context, start_time):
         result = self.db.vol_get_usage_by_time(context, start_time)
-        return jsonutils.to_primitive(result)
+        return utils.to_primitive(result)
 
     def vol_usage_update(self, context, vol_id, rd_req, rd_bytes, wr_req,
                          wr_bytes, instance, last_refreshed=None,
@@ -325,19 +396,19 @@ class ConductorManager(manager.SchedulerDependentManager):
         elif host:
             result = self.db.service_get_all_by_host(context, host)
 
-        return jsonutils.to_primitive(result)
+        return utils.to_primitive(result)
 
     def action_event_start(self, context, values):
         evt = self.db.action_event_start(context, values)
-        return jsonutils.to_primitive(evt)
+        return utils.to_primitive(evt)
 
     def action_event_finish(self, context, values):
         evt = self.db.action_event_finish(context, values)
-        return jsonutils.to_primitive(evt)
+        return utils.to_primitive(evt)
 
     def service_create(self, context, values):
         svc = self.db.service_create(context, values)
-        return jsonutils.to_primitive(svc)
+        return utils.to_primitive(svc)
 
     @rpc_common.client_exceptions(exception.ServiceNotFound)
     def service_destroy(self, context, service_id):
@@ -345,35 +416,88 @@ class ConductorManager(manager.SchedulerDependentManager):
 
     def compute_node_create(self, context, values):
         result = self.db.compute_node_create(context, values)
-        return jsonutils.to_primitive(result)
+        return utils.to_primitive(result)
 
     def compute_node_update(self, context, node, values, prune_stats=False):
         result = self.db.compute_node_update(context, node['id'], values,
                                              prune_stats)
-        return jsonutils.to_primitive(result)
+        return utils.to_primitive(result)
 
     @rpc_common.client_exceptions(exception.ServiceNotFound)
     def service_update(self, context, service, values):
         svc = self.db.service_update(context, service['id'], values)
-        return jsonutils.to_primitive(svc)
+        return utils.to_primitive(svc)
+
+    def service_heartbeat(self, context, service_id, report_count):
+        if self._heartbeat_timer is None:
+            # Batching is off, or nothing would flush the batch, as when
+            # the conductor runs inside another service
+            self.db.service_heartbeat_update(context,
+                                             {service_id: report_count})
+            return
+        pending = self._pending_heartbeats
+        pending[service_id] = max(report_count, pending.get(service_id, 0))
+
+    def _flush_heartbeats(self, context):
+        if not self._pending_heartbeats:
+            return
+        heartbeats = self._pending_heartbeats
+        self._pending_heartbeats = {}
+        try:
+            self.db.service_heartbeat_update(context, heartbeats)
+        except Exception:
+            # The services cast their heartbeats and cannot see this, so
+            # they will show as down if it goes on for service_down_time.
+            LOG.exception(_("Failed to write the heartbeats of services "
+                            "%s, will retry"), sorted(heartbeats))
+            # Put them back for the next flush, unless newer ones have
+            # arrived in the meantime.
+            for service_id, report_count in heartbeats.iteritems():
+                self._pending_heartbeats.setdefault(service_id,
+                                                    report_count)
+
+    @manager.periodic_task(spacing=CONF.conductor.usage_rollup_interval)
+    def _roll_up_usage(self, context):
+        if CONF.conductor.usage_rollup_days <= 0:
+            return
+        end = timeutils.utcnow().replace(hour=0, minute=0, second=0,
+                                         microsecond=0)
+        begin = end - (CONF.conductor.usage_rollup_days *
+                       compute_utils.USAGE_ROLLUP_PERIOD)
+        # Once rolled up, a day is kept in step with the instances by the
+        # updates to them that change its usage, see instance_update().
+        done = set(self.db.instance_usage_rollup_get_periods(context, begin,
+                                                             end))
+        for period in compute_utils.usage_rollup_periods(begin, end):
+            if period in done:
+                continue
+            LOG.info(_("Rolling up instance usage for %s") % period)
+            try:
+                compute_utils.roll_up_usage(context, period)
+            except exception.InstanceUsageRollupExists:
+                LOG.info(_("Instance usage for %s was rolled up by another "
+                           "conductor") % period)
+            except Exception:
+                LOG.exception(_("Failed to roll up instance usage for %s")
+                              % period)
 
     def task_log_get(self, context, task_name, begin, end, host, state=None):
         result = self.db.task_log_get(context, task_name, begin, end, host,
                                       state)
-        return jsonutils.to_primitive(result)
+        return utils.to_primitive(result)
 
     def task_log_begin_task(self, context, task_name, begin, end, host,
                             task_items=None, message=None):
         result = self.db.task_log_begin_task(context.elevated(), task_name,
                                              begin, end, host, task_items,
                                              message)
-        return jsonutils.to_primitive(result)
+        return utils.to_primitive(result)
 
     def task_log_end_task(self, context, task_name, begin, end, host,
                           errors, message=None):
         result = self.db.task_log_end_task(context.elevated(), task_name,
                                            begin, end, host, errors, message)
-        return jsonutils.to_primitive(result)
+        return utils.to_primitive(result)
 
     def notify_usage_exists(self, context, instance, current_period=False,
                             ignore_missing_network_data=True,
@@ -16,8 +16,8 @@
 
 from oslo.config import cfg
 
-from nova.openstack.common import jsonutils
 import nova.openstack.common.rpc.proxy
+from nova import utils
 
 CONF = cfg.CONF
 
@@ -81,6 +81,9 @@ class ConductorAPI(nova.openstack.common.rpc.proxy.RpcProxy):
                  quota_rollback
     1.42 - Added get_ec2_ids, aggregate_metadata_get_by_host
     1.43 - Added compute_stop
+    1.44 - Added service_heartbeat
+    1.45 - Added bw_usage_get_by_uuids
+    1.46 - Added instance_update_lean
     """
 
     BASE_RPC_API_VERSION = '1.0'
@@ -91,13 +94,13 @@ class ConductorAPI(nova.openstack.common.rpc.proxy.RpcProxy):
             default_version=self.BASE_RPC_API_VERSION)
 
     def ping(self, context, arg, timeout=None):
-        arg_p = jsonutils.to_primitive(arg)
+        arg_p = utils.to_primitive(arg)
         msg = self.make_msg('ping', arg=arg_p)
         return self.call(context, msg, version='1.22', timeout=timeout)
 
     def instance_update(self, context, instance_uuid, updates,
                         service=None):
-        updates_p = jsonutils.to_primitive(updates)
+        updates_p = utils.to_primitive(updates)
         return self.call(context,
                          self.make_msg('instance_update',
                                        instance_uuid=instance_uuid,
@@ -105,6 +108,16 @@ class ConductorAPI(nova.openstack.common.rpc.proxy.RpcProxy):
                                        service=service),
                          version='1.38')
 
+    def instance_update_lean(self, context, instance_uuid, updates,
+                             service=None):
+        updates_p = utils.to_primitive(updates)
+        return self.call(context,
+                         self.make_msg('instance_update_lean',
+                                       instance_uuid=instance_uuid,
+                                       updates=updates_p,
+                                       service=service),
+                         version='1.46')
+
     def instance_get(self, context, instance_id):
         msg = self.make_msg('instance_get',
                             instance_id=instance_id)
@@ -134,25 +147,25 @@ class ConductorAPI(nova.openstack.common.rpc.proxy.RpcProxy):
         return self.call(context, msg, version='1.31')
 
     def migration_create(self, context, instance, values):
-        instance_p = jsonutils.to_primitive(instance)
+        instance_p = utils.to_primitive(instance)
         msg = self.make_msg('migration_create', instance=instance_p,
                             values=values)
         return self.call(context, msg, version='1.30')
 
     def migration_update(self, context, migration, status):
-        migration_p = jsonutils.to_primitive(migration)
+        migration_p = utils.to_primitive(migration)
         msg = self.make_msg('migration_update', migration=migration_p,
                             status=status)
         return self.call(context, msg, version='1.1')
 
     def aggregate_host_add(self, context, aggregate, host):
-        aggregate_p = jsonutils.to_primitive(aggregate)
+        aggregate_p = utils.to_primitive(aggregate)
         msg = self.make_msg('aggregate_host_add', aggregate=aggregate_p,
                             host=host)
         return self.call(context, msg, version='1.3')
 
     def aggregate_host_delete(self, context, aggregate, host):
-        aggregate_p = jsonutils.to_primitive(aggregate)
+        aggregate_p = utils.to_primitive(aggregate)
         msg = self.make_msg('aggregate_host_delete', aggregate=aggregate_p,
                             host=host)
         return self.call(context, msg, version='1.3')
@@ -167,14 +180,14 @@ class ConductorAPI(nova.openstack.common.rpc.proxy.RpcProxy):
 
     def aggregate_metadata_add(self, context, aggregate, metadata,
                                set_delete=False):
-        aggregate_p = jsonutils.to_primitive(aggregate)
+        aggregate_p = utils.to_primitive(aggregate)
         msg = self.make_msg('aggregate_metadata_add', aggregate=aggregate_p,
                             metadata=metadata,
                             set_delete=set_delete)
         return self.call(context, msg, version='1.7')
 
     def aggregate_metadata_delete(self, context, aggregate, key):
-        aggregate_p = jsonutils.to_primitive(aggregate)
+        aggregate_p = utils.to_primitive(aggregate)
         msg = self.make_msg('aggregate_metadata_delete', aggregate=aggregate_p,
                             key=key)
         return self.call(context, msg, version='1.7')
@@ -195,18 +208,23 @@ class ConductorAPI(nova.openstack.common.rpc.proxy.RpcProxy):
                             last_refreshed=last_refreshed)
         return self.call(context, msg, version='1.5')
 
+    def bw_usage_get_by_uuids(self, context, uuids, start_period):
+        msg = self.make_msg('bw_usage_get_by_uuids', uuids=uuids,
+                            start_period=start_period)
+        return self.call(context, msg, version='1.45')
+
     def get_backdoor_port(self, context):
         msg = self.make_msg('get_backdoor_port')
         return self.call(context, msg, version='1.6')
 
     def security_group_get_by_instance(self, context, instance):
-        instance_p = jsonutils.to_primitive(instance)
+        instance_p = utils.to_primitive(instance)
         msg = self.make_msg('security_group_get_by_instance',
                             instance=instance_p)
         return self.call(context, msg, version='1.8')
 
     def security_group_rule_get_by_security_group(self, context, secgroup):
-        secgroup_p = jsonutils.to_primitive(secgroup)
+        secgroup_p = utils.to_primitive(secgroup)
         msg = self.make_msg('security_group_rule_get_by_security_group',
                             secgroup=secgroup_p)
         return self.call(context, msg, version='1.8')
@@ -228,7 +246,7 @@ class ConductorAPI(nova.openstack.common.rpc.proxy.RpcProxy):
         return self.call(context, msg, version='1.12')
 
     def block_device_mapping_get_all_by_instance(self, context, instance):
-        instance_p = jsonutils.to_primitive(instance)
+        instance_p = utils.to_primitive(instance)
         msg = self.make_msg('block_device_mapping_get_all_by_instance',
                             instance=instance_p)
         return self.call(context, msg, version='1.13')
@@ -236,8 +254,8 @@ class ConductorAPI(nova.openstack.common.rpc.proxy.RpcProxy):
     def block_device_mapping_destroy(self, context, bdms=None,
                                      instance=None, volume_id=None,
                                      device_name=None):
-        bdms_p = jsonutils.to_primitive(bdms)
-        instance_p = jsonutils.to_primitive(instance)
+        bdms_p = utils.to_primitive(bdms)
+        instance_p = utils.to_primitive(instance)
         msg = self.make_msg('block_device_mapping_destroy',
                             bdms=bdms_p,
                             instance=instance_p, volume_id=volume_id,
@@ -264,12 +282,12 @@ class ConductorAPI(nova.openstack.common.rpc.proxy.RpcProxy):
         return self.call(context, msg, version='1.35')
 
     def instance_destroy(self, context, instance):
-        instance_p = jsonutils.to_primitive(instance)
+        instance_p = utils.to_primitive(instance)
         msg = self.make_msg('instance_destroy', instance=instance_p)
         self.call(context, msg, version='1.16')
 
     def instance_info_cache_delete(self, context, instance):
-        instance_p = jsonutils.to_primitive(instance)
+        instance_p = utils.to_primitive(instance)
         msg = self.make_msg('instance_info_cache_delete', instance=instance_p)
         self.call(context, msg, version='1.17')
 
@@ -279,14 +297,14 @@ class ConductorAPI(nova.openstack.common.rpc.proxy.RpcProxy):
         return self.call(context, msg, version='1.18')
 
     def vol_get_usage_by_time(self, context, start_time):
-        start_time_p = jsonutils.to_primitive(start_time)
+        start_time_p = utils.to_primitive(start_time)
         msg = self.make_msg('vol_get_usage_by_time', start_time=start_time_p)
         return self.call(context, msg, version='1.19')
 
     def vol_usage_update(self, context, vol_id, rd_req, rd_bytes, wr_req,
                          wr_bytes, instance, last_refreshed=None,
                          update_totals=False):
-        instance_p = jsonutils.to_primitive(instance)
+        instance_p = utils.to_primitive(instance)
         msg = self.make_msg('vol_usage_update', vol_id=vol_id, rd_req=rd_req,
                             rd_bytes=rd_bytes, wr_req=wr_req,
                             wr_bytes=wr_bytes,
@@ -312,17 +330,17 @@ class ConductorAPI(nova.openstack.common.rpc.proxy.RpcProxy):
         return self.call(context, msg, version='1.36')
 
     def action_event_start(self, context, values):
-        values_p = jsonutils.to_primitive(values)
+        values_p = utils.to_primitive(values)
         msg = self.make_msg('action_event_start', values=values_p)
         return self.call(context, msg, version='1.25')
 
     def action_event_finish(self, context, values):
-        values_p = jsonutils.to_primitive(values)
+        values_p = utils.to_primitive(values)
         msg = self.make_msg('action_event_finish', values=values_p)
         return self.call(context, msg, version='1.25')
 
     def instance_info_cache_update(self, context, instance, values):
-        instance_p = jsonutils.to_primitive(instance)
+        instance_p = utils.to_primitive(instance)
         msg = self.make_msg('instance_info_cache_update',
                             instance=instance_p,
                             values=values)
@@ -341,13 +359,13 @@ class ConductorAPI(nova.openstack.common.rpc.proxy.RpcProxy):
         return self.call(context, msg, version='1.33')
 
     def compute_node_update(self, context, node, values, prune_stats=False):
-        node_p = jsonutils.to_primitive(node)
+        node_p = utils.to_primitive(node)
         msg = self.make_msg('compute_node_update', node=node_p, values=values,
                             prune_stats=prune_stats)
         return self.call(context, msg, version='1.33')
 
     def service_update(self, context, service, values):
-        service_p = jsonutils.to_primitive(service)
+        service_p = utils.to_primitive(service)
         msg = self.make_msg('service_update', service=service_p, values=values)
         return self.call(context, msg, version='1.34')
 
@@ -373,9 +391,9 @@ class ConductorAPI(nova.openstack.common.rpc.proxy.RpcProxy):
     def notify_usage_exists(self, context, instance, current_period=False,
                             ignore_missing_network_data=True,
                             system_metadata=None, extra_usage_info=None):
-        instance_p = jsonutils.to_primitive(instance)
-        system_metadata_p = jsonutils.to_primitive(system_metadata)
-        extra_usage_info_p = jsonutils.to_primitive(extra_usage_info)
+        instance_p = utils.to_primitive(instance)
+        system_metadata_p = utils.to_primitive(system_metadata)
+        extra_usage_info_p = utils.to_primitive(extra_usage_info)
         msg = self.make_msg('notify_usage_exists', instance=instance_p,
                   current_period=current_period,
                   ignore_missing_network_data=ignore_missing_network_data,
@@ -384,7 +402,7 @@ class ConductorAPI(nova.openstack.common.rpc.proxy.RpcProxy):
         return self.call(context, msg, version='1.39')
 
     def security_groups_trigger_handler(self, context, event, args):
-        args_p = jsonutils.to_primitive(args)
+        args_p = utils.to_primitive(args)
         msg = self.make_msg('security_groups_trigger_handler', event=event,
                             args=args_p)
         return self.call(context, msg, version='1.40')
@@ -395,36 +413,41 @@ class ConductorAPI(nova.openstack.common.rpc.proxy.RpcProxy):
         return self.call(context, msg, version='1.40')
 
     def network_migrate_instance_start(self, context, instance, migration):
-        instance_p = jsonutils.to_primitive(instance)
-        migration_p = jsonutils.to_primitive(migration)
+        instance_p = utils.to_primitive(instance)
+        migration_p = utils.to_primitive(migration)
         msg = self.make_msg('network_migrate_instance_start',
                             instance=instance_p, migration=migration_p)
         return self.call(context, msg, version='1.41')
 
     def network_migrate_instance_finish(self, context, instance, migration):
-        instance_p = jsonutils.to_primitive(instance)
-        migration_p = jsonutils.to_primitive(migration)
+        instance_p = utils.to_primitive(instance)
+        migration_p = utils.to_primitive(migration)
         msg = self.make_msg('network_migrate_instance_finish',
                             instance=instance_p, migration=migration_p)
         return self.call(context, msg, version='1.41')
 
     def quota_commit(self, context, reservations):
-        reservations_p = jsonutils.to_primitive(reservations)
+        reservations_p = utils.to_primitive(reservations)
         msg = self.make_msg('quota_commit', reservations=reservations_p)
         return self.call(context, msg, version='1.41')
 
     def quota_rollback(self, context, reservations):
-        reservations_p = jsonutils.to_primitive(reservations)
+        reservations_p = utils.to_primitive(reservations)
         msg = self.make_msg('quota_rollback', reservations=reservations_p)
         return self.call(context, msg, version='1.41')
 
     def get_ec2_ids(self, context, instance):
-        instance_p = jsonutils.to_primitive(instance)
+        instance_p = utils.to_primitive(instance)
         msg = self.make_msg('get_ec2_ids', instance=instance_p)
         return self.call(context, msg, version='1.42')
 
     def compute_stop(self, context, instance, do_cast=True):
-        instance_p = jsonutils.to_primitive(instance)
+        instance_p = utils.to_primitive(instance)
         msg = self.make_msg('compute_stop', instance=instance_p,
                             do_cast=do_cast)
         return self.call(context, msg, version='1.43')
+
+    def service_heartbeat(self, context, service_id, report_count):
+        msg = self.make_msg('service_heartbeat', service_id=service_id,
+                            report_count=report_count)
+        self.cast(context, msg, version='1.44')
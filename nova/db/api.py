@@ -46,6 +46,7 @@ these objects be simple dictionaries.
 from oslo.config import cfg
 
 from nova.cells import rpcapi as cells_rpcapi
+from nova.db import threadpool
 from nova import exception
 from nova.openstack.common.db import api as db_api
 from nova.openstack.common import log as logging
@@ -65,11 +66,13 @@ db_opts = [
 
 CONF = cfg.CONF
 CONF.register_opts(db_opts)
+CONF.import_opt('enable', 'nova.cells.opts', group='cells')
 
 _BACKEND_MAPPING = {'sqlalchemy': 'nova.db.sqlalchemy.api'}
 
 
-IMPL = db_api.DBAPI(backend_mapping=_BACKEND_MAPPING)
+IMPL = threadpool.ThreadPoolDBAPI(
+        db_api.DBAPI(backend_mapping=_BACKEND_MAPPING))
 LOG = logging.getLogger(__name__)
 
 
@@ -86,6 +89,14 @@ class NoMoreTargets(exception.NovaException):
 ###################
 
 
+def tpool_stats():
+    """Return queue depth and wait time statistics of the DB thread pool.
+
+    Returns None unless dbapi_tpool_size is set.
+    """
+    return IMPL.tpool_stats()
+
+
 def constraint(**conditions):
     """Return a constraint object suitable for use with some updates."""
     return IMPL.constraint(**conditions)
@@ -169,6 +180,14 @@ def service_update(context, service_id, values):
     return IMPL.service_update(context, service_id, values)
 
 
+def service_heartbeat_update(context, report_counts):
+    """Record heartbeats for several services in a single update.
+
+    :param report_counts: dict mapping service ids to their report_count.
+    """
+    return IMPL.service_heartbeat_update(context, report_counts)
+
+
 ###################
 
 
@@ -560,6 +579,14 @@ def instance_create(context, values):
     return IMPL.instance_create(context, values)
 
 
+def instance_create_bulk(context, values_list):
+    """Create an instance from each values dictionary in one transaction.
+
+    :returns: the new instances, in the order given.
+    """
+    return IMPL.instance_create_bulk(context, values_list)
+
+
 def instance_data_get_for_project(context, project_id, session=None):
     """Get (instance_count, total_cores, total_ram) for project."""
     return IMPL.instance_data_get_for_project(context, project_id,
@@ -612,6 +639,21 @@ def instance_get_active_by_window_joined(context, begin, end=None,
                                               project_id, host)
 
 
+def instance_get_active_by_window_usage(context, begin, end=None,
+                                        project_id=None, marker=None,
+                                        limit=None):
+    """Get the fields usage reports need for instances active during a
+    certain time window, ordered by id.
+
+    Specifying a project_id will filter for a certain project.
+    Specifying a marker, the id of the last instance already seen, and a
+    limit returns the instances a page at a time.
+    """
+    return IMPL.instance_get_active_by_window_usage(context, begin, end,
+                                                    project_id, marker,
+                                                    limit)
+
+
 def instance_get_all_by_host(context, host):
     """Get all instances belonging to a host."""
     return IMPL.instance_get_all_by_host(context, host)
@@ -692,6 +734,39 @@ def instance_update_and_get_original(context, instance_uuid, values):
     return rv
 
 
+def instance_update_lean(context, instance_uuid, values, update_cells=True):
+    """Set the given properties on an instance without loading it, for
+    callers that do not need the updated instance back.  The instance is
+    only loaded to send it to the top cell when cells are enabled.
+
+    If "expected_task_state" exists in values, the update only happens
+    when the instance's task state matches it.  Otherwise a
+    UnexpectedTaskStateError is thrown.
+
+    Raises NotFound if instance does not exist.
+
+    """
+    IMPL.instance_update_lean(context, instance_uuid, values)
+    if update_cells and CONF.cells.enable:
+        # The top cell creates instances it does not know from the
+        # update, so it needs the whole instance, not the changed columns.
+        try:
+            instance = IMPL.instance_get_by_uuid(context, instance_uuid)
+            cells_rpcapi.CellsAPI().instance_update_at_top(context, instance)
+        except Exception:
+            LOG.exception(_("Failed to notify cells of instance update"))
+
+
+def instance_update_batch(context, updates):
+    """Apply a list of (instance_uuid, values, info_cache) updates to
+    instances in one transaction, without notifying cells.  info_cache
+    may be None to leave an instance's info cache alone.
+
+    :returns: the uuids of the instances that were not found.
+    """
+    return IMPL.instance_update_batch(context, updates)
+
+
 def instance_add_security_group(context, instance_id, security_group_id):
     """Associate the given security group with the given instance."""
     return IMPL.instance_add_security_group(context, instance_id,
@@ -1722,6 +1797,45 @@ def task_log_get(context, task_name, period_beginning,
 ####################
 
 
+def instance_usage_rollup_compute(context, period_beginning, period_ending):
+    """Add up the hours each tenant ran instances of each flavor for
+    during a period, from the instances themselves.
+
+    :returns: a list of dicts with project_id, instance_type_id and hours.
+    """
+    return IMPL.instance_usage_rollup_compute(context, period_beginning,
+                                              period_ending)
+
+
+def instance_usage_rollup_replace(context, period_beginning, rollups):
+    """Store the usage rolled up for the period starting at
+    period_beginning, replacing any stored before.
+    """
+    return IMPL.instance_usage_rollup_replace(context, period_beginning,
+                                              rollups)
+
+
+def instance_usage_rollup_get_periods(context, begin, end):
+    """Get the beginnings of the rolled up periods beginning within
+    a window.
+    """
+    return IMPL.instance_usage_rollup_get_periods(context, begin, end)
+
+
+def instance_usage_rollup_get_by_window(context, begin, end,
+                                        project_id=None):
+    """Sum up the rolled up hours of the periods beginning within a window,
+    per tenant and flavor.
+
+    Specifying a project_id will filter for a certain project.
+    """
+    return IMPL.instance_usage_rollup_get_by_window(context, begin, end,
+                                                    project_id)
+
+
+####################
+
+
 def archive_deleted_rows(context, max_rows=None):
     """Move up to max_rows rows from production tables to corresponding shadow
     tables.
@@ -40,6 +40,7 @@ from sqlalchemy.orm import joinedload
 from sqlalchemy.orm import joinedload_all
 from sqlalchemy.schema import Table
 from sqlalchemy.sql.expression import asc
+from sqlalchemy.sql.expression import case
 from sqlalchemy.sql.expression import desc
 from sqlalchemy.sql.expression import select
 from sqlalchemy.sql import func
@@ -51,6 +52,7 @@ from nova.compute import vm_states
 import nova.context
 from nova import db
 from nova.db.sqlalchemy import models
+from nova.db.sqlalchemy import utils as db_utils
 from nova import exception
 from nova.openstack.common.db.sqlalchemy import session as db_session
 from nova.openstack.common.db.sqlalchemy import utils as sqlalchemyutils
@@ -440,6 +442,18 @@ def service_update(context, service_id, values):
     return service_ref
 
 
+@require_admin_context
+def service_heartbeat_update(context, report_counts):
+    if not report_counts:
+        return
+    model_query(context, models.Service, read_deleted="no").\
+            filter(models.Service.id.in_(report_counts.keys())).\
+            update({'report_count': case(report_counts,
+                                         value=models.Service.id),
+                    'updated_at': timeutils.utcnow()},
+                   synchronize_session=False)
+
+
 ###################
 
 def compute_node_get(context, compute_id):
@@ -1370,6 +1384,10 @@ def _metadata_refs(metadata_dict, meta_class):
 
 
 def _validate_unique_server_name(context, session, name):
+    _validate_unique_server_names(context, session, [name])
+
+
+def _validate_unique_server_names(context, session, names):
     if not CONF.osapi_compute_unique_server_name_scope:
         return
 
@@ -1391,10 +1409,13 @@ def _validate_unique_server_name(context, session, name):
         LOG.warn(msg)
         return
 
-    lowername = name.lower()
-    for instance in instance_list:
-        if instance['hostname'].lower() == lowername:
-            raise exception.InstanceExists(name=instance['hostname'])
+    hostnames = dict((instance['hostname'].lower(), instance['hostname'])
+                     for instance in instance_list)
+    for name in names:
+        lowername = name.lower()
+        if lowername in hostnames:
+            raise exception.InstanceExists(name=hostnames[lowername])
+        hostnames[lowername] = name
 
 
 @require_context
@@ -1451,6 +1472,99 @@ def instance_create(context, values):
     return instance_ref
 
 
+def _insert_rows(session, table, rows):
+    """Insert rows with one executemany per distinct set of columns."""
+    rows_by_keys = {}
+    for row in rows:
+        rows_by_keys.setdefault(tuple(sorted(row)), []).append(row)
+    for rows in rows_by_keys.values():
+        session.execute(table.insert(), rows)
+
+
+@require_context
+def instance_create_bulk(context, values_list):
+    """Create many Instance records in one transaction.
+
+    Takes the same values as instance_create(), but ensures the project's
+    default security group and looks the other groups up once, and
+    inserts the instances and their metadata, system metadata, info
+    caches, security group associations and ec2 id mappings with one
+    multi-row INSERT each.  Returns the instances in the order given.
+    """
+    columns = set(models.Instance.__table__.columns.keys())
+    instance_rows = []
+    metadata_rows = []
+    system_metadata_rows = []
+    info_cache_rows = []
+    group_names = {}
+    for values in values_list:
+        values = values.copy()
+        if not values.get('uuid'):
+            values['uuid'] = str(uuid.uuid4())
+        instance_uuid = values['uuid']
+        for key, value in (values.pop('metadata', None) or {}).iteritems():
+            metadata_rows.append({'key': key, 'value': value,
+                                  'instance_uuid': instance_uuid})
+        for key, value in (values.pop('system_metadata', None) or
+                           {}).iteritems():
+            system_metadata_rows.append({'key': key, 'value': value,
+                                         'instance_uuid': instance_uuid})
+        info_cache = dict(values.pop('info_cache', None) or {})
+        info_cache['instance_uuid'] = instance_uuid
+        info_cache_rows.append(info_cache)
+        group_names[instance_uuid] = values.pop('security_groups', [])
+        instance_rows.append(dict((key, value)
+                                  for key, value in values.iteritems()
+                                  if key in columns))
+
+    uuids = [row['uuid'] for row in instance_rows]
+    # NOTE: creating the default group can also create its rules, which
+    # happens in separate transactions, so do it before starting ours
+    _existed, default_group = security_group_ensure_default(context)
+    session = get_session()
+    with session.begin():
+        hostnames = [row['hostname'] for row in instance_rows
+                     if row.get('hostname')]
+        if hostnames:
+            _validate_unique_server_names(context, session, hostnames)
+
+        groups = {'default': default_group}
+        other_names = set()
+        for names in group_names.values():
+            other_names.update(name for name in names if name != 'default')
+        if other_names:
+            for group in _security_group_get_by_names(context, session,
+                    context.project_id, list(other_names)):
+                groups[group['name']] = group
+        association_rows = []
+        for instance_uuid in uuids:
+            for name in set(group_names[instance_uuid]):
+                association_rows.append({'instance_uuid': instance_uuid,
+                                         'security_group_id':
+                                         groups[name]['id']})
+
+        _insert_rows(session, models.Instance.__table__, instance_rows)
+        for model, rows in ((models.InstanceMetadata, metadata_rows),
+                            (models.InstanceSystemMetadata,
+                             system_metadata_rows),
+                            (models.InstanceInfoCache, info_cache_rows),
+                            (models.SecurityGroupInstanceAssociation,
+                             association_rows),
+                            (models.InstanceIdMapping,
+                             [{'uuid': instance_uuid}
+                              for instance_uuid in uuids])):
+            if rows:
+                _insert_rows(session, model.__table__, rows)
+
+        instances = _build_instance_get(context, session=session).\
+                        filter(models.Instance.uuid.in_(uuids)).\
+                        all()
+
+    instances_by_uuid = dict((instance['uuid'], instance)
+                             for instance in instances)
+    return [instances_by_uuid[instance_uuid] for instance_uuid in uuids]
+
+
 @require_admin_context
 def instance_data_get_for_project(context, project_id, session=None):
     result = model_query(context,
@@ -1679,6 +1793,37 @@ def instance_get_active_by_window_joined(context, begin, end=None,
     return query.all()
 
 
+_INSTANCE_USAGE_COLUMNS = ('id', 'uuid', 'display_name', 'project_id',
+                           'instance_type_id', 'vm_state', 'launched_at',
+                           'terminated_at')
+
+
+@require_context
+def instance_get_active_by_window_usage(context, begin, end=None,
+                                        project_id=None, marker=None,
+                                        limit=None):
+    """Return the usage columns of instances active during window.
+
+    Only the columns are selected, so no models or joins are built.
+    """
+    session = get_session()
+    columns = [getattr(models.Instance, c) for c in _INSTANCE_USAGE_COLUMNS]
+    query = session.query(*columns).\
+                    filter(or_(models.Instance.terminated_at == None,
+                               models.Instance.terminated_at > begin))
+    if end:
+        query = query.filter(models.Instance.launched_at < end)
+    if project_id:
+        query = query.filter_by(project_id=project_id)
+    if marker is not None:
+        query = query.filter(models.Instance.id > marker)
+    query = query.order_by(models.Instance.id)
+    if limit is not None:
+        query = query.limit(limit)
+
+    return [dict(zip(_INSTANCE_USAGE_COLUMNS, row)) for row in query]
+
+
 @require_admin_context
 def _instance_get_all_query(context, project_only=False):
     return model_query(context, models.Instance, project_only=project_only).\
@@ -1788,6 +1933,74 @@ def instance_update_and_get_original(context, instance_uuid, values):
                             copy_old_instance=True)
 
 
+# Values instance_update_lean() hands to _instance_update(), as setting
+# them takes more than writing a column of the instances table
+_INSTANCE_UPDATE_NEEDS_LOAD = set(['metadata', 'system_metadata',
+                                   'hostname', 'instance_type_id',
+                                   'launched_at', 'terminated_at'])
+
+# The columns the usage of an instance is worked out from
+_INSTANCE_USAGE_FIELDS = ('launched_at', 'terminated_at', 'instance_type_id')
+
+
+@require_context
+def instance_update_lean(context, instance_uuid, values):
+    """Set the given columns on an instance with a single UPDATE,
+    without loading the instance.  Returns nothing.
+
+    If "expected_task_state" exists in values, the UPDATE is conditional
+    on the task state and UnexpectedTaskStateError is raised when no row
+    matched it.  Values that need the instance loaded to be set, such as
+    metadata, are handled by instance_update() instead.
+
+    Raises NotFound if instance does not exist.
+    """
+    values = dict(values)
+    columns = set(models.Instance.__table__.columns.keys())
+    keys = set(values) - set(['expected_task_state'])
+    if keys & _INSTANCE_UPDATE_NEEDS_LOAD or not keys <= columns:
+        _instance_update(context, instance_uuid, values)
+        return
+
+    if not uuidutils.is_uuid_like(instance_uuid):
+        raise exception.InvalidUUID(instance_uuid)
+
+    session = get_session()
+    with session.begin():
+        query = model_query(context, models.Instance, session=session,
+                            project_only=True).\
+                        filter_by(uuid=instance_uuid)
+        expected = None
+        if "expected_task_state" in values:
+            expected = values.pop("expected_task_state")
+            if not isinstance(expected, (tuple, list, set)):
+                expected = (expected,)
+            states = [state for state in expected if state is not None]
+            task_state = models.Instance.task_state
+            if not states:
+                query = query.filter(task_state == None)
+            elif None in expected:
+                query = query.filter(or_(task_state == None,
+                                         task_state.in_(states)))
+            else:
+                query = query.filter(task_state.in_(states))
+
+        if query.update(values, synchronize_session=False):
+            return
+
+        # Nothing was updated, find out why
+        actual = model_query(context, models.Instance.task_state,
+                             base_model=models.Instance, session=session,
+                             project_only=True).\
+                        filter_by(uuid=instance_uuid).\
+                        first()
+        if actual is None:
+            raise exception.InstanceNotFound(instance_id=instance_uuid)
+        if expected is not None:
+            raise exception.UnexpectedTaskStateError(actual=actual[0],
+                                                     expected=expected)
+
+
 # NOTE(danms): This updates the instance's metadata list in-place and in
 # the database to avoid stale data and refresh issues. It assumes the
 # delete=True behavior of instance_metadata_update(...)
@@ -1812,13 +2025,15 @@ def _instance_metadata_update_in_place(context, instance, metadata_type, model,
         instance[metadata_type].append(newitem)
 
 
-def _instance_update(context, instance_uuid, values, copy_old_instance=False):
-    session = get_session()
+def _instance_update(context, instance_uuid, values, copy_old_instance=False,
+                     session=None):
+    if session is None:
+        session = get_session()
 
     if not uuidutils.is_uuid_like(instance_uuid):
         raise exception.InvalidUUID(instance_uuid)
 
-    with session.begin():
+    with session.begin(subtransactions=True):
         instance_ref = _instance_get_by_uuid(context, instance_uuid,
                                              session=session)
         # TODO(deva): remove extra_specs from here after it is included
@@ -1855,6 +2070,11 @@ def _instance_update(context, instance_uuid, values, copy_old_instance=False):
         else:
             old_instance_ref = None
 
+        old_usage = None
+        if set(values) & set(_INSTANCE_USAGE_FIELDS):
+            old_usage = dict((key, instance_ref[key])
+                             for key in _INSTANCE_USAGE_FIELDS)
+
         metadata = values.get('metadata')
         if metadata is not None:
             _instance_metadata_update_in_place(context, instance_ref,
@@ -1881,9 +2101,37 @@ def _instance_update(context, instance_uuid, values, copy_old_instance=False):
             # instance_type.
             session.refresh(instance_ref['instance_type'])
 
+        if old_usage is not None:
+            _instance_usage_rollup_adjust(
+                context, session, instance_ref['project_id'], old_usage,
+                dict((key, instance_ref[key])
+                     for key in _INSTANCE_USAGE_FIELDS))
+
     return (old_instance_ref, instance_ref)
 
 
+@require_context
+def instance_update_batch(context, updates):
+    uuids = [instance_uuid for instance_uuid, values, info_cache in updates]
+    session = get_session()
+    with session.begin():
+        query = model_query(context, models.Instance.uuid,
+                            base_model=models.Instance, session=session).\
+                        filter(models.Instance.uuid.in_(uuids))
+        existing = set(row[0] for row in query)
+        for instance_uuid, values, info_cache in updates:
+            if instance_uuid not in existing:
+                continue
+            _instance_update(context, instance_uuid, dict(values),
+                             session=session)
+            if info_cache is not None:
+                _instance_info_cache_update(context, instance_uuid,
+                                            info_cache, session)
+
+    return [instance_uuid for instance_uuid in uuids
+            if instance_uuid not in existing]
+
+
 def instance_add_security_group(context, instance_uuid, security_group_id):
     """Associate the given security group with the given instance."""
     sec_group_ref = models.SecurityGroupInstanceAssociation()
@@ -1926,19 +2174,24 @@ def instance_info_cache_update(context, instance_uuid, values):
     """
     session = get_session()
     with session.begin():
-        info_cache = model_query(context, models.InstanceInfoCache,
-                                 session=session).\
-                         filter_by(instance_uuid=instance_uuid).\
-                         first()
+        return _instance_info_cache_update(context, instance_uuid, values,
+                                           session)
 
-        if info_cache and not info_cache['deleted']:
-            # NOTE(tr3buchet): let's leave it alone if it's already deleted
-            info_cache.update(values)
-        else:
-            # NOTE(tr3buchet): just in case someone blows away an instance's
-            #                  cache entry
-            info_cache = models.InstanceInfoCache()
-            info_cache.update({'instance_uuid': instance_uuid})
+
+def _instance_info_cache_update(context, instance_uuid, values, session):
+    info_cache = model_query(context, models.InstanceInfoCache,
+                             session=session).\
+                     filter_by(instance_uuid=instance_uuid).\
+                     first()
+
+    if info_cache and not info_cache['deleted']:
+        # NOTE(tr3buchet): let's leave it alone if it's already deleted
+        info_cache.update(values)
+    else:
+        # NOTE(tr3buchet): just in case someone blows away an instance's
+        #                  cache entry
+        info_cache = models.InstanceInfoCache()
+        info_cache.update({'instance_uuid': instance_uuid})
 
     return info_cache
 
@@ -4750,6 +5003,159 @@ def task_log_end_task(context, task_name, period_beginning, period_ending,
             raise exception.TaskNotRunning(task_name=task_name, host=host)
 
 
+##################
+
+
+# Usage is rolled up per UTC day, see nova.compute.utils
+_USAGE_ROLLUP_PERIOD = datetime.timedelta(days=1)
+
+
+def _instance_usage_hours(instance, begin, end):
+    """Hours an instance ran for between begin and end."""
+    if instance['launched_at'] is None:
+        return 0.0
+    start = max(instance['launched_at'], begin)
+    stop = min(instance['terminated_at'] or end, end)
+    if stop <= start:
+        return 0.0
+    return timeutils.delta_seconds(start, stop) / 3600.0
+
+
+@require_admin_context
+def instance_usage_rollup_compute(context, period_beginning, period_ending,
+                                  page_size=1000):
+    hours = {}
+    marker = None
+    while True:
+        instances = instance_get_active_by_window_usage(
+            context, period_beginning, period_ending, marker=marker,
+            limit=page_size)
+        for instance in instances:
+            key = (instance['project_id'], instance['instance_type_id'])
+            hours[key] = hours.get(key, 0.0) + _instance_usage_hours(
+                instance, period_beginning, period_ending)
+        if len(instances) < page_size:
+            break
+        marker = instances[-1]['id']
+
+    return [dict(project_id=project_id, instance_type_id=instance_type_id,
+                 hours=hours[(project_id, instance_type_id)])
+            for project_id, instance_type_id in sorted(hours)]
+
+
+@require_admin_context
+def instance_usage_rollup_replace(context, period_beginning, rollups):
+    session = get_session()
+    with session.begin():
+        model_query(context, models.InstanceUsageRollup, session=session,
+                    read_deleted="yes").\
+                filter_by(period_beginning=period_beginning).\
+                delete(synchronize_session=False)
+
+        # The row without project or flavor marks the period as rolled up
+        for values in [dict(project_id=None, instance_type_id=None,
+                            hours=0.0)] + list(rollups):
+            rollup = models.InstanceUsageRollup()
+            rollup.update(values)
+            rollup.period_beginning = period_beginning
+            session.add(rollup)
+        try:
+            session.flush()
+        except db_session.DBDuplicateEntry:
+            # Rows inserted by someone else replacing the same period
+            raise exception.InstanceUsageRollupExists(
+                period_beginning=period_beginning)
+
+
+def _instance_usage_rollup_adjust(context, session, project_id, old, new):
+    """Change the rolled up periods by the usage an instance gains or loses
+    in them from an update to its launch or termination time or flavor.
+
+    Rebuilding and rescuing an instance set launched_at afresh and a resize
+    moves its usage to the new flavor, which changes what recomputing past
+    periods from the instances gives.  The rollups follow along, so they
+    always match that recomputation.
+    """
+    if all(old[key] == new[key] for key in _INSTANCE_USAGE_FIELDS):
+        return
+    launches = [usage['launched_at'] for usage in (old, new)
+                if usage['launched_at'] is not None]
+    if not launches:
+        return
+    begin = min(launches).replace(hour=0, minute=0, second=0, microsecond=0)
+    now = timeutils.utcnow()
+    end = max(usage['terminated_at'] or now for usage in (old, new))
+
+    for period_beginning in instance_usage_rollup_get_periods(
+            context, begin, end, session=session):
+        period_ending = period_beginning + _USAGE_ROLLUP_PERIOD
+        hours = collections.defaultdict(float)
+        hours[old['instance_type_id']] -= _instance_usage_hours(
+            old, period_beginning, period_ending)
+        hours[new['instance_type_id']] += _instance_usage_hours(
+            new, period_beginning, period_ending)
+        for instance_type_id, delta in hours.iteritems():
+            if delta:
+                _instance_usage_rollup_add(context, session,
+                                           period_beginning, project_id,
+                                           instance_type_id, delta)
+
+
+def _instance_usage_rollup_add(context, session, period_beginning,
+                               project_id, instance_type_id, hours):
+    query = model_query(context, models.InstanceUsageRollup,
+                        session=session, read_deleted="no").\
+                filter_by(period_beginning=period_beginning).\
+                filter_by(project_id=project_id).\
+                filter_by(instance_type_id=instance_type_id)
+    if query.update({'hours': models.InstanceUsageRollup.hours + hours},
+                    synchronize_session=False):
+        return
+    rollup = models.InstanceUsageRollup()
+    rollup.update(dict(period_beginning=period_beginning,
+                       project_id=project_id,
+                       instance_type_id=instance_type_id, hours=hours))
+    session.add(rollup)
+    # Later updates in this session find the row to add to
+    session.flush()
+
+
+@require_context
+def instance_usage_rollup_get_periods(context, begin, end, session=None):
+    rows = model_query(context,
+                       models.InstanceUsageRollup.period_beginning,
+                       base_model=models.InstanceUsageRollup,
+                       session=session, read_deleted="no").\
+                filter(models.InstanceUsageRollup.period_beginning >= begin).\
+                filter(models.InstanceUsageRollup.period_beginning < end).\
+                filter(models.InstanceUsageRollup.project_id == None).\
+                order_by(models.InstanceUsageRollup.period_beginning).\
+                distinct().\
+                all()
+    return [row[0] for row in rows]
+
+
+@require_context
+def instance_usage_rollup_get_by_window(context, begin, end,
+                                        project_id=None):
+    query = model_query(context,
+                        models.InstanceUsageRollup.project_id,
+                        models.InstanceUsageRollup.instance_type_id,
+                        func.sum(models.InstanceUsageRollup.hours),
+                        base_model=models.InstanceUsageRollup,
+                        read_deleted="no").\
+                filter(models.InstanceUsageRollup.period_beginning >= begin).\
+                filter(models.InstanceUsageRollup.period_beginning < end).\
+                filter(models.InstanceUsageRollup.project_id != None)
+    if project_id:
+        query = query.filter_by(project_id=project_id)
+    query = query.group_by(models.InstanceUsageRollup.project_id,
+                           models.InstanceUsageRollup.instance_type_id)
+
+    return [dict(project_id=row[0], instance_type_id=row[1], hours=row[2])
+            for row in query]
+
+
 def _get_default_deleted_value(table):
     # TODO(dripton): It would be better to introspect the actual default value
     # from the column, but I don't see a way to do that in the low-level APIs
@@ -4784,37 +5190,51 @@ def archive_deleted_rows_for_table(context, tablename, max_rows=None):
     default_deleted_value = _get_default_deleted_value(table)
     shadow_tablename = "shadow_" + tablename
     rows_archived = 0
+    if max_rows <= 0:
+        return rows_archived
     try:
         shadow_table = Table(shadow_tablename, metadata, autoload=True)
     except NoSuchTableError:
         # No corresponding shadow table; skip it.
         return rows_archived
+    try:
+        column = table.c.id
+    except AttributeError:
+        # We have one table (dns_domains) where the key is called
+        # "domain" rather than "id"
+        column = table.c.domain
+    deleted = table.c.deleted != default_deleted_value
     # Group the insert and delete in a transaction.
     with conn.begin():
-        # TODO(dripton): It would be more efficient to insert(select) and then
-        # delete(same select) without ever returning the selected rows back to
-        # Python.  sqlalchemy does not support that directly, but we have
-        # nova.db.sqlalchemy.utils.InsertFromSelect for the insert side.  We
-        # need a corresponding function for the delete side.
-        try:
-            column = table.c.id
-            column_name = "id"
-        except AttributeError:
-            # We have one table (dns_domains) where the key is called
-            # "domain" rather than "id"
-            column = table.c.domain
-            column_name = "domain"
-        query = select([table],
-                       table.c.deleted != default_deleted_value).\
-                       order_by(column).limit(max_rows)
-        rows = conn.execute(query).fetchall()
-        if rows:
-            insert_statement = shadow_table.insert()
-            conn.execute(insert_statement, rows)
-            keys = [getattr(row, column_name) for row in rows]
-            delete_statement = table.delete(column.in_(keys))
-            result = conn.execute(delete_statement)
-            rows_archived = result.rowcount
+        # The key of the max_rows'th deleted row, or of the last one if
+        # there are fewer, marks the end of this batch. The rows are
+        # copied and deleted without ever coming back to Python, and a
+        # later call picks up from the rows left behind.
+        low_water_mark = conn.execute(
+            select([func.min(column)], deleted)).scalar()
+        high_water_mark = conn.execute(
+            select([column], deleted).order_by(column).
+            offset(max_rows - 1).limit(1)).scalar()
+        if high_water_mark is None:
+            high_water_mark = conn.execute(
+                select([func.max(column)], deleted)).scalar()
+        if high_water_mark is None:
+            return rows_archived
+        batch = and_(deleted, column <= high_water_mark)
+        columns = [table.c[shadow_column.name]
+                   for shadow_column in shadow_table.columns]
+        conn.execute(db_utils.InsertFromSelect(shadow_table,
+                                               select(columns, batch)))
+        # Rows soft-deleted by another transaction after the insert match
+        # the batch too, so delete by the keys that reached the shadow
+        # table rather than by the batch again.
+        shadow_column = shadow_table.c[column.name]
+        copied = select([shadow_column],
+                        and_(shadow_column >= low_water_mark,
+                             shadow_column <= high_water_mark))
+        result = conn.execute(table.delete(and_(deleted,
+                                                column.in_(copied))))
+        rows_archived = result.rowcount
     return rows_archived
 
 
@@ -1012,3 +1012,20 @@ class TaskLog(BASE, NovaBase):
     message = Column(String(255), nullable=False)
     task_items = Column(Integer(), default=0)
     errors = Column(Integer(), default=0)
+
+
+class InstanceUsageRollup(BASE, NovaBase):
+    """Instance hours used by a tenant with one flavor over one period.
+
+    Each rolled up period also has a row with no project or flavor, so a
+    period without usage can be told apart from one not rolled up yet.
+    """
+    __tablename__ = 'instance_usage_rollups'
+    __table_args__ = (schema.UniqueConstraint(
+        'period_beginning', 'project_id', 'instance_type_id',
+        name='uniq_period_beginning_x_project_id_x_instance_type_id'), )
+    id = Column(Integer, primary_key=True, nullable=False, autoincrement=True)
+    period_beginning = Column(DateTime, nullable=False)
+    project_id = Column(String(255))
+    instance_type_id = Column(Integer)
+    hours = Column(Float, default=0.0)
@@ -0,0 +1,162 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Run DB API calls in a sized pool of native threads.
+
+MySQLdb does not yield to eventlet, so a long query stalls every other
+greenthread in the process.  With dbapi_tpool_size set, each DB API call
+runs in eventlet's tpool instead, and the calls are counted so the queue
+depth and the time calls wait for a free thread can be reported.
+"""
+
+import functools
+import time
+
+from oslo.config import cfg
+
+from nova.openstack.common import lockutils
+from nova.openstack.common import log as logging
+
+tpool_opts = [
+    cfg.IntOpt('dbapi_tpool_size',
+               default=0,
+               help='Number of native threads to run DB API calls in, or 0 '
+                    'to run them in the calling greenthread. The SQL '
+                    'connection pool defaults to the same size'),
+    cfg.IntOpt('dbapi_tpool_stats_interval',
+               default=60,
+               help='Seconds between reports of the queue depth and wait '
+                    'times of the DB thread pool in the log of each '
+                    'service using the database (0 disables them)'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(tpool_opts)
+CONF.import_opt('dbapi_use_tpool', 'nova.openstack.common.db.api')
+CONF.import_opt('sql_max_pool_size',
+                'nova.openstack.common.db.sqlalchemy.session')
+
+LOG = logging.getLogger(__name__)
+
+
+def _set_tpool_size(tpool, size):
+    # NOTE: older eventlet releases have no set_num_threads() and read the
+    # size once, when the pool is lazily set up by the first execute().
+    if hasattr(tpool, 'set_num_threads'):
+        tpool.set_num_threads(size)
+    else:
+        tpool._nthreads = size
+
+
+class TpoolStats(object):
+    """Queue depth and wait time of DB API calls run in the thread pool.
+
+    The counters are only updated from green threads, on either side of the
+    hand-off to the pool, so they need no locking.
+    """
+
+    def __init__(self, pool_size):
+        self.pool_size = pool_size
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.calls = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    @property
+    def queue_depth(self):
+        """Calls waiting for a free thread."""
+        return max(0, self.in_flight - self.pool_size)
+
+    def call_started(self):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    def call_finished(self, wait):
+        self.in_flight -= 1
+        self.calls += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+
+    def to_dict(self):
+        return {'pool_size': self.pool_size,
+                'in_flight': self.in_flight,
+                'max_in_flight': self.max_in_flight,
+                'queue_depth': self.queue_depth,
+                'calls': self.calls,
+                'average_wait': self.calls and self.total_wait / self.calls,
+                'max_wait': self.max_wait}
+
+
+class ThreadPoolDBAPI(object):
+    """Wraps a DBAPI so its calls run in eventlet's tpool, sized by
+    dbapi_tpool_size, when that is set.
+    """
+
+    def __init__(self, dbapi):
+        self._dbapi = dbapi
+        self._tpool = None
+        self._stats = None
+        self._configured = False
+
+    @lockutils.synchronized('dbapi_tpool', 'nova-')
+    def _configure(self):
+        if self._configured:
+            return
+        size = CONF.dbapi_tpool_size
+        if size > 0 and CONF.dbapi_use_tpool:
+            LOG.warn(_("dbapi_use_tpool already runs DB API calls in a "
+                       "thread pool, ignoring dbapi_tpool_size"))
+        elif size > 0:
+            from eventlet import tpool
+            _set_tpool_size(tpool, size)
+            # Let every thread hold a connection, unless told otherwise
+            CONF.set_default('sql_max_pool_size', size)
+            self._tpool = tpool
+            self._stats = TpoolStats(size)
+        self._configured = True
+
+    def __getattr__(self, key):
+        if not self._configured:
+            self._configure()
+        attr = getattr(self._dbapi, key)
+        if self._tpool is None or not hasattr(attr, '__call__'):
+            return attr
+
+        stats = self._stats
+
+        def tpool_wrapper(*args, **kwargs):
+            started = []
+
+            def timed_call():
+                started.append(time.time())
+                return attr(*args, **kwargs)
+
+            submitted = time.time()
+            stats.call_started()
+            try:
+                return self._tpool.execute(timed_call)
+            finally:
+                stats.call_finished(started and started[0] - submitted or 0)
+
+        functools.update_wrapper(tpool_wrapper, attr)
+        return tpool_wrapper
+
+    def tpool_stats(self):
+        """Return thread pool statistics, or None if it is not in use."""
+        if not self._configured:
+            self._configure()
+        if self._stats is None:
+            return None
+        return self._stats.to_dict()
@@ -1084,6 +1084,11 @@ class TaskAlreadyRunning(NovaException):
     message = _("Task %(task_name)s is already running on host %(host)s")
 
 
+class InstanceUsageRollupExists(NovaException):
+    message = _("Instance usage for %(period_beginning)s is being rolled up "
+                "elsewhere")
+
+
 class TaskNotRunning(NovaException):
     message = _("Task %(task_name)s is not running on host %(host)s")
 
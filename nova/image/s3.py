@@ -20,13 +20,13 @@
 
 import base64
 import binascii
+import collections
 import os
-import shutil
 import tarfile
-import tempfile
 
 import boto.s3.connection
 import eventlet
+from eventlet.green import subprocess
 from lxml import etree
 from oslo.config import cfg
 
@@ -41,9 +41,13 @@ from nova import utils
 LOG = logging.getLogger(__name__)
 
 s3_opts = [
-    cfg.StrOpt('image_decryption_dir',
-               default='/tmp',
-               help='parent dir for tempdir used for image decryption'),
+    cfg.IntOpt('s3_image_download_parts',
+               default=4,
+               help='number of parts of a bundled image to download from '
+                    's3 at once when registering it. Images are decrypted '
+                    'and untarred as their parts arrive, without going '
+                    'through local disk, so this is also the most parts '
+                    'held in memory per image being registered'),
     cfg.StrOpt('s3_host',
                default='$my_ip',
                help='hostname or ip for openstack to use when accessing '
@@ -267,8 +271,6 @@ class S3ImageService(object):
     def _s3_create(self, context, metadata):
         """Gets a manifest from s3 and makes an image."""
 
-        image_path = tempfile.mkdtemp(dir=CONF.image_decryption_dir)
-
         image_location = metadata['properties']['image_location']
         bucket_name = image_location.split('/')[0]
         manifest_path = image_location[len(bucket_name) + 1:]
@@ -283,8 +285,7 @@ class S3ImageService(object):
         def delayed_create():
             """This handles the fetching and decrypting of the part files."""
             context.update_store()
-            log_vars = {'image_location': image_location,
-                        'image_path': image_path}
+            log_vars = {'image_location': image_location}
 
             def _update_image_state(context, image_uuid, image_state):
                 metadata = {'properties': {'image_state': image_state}}
@@ -296,30 +297,6 @@ class S3ImageService(object):
                 self.service.update(context, image_uuid, metadata, image_data,
                                     purge_props=False)
 
-            _update_image_state(context, image_uuid, 'downloading')
-
-            try:
-                parts = []
-                elements = manifest.find('image').getiterator('filename')
-                for fn_element in elements:
-                    part = self._download_file(bucket,
-                                               fn_element.text,
-                                               image_path)
-                    parts.append(part)
-
-                # NOTE(vish): this may be suboptimal, should we use cat?
-                enc_filename = os.path.join(image_path, 'image.encrypted')
-                with open(enc_filename, 'w') as combined:
-                    for filename in parts:
-                        with open(filename) as part:
-                            shutil.copyfileobj(part, combined)
-
-            except Exception:
-                LOG.exception(_("Failed to download %(image_location)s "
-                                "to %(image_path)s"), log_vars)
-                _update_image_state(context, image_uuid, 'failed_download')
-                return
-
             _update_image_state(context, image_uuid, 'decrypting')
 
             try:
@@ -328,33 +305,31 @@ class S3ImageService(object):
                 hex_iv = manifest.find('image/ec2_encrypted_iv').text
                 encrypted_iv = binascii.a2b_hex(hex_iv)
 
-                dec_filename = os.path.join(image_path, 'image.tar.gz')
-                self._decrypt_image(context, enc_filename, encrypted_key,
-                                    encrypted_iv, dec_filename)
+                key, iv = self._decrypt_key(context, encrypted_key,
+                                            encrypted_iv)
             except Exception:
-                LOG.exception(_("Failed to decrypt %(image_location)s "
-                                "to %(image_path)s"), log_vars)
+                LOG.exception(_("Failed to decrypt the key of "
+                                "%(image_location)s"), log_vars)
                 _update_image_state(context, image_uuid, 'failed_decrypt')
                 return
 
-            _update_image_state(context, image_uuid, 'untarring')
-
-            try:
-                unz_filename = self._untarzip_image(image_path, dec_filename)
-            except Exception:
-                LOG.exception(_("Failed to untar %(image_location)s "
-                                "to %(image_path)s"), log_vars)
-                _update_image_state(context, image_uuid, 'failed_untar')
-                return
-
             _update_image_state(context, image_uuid, 'uploading')
+
+            elements = manifest.find('image').getiterator('filename')
+            parts = self._download_parts(bucket,
+                                         [fn_element.text
+                                          for fn_element in elements])
+            bundle = BundleStream(parts, key, iv)
             try:
-                with open(unz_filename) as image_file:
-                    _update_image_data(context, image_uuid, image_file)
+                _update_image_data(context, image_uuid, bundle.open_image())
+                bundle.close()
             except Exception:
+                bundle.abort()
+                image_state = bundle.failed_state or 'failed_upload'
                 LOG.exception(_("Failed to upload %(image_location)s "
-                                "to %(image_path)s"), log_vars)
-                _update_image_state(context, image_uuid, 'failed_upload')
+                                "(%(image_state)s)"),
+                              dict(log_vars, image_state=image_state))
+                _update_image_state(context, image_uuid, image_state)
                 return
 
             metadata = {'status': 'active',
@@ -362,14 +337,35 @@ class S3ImageService(object):
             self.service.update(context, image_uuid, metadata,
                     purge_props=False)
 
-            shutil.rmtree(image_path)
-
         eventlet.spawn_n(delayed_create)
 
         return image
 
-    def _decrypt_image(self, context, encrypted_filename, encrypted_key,
-                       encrypted_iv, decrypted_filename):
+    @staticmethod
+    def _download_part(bucket, filename):
+        return bucket.get_key(filename).get_contents_as_string()
+
+    def _download_parts(self, bucket, filenames):
+        """Yield the contents of the parts of a bundle in order.
+
+        Up to CONF.s3_image_download_parts parts are downloaded at once, so
+        that is also the most held in memory while they wait to be used.
+        """
+        pending = collections.deque()
+        try:
+            for filename in filenames:
+                pending.append(eventlet.spawn(self._download_part, bucket,
+                                              filename))
+                if len(pending) >= CONF.s3_image_download_parts:
+                    yield pending.popleft().wait()
+            while pending:
+                yield pending.popleft().wait()
+        finally:
+            for thread in pending:
+                thread.kill()
+
+    def _decrypt_key(self, context, encrypted_key, encrypted_iv):
+        """Have nova-cert decrypt the key and iv of a bundle."""
         elevated = context.elevated()
         try:
             key = self.cert_rpcapi.decrypt_text(elevated,
@@ -385,35 +381,103 @@ class S3ImageService(object):
         except Exception, exc:
             raise exception.NovaException(_('Failed to decrypt initialization '
                                     'vector: %s') % exc)
-
-        try:
-            utils.execute('openssl', 'enc',
-                          '-d', '-aes-128-cbc',
-                          '-in', '%s' % (encrypted_filename,),
-                          '-K', '%s' % (key,),
-                          '-iv', '%s' % (iv,),
-                          '-out', '%s' % (decrypted_filename,))
-        except exception.ProcessExecutionError, exc:
-            raise exception.NovaException(_('Failed to decrypt image file '
-                                    '%(image_file)s: %(err)s') %
-                                    {'image_file': encrypted_filename,
-                                     'err': exc.stdout})
+        return key, iv
 
     @staticmethod
-    def _test_for_malicious_tarball(path, filename):
-        """Raises exception if extracting tarball would escape extract path."""
-        tar_file = tarfile.open(filename, 'r|gz')
-        for n in tar_file.getnames():
-            if not os.path.abspath(os.path.join(path, n)).startswith(path):
-                tar_file.close()
-                raise exception.NovaException(_('Unsafe filenames in image'))
-        tar_file.close()
+    def _image_member(tar_file):
+        """Return the first file in tar_file, which is the image.
 
-    @staticmethod
-    def _untarzip_image(path, filename):
-        S3ImageService._test_for_malicious_tarball(path, filename)
-        tar_file = tarfile.open(filename, 'r|gz')
-        tar_file.extractall(path)
-        image_file = tar_file.getnames()[0]
-        tar_file.close()
-        return os.path.join(path, image_file)
+        Raises exception if a name before it would escape the extract path.
+        """
+        for member in tar_file:
+            name = os.path.normpath(member.name)
+            if (os.path.isabs(name) or name == os.pardir or
+                    name.startswith(os.pardir + os.sep)):
+                raise exception.NovaException(_('Unsafe filenames in image'))
+            if member.isfile():
+                return member
+        raise exception.NovaException(_('No image file in bundle'))
+
+
+class BundleStream(object):
+    """Decrypts and untars a bundled image as its parts arrive.
+
+    The parts are written to openssl from a greenthread, and the image is
+    read from the gzipped tarball openssl writes out, so none of the
+    intermediate files of a bundle are ever written to disk.
+
+    failed_state is set to the image_state for the stage that failed
+    first, if one did.
+    """
+
+    def __init__(self, parts, key, iv):
+        self.failed_state = None
+        self._process = subprocess.Popen(['openssl', 'enc', '-d',
+                                          '-aes-128-cbc', '-K', key,
+                                          '-iv', iv],
+                                         stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE,
+                                         stderr=subprocess.PIPE,
+                                         close_fds=True)
+        self._writer = eventlet.spawn(self._write_parts, parts)
+
+    def _fail(self, image_state):
+        if self.failed_state is None:
+            self.failed_state = image_state
+
+    def _write_parts(self, parts):
+        stdin = self._process.stdin
+        try:
+            while True:
+                try:
+                    part = parts.next()
+                except StopIteration:
+                    break
+                except Exception:
+                    LOG.exception(_("Failed to download image part"))
+                    self._fail('failed_download')
+                    return
+                try:
+                    stdin.write(part)
+                except IOError:
+                    # openssl has gone away, what it wrote says why
+                    return
+        finally:
+            parts.close()
+            stdin.close()
+
+    def open_image(self):
+        """Return a file object that reads the image out of the bundle."""
+        try:
+            tar_file = tarfile.open(fileobj=self._process.stdout,
+                                    mode='r|gz')
+            return tar_file.extractfile(S3ImageService._image_member(tar_file))
+        except Exception:
+            self._fail('failed_untar')
+            raise
+
+    def close(self):
+        """Wait for the download and decryption to finish."""
+        # Read the rest of the tarball after the image, or openssl can
+        # block writing it out and the writer block feeding openssl.
+        while self._process.stdout.read(65536):
+            pass
+        self._writer.wait()
+        self._process.stdout.close()
+        err = self._process.stderr.read()
+        if self._process.wait() != 0:
+            self._fail('failed_decrypt')
+            raise exception.NovaException(_('Failed to decrypt image: %s')
+                                          % err)
+        if self.failed_state is not None:
+            raise exception.NovaException(_('Failed to download image'))
+
+    def abort(self):
+        """Stop the download and decryption after a failure."""
+        if self._process.poll() not in (None, 0):
+            self._fail('failed_decrypt')
+        self._writer.kill()
+        if self._process.poll() is None:
+            self._process.kill()
+        self._process.stdout.close()
+        self._process.wait()
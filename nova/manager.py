@@ -280,6 +280,14 @@ class Manager(base.Base):
         """
         pass
 
+    def cleanup_host(self):
+        """Hook to do cleanup work when the service shuts down, before its
+        RPC connection is closed.
+
+        Child classes should override this method.
+        """
+        pass
+
 
 class SchedulerDependentManager(Manager):
     """Periodically send capability updates to the Scheduler services.
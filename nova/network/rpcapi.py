@@ -20,9 +20,9 @@ Client side of the network RPC API.
 
 from oslo.config import cfg
 
-from nova.openstack.common import jsonutils
 from nova.openstack.common import rpc
 from nova.openstack.common.rpc import proxy as rpc_proxy
+from nova import utils
 
 rpcapi_opts = [
     cfg.StrOpt('network_topic',
@@ -167,7 +167,7 @@ class NetworkAPI(rpc_proxy.RpcProxy):
                 instance_id=instance_id, project_id=project_id, host=host,
                 rxtx_factor=rxtx_factor, vpn=vpn,
                 requested_networks=requested_networks,
-                macs=jsonutils.to_primitive(macs)),
+                macs=utils.to_primitive(macs)),
                 topic=topic, version='1.9')
 
     def deallocate_for_instance(self, ctxt, instance_id, project_id, host):
@@ -255,7 +255,7 @@ class NetworkAPI(rpc_proxy.RpcProxy):
                 instance_id=instance_id, host=host, teardown=teardown))
 
     def set_network_host(self, ctxt, network_ref):
-        network_ref_p = jsonutils.to_primitive(network_ref)
+        network_ref_p = utils.to_primitive(network_ref)
         return self.call(ctxt, self.make_msg('set_network_host',
                 network_ref=network_ref_p))
 
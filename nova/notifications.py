@@ -210,9 +210,13 @@ def audit_period_bounds(current_period=False):
 
 
 def bandwidth_usage(instance_ref, audit_start,
-        ignore_missing_network_data=True):
+        ignore_missing_network_data=True, bw_usages=None):
     """Get bandwidth usage information for the instance for the
     specified audit period.
+
+    :param bw_usages: the instance's bandwidth usage records for the audit
+        period, if they have already been fetched; otherwise they are read
+        from the database.
     """
 
     admin_context = nova.context.get_admin_context(read_deleted='yes')
@@ -235,8 +239,10 @@ def bandwidth_usage(instance_ref, audit_start,
     macs = [vif['address'] for vif in nw_info]
     uuids = [instance_ref["uuid"]]
 
-    bw_usages = db.bw_usage_get_by_uuids(admin_context, uuids, audit_start)
-    bw_usages = [b for b in bw_usages if b.mac in macs]
+    if bw_usages is None:
+        bw_usages = db.bw_usage_get_by_uuids(admin_context, uuids,
+                                             audit_start)
+    bw_usages = [b for b in bw_usages if b['mac'] in macs]
 
     bw = {}
 
@@ -247,7 +253,7 @@ def bandwidth_usage(instance_ref, audit_start,
                 label = vif['network']['label']
                 break
 
-        bw[label] = dict(bw_in=b.bw_in, bw_out=b.bw_out)
+        bw[label] = dict(bw_in=b['bw_in'], bw_out=b['bw_out'])
 
     return bw
 
@@ -0,0 +1,228 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Notification driver that sends notifications from a background
+greenthread.
+
+notify() puts the message on a bounded in-memory queue and returns, so a
+slow message broker no longer holds up the caller.  A greenthread takes
+up to notification_batch_size messages off the queue and hands them one
+at a time to the drivers in queued_notification_driver, then yields to
+other greenthreads.  The drivers are not batched; the batch size only
+bounds how long the greenthread runs before it yields.
+
+To use it, set notification_driver to nova.notifier.queue_notifier and
+queued_notification_driver to the drivers that should get the
+notifications, e.g. nova.openstack.common.notifier.rpc_notifier.
+"""
+
+import atexit
+
+import eventlet
+from eventlet import queue
+from oslo.config import cfg
+
+from nova import exception
+from nova.openstack.common import importutils
+from nova.openstack.common import log as logging
+from nova.openstack.common import timeutils
+
+queue_notifier_opts = [
+    cfg.MultiStrOpt('queued_notification_driver',
+                    default=[],
+                    help='Driver or drivers the queue notifier sends '
+                         'notifications to; can be specified multiple times'),
+    cfg.IntOpt('notification_queue_size',
+               default=1000,
+               help='Number of notifications the queue notifier holds in '
+                    'memory, or 0 for no limit'),
+    cfg.StrOpt('notification_queue_overflow',
+               default='drop_oldest',
+               help='What to do with a notification when the queue is full: '
+                    'drop_oldest, drop_newest or block until there is room'),
+    cfg.IntOpt('notification_batch_size',
+               default=100,
+               help='Maximum number of queued notifications sent before the '
+                    'background greenthread yields to other greenthreads'),
+    cfg.IntOpt('notification_queue_stats_interval',
+               default=600,
+               help='Seconds between reports of the notification queue '
+                    'counters in the log, made by the background greenthread '
+                    'after it sends a batch (0 disables them)'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(queue_notifier_opts)
+
+LOG = logging.getLogger(__name__)
+
+OVERFLOW_POLICIES = ('drop_oldest', 'drop_newest', 'block')
+
+_drivers = None
+_queue = None
+_worker = None
+_last_report = None
+
+# Counters for the notification queue, see queue_stats()
+_queue_stats = {'queued': 0, 'sent': 0, 'dropped': 0, 'batches': 0,
+                'max_depth': 0}
+
+
+def _get_drivers():
+    """Load, cache and return the drivers queued notifications go to."""
+    global _drivers
+    if _drivers is None:
+        _drivers = []
+        for notification_driver in CONF.queued_notification_driver:
+            try:
+                _drivers.append(
+                        importutils.import_module(notification_driver))
+            except ImportError:
+                LOG.exception(_("Failed to load notifier %s. "
+                                "These notifications will not be sent.") %
+                              notification_driver)
+    return _drivers
+
+
+def notify(context, message):
+    """Queue a notification for the background greenthread to send,
+    starting the greenthread if need be.
+    """
+    global _queue, _worker, _last_report
+    if _queue is None:
+        if CONF.notification_queue_overflow not in OVERFLOW_POLICIES:
+            raise exception.NovaException(
+                _("Invalid notification_queue_overflow %(overflow)s, "
+                  "must be one of %(policies)s") %
+                {'overflow': CONF.notification_queue_overflow,
+                 'policies': ', '.join(OVERFLOW_POLICIES)})
+        _queue = queue.Queue(CONF.notification_queue_size or None)
+    if _worker is None:
+        _last_report = timeutils.utcnow()
+        _worker = eventlet.spawn(_send_queued)
+
+    overflow = CONF.notification_queue_overflow
+    if _queue.full() and overflow != 'block':
+        _queue_stats['dropped'] += 1
+        if _queue_stats['dropped'] % 100 == 1:
+            LOG.warn(_("Notification queue is full, %d notifications "
+                       "dropped so far"), _queue_stats['dropped'])
+        if overflow == 'drop_newest':
+            return
+        try:
+            _queue.get_nowait()
+            _queue.task_done()
+        except queue.Empty:
+            pass
+
+    _queue.put((context, message))
+    _queue_stats['queued'] += 1
+    _queue_stats['max_depth'] = max(_queue_stats['max_depth'],
+                                    _queue.qsize())
+
+
+def _send(context, message):
+    for driver in _get_drivers():
+        try:
+            driver.notify(context, message)
+        except Exception as e:
+            LOG.exception(_("Problem '%(e)s' attempting to "
+                            "send to notification system. "
+                            "Payload=%(payload)s")
+                          % dict(e=e, payload=message.get('payload')))
+
+
+def _get_batch(block=True):
+    batch = []
+    try:
+        if block:
+            batch.append(_queue.get())
+        while len(batch) < max(CONF.notification_batch_size, 1):
+            batch.append(_queue.get_nowait())
+    except queue.Empty:
+        pass
+    return batch
+
+
+def _send_batch(batch):
+    try:
+        for context, message in batch:
+            _send(context, message)
+    finally:
+        # Lets flush() know these are no longer in flight
+        for item in batch:
+            _queue.task_done()
+    _queue_stats['sent'] += len(batch)
+    _queue_stats['batches'] += 1
+
+
+def _report_stats():
+    """Log the queue counters if notification_queue_stats_interval seconds
+    have passed since they were last logged.
+    """
+    global _last_report
+    interval = CONF.notification_queue_stats_interval
+    if interval <= 0 or not timeutils.is_older_than(_last_report, interval):
+        return
+    _last_report = timeutils.utcnow()
+    LOG.info(_("Notification queue: %(queued)d queued, %(sent)d sent in "
+               "%(batches)d batches, %(dropped)d dropped, %(depth)d waiting "
+               "and %(max_depth)d waiting at most"), queue_stats())
+
+
+def _send_queued():
+    while True:
+        _send_batch(_get_batch())
+        _report_stats()
+        # Let the callers run between batches
+        eventlet.sleep(0)
+
+
+def flush():
+    """Send everything queued from the calling greenthread, then wait for
+    the notifications the background greenthread is still sending.
+    """
+    if _queue is None:
+        return
+    batch = _get_batch(block=False)
+    while batch:
+        _send_batch(batch)
+        batch = _get_batch(block=False)
+    _queue.join()
+
+
+def queue_stats():
+    """Return counters for the notification queue: notifications queued,
+    sent, dropped because the queue was full, batches sent, and the
+    current and largest number of notifications waiting.
+    """
+    stats = dict(_queue_stats)
+    stats['depth'] = _queue and _queue.qsize() or 0
+    return stats
+
+
+atexit.register(flush)
+
+
+def _reset():
+    """Used by unit tests to drop the queue and the loaded drivers."""
+    global _drivers, _queue, _worker, _last_report
+    if _worker is not None:
+        _worker.kill()
+    _drivers = None
+    _queue = None
+    _worker = None
+    _last_report = None
+    for key in _queue_stats:
+        _queue_stats[key] = 0
@@ -34,11 +34,13 @@ S3 client with this module::
 
 """
 
-import bisect
+import contextlib
 import datetime
 import hashlib
 import os
 import os.path
+import sqlite3
+import time
 import urllib
 
 from oslo.config import cfg
@@ -61,11 +63,21 @@ s3_opts = [
     cfg.IntOpt('s3_listen_port',
                default=3333,
                help='port for s3 api to listen'),
+    cfg.IntOpt('s3_index_rebuild_interval',
+               default=3600,
+               help='Seconds after which the listing index of a bucket is '
+                    'rebuilt from the files in it, picking up objects '
+                    'changed by other means (0 only rebuilds it the first '
+                    'time the bucket is used after a start)'),
 ]
 
 CONF = cfg.CONF
 CONF.register_opts(s3_opts)
 
+# Objects are read and written this many bytes at a time, so they never
+# have to fit in memory
+CHUNK_SIZE = 65536
+
 
 def get_wsgi_server():
     return wsgi.Server("S3 Objectstore",
@@ -96,9 +108,189 @@ class S3Application(wsgi.Router):
         self.directory = os.path.abspath(root_directory)
         fileutils.ensure_tree(self.directory)
         self.bucket_depth = bucket_depth
+        # When the index of each bucket was last built by this process
+        self.indexes_built_at = {}
         super(S3Application, self).__init__(mapper)
 
 
+class BucketIndex(object):
+    """Sorted index of the objects in a bucket, with their sizes,
+    modification times and the MD5 they were PUT with, so listing a bucket
+    costs a B-tree lookup and a page of rows instead of a walk of the whole
+    bucket.
+
+    The index is a sqlite database under .index in the root directory.
+    It is kept up to date by object PUTs and DELETEs.  It is rebuilt from
+    the files in the bucket the first time the bucket is used after a
+    start, in case the server stopped between writing a file and the
+    index, and every CONF.s3_index_rebuild_interval seconds after that,
+    to pick up files changed by other means.  Rebuilding keeps the MD5s
+    of the objects that did not change.
+    """
+
+    def __init__(self, application, bucket_name):
+        self.application = application
+        self.bucket_name = bucket_name
+        self.path = os.path.join(application.directory, '.index',
+                                 bucket_name + '.sqlite')
+
+    def _is_stale(self):
+        built_at = self.application.indexes_built_at.get(self.bucket_name)
+        if built_at is None or not os.path.exists(self.path):
+            return True
+        interval = CONF.s3_index_rebuild_interval
+        return interval > 0 and time.time() - built_at >= interval
+
+    @contextlib.contextmanager
+    def _connect(self):
+        if self._is_stale():
+            self._build()
+        conn = sqlite3.connect(self.path)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _build(self):
+        fileutils.ensure_tree(os.path.dirname(self.path))
+        built_at = time.time()
+        etags = self._etags()
+        bucket_path = os.path.join(self.application.directory,
+                                   self.bucket_name)
+        skip = len(bucket_path) + 1
+        for i in range(self.application.bucket_depth):
+            skip += 2 * (i + 1) + 1
+        rows = []
+        for root, dirs, files in os.walk(bucket_path):
+            for file_name in files:
+                path = os.path.join(root, file_name)
+                info = os.stat(path)
+                name = path[skip:]
+                etag = etags.get(name)
+                if etag is not None and etag[:2] != (info.st_size,
+                                                     info.st_mtime):
+                    etag = None
+                rows.append((buffer(name), info.st_size, info.st_mtime,
+                             etag and etag[2]))
+
+        # Build the index beside where it goes, so a half-built index is
+        # never used
+        tmp_path = self.path + '.tmp'
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        conn = sqlite3.connect(tmp_path)
+        try:
+            with conn:
+                conn.execute('CREATE TABLE objects (name BLOB PRIMARY KEY, '
+                             'size INTEGER, mtime REAL, etag TEXT)')
+                conn.executemany('INSERT INTO objects VALUES (?, ?, ?, ?)',
+                                 rows)
+        finally:
+            conn.close()
+        os.rename(tmp_path, self.path)
+        self.application.indexes_built_at[self.bucket_name] = built_at
+
+    def _etags(self):
+        """Return the (size, mtime, MD5) of each object in the current
+        index, by name.
+        """
+        if not os.path.exists(self.path):
+            return {}
+        conn = sqlite3.connect(self.path)
+        try:
+            return dict((str(name), (size, mtime, etag))
+                        for name, size, mtime, etag in conn.execute(
+                            'SELECT name, size, mtime, etag FROM objects '
+                            'WHERE etag IS NOT NULL'))
+        except sqlite3.Error:
+            return {}
+        finally:
+            conn.close()
+
+    def add(self, object_name, info, etag):
+        with self._connect() as conn:
+            conn.execute('INSERT OR REPLACE INTO objects '
+                         'VALUES (?, ?, ?, ?)',
+                         (buffer(object_name), info.st_size, info.st_mtime,
+                          etag))
+
+    def etag(self, object_name, info):
+        """Return the ETag the object was PUT with, or None if it is not
+        known or the file has changed since.
+        """
+        with self._connect() as conn:
+            row = conn.execute('SELECT size, mtime, etag FROM objects '
+                               'WHERE name = ?',
+                               (buffer(object_name),)).fetchone()
+        if row is None or row[:2] != (info.st_size, info.st_mtime):
+            return None
+        return row[2]
+
+    def remove(self, object_name):
+        with self._connect() as conn:
+            conn.execute('DELETE FROM objects WHERE name = ?',
+                         (buffer(object_name),))
+
+    def list(self, prefix, marker, limit):
+        """Return up to limit (name, size, mtime) tuples for the objects
+        after marker whose names start with prefix, in name order.
+        """
+        query = ('SELECT name, size, mtime FROM objects WHERE name > ? '
+                 'AND name >= ? ORDER BY name LIMIT ?')
+        with self._connect() as conn:
+            rows = conn.execute(query, (buffer(marker), buffer(prefix),
+                                        limit))
+            objects = []
+            for name, size, mtime in rows:
+                name = str(name)
+                if not name.startswith(prefix):
+                    break
+                objects.append((name, size, mtime))
+            return objects
+
+    def destroy(self):
+        self.application.indexes_built_at.pop(self.bucket_name, None)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class FileIter(object):
+    """WSGI app_iter that reads a file CHUNK_SIZE bytes at a time.
+
+    app_iter_range() lets webob serve Range requests by seeking rather
+    than reading through the start of the file.
+    """
+
+    def __init__(self, path):
+        self.file = open(path, "rb")
+
+    def __iter__(self):
+        return self.app_iter_range()
+
+    def app_iter_range(self, start=None, stop=None):
+        if start:
+            self.file.seek(start)
+        left = None
+        if stop is not None:
+            left = stop - (start or 0)
+        try:
+            while left is None or left > 0:
+                size = CHUNK_SIZE
+                if left is not None:
+                    size = min(size, left)
+                    left -= size
+                chunk = self.file.read(size)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            self.close()
+
+    def close(self):
+        self.file.close()
+
+
 class BaseRequestHandler(object):
     """Base class emulating Tornado's web framework pattern in WSGI.
 
@@ -211,6 +403,9 @@ class RootHandler(BaseRequestHandler):
         names = os.listdir(self.application.directory)
         buckets = []
         for name in names:
+            if name.startswith('.'):
+                # Not a bucket, the bucket indexes live in .index
+                continue
             path = os.path.join(self.application.directory, name)
             info = os.stat(path)
             buckets.append({
@@ -235,38 +430,18 @@ class BucketHandler(BaseRequestHandler):
             not os.path.isdir(path)):
             self.set_status(404)
             return
-        object_names = []
-        for root, dirs, files in os.walk(path):
-            for file_name in files:
-                object_names.append(os.path.join(root, file_name))
-        skip = len(path) + 1
-        for i in range(self.application.bucket_depth):
-            skip += 2 * (i + 1) + 1
-        object_names = [n[skip:] for n in object_names]
-        object_names.sort()
+        index = BucketIndex(self.application, bucket_name)
+        objects = index.list(utils.utf8(prefix), utils.utf8(marker),
+                             max_keys + 1)
+        truncated = len(objects) > max_keys
         contents = []
-
-        start_pos = 0
-        if marker:
-            start_pos = bisect.bisect_right(object_names, marker, start_pos)
-        if prefix:
-            start_pos = bisect.bisect_left(object_names, prefix, start_pos)
-
-        truncated = False
-        for object_name in object_names[start_pos:]:
-            if not object_name.startswith(prefix):
-                break
-            if len(contents) >= max_keys:
-                truncated = True
-                break
-            object_path = self._object_path(bucket_name, object_name)
+        for object_name, size, mtime in objects[:max_keys]:
             c = {"Key": object_name}
             if not terse:
-                info = os.stat(object_path)
                 c.update({
                     "LastModified": datetime.datetime.utcfromtimestamp(
-                        info.st_mtime),
-                    "Size": info.st_size,
+                        mtime),
+                    "Size": size,
                 })
             contents.append(c)
             marker = object_name
@@ -300,6 +475,7 @@ class BucketHandler(BaseRequestHandler):
             self.set_status(403)
             return
         os.rmdir(path)
+        BucketIndex(self.application, bucket_name).destroy()
         self.set_status(204)
         self.finish()
 
@@ -314,13 +490,18 @@ class ObjectHandler(BaseRequestHandler):
             return
         info = os.stat(path)
         self.set_header("Content-Type", "application/unknown")
-        self.set_header("Last-Modified", datetime.datetime.utcfromtimestamp(
-            info.st_mtime))
-        object_file = open(path, "r")
-        try:
-            self.finish(object_file.read())
-        finally:
-            object_file.close()
+        self.response.app_iter = FileIter(path)
+        self.response.content_length = info.st_size
+        self.response.last_modified = info.st_mtime
+        # The ETag is the MD5 of the body, remembered when it was PUT
+        etag = BucketIndex(self.application, bucket).etag(object_name, info)
+        if etag is not None:
+            self.response.etag = etag
+        self.response.accept_ranges = 'bytes'
+        # Let webob answer Range, If-None-Match and If-Modified-Since
+        self.response.conditional_response = True
+
+    head = get
 
     def put(self, bucket, object_name):
         object_name = urllib.unquote(object_name)
@@ -336,11 +517,18 @@ class ObjectHandler(BaseRequestHandler):
             return
         directory = os.path.dirname(path)
         fileutils.ensure_tree(directory)
-        object_file = open(path, "w")
-        object_file.write(self.request.body)
-        object_file.close()
-        self.set_header('ETag',
-                        '"%s"' % hashlib.md5(self.request.body).hexdigest())
+        md5 = hashlib.md5()
+        body_file = self.request.body_file
+        with open(path, "w") as object_file:
+            chunk = body_file.read(CHUNK_SIZE)
+            while chunk:
+                md5.update(chunk)
+                object_file.write(chunk)
+                chunk = body_file.read(CHUNK_SIZE)
+        etag = md5.hexdigest()
+        BucketIndex(self.application, bucket).add(object_name,
+                                                   os.stat(path), etag)
+        self.set_header('ETag', '"%s"' % etag)
         self.finish()
 
     def delete(self, bucket, object_name):
@@ -351,5 +539,6 @@ class ObjectHandler(BaseRequestHandler):
             self.set_status(404)
             return
         os.unlink(path)
+        BucketIndex(self.application, bucket).remove(object_name)
         self.set_status(204)
         self.finish()
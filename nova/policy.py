@@ -17,7 +17,10 @@
 
 """Policy Engine For Nova."""
 
+import datetime
 import os.path
+import re
+import time
 
 from oslo.config import cfg
 
@@ -33,6 +36,19 @@ policy_opts = [
     cfg.StrOpt('policy_default_rule',
                default='default',
                help=_('Rule checked when requested rule is not found')),
+    cfg.IntOpt('policy_file_check_interval',
+               default=1,
+               help=_('Seconds between checks of the policy file for '
+                      'changes')),
+    cfg.IntOpt('policy_cache_size',
+               default=10000,
+               help=_('Number of policy decisions to remember; 0 disables '
+                      'the decision cache')),
+    cfg.IntOpt('policy_cache_stats_interval',
+               default=600,
+               help=_('Seconds between reports of the policy decision cache '
+                      'hit and miss counts in the log of each service '
+                      '(0 disables them)')),
     ]
 
 CONF = cfg.CONF
@@ -41,6 +57,18 @@ CONF.register_opts(policy_opts)
 _POLICY_PATH = None
 _POLICY_CACHE = {}
 
+# Decisions are only valid for the rules they were made with, so the cache
+# is emptied whenever policy._rules is replaced.
+_DECISION_RULES = None
+_DECISION_CACHE = {}
+_DECISION_INPUTS = {}
+_DECISION_STATS = {'hits': 0, 'misses': 0, 'uncacheable': 0}
+
+_MISSING = object()
+_IMMUTABLE_TYPES = (basestring, int, long, float, bool, type(None),
+                    datetime.datetime)
+_TARGET_KEY_RE = re.compile(r'%\(([^)]+)\)')
+
 
 def reset():
     global _POLICY_PATH
@@ -48,6 +76,9 @@ def reset():
     _POLICY_PATH = None
     _POLICY_CACHE = {}
     policy.reset()
+    _reset_decisions()
+    for key in _DECISION_STATS:
+        _DECISION_STATS[key] = 0
 
 
 def init():
@@ -59,8 +90,14 @@ def init():
             _POLICY_PATH = CONF.find_file(_POLICY_PATH)
         if not _POLICY_PATH:
             raise exception.ConfigNotFound(path=CONF.policy_file)
+    now = time.time()
+    checked_at = _POLICY_CACHE.get('checked_at')
+    if (checked_at is not None and
+            0 <= now - checked_at < CONF.policy_file_check_interval):
+        return
     utils.read_cached_file(_POLICY_PATH, _POLICY_CACHE,
                            reload_func=_set_rules)
+    _POLICY_CACHE['checked_at'] = now
 
 
 def _set_rules(data):
@@ -68,6 +105,135 @@ def _set_rules(data):
     policy.set_rules(policy.Rules.load_json(data, default_rule))
 
 
+def _reset_decisions():
+    global _DECISION_RULES
+    _DECISION_RULES = policy._rules
+    _DECISION_CACHE.clear()
+    _DECISION_INPUTS.clear()
+
+
+def _check_inputs(check, seen):
+    """Find the credentials and target keys a check tree depends on.
+
+    Returns a pair of sets, or None if the result of the check can not be
+    cached, e.g. because it asks a remote server.
+    """
+    check_type = type(check)
+    if check_type in (policy.TrueCheck, policy.FalseCheck):
+        return set(), set()
+    if check_type is policy.NotCheck:
+        return _check_inputs(check.rule, seen)
+    if check_type in (policy.AndCheck, policy.OrCheck):
+        creds, target = set(), set()
+        for rule in check.rules:
+            inputs = _check_inputs(rule, seen)
+            if inputs is None:
+                return None
+            creds.update(inputs[0])
+            target.update(inputs[1])
+        return creds, target
+    if check_type is policy.RuleCheck:
+        if check.match in seen:
+            return set(), set()
+        return _rule_inputs(check.match, seen | set([check.match]))
+    if check_type is policy.RoleCheck:
+        return set(['roles']), set()
+    if check_type is policy.GenericCheck:
+        return (set([check.kind]),
+                set(_TARGET_KEY_RE.findall(check.match)))
+    if check_type is IsAdminCheck:
+        return set(['is_admin']), set()
+    return None
+
+
+def _rule_inputs(action, seen=frozenset()):
+    try:
+        rule = policy._rules[action]
+    except (KeyError, TypeError):
+        # Missing rules and missing policy both fail closed
+        return set(), set()
+    return _check_inputs(rule, seen)
+
+
+def _freeze(value):
+    """Turn a value into a hashable one that changes whenever it does.
+
+    Raises TypeError for objects which might change without their hash.
+    """
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    if value is _MISSING or isinstance(value, _IMMUTABLE_TYPES):
+        return value
+    raise TypeError(value)
+
+
+def _decision_key(action, context, target):
+    """Build the cache key for a decision, or None if it can't be cached.
+
+    Only the attributes the rule references are part of the key.  A target
+    of None stands for the credentials themselves.
+    """
+    if CONF.policy_cache_size <= 0:
+        return None
+
+    if _DECISION_RULES is not policy._rules:
+        _reset_decisions()
+
+    if action not in _DECISION_INPUTS:
+        inputs = _rule_inputs(action)
+        if inputs is not None:
+            inputs = (tuple(sorted(inputs[0])), tuple(sorted(inputs[1])))
+        _DECISION_INPUTS[action] = inputs
+    inputs = _DECISION_INPUTS[action]
+    if inputs is None:
+        return None
+
+    cred_keys, target_keys = inputs
+    key = [action, target is None]
+    key.extend(getattr(context, k, _MISSING) for k in cred_keys)
+    if target is None:
+        key.extend(getattr(context, k, _MISSING) for k in target_keys)
+    else:
+        key.extend(target.get(k, _MISSING) for k in target_keys)
+    try:
+        return _freeze(key)
+    except TypeError:
+        return None
+
+
+def _cached_check(context, action, target):
+    key = _decision_key(action, context, target)
+    if key is None:
+        _DECISION_STATS['uncacheable'] += 1
+    else:
+        try:
+            result = _DECISION_CACHE[key]
+            _DECISION_STATS['hits'] += 1
+            return result
+        except KeyError:
+            _DECISION_STATS['misses'] += 1
+
+    credentials = context.to_dict()
+    if target is None:
+        target = credentials
+    result = policy.check(action, target, credentials)
+
+    if key is not None:
+        if len(_DECISION_CACHE) >= CONF.policy_cache_size:
+            _DECISION_CACHE.clear()
+        _DECISION_CACHE[key] = result
+    return result
+
+
+def cache_stats():
+    """Return hit and miss counts for the policy decision cache."""
+    stats = dict(_DECISION_STATS)
+    stats['size'] = len(_DECISION_CACHE)
+    return stats
+
+
 def enforce(context, action, target, do_raise=True):
     """Verifies that the action is valid on the target in this context.
 
@@ -92,14 +258,12 @@ def enforce(context, action, target, do_raise=True):
     """
     init()
 
-    credentials = context.to_dict()
+    result = _cached_check(context, action, target)
 
-    # Add the exception arguments if asked to do a raise
-    extra = {}
-    if do_raise:
-        extra.update(exc=exception.PolicyNotAuthorized, action=action)
+    if do_raise and result is False:
+        raise exception.PolicyNotAuthorized(action=action)
 
-    return policy.check(action, target, credentials, **extra)
+    return result
 
 
 def check_is_admin(context):
@@ -109,10 +273,7 @@ def check_is_admin(context):
     init()
 
     #the target is user-self
-    credentials = context.to_dict()
-    target = credentials
-
-    return policy.check('context_is_admin', target, credentials)
+    return _cached_check(context, 'context_is_admin', None)
 
 
 @policy.register('is_admin')
@@ -20,8 +20,8 @@ Client side of the scheduler manager RPC API.
 
 from oslo.config import cfg
 
-from nova.openstack.common import jsonutils
 import nova.openstack.common.rpc.proxy
+from nova import utils
 
 rpcapi_opts = [
     cfg.StrOpt('scheduler_topic',
@@ -86,10 +86,10 @@ class SchedulerAPI(nova.openstack.common.rpc.proxy.RpcProxy):
 
     def prep_resize(self, ctxt, instance, instance_type, image,
             request_spec, filter_properties, reservations):
-        instance_p = jsonutils.to_primitive(instance)
-        instance_type_p = jsonutils.to_primitive(instance_type)
-        reservations_p = jsonutils.to_primitive(reservations)
-        image_p = jsonutils.to_primitive(image)
+        instance_p = utils.to_primitive(instance)
+        instance_type_p = utils.to_primitive(instance_type)
+        reservations_p = utils.to_primitive(reservations)
+        image_p = utils.to_primitive(image)
         self.cast(ctxt, self.make_msg('prep_resize',
                 instance=instance_p, instance_type=instance_type_p,
                 image=image_p, request_spec=request_spec,
@@ -103,7 +103,7 @@ class SchedulerAPI(nova.openstack.common.rpc.proxy.RpcProxy):
             instance, dest):
         # NOTE(comstud): Call vs cast so we can get exceptions back, otherwise
         # this call in the scheduler driver doesn't return anything.
-        instance_p = jsonutils.to_primitive(instance)
+        instance_p = utils.to_primitive(instance)
         return self.call(ctxt, self.make_msg('live_migration',
                 block_migration=block_migration,
                 disk_over_commit=disk_over_commit, instance=instance_p,
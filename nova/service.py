@@ -33,11 +33,14 @@ from oslo.config import cfg
 
 from nova import conductor
 from nova import context
+from nova import db
 from nova import exception
+from nova.notifier import queue_notifier
 from nova.openstack.common import eventlet_backdoor
 from nova.openstack.common import importutils
 from nova.openstack.common import log as logging
 from nova.openstack.common import rpc
+from nova import policy
 from nova import servicegroup
 from nova import utils
 from nova import version
@@ -115,7 +118,58 @@ service_opts = [
 
 CONF = cfg.CONF
 CONF.register_opts(service_opts)
+CONF.import_opt('dbapi_tpool_size', 'nova.db.threadpool')
+CONF.import_opt('dbapi_tpool_stats_interval', 'nova.db.threadpool')
 CONF.import_opt('host', 'nova.netconf')
+CONF.import_opt('policy_cache_stats_interval', 'nova.policy')
+
+
+def _log_db_tpool_stats():
+    stats = db.tpool_stats()
+    if stats is None:
+        return
+    LOG.info(_("DB thread pool: %(in_flight)d calls in %(pool_size)d "
+               "threads, %(queue_depth)d queued, %(max_in_flight)d in "
+               "flight at most; %(calls)d calls waited %(average_wait).3fs "
+               "on average and %(max_wait).3fs at most for a thread"), stats)
+
+
+def _start_db_tpool_stats():
+    """Log the statistics of the DB thread pool every
+    dbapi_tpool_stats_interval seconds, if DB API calls run in one.
+
+    Returns the timer, or None.
+    """
+    interval = CONF.dbapi_tpool_stats_interval
+    if interval <= 0 or CONF.dbapi_tpool_size <= 0:
+        return None
+    timer = utils.FixedIntervalLoopingCall(_log_db_tpool_stats)
+    timer.start(interval=interval, initial_delay=interval)
+    return timer
+
+
+def _log_policy_cache_stats():
+    stats = policy.cache_stats()
+    if not (stats['hits'] or stats['misses'] or stats['uncacheable']):
+        # Nothing in this service checks policy
+        return
+    LOG.info(_("Policy decision cache: %(hits)d hits, %(misses)d misses, "
+               "%(uncacheable)d uncacheable checks, %(size)d decisions "
+               "cached"), stats)
+
+
+def _start_policy_cache_stats():
+    """Log the policy decision cache counters every
+    policy_cache_stats_interval seconds.
+
+    Returns the timer, or None.
+    """
+    interval = CONF.policy_cache_stats_interval
+    if interval <= 0:
+        return None
+    timer = utils.FixedIntervalLoopingCall(_log_policy_cache_stats)
+    timer.start(interval=interval, initial_delay=interval)
+    return timer
 
 
 class SignalExit(SystemExit):
@@ -401,6 +455,7 @@ class Service(object):
         self.binary = binary
         self.topic = topic
         self.manager_class_name = manager
+        self.db_allowed = db_allowed
         # NOTE(russellb) We want to make sure to create the servicegroup API
         # instance early, before creating other things such as the manager,
         # that will also create a servicegroup API instance.  Internally, the
@@ -478,6 +533,14 @@ class Service(object):
                            periodic_interval_max=self.periodic_interval_max)
             self.timers.append(periodic)
 
+        if self.db_allowed:
+            db_stats = _start_db_tpool_stats()
+            if db_stats:
+                self.timers.append(db_stats)
+        policy_stats = _start_policy_cache_stats()
+        if policy_stats:
+            self.timers.append(policy_stats)
+
     def _create_service_ref(self, context):
         svc_values = {
             'host': self.host,
@@ -545,6 +608,10 @@ class Service(object):
             LOG.warn(_('Service killed that has no database entry'))
 
     def stop(self):
+        try:
+            self.manager.cleanup_host()
+        except Exception:
+            LOG.exception(_('Service %s failed to clean up'), self.topic)
         # Try to shut the connection down, but if we get any sort of
         # errors, go ahead and ignore them.. as we're shutting down anyway
         try:
@@ -557,6 +624,8 @@ class Service(object):
             except Exception:
                 pass
         self.timers = []
+        # Send any notifications still queued while we can
+        queue_notifier.flush()
 
     def wait(self):
         for x in self.timers:
@@ -609,6 +678,7 @@ class WSGIService(object):
         # Pull back actual port used
         self.port = self.server.port
         self.backdoor_port = None
+        self.timers = []
 
     def _get_manager(self):
         """Initialize a Manager object appropriate for this service.
@@ -648,6 +718,11 @@ class WSGIService(object):
         self.server.start()
         if self.manager:
             self.manager.post_start_hook()
+        for start_stats in (_start_db_tpool_stats,
+                            _start_policy_cache_stats):
+            timer = start_stats()
+            if timer:
+                self.timers.append(timer)
 
     def stop(self):
         """Stop serving this API.
@@ -656,6 +731,10 @@ class WSGIService(object):
 
         """
         self.server.stop()
+        for timer in self.timers:
+            timer.stop()
+        self.timers = []
+        queue_notifier.flush()
 
     def wait(self):
         """Wait for the service to stop serving this API.
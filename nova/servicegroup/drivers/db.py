@@ -14,6 +14,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import time
+
 from oslo.config import cfg
 
 from nova import conductor
@@ -24,7 +26,24 @@ from nova.servicegroup import api
 from nova import utils
 
 
+db_driver_opts = [
+    cfg.IntOpt('servicegroup_db_cache_time',
+               default=5,
+               help='Seconds for which the DB servicegroup driver reuses '
+                    'the members of a group before fetching them again '
+                    '(0 disables the cache)'),
+    cfg.BoolOpt('servicegroup_db_batch_heartbeats',
+                default=False,
+                help='Send service heartbeats to nova-conductor as casts '
+                     'that it writes to the database in batches, instead '
+                     'of waiting for each write.  Only enable this once '
+                     'every nova-conductor supports RPC API 1.44.  A '
+                     'service then no longer notices itself when its '
+                     'heartbeats cannot be written'),
+]
+
 CONF = cfg.CONF
+CONF.register_opts(db_driver_opts)
 CONF.import_opt('service_down_time', 'nova.service')
 
 LOG = logging.getLogger(__name__)
@@ -35,6 +54,8 @@ class DbDriver(api.ServiceGroupDriver):
     def __init__(self, *args, **kwargs):
         self.db_allowed = kwargs.get('db_allowed', True)
         self.conductor_api = conductor.API(use_local=self.db_allowed)
+        # Services of each group as last fetched, with the fetch time
+        self._members = {}
 
     def join(self, member_id, group_id, service=None):
         """Join the given service with it's group."""
@@ -74,23 +95,43 @@ class DbDriver(api.ServiceGroupDriver):
         """
         LOG.debug(_('DB_Driver: get_all members of the %s group') % group_id)
         rs = []
-        ctxt = context.get_admin_context()
-        services = self.conductor_api.service_get_all_by_topic(ctxt, group_id)
-        for service in services:
+        for service in self._get_members(group_id):
             if self.is_up(service):
                 rs.append(service['host'])
         return rs
 
+    def _get_members(self, group_id):
+        """Return the services of a group, fetching them if the copy
+        from a previous call is too old.
+
+        The copy only saves the round trip: is_up() still judges each
+        service by the heartbeat it was fetched with, so a cached service is
+        at worst seen as servicegroup_db_cache_time seconds staler than it
+        really is.
+        """
+        fetched_at, services = self._members.get(group_id, (None, None))
+        now = time.time()
+        if (fetched_at is None or
+                now - fetched_at >= CONF.servicegroup_db_cache_time):
+            ctxt = context.get_admin_context()
+            services = self.conductor_api.service_get_all_by_topic(ctxt,
+                                                                  group_id)
+            if CONF.servicegroup_db_cache_time > 0:
+                self._members[group_id] = (now, services)
+        return services
+
     def _report_state(self, service):
         """Update the state of this service in the datastore."""
         ctxt = context.get_admin_context()
-        state_catalog = {}
         try:
             report_count = service.service_ref['report_count'] + 1
-            state_catalog['report_count'] = report_count
-
-            service.service_ref = self.conductor_api.service_update(ctxt,
-                    service.service_ref, state_catalog)
+            if CONF.servicegroup_db_batch_heartbeats:
+                service.service_ref = self.conductor_api.service_heartbeat(
+                        ctxt, service.service_ref, report_count)
+            else:
+                service.service_ref = self.conductor_api.service_update(
+                        ctxt, service.service_ref,
+                        {'report_count': report_count})
 
             # TODO(termie): make this pattern be more elegant.
             if getattr(service, 'model_disconnected', False):
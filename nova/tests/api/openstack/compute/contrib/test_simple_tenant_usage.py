@@ -65,13 +65,24 @@ def get_fake_db_instance(start, end, instance_id, tenant_id):
             'terminated_at': end}
 
 
-def fake_instance_get_active_by_window_joined(self, context, begin, end,
-        project_id):
-            return [get_fake_db_instance(START,
-                                         STOP,
-                                         x,
-                                         "faketenant_%s" % (x / SERVERS))
-                                         for x in xrange(TENANTS * SERVERS)]
+def fake_instance_get_active_by_window_usage(self, context, begin, end,
+        project_id, marker=None, limit=None):
+            instances = [get_fake_db_instance(START,
+                                              STOP,
+                                              x,
+                                              "faketenant_%s" % (x / SERVERS))
+                         for x in xrange(TENANTS * SERVERS)]
+            if project_id:
+                instances = [i for i in instances
+                             if i['project_id'] == project_id]
+            if marker is not None:
+                instances = [i for i in instances if i['id'] > marker]
+            return instances[:limit]
+
+
+def fake_get_usage_rollups_by_window(self, context, begin, end,
+                                     project_id=None):
+    return None
 
 
 class SimpleTenantUsageTest(test.TestCase):
@@ -79,8 +90,10 @@ class SimpleTenantUsageTest(test.TestCase):
         super(SimpleTenantUsageTest, self).setUp()
         self.stubs.Set(api.API, "get_instance_type",
                        fake_instance_type_get)
-        self.stubs.Set(api.API, "get_active_by_window",
-                       fake_instance_get_active_by_window_joined)
+        self.stubs.Set(api.API, "get_active_usage_by_window",
+                       fake_instance_get_active_by_window_usage)
+        self.stubs.Set(api.API, "get_usage_rollups_by_window",
+                       fake_get_usage_rollups_by_window)
         self.admin_context = context.RequestContext('fakeadmin_0',
                                                     'faketenant_0',
                                                     is_admin=True)
@@ -134,20 +147,58 @@ class SimpleTenantUsageTest(test.TestCase):
         future = NOW + datetime.timedelta(hours=HOURS)
         self._test_verify_show(START, future)
 
-    def _get_tenant_usages(self, detailed=''):
+    def _get_tenant_usages(self, detailed='', query='', status=200):
         req = webob.Request.blank(
                     '/v2/faketenant_0/os-simple-tenant-usage?'
-                    'detailed=%s&start=%s&end=%s' %
-                    (detailed, START.isoformat(), STOP.isoformat()))
+                    'detailed=%s&start=%s&end=%s%s' %
+                    (detailed, START.isoformat(), STOP.isoformat(), query))
         req.method = "GET"
         req.headers["content-type"] = "application/json"
 
         res = req.get_response(fakes.wsgi_app(
                                fake_auth_context=self.admin_context,
                                init_only=('os-simple-tenant-usage',)))
-        self.assertEqual(res.status_int, 200)
-        res_dict = jsonutils.loads(res.body)
-        return res_dict['tenant_usages']
+        self.assertEqual(res.status_int, status)
+        if status == 200:
+            res_dict = jsonutils.loads(res.body)
+            return res_dict['tenant_usages']
+
+    def _server_uuids(self, usages):
+        uuids = []
+        for usage in sorted(usages, key=lambda u: u['tenant_id']):
+            uuids.extend(s['instance_id'] for s in usage['server_usages'])
+        return uuids
+
+    def test_verify_detailed_index_paginated(self):
+        uuids = ['00000000-0000-0000-0000-00000000000000%02d' % x
+                 for x in xrange(TENANTS * SERVERS)]
+        usages = self._get_tenant_usages('1', '&limit=3')
+        self.assertEqual(uuids[:3], self._server_uuids(usages))
+        # The totals still cover every server
+        for usage in usages:
+            self.assertEqual(int(usage['total_hours']), SERVERS * HOURS)
+
+        usages = self._get_tenant_usages('1', '&limit=4&marker=%s' %
+                                         uuids[2])
+        self.assertEqual(uuids[3:7], self._server_uuids(usages))
+
+    def test_verify_detailed_index_bad_marker(self):
+        self._get_tenant_usages('1', '&marker=unknown', status=400)
+
+    def test_instances_read_in_pages(self):
+        self.stubs.Set(simple_tenant_usage, 'USAGE_PAGE_SIZE', 4)
+        markers = []
+
+        def fake_usage_by_window(*args, **kwargs):
+            markers.append(kwargs['marker'])
+            return fake_instance_get_active_by_window_usage(*args, **kwargs)
+        self.stubs.Set(api.API, "get_active_usage_by_window",
+                       fake_usage_by_window)
+
+        usages = self._get_tenant_usages('1')
+        self.assertEqual([None, 3, 7], markers)
+        self.assertEqual(TENANTS * SERVERS,
+                         len(self._server_uuids(usages)))
 
     def test_verify_detailed_index(self):
         usages = self._get_tenant_usages('1')
@@ -167,6 +218,70 @@ class SimpleTenantUsageTest(test.TestCase):
         for i in xrange(TENANTS):
             self.assertEqual(usages[i].get('server_usages'), None)
 
+    def _rolled_up_usages(self, rollups, detailed=False):
+        start = datetime.datetime(2013, 3, 1, 18)
+        stop = datetime.datetime(2013, 3, 4, 6)
+        windows = []
+        rollup_windows = []
+
+        def fake_usage_by_window(self, context, begin, end, project_id,
+                                 marker=None, limit=None):
+            windows.append((begin, end))
+            return [get_fake_db_instance(start, None, 1, 'faketenant_0')]
+
+        def fake_rollups(self, context, begin, end, project_id=None):
+            rollup_windows.append((begin, end))
+            return rollups
+        self.stubs.Set(api.API, "get_active_usage_by_window",
+                       fake_usage_by_window)
+        self.stubs.Set(api.API, "get_usage_rollups_by_window", fake_rollups)
+
+        controller = simple_tenant_usage.SimpleTenantUsageController()
+        usages = controller._tenant_usages_for_period(
+            self.admin_context, start, stop, detailed=detailed)
+        self.assertEqual([(datetime.datetime(2013, 3, 2),
+                           datetime.datetime(2013, 3, 4))], rollup_windows)
+        return windows, dict((u['tenant_id'], u) for u in usages)
+
+    def test_verify_simple_index_from_rollups(self):
+        rollups = [dict(project_id='faketenant_0', instance_type_id=1,
+                        hours=48.0),
+                   dict(project_id='faketenant_1', instance_type_id=1,
+                        hours=10.0)]
+        windows, usages = self._rolled_up_usages(rollups)
+        # Only the partial days are read from the instances
+        self.assertEqual([(datetime.datetime(2013, 3, 1, 18),
+                           datetime.datetime(2013, 3, 2)),
+                          (datetime.datetime(2013, 3, 4),
+                           datetime.datetime(2013, 3, 4, 6))], windows)
+        self.assertEqual(60, usages['faketenant_0']['total_hours'])
+        self.assertEqual(60 * VCPUS,
+                         usages['faketenant_0']['total_vcpus_usage'])
+        self.assertEqual(10, usages['faketenant_1']['total_hours'])
+        self.assertEqual(10 * MEMORY_MB,
+                         usages['faketenant_1']['total_memory_mb_usage'])
+
+    def test_verify_simple_index_not_rolled_up(self):
+        windows, usages = self._rolled_up_usages(None)
+        self.assertEqual([(datetime.datetime(2013, 3, 1, 18),
+                           datetime.datetime(2013, 3, 4, 6))], windows)
+        self.assertEqual(60, usages['faketenant_0']['total_hours'])
+        self.assertEqual(['faketenant_0'], usages.keys())
+
+    def test_verify_detailed_index_from_rollups(self):
+        # The rollups disagree with the instance, to tell where totals
+        # come from
+        rollups = [dict(project_id='faketenant_0', instance_type_id=1,
+                        hours=47.0)]
+        windows, usages = self._rolled_up_usages(rollups, detailed=True)
+        # The servers are listed over the whole period
+        self.assertEqual([(datetime.datetime(2013, 3, 1, 18),
+                           datetime.datetime(2013, 3, 4, 6))], windows)
+        usage = usages['faketenant_0']
+        self.assertEqual(59, usage['total_hours'])
+        self.assertEqual(59 * VCPUS, usage['total_vcpus_usage'])
+        self.assertEqual([60], [u['hours'] for u in usage['server_usages']])
+
     def _test_verify_show(self, start, stop):
         tenant_id = 0
         req = webob.Request.blank(
@@ -27,6 +27,7 @@ import webob
 from nova.api.openstack.compute import limits
 from nova.api.openstack.compute import views
 from nova.api.openstack import xmlutil
+from nova.common import memorycache
 import nova.context
 from nova.openstack.common import jsonutils
 from nova import test
@@ -311,6 +312,17 @@ class LimitMiddlewareTest(BaseLimitTestSuite):
         # Test that middleware selected correct limiter class.
         assert isinstance(self.app._limiter, TestLimiter)
 
+    def test_shared_limiter_needs_memcached(self):
+        app = limits.RateLimitingMiddleware(
+            self._empty_app, limiter='%s.SharedLimiter' % limits.__name__)
+        self.assertEqual(limits.Limiter, type(app._limiter))
+
+        self.flags(memcached_servers=['127.0.0.1:11211'])
+        self.stubs.Set(memorycache, 'get_client', memorycache.Client)
+        app = limits.RateLimitingMiddleware(
+            self._empty_app, limiter='%s.SharedLimiter' % limits.__name__)
+        self.assertEqual(limits.SharedLimiter, type(app._limiter))
+
     def test_good_request(self):
         # Test successful GET request through middleware.
         request = webob.Request.blank("/")
@@ -606,6 +618,103 @@ class LimiterTest(BaseLimitTestSuite):
         results = list(self._check(5, "PUT", "/anything", "user2"))
         self.assertEqual(expected, results)
 
+    def test_least_recently_used_user_forgotten(self):
+        self.flags(osapi_rate_limit_max_users=2)
+        limiter = limits.Limiter(TEST_LIMITS)
+        limiter.check_for_delay("GET", "/delayed", "user1")
+        limiter.check_for_delay("GET", "/delayed", "user2")
+        limiter.check_for_delay("GET", "/delayed", "user1")
+        limiter.check_for_delay("GET", "/delayed", "user3")
+
+        self.assertEqual(2, len(limiter.levels))
+        self.assertTrue("user1" in limiter.levels)
+        self.assertFalse("user2" in limiter.levels)
+        self.assertTrue("user3" in limiter.levels)
+
+
+class LimitRoutesTest(test.TestCase):
+    """
+    Tests for the `limits.LimitRoutes` class.
+    """
+
+    def test_match(self):
+        routes = limits.LimitRoutes(TEST_LIMITS)
+        self.assertEqual([1, 2], routes.match("POST", "/servers/1"))
+        self.assertEqual([1], routes.match("POST", "/images"))
+        self.assertEqual([3, 4], routes.match("PUT", "/servers"))
+        self.assertEqual([], routes.match("GET", "/servers"))
+        self.assertEqual([], routes.match("DELETE", "/servers"))
+
+    def test_one_pattern_per_verb(self):
+        routes = limits.LimitRoutes(TEST_LIMITS)
+        pattern, indexes = routes.routes["POST"]
+        self.assertNotEqual(None, pattern)
+        self.assertEqual([1, 2], indexes)
+
+    def test_regex_with_groups_matched_alone(self):
+        test_limits = [
+            limits.Limit("GET", "*", r"^/(\w)\1", 1, limits.PER_MINUTE),
+            limits.Limit("GET", "*", ".*", 1, limits.PER_MINUTE),
+        ]
+        routes = limits.LimitRoutes(test_limits)
+        self.assertEqual(None, routes.routes["GET"][0])
+        self.assertEqual([0, 1], routes.match("GET", "/aa"))
+        self.assertEqual([1], routes.match("GET", "/ab"))
+
+
+class SharedLimiterTest(BaseLimitTestSuite):
+    """
+    Tests for the memcached backed `limits.SharedLimiter` class.
+    """
+
+    def setUp(self):
+        super(SharedLimiterTest, self).setUp()
+        cache = memorycache.Client()
+        self.stubs.Set(memorycache, "get_client", lambda: cache)
+        self.limiter = limits.SharedLimiter(TEST_LIMITS)
+
+    def _check(self, num, verb, url, username=None, limiter=None):
+        limiter = limiter or self.limiter
+        return [limiter.check_for_delay(verb, url, username)[0]
+                for x in xrange(num)]
+
+    def test_delay_PUT(self):
+        expected = [None] * 10 + [66.0]
+        self.assertEqual(expected, self._check(11, "PUT", "/anything"))
+
+    def test_previous_window_slides_away(self):
+        self._check(10, "PUT", "/anything")
+        self.time += 66.0
+
+        results = self._check(2, "PUT", "/anything")
+        self.assertEqual(None, results[0])
+        self.assertAlmostEqual(6.0, results[1])
+
+    def test_shared_between_workers(self):
+        other = limits.SharedLimiter(TEST_LIMITS)
+        self._check(5, "PUT", "/anything")
+        expected = [None] * 5 + [66.0]
+        self.assertEqual(expected,
+                         self._check(6, "PUT", "/anything", limiter=other))
+
+    def test_multiple_users(self):
+        self._check(10, "PUT", "/anything", "user1")
+        self.assertEqual([None], self._check(1, "PUT", "/anything", "user2"))
+        self.assertEqual([66.0], self._check(1, "PUT", "/anything", "user1"))
+
+    def test_user_limit(self):
+        limiter = limits.SharedLimiter(TEST_LIMITS, **{'user:user3': ''})
+        expected = [None] * 20
+        self.assertEqual(expected, self._check(20, "PUT", "/anything",
+                                               "user3", limiter=limiter))
+
+    def test_get_limits(self):
+        self._check(3, "PUT", "/servers")
+        result = self.limiter.get_limits()
+        self.assertEqual(7, result[3]["remaining"])
+        self.assertEqual(2, result[4]["remaining"])
+        self.assertEqual(1, result[0]["remaining"])
+
 
 class WsgiLimiterTest(BaseLimitTestSuite):
     """
@@ -17,12 +17,16 @@ Tests For CellsManager
 """
 import copy
 import datetime
+import os
 
+import fixtures
 from oslo.config import cfg
 
+from nova.cells import manager
 from nova.cells import messaging
 from nova.cells import utils as cells_utils
 from nova import context
+from nova import exception
 from nova.openstack.common import rpc
 from nova.openstack.common import timeutils
 from nova import test
@@ -140,18 +144,167 @@ class CellsManagerClassTestCase(test.TestCase):
         self.assertEqual('fake-response', response)
 
     def test_instance_update_at_top(self):
+        self.flags(instance_update_batch_interval=0, group='cells')
         self.mox.StubOutWithMock(self.msg_runner, 'instance_update_at_top')
         self.msg_runner.instance_update_at_top(self.ctxt, 'fake-instance')
         self.mox.ReplayAll()
         self.cells_manager.instance_update_at_top(self.ctxt,
                                                   instance='fake-instance')
 
+    def _batch_instance_updates(self, batch_message=True):
+        self.flags(instance_update_batch_interval=1,
+                   instance_update_batch_message=batch_message,
+                   group='cells')
+
+    def test_instance_updates_are_coalesced(self):
+        self._batch_instance_updates()
+        instance1 = {'uuid': 'uuid1', 'vm_state': 'building'}
+        instance2 = {'uuid': 'uuid2', 'vm_state': 'building'}
+        instance1_active = {'uuid': 'uuid1', 'vm_state': 'active'}
+        self.mox.StubOutWithMock(self.msg_runner, 'instance_update_at_top')
+        self.mox.StubOutWithMock(self.msg_runner,
+                                 'instance_update_at_top_batch')
+        self.msg_runner.instance_update_at_top_batch(
+                self.ctxt, [instance1_active, instance2])
+        self.mox.ReplayAll()
+        self.cells_manager.instance_update_at_top(self.ctxt, instance1)
+        self.cells_manager.instance_update_at_top(self.ctxt, instance2)
+        self.cells_manager.instance_update_at_top(self.ctxt,
+                                                  instance1_active)
+        self.cells_manager._flush_instance_updates(self.ctxt)
+        # Nothing is left to send
+        self.cells_manager._flush_instance_updates(self.ctxt)
+
+        stats = self.cells_manager.instance_update_stats
+        self.assertEqual(3, stats['updates'])
+        self.assertEqual(2, stats['instances'])
+        self.assertEqual(1, stats['messages'])
+        self.assertTrue(stats['max_lag'] >= 0)
+
+    def test_partial_instance_updates_are_merged(self):
+        self._batch_instance_updates()
+        instance = {'uuid': 'uuid1', 'vm_state': 'building',
+                    'task_state': 'spawning', 'host': 'fake-host'}
+        partial = {'uuid': 'uuid1', 'task_state': None}
+        self.mox.StubOutWithMock(self.msg_runner,
+                                 'instance_update_at_top_batch')
+        self.msg_runner.instance_update_at_top_batch(
+                self.ctxt, [{'uuid': 'uuid1', 'vm_state': 'building',
+                             'task_state': None, 'host': 'fake-host'}])
+        self.mox.ReplayAll()
+        self.cells_manager.instance_update_at_top(self.ctxt, instance)
+        self.cells_manager.instance_update_at_top(self.ctxt, partial)
+        self.cells_manager._flush_instance_updates(self.ctxt)
+        # The caller's instance is left alone
+        self.assertEqual('spawning', instance['task_state'])
+
+    def test_instance_update_batch_size(self):
+        self._batch_instance_updates()
+        self.flags(instance_update_batch_size=2, group='cells')
+        instances = [{'uuid': 'uuid%d' % i} for i in xrange(5)]
+        self.mox.StubOutWithMock(self.msg_runner,
+                                 'instance_update_at_top_batch')
+        self.msg_runner.instance_update_at_top_batch(self.ctxt,
+                                                     instances[0:2])
+        self.msg_runner.instance_update_at_top_batch(self.ctxt,
+                                                     instances[2:4])
+        self.msg_runner.instance_update_at_top_batch(self.ctxt,
+                                                     instances[4:])
+        self.mox.ReplayAll()
+        for instance in instances:
+            self.cells_manager.instance_update_at_top(self.ctxt, instance)
+        self.cells_manager._flush_instance_updates(self.ctxt)
+
+    def test_batched_instance_updates_without_batch_message(self):
+        self._batch_instance_updates(batch_message=False)
+        instances = [{'uuid': 'uuid%d' % i} for i in xrange(2)]
+        self.mox.StubOutWithMock(self.msg_runner, 'instance_update_at_top')
+        self.mox.StubOutWithMock(self.msg_runner,
+                                 'instance_update_at_top_batch')
+        self.msg_runner.instance_update_at_top(self.ctxt, instances[0])
+        self.msg_runner.instance_update_at_top(self.ctxt, instances[1])
+        self.mox.ReplayAll()
+        for instance in instances:
+            self.cells_manager.instance_update_at_top(self.ctxt, instance)
+        self.cells_manager._flush_instance_updates(self.ctxt)
+        self.assertEqual(2,
+                self.cells_manager.instance_update_stats['messages'])
+
+    def test_batched_instance_update_sends_info_cache_now(self):
+        self._batch_instance_updates()
+        instance = {'uuid': 'uuid1', 'vm_state': 'active',
+                    'info_cache': 'fake-info-cache'}
+        self.mox.StubOutWithMock(self.msg_runner, 'instance_update_at_top')
+        self.mox.StubOutWithMock(self.msg_runner,
+                                 'instance_update_at_top_batch')
+        self.msg_runner.instance_update_at_top(self.ctxt,
+                {'uuid': 'uuid1', 'info_cache': 'fake-info-cache'})
+        self.msg_runner.instance_update_at_top(self.ctxt,
+                {'uuid': 'uuid1', 'info_cache': 'newer-info-cache'})
+        self.msg_runner.instance_update_at_top_batch(self.ctxt,
+                [{'uuid': 'uuid1', 'vm_state': 'active'}])
+        self.mox.ReplayAll()
+        self.cells_manager.instance_update_at_top(self.ctxt, instance)
+        self.cells_manager.instance_update_at_top(self.ctxt,
+                {'uuid': 'uuid1', 'info_cache': 'newer-info-cache'})
+        self.cells_manager._flush_instance_updates(self.ctxt)
+
+    def test_unsent_instance_updates_are_requeued(self):
+        self._batch_instance_updates()
+        self.flags(instance_update_batch_size=1, group='cells')
+        call_info = {'sent': []}
+
+        def update_at_top_batch(ctxt, instances):
+            if not call_info['sent']:
+                call_info['sent'].append(instances[0]['uuid'])
+                return
+            # Another update for the failed instance arrives mid-flush
+            call_info['failed'] = instances[0]['uuid']
+            self.cells_manager.instance_update_at_top(ctxt,
+                    {'uuid': instances[0]['uuid'], 'task_state': None})
+            raise test.TestingException()
+
+        self.stubs.Set(self.msg_runner, 'instance_update_at_top_batch',
+                       update_at_top_batch)
+        uuids = ['uuid1', 'uuid2', 'uuid3']
+        for uuid in uuids:
+            self.cells_manager.instance_update_at_top(self.ctxt,
+                    {'uuid': uuid, 'task_state': 'spawning'})
+        self.cells_manager._flush_instance_updates(self.ctxt)
+
+        self.assertEqual(1, len(call_info['sent']))
+        uuids.remove(call_info['sent'][0])
+        pending = self.cells_manager._pending_instance_updates
+        self.assertEqual(uuids, sorted(pending))
+        self.assertEqual({'uuid': call_info['failed'], 'task_state': None},
+                         pending[call_info['failed']][0])
+
+    def test_cleanup_host_flushes_instance_updates(self):
+        self._batch_instance_updates()
+        self.mox.StubOutWithMock(context, 'get_admin_context')
+        self.mox.StubOutWithMock(self.msg_runner,
+                                 'instance_update_at_top_batch')
+        context.get_admin_context().AndReturn(self.ctxt)
+        self.msg_runner.instance_update_at_top_batch(self.ctxt,
+                                                     [{'uuid': 'uuid1'}])
+        self.mox.ReplayAll()
+        self.cells_manager.instance_update_at_top(self.ctxt,
+                                                  {'uuid': 'uuid1'})
+        self.cells_manager.cleanup_host()
+
     def test_instance_destroy_at_top(self):
+        self._batch_instance_updates()
+        fake_instance = {'uuid': 'fake-uuid'}
         self.mox.StubOutWithMock(self.msg_runner, 'instance_destroy_at_top')
-        self.msg_runner.instance_destroy_at_top(self.ctxt, 'fake-instance')
+        self.mox.StubOutWithMock(self.msg_runner,
+                                 'instance_update_at_top_batch')
+        self.msg_runner.instance_destroy_at_top(self.ctxt, fake_instance)
         self.mox.ReplayAll()
+        # The update still waiting to be sent is dropped
+        self.cells_manager.instance_update_at_top(self.ctxt, fake_instance)
         self.cells_manager.instance_destroy_at_top(self.ctxt,
-                                                  instance='fake-instance')
+                                                  instance=fake_instance)
+        self.cells_manager._flush_instance_updates(self.ctxt)
 
     def test_instance_delete_everywhere(self):
         self.mox.StubOutWithMock(self.msg_runner,
@@ -240,6 +393,120 @@ class CellsManagerClassTestCase(test.TestCase):
         self.assertEqual(call_info['sync_instances'],
                 [instances[-1], instances[0]])
 
+    def _setup_heal_in_bulk(self, num_instances):
+        self.flags(instance_updated_at_threshold=0,
+                   instance_heal_batch_size=2,
+                   instance_update_batch_message=True,
+                   instance_heal_sweep_time=0,
+                   instance_heal_cursor_file=os.path.join(
+                       self.useFixture(fixtures.TempDir()).path, 'cursor'),
+                   group='cells')
+        instances = [dict(id=i, uuid='uuid%d' % i, deleted=(i == 2))
+                     for i in xrange(num_instances)]
+        call_info = {'markers': [], 'updates': [], 'destroys': []}
+
+        def instance_get_all_by_filters(context, filters, sort_key,
+                                        sort_dir, limit=None, marker=None):
+            self.assertEqual(context.read_deleted, 'yes')
+            self.assertEqual(('id', 'asc'), (sort_key, sort_dir))
+            call_info['markers'].append(marker)
+            start = 0
+            if marker is not None:
+                start = [inst['uuid'] for inst in instances].index(marker)
+                start += 1
+            return instances[start:start + limit]
+
+        def update_at_top_batch(context, updates):
+            call_info['updates'].append([inst['id'] for inst in updates])
+
+        def destroy_at_top(context, instance):
+            call_info['destroys'].append(instance['id'])
+
+        self.stubs.Set(self.cells_manager.db, 'instance_get_all_by_filters',
+                       instance_get_all_by_filters)
+        self.stubs.Set(self.msg_runner, 'instance_update_at_top_batch',
+                       update_at_top_batch)
+        self.stubs.Set(self.msg_runner, 'instance_destroy_at_top',
+                       destroy_at_top)
+        return instances, call_info
+
+    def test_heal_instances_in_bulk(self):
+        instances, call_info = self._setup_heal_in_bulk(5)
+        fake_context = context.RequestContext('fake', 'fake')
+
+        self.cells_manager._heal_instances(fake_context)
+        self.assertEqual([None], call_info['markers'])
+        self.assertEqual([[0, 1]], call_info['updates'])
+
+        self.cells_manager._heal_instances(fake_context)
+        self.assertEqual([None, 'uuid1'], call_info['markers'])
+        self.assertEqual([[0, 1], [3]], call_info['updates'])
+        self.assertEqual([2], call_info['destroys'])
+
+        # A short page finishes the sweep and the next starts over
+        self.cells_manager._heal_instances(fake_context)
+        self.assertEqual([None, 'uuid1', 'uuid3'], call_info['markers'])
+        self.assertEqual([[0, 1], [3], [4]], call_info['updates'])
+        self.assertEqual(1, self.cells_manager.heal_stats['sweeps'])
+        self.assertEqual(5,
+                self.cells_manager.heal_stats['last_sweep_instances'])
+        self.cells_manager._heal_instances(fake_context)
+        self.assertEqual(None, call_info['markers'][-1])
+
+    def test_heal_instances_in_bulk_resumes_from_cursor(self):
+        instances, call_info = self._setup_heal_in_bulk(5)
+        fake_context = context.RequestContext('fake', 'fake')
+        self.cells_manager._heal_instances(fake_context)
+
+        # A restarted manager carries on where the last one got to
+        cells_manager = fakes.get_cells_manager(self.our_cell)
+        cells_manager.db = self.cells_manager.db
+        cells_manager.msg_runner = self.msg_runner
+        cells_manager._heal_instances(fake_context)
+        self.assertEqual([None, 'uuid1'], call_info['markers'])
+
+    def test_heal_instances_in_bulk_marker_gone(self):
+        instances, call_info = self._setup_heal_in_bulk(5)
+        fake_context = context.RequestContext('fake', 'fake')
+        self.cells_manager._heal_instances(fake_context)
+        get_all = self.cells_manager.db.instance_get_all_by_filters
+
+        def instance_get_all_by_filters(context, filters, sort_key,
+                                        sort_dir, limit=None, marker=None):
+            if marker == 'uuid1':
+                call_info['markers'].append(marker)
+                raise exception.MarkerNotFound(marker=marker)
+            return get_all(context, filters, sort_key, sort_dir,
+                           limit=limit, marker=marker)
+
+        self.stubs.Set(self.cells_manager.db, 'instance_get_all_by_filters',
+                       instance_get_all_by_filters)
+        self.cells_manager._heal_instances(fake_context)
+        self.assertEqual([None, 'uuid1', None], call_info['markers'])
+        self.assertEqual([[0, 1], [0, 1]], call_info['updates'])
+
+    def test_heal_instances_in_bulk_keeps_pace(self):
+        instances, call_info = self._setup_heal_in_bulk(9)
+        self.flags(instance_heal_sweep_time=100, group='cells')
+        fake_context = context.RequestContext('fake', 'fake')
+        now = [1000.0]
+        self.stubs.Set(manager.time, 'time', lambda: now[0])
+
+        # The first sweep has nothing to go by, so goes a page at a time
+        for i in xrange(5):
+            self.cells_manager._heal_instances(fake_context)
+            now[0] += 10
+        self.assertEqual(1, self.cells_manager.heal_stats['sweeps'])
+        self.assertEqual(9,
+                self.cells_manager.heal_stats['last_sweep_instances'])
+        self.assertEqual(5, len(call_info['markers']))
+
+        # 9 instances in 100 seconds makes 9 every 100 seconds
+        now[0] += 90
+        self.cells_manager._heal_instances(fake_context)
+        self.assertEqual(10, len(call_info['markers']))
+        self.assertEqual(2, self.cells_manager.heal_stats['sweeps'])
+
     def test_sync_instances(self):
         self.mox.StubOutWithMock(self.msg_runner,
                                  'sync_instances')
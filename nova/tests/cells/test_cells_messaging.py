@@ -929,6 +929,67 @@ class CellsBroadcastMethodsTestCase(test.TestCase):
 
         self.src_msg_runner.instance_update_at_top(self.ctxt, fake_instance)
 
+    def _instance_update_batch(self):
+        instances = [{'id': 1, 'uuid': 'fake_uuid1', 'other': 'meow',
+                      'info_cache': {'id': 1, 'other': 'moo'}},
+                     {'id': 2, 'uuid': 'fake_uuid2', 'other': 'woof'}]
+        cell_name = 'api-cell!child-cell2!grandchild-cell1'
+        updates = [('fake_uuid1', {'uuid': 'fake_uuid1', 'other': 'meow',
+                                   'cell_name': cell_name},
+                    {'other': 'moo'}),
+                   ('fake_uuid2', {'uuid': 'fake_uuid2', 'other': 'woof',
+                                   'cell_name': cell_name},
+                    None)]
+
+        # To show these should not be called in src/mid-level cell
+        self.mox.StubOutWithMock(self.src_db_inst, 'instance_update_batch')
+        self.mox.StubOutWithMock(self.mid_db_inst, 'instance_update_batch')
+
+        self.mox.StubOutWithMock(self.tgt_db_inst, 'instance_update_batch')
+        self.mox.StubOutWithMock(self.tgt_db_inst, 'instance_update')
+        self.mox.StubOutWithMock(self.tgt_db_inst, 'instance_create')
+        self.mox.StubOutWithMock(self.tgt_db_inst,
+                                 'instance_info_cache_update')
+        return instances, updates
+
+    def test_instance_update_at_top_batch(self):
+        instances, updates = self._instance_update_batch()
+        self.tgt_db_inst.instance_update_batch(self.ctxt,
+                                               updates).AndReturn([])
+        self.mox.ReplayAll()
+
+        self.src_msg_runner.instance_update_at_top_batch(self.ctxt,
+                                                         instances)
+
+    def test_instance_update_at_top_batch_creates_unknown(self):
+        instances, updates = self._instance_update_batch()
+        self.tgt_db_inst.instance_update_batch(
+                self.ctxt, updates).AndReturn(['fake_uuid2'])
+        self.tgt_db_inst.instance_update(
+                self.ctxt, 'fake_uuid2', updates[1][1],
+                update_cells=False).AndRaise(
+                        exception.InstanceNotFound(instance_id='fake_uuid2'))
+        self.tgt_db_inst.instance_create(self.ctxt, updates[1][1])
+        self.mox.ReplayAll()
+
+        self.src_msg_runner.instance_update_at_top_batch(self.ctxt,
+                                                         instances)
+
+    def test_instance_update_at_top_batch_failure(self):
+        instances, updates = self._instance_update_batch()
+        self.tgt_db_inst.instance_update_batch(
+                self.ctxt, updates).AndRaise(test.TestingException())
+        # Each instance is then updated on its own
+        self.tgt_db_inst.instance_update(
+                self.ctxt, 'fake_uuid1', updates[0][1],
+                update_cells=False).AndRaise(test.TestingException())
+        self.tgt_db_inst.instance_update(self.ctxt, 'fake_uuid2',
+                                         updates[1][1], update_cells=False)
+        self.mox.ReplayAll()
+
+        self.src_msg_runner.instance_update_at_top_batch(self.ctxt,
+                                                         instances)
+
     def test_instance_destroy_at_top(self):
         fake_instance = {'uuid': 'fake_uuid'}
 
@@ -160,13 +160,16 @@ class CellsSchedulerTestCase(test.TestCase):
         def fake_sleep(_secs):
             return
 
-        def fake_instance_update(ctxt, instance_uuid, values):
+        def fake_instance_update(ctxt, instance_uuid, values,
+                                 update_cells=True):
             self.assertEqual(vm_states.ERROR, values['vm_state'])
+            # The top cell has already been told
+            self.assertFalse(update_cells)
             call_info['errored_uuids'].append(instance_uuid)
 
         self.stubs.Set(self.scheduler, '_run_instance', fake_run_instance)
         self.stubs.Set(time, 'sleep', fake_sleep)
-        self.stubs.Set(db, 'instance_update', fake_instance_update)
+        self.stubs.Set(db, 'instance_update_lean', fake_instance_update)
 
         self.msg_runner.schedule_run_instance(self.ctxt,
                 self.my_cell_state, host_sched_kwargs)
@@ -187,8 +190,11 @@ class CellsSchedulerTestCase(test.TestCase):
             call_info['num_tries'] += 1
             raise test.TestingException()
 
-        def fake_instance_update(ctxt, instance_uuid, values):
+        def fake_instance_update(ctxt, instance_uuid, values,
+                                 update_cells=True):
             self.assertEqual(vm_states.ERROR, values['vm_state'])
+            # The top cell has already been told
+            self.assertFalse(update_cells)
             call_info['errored_uuids1'].append(instance_uuid)
 
         def fake_instance_update_at_top(ctxt, instance):
@@ -196,7 +202,7 @@ class CellsSchedulerTestCase(test.TestCase):
             call_info['errored_uuids2'].append(instance['uuid'])
 
         self.stubs.Set(self.scheduler, '_run_instance', fake_run_instance)
-        self.stubs.Set(db, 'instance_update', fake_instance_update)
+        self.stubs.Set(db, 'instance_update_lean', fake_instance_update)
         self.stubs.Set(self.msg_runner, 'instance_update_at_top',
                        fake_instance_update_at_top)
 
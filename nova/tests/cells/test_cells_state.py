@@ -0,0 +1,124 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""
+Tests For CellStateManager
+"""
+import random
+
+from nova.cells import state
+from nova import context
+from nova import db
+from nova import test
+
+
+FAKE_INSTANCE_TYPES = [
+    dict(memory_mb=512, root_gb=1, ephemeral_gb=0),
+    dict(memory_mb=1024, root_gb=10, ephemeral_gb=10),
+    dict(memory_mb=1024, root_gb=20, ephemeral_gb=0),
+    dict(memory_mb=0, root_gb=0, ephemeral_gb=0),
+]
+
+
+def _compute_node(host, free_ram_mb, free_disk_gb, disabled=False):
+    return dict(free_ram_mb=free_ram_mb, free_disk_gb=free_disk_gb,
+                service=dict(host=host, disabled=disabled))
+
+
+def _capacities(compute_nodes, instance_types):
+    """Work the capacities out the long way, host by host and flavor by
+    flavor.
+    """
+    ram_units = {}
+    disk_units = {}
+    total_ram = total_disk = 0
+    hosts = [compute for compute in compute_nodes
+             if not compute['service']['disabled']]
+    if not hosts:
+        return {}
+    for compute in hosts:
+        free_ram = compute['free_ram_mb']
+        free_disk = compute['free_disk_gb'] * 1024
+        total_ram += free_ram
+        total_disk += free_disk
+        for instance_type in instance_types:
+            ram = instance_type['memory_mb']
+            disk = (instance_type['root_gb'] +
+                    instance_type['ephemeral_gb']) * 1024
+            ram_units.setdefault(str(ram), 0)
+            disk_units.setdefault(str(disk), 0)
+            if ram:
+                ram_units[str(ram)] += max(0, int(free_ram / ram))
+            if disk:
+                disk_units[str(disk)] += max(0, int(free_disk / disk))
+    return {'ram_free': {'total_mb': total_ram, 'units_by_mb': ram_units},
+            'disk_free': {'total_mb': total_disk,
+                          'units_by_mb': disk_units}}
+
+
+class CellStateManagerTestCase(test.TestCase):
+    def setUp(self):
+        super(CellStateManagerTestCase, self).setUp()
+        self.ctxt = context.get_admin_context()
+        self.compute_nodes = []
+        self.instance_types = list(FAKE_INSTANCE_TYPES)
+        self.stubs.Set(db, 'compute_node_get_all',
+                       lambda ctxt: self.compute_nodes)
+        self.stubs.Set(db, 'instance_type_get_all',
+                       lambda ctxt: self.instance_types)
+        self.state_manager = state.CellStateManager()
+
+    def _update_capacity(self):
+        self.state_manager._update_our_capacity(self.ctxt)
+        return self.state_manager.my_cell_state.capacities
+
+    def test_capacities(self):
+        self.compute_nodes = [_compute_node('host1', 2048, 100),
+                              _compute_node('host2', 700, 30),
+                              _compute_node('host3', 4096, 100,
+                                            disabled=True)]
+        expected = {'ram_free': {'total_mb': 2748,
+                                 'units_by_mb': {'512': 5, '1024': 4,
+                                                 '0': 0}},
+                    'disk_free': {'total_mb': 130 * 1024,
+                                  'units_by_mb': {'1024': 130,
+                                                  '20480': 12,
+                                                  '0': 0}}}
+        self.assertEqual(expected, self._update_capacity())
+
+    def test_no_compute_nodes(self):
+        self.assertEqual({}, self._update_capacity())
+
+    def test_capacities_follow_changes(self):
+        rand = random.Random(0)
+        self.compute_nodes = [_compute_node('host%d' % i,
+                                            rand.randint(-512, 8192),
+                                            rand.randint(0, 500))
+                              for i in xrange(50)]
+        for i in xrange(20):
+            for compute in rand.sample(self.compute_nodes, 5):
+                compute['free_ram_mb'] = rand.randint(-512, 8192)
+                compute['free_disk_gb'] = rand.randint(0, 500)
+            if i % 5 == 1:
+                self.compute_nodes.pop(rand.randrange(
+                    len(self.compute_nodes)))
+            if i % 5 == 2:
+                self.compute_nodes[0]['service']['disabled'] = (
+                    not self.compute_nodes[0]['service']['disabled'])
+            if i % 5 == 3:
+                self.instance_types.append(
+                    dict(memory_mb=rand.choice([256, 512, 4096]),
+                         root_gb=rand.randint(1, 80), ephemeral_gb=0))
+            self.assertEqual(_capacities(self.compute_nodes,
+                                         self.instance_types),
+                             self._update_capacity())
@@ -21,6 +21,7 @@
 import base64
 import copy
 import datetime
+import random
 import sys
 import time
 import traceback
@@ -978,6 +979,27 @@ class ComputeTestCase(BaseTestCase):
         self.compute.unpause_instance(self.context, instance=instance)
         self.compute.terminate_instance(self.context, instance=instance)
 
+    def test_pause_updates_lean(self):
+        # Ensure pausing does not fetch the updated instance back.
+        instance = jsonutils.to_primitive(self._create_fake_instance())
+        self.compute.run_instance(self.context, instance=instance)
+        db.instance_update(self.context, instance['uuid'],
+                           {"task_state": task_states.PAUSING})
+        self.mox.StubOutWithMock(self.compute.conductor_api,
+                                 'instance_update')
+        self.mox.ReplayAll()
+        self.compute.pause_instance(self.context, instance=instance)
+        inst_ref = db.instance_get_by_uuid(self.context, instance['uuid'])
+        self.assertEqual(vm_states.PAUSED, inst_ref['vm_state'])
+        self.assertEqual(None, inst_ref['task_state'])
+
+        # A lost race leaves the instance alone
+        self.assertRaises(exception.UnexpectedTaskStateError,
+                          self.compute.unpause_instance, self.context,
+                          instance=instance)
+        inst_ref = db.instance_get_by_uuid(self.context, instance['uuid'])
+        self.assertEqual(vm_states.PAUSED, inst_ref['vm_state'])
+
     def test_suspend(self):
         # ensure instance can be suspended and resumed.
         instance = jsonutils.to_primitive(self._create_fake_instance())
@@ -2991,6 +3013,97 @@ class ComputeTestCase(BaseTestCase):
         self.assertEqual(len(instances), 1)
         self.assertEqual(instances[0]['task_state'], None)
 
+    def _fake_sync_instance(self, vm_state, db_power_state):
+        return {'uuid': 'fake-uuid', 'name': 'instance-1',
+                'host': self.compute.host, 'task_state': None,
+                'vm_state': vm_state, 'power_state': db_power_state}
+
+    def test_sync_power_states_in_sync(self):
+        instances = [self._fake_sync_instance(vm_states.ACTIVE,
+                                              power_state.RUNNING)]
+        self.mox.StubOutWithMock(self.compute.conductor_api,
+                                 'instance_get_all_by_host')
+        self.mox.StubOutWithMock(self.compute.driver, 'get_power_states')
+        self.mox.StubOutWithMock(self.compute.driver, 'get_info')
+        self.mox.StubOutWithMock(self.compute.conductor_api,
+                                 'instance_get_all_by_filters')
+        self.compute.conductor_api.instance_get_all_by_host(
+            self.context, self.compute.host).AndReturn(instances)
+        self.compute.driver.get_power_states().AndReturn(
+            {'instance-1': power_state.RUNNING})
+        self.mox.ReplayAll()
+
+        self.compute._sync_power_states(self.context)
+
+    def _stub_sync_out_of_sync(self, instance, vm_power_states,
+                               current_instances):
+        self.mox.StubOutWithMock(self.compute.conductor_api,
+                                 'instance_get_all_by_host')
+        self.mox.StubOutWithMock(self.compute.driver, 'get_power_states')
+        self.mox.StubOutWithMock(self.compute.conductor_api,
+                                 'instance_get_all_by_filters')
+        self.mox.StubOutWithMock(self.compute, '_instance_update')
+        self.mox.StubOutWithMock(self.compute.conductor_api, 'compute_stop')
+        self.compute.conductor_api.instance_get_all_by_host(
+            self.context, self.compute.host).AndReturn([instance])
+        self.compute.driver.get_power_states().AndReturn(vm_power_states)
+        self.compute.conductor_api.instance_get_all_by_filters(
+            self.context, {'uuid': [instance['uuid']]}
+            ).AndReturn(current_instances)
+
+    def test_sync_power_states_out_of_sync(self):
+        instance = self._fake_sync_instance(vm_states.ACTIVE,
+                                            power_state.RUNNING)
+        self._stub_sync_out_of_sync(instance,
+                                    {'instance-1': power_state.SHUTDOWN},
+                                    [instance])
+        self.compute._instance_update(self.context, 'fake-uuid',
+                                      power_state=power_state.SHUTDOWN)
+        self.compute.conductor_api.compute_stop(self.context, instance)
+        self.mox.ReplayAll()
+
+        self.compute._sync_power_states(self.context)
+
+    def test_sync_power_states_deleted_meanwhile(self):
+        instance = self._fake_sync_instance(vm_states.ACTIVE,
+                                            power_state.RUNNING)
+        self._stub_sync_out_of_sync(instance, {}, [])
+        self.mox.ReplayAll()
+
+        self.compute._sync_power_states(self.context)
+
+    def test_sync_power_states_soft_deleted(self):
+        instance = self._create_fake_instance(
+            {'host': self.compute.host,
+             'vm_state': vm_states.SOFT_DELETED,
+             'power_state': power_state.RUNNING})
+        self.stubs.Set(self.compute.driver, 'get_power_states',
+                       lambda: {instance['name']: power_state.SHUTDOWN})
+
+        self.compute._sync_power_states(self.context)
+
+        instance = db.instance_get_by_uuid(self.context, instance['uuid'])
+        self.assertEqual(power_state.SHUTDOWN, instance['power_state'])
+
+    def test_sync_power_states_without_get_power_states(self):
+        instance = self._fake_sync_instance(vm_states.STOPPED,
+                                            power_state.SHUTDOWN)
+        self.mox.StubOutWithMock(self.compute.conductor_api,
+                                 'instance_get_all_by_host')
+        self.mox.StubOutWithMock(self.compute.driver, 'get_power_states')
+        self.mox.StubOutWithMock(self.compute.driver, 'get_num_instances')
+        self.mox.StubOutWithMock(self.compute.driver, 'get_info')
+        self.compute.conductor_api.instance_get_all_by_host(
+            self.context, self.compute.host).AndReturn([instance])
+        self.compute.driver.get_power_states().AndRaise(
+            NotImplementedError())
+        self.compute.driver.get_num_instances().AndReturn(1)
+        self.compute.driver.get_info(instance).AndReturn(
+            {'state': power_state.SHUTDOWN})
+        self.mox.ReplayAll()
+
+        self.compute._sync_power_states(self.context)
+
     def test_add_instance_fault(self):
         instance = self._create_fake_instance()
         exc_info = None
@@ -3707,6 +3820,59 @@ class ComputeTestCase(BaseTestCase):
         self.mox.ReplayAll()
         self.compute._instance_usage_audit(self.context)
 
+    def test_instance_usage_audit_bulk_bandwidth(self):
+        instances = [{'uuid': 'foo', 'info_cache': {'network_info': []}},
+                     {'uuid': 'bar', 'info_cache': {'network_info': []}},
+                     {'uuid': 'baz', 'info_cache': None}]
+        usages = [{'uuid': 'foo', 'mac': 'a'}, {'uuid': 'foo', 'mac': 'b'}]
+        self.flags(instance_usage_audit=True)
+        begin, end = utils.last_completed_audit_period()
+        self.stubs.Set(compute_utils, 'has_audit_been_run',
+                       lambda *a, **k: False)
+        self.stubs.Set(self.compute.conductor_api,
+                       'instance_get_active_by_window_joined',
+                       lambda *a, **k: instances)
+        self.stubs.Set(compute_utils, 'start_instance_usage_audit',
+                       lambda *a, **k: None)
+        self.stubs.Set(compute_utils, 'finish_instance_usage_audit',
+                       lambda *a, **k: None)
+
+        self.mox.StubOutWithMock(self.compute.conductor_api,
+                                 'bw_usage_get_by_uuids')
+        self.mox.StubOutWithMock(self.compute.conductor_api,
+                                 'notify_usage_exists')
+        self.mox.StubOutWithMock(compute_utils, 'notify_usage_exists')
+        self.compute.conductor_api.bw_usage_get_by_uuids(
+            self.context, mox.SameElementsAs(['foo', 'bar']),
+            begin).AndReturn(usages)
+        compute_utils.notify_usage_exists(
+            self.context, instances[0], ignore_missing_network_data=False,
+            bw_usages=usages)
+        compute_utils.notify_usage_exists(
+            self.context, instances[1], ignore_missing_network_data=False,
+            bw_usages=[])
+        self.compute.conductor_api.notify_usage_exists(
+            self.context, instances[2], ignore_missing_network_data=False)
+        self.mox.ReplayAll()
+        self.compute._instance_usage_audit(self.context)
+
+    def test_instance_usage_audit_jitter(self):
+        self.flags(instance_usage_audit=True, instance_usage_audit_jitter=600)
+        begin, end = utils.last_completed_audit_period()
+        self.stubs.Set(random, 'uniform', lambda a, b: 300)
+        self.mox.StubOutWithMock(compute_utils, 'has_audit_been_run')
+        compute_utils.has_audit_been_run(self.context,
+                                         self.compute.conductor_api,
+                                         self.compute.host).AndReturn(True)
+        self.mox.ReplayAll()
+
+        timeutils.set_time_override(end + datetime.timedelta(seconds=200))
+        self.addCleanup(timeutils.clear_time_override)
+        self.compute._instance_usage_audit(self.context)
+
+        timeutils.advance_time_seconds(200)
+        self.compute._instance_usage_audit(self.context)
+
 
 class ComputeAPITestCase(BaseTestCase):
 
@@ -5709,6 +5875,41 @@ class ComputeAPITestCase(BaseTestCase):
 
         db.instance_destroy(self.context, refs[0]['uuid'])
 
+    def test_multi_instance_created_in_bulk(self):
+        def fake_instance_create(*args, **kwargs):
+            self.fail('instances should be created together')
+
+        self.stubs.Set(db, 'instance_create', fake_instance_create)
+        (refs, resv_id) = self.compute_api.create(self.context,
+                instance_types.get_default_instance_type(), None,
+                min_count=3, max_count=3, display_name='x',
+                metadata={'role': 'web'})
+        self.assertEqual(3, len(refs))
+        for ref in refs:
+            instance = db.instance_get_by_uuid(self.context, ref['uuid'])
+            self.assertEqual(resv_id, instance['reservation_id'])
+            self.assertEqual(vm_states.BUILDING, instance['vm_state'])
+            self.assertEqual({'role': 'web'},
+                             utils.metadata_to_dict(instance['metadata']))
+            self.assertEqual(['default'], [group['name'] for group in
+                                           instance['security_groups']])
+
+    def test_multi_instance_cleaned_up_when_one_fails(self):
+        validated = []
+
+        def fake_validate_bdm(context, instance):
+            validated.append(instance['uuid'])
+            if len(validated) == 2:
+                raise exception.InvalidBDM()
+
+        self.stubs.Set(self.compute_api, '_validate_bdm', fake_validate_bdm)
+        self.assertRaises(exception.InvalidBDM, self.compute_api.create,
+                          self.context,
+                          instance_types.get_default_instance_type(), None,
+                          min_count=3, max_count=3)
+        self.assertEqual(2, len(validated))
+        self.assertEqual([], db.instance_get_all(self.context))
+
     def test_multi_instance_display_name_template(self):
         self.flags(multi_instance_display_name_template='%(name)s')
         (refs, resv_id) = self.compute_api.create(self.context,
@@ -17,6 +17,7 @@
 
 """Tests For miscellaneous util methods used with compute."""
 
+import datetime
 import string
 
 from oslo.config import cfg
@@ -406,3 +407,53 @@ class UsageInfoTestCase(test.TestCase):
         image_ref_url = "%s/images/1" % glance.generate_glance_url()
         self.assertEquals(payload['image_ref_url'], image_ref_url)
         self.compute.terminate_instance(self.context, instance)
+
+
+class UsageRollupTestCase(test.TestCase):
+    def setUp(self):
+        super(UsageRollupTestCase, self).setUp()
+        self.context = context.get_admin_context()
+        self.day = datetime.datetime(2013, 3, 1)
+
+    def test_usage_rollup_periods(self):
+        days = [datetime.datetime(2013, 3, 2), datetime.datetime(2013, 3, 3)]
+        self.assertEqual(days, compute_utils.usage_rollup_periods(
+            datetime.datetime(2013, 3, 1, 0, 0, 1),
+            datetime.datetime(2013, 3, 4, 23, 59)))
+        self.assertEqual(days, compute_utils.usage_rollup_periods(
+            days[0], datetime.datetime(2013, 3, 4)))
+        self.assertEqual([], compute_utils.usage_rollup_periods(
+            datetime.datetime(2013, 3, 1, 12), datetime.datetime(2013, 3, 2,
+                                                                 12)))
+
+    def test_roll_up_usage(self):
+        rollups = [dict(project_id='fake', instance_type_id=1, hours=3.0)]
+        self.mox.StubOutWithMock(db, 'instance_usage_rollup_compute')
+        self.mox.StubOutWithMock(db, 'instance_usage_rollup_replace')
+        db.instance_usage_rollup_compute(
+            self.context, self.day,
+            datetime.datetime(2013, 3, 2)).AndReturn(rollups)
+        db.instance_usage_rollup_replace(self.context, self.day, rollups)
+        self.mox.ReplayAll()
+        self.assertEqual(rollups,
+                         compute_utils.roll_up_usage(self.context, self.day))
+
+    def test_check_usage_rollup(self):
+        next_day = datetime.datetime(2013, 3, 2)
+        self.mox.StubOutWithMock(db, 'instance_usage_rollup_get_by_window')
+        self.mox.StubOutWithMock(db, 'instance_usage_rollup_compute')
+        db.instance_usage_rollup_get_by_window(
+            self.context, self.day, next_day).AndReturn([
+                dict(project_id='a', instance_type_id=1, hours=3.0),
+                dict(project_id='b', instance_type_id=1, hours=2.0),
+                dict(project_id='c', instance_type_id=1, hours=4.0)])
+        db.instance_usage_rollup_compute(
+            self.context, self.day, next_day).AndReturn([
+                dict(project_id='a', instance_type_id=1, hours=3.0001),
+                dict(project_id='b', instance_type_id=2, hours=2.0),
+                dict(project_id='c', instance_type_id=1, hours=5.0)])
+        self.mox.ReplayAll()
+        self.assertEqual([('b', 1, 2.0, 0.0), ('b', 2, 0.0, 2.0),
+                          ('c', 1, 4.0, 5.0)],
+                         compute_utils.check_usage_rollup(self.context,
+                                                          self.day))
@@ -14,6 +14,8 @@
 
 """Tests for the conductor service."""
 
+import datetime
+
 import mox
 
 from nova.api.ec2 import ec2utils
@@ -34,11 +36,25 @@ from nova.openstack.common.rpc import common as rpc_common
 from nova.openstack.common import timeutils
 from nova import quota
 from nova import test
+from nova import utils
 
 
 FAKE_IMAGE_REF = 'fake-image-ref'
 
 
+class FakeLoopingCall(object):
+    def __init__(self, f, *args, **kwargs):
+        self.f = f
+        self.args = args
+        self.interval = None
+
+    def start(self, interval, initial_delay=None):
+        self.interval = interval
+
+    def stop(self):
+        self.interval = None
+
+
 class FakeContext(context.RequestContext):
     def elevated(self):
         """Return a consistent elevated context so we can detect it."""
@@ -97,6 +113,18 @@ class _BaseTestCase(object):
         self.assertEqual(instance['vm_state'], vm_states.STOPPED)
         self.assertEqual(new_inst['vm_state'], instance['vm_state'])
 
+    def _do_update_lean(self, instance_uuid, **updates):
+        return self.conductor.instance_update_lean(self.context,
+                                                   instance_uuid, updates)
+
+    def test_instance_update_lean(self):
+        instance = self._create_fake_instance()
+        result = self._do_update_lean(instance['uuid'],
+                                      vm_state=vm_states.STOPPED)
+        self.assertEqual(None, result)
+        instance = db.instance_get_by_uuid(self.context, instance['uuid'])
+        self.assertEqual(instance['vm_state'], vm_states.STOPPED)
+
     def test_action_event_start(self):
         self.mox.StubOutWithMock(db, 'action_event_start')
         db.action_event_start(self.context, mox.IgnoreArg())
@@ -265,6 +293,15 @@ class _BaseTestCase(object):
         result = self.conductor.bw_usage_update(*update_args)
         self.assertEqual(result, 'foo')
 
+    def test_bw_usage_get_by_uuids(self):
+        self.mox.StubOutWithMock(db, 'bw_usage_get_by_uuids')
+        db.bw_usage_get_by_uuids(self.context, ['uuid1', 'uuid2'],
+                                 0).AndReturn(['foo'])
+        self.mox.ReplayAll()
+        result = self.conductor.bw_usage_get_by_uuids(self.context,
+                                                      ['uuid1', 'uuid2'], 0)
+        self.assertEqual(result, ['foo'])
+
     def test_get_backdoor_port(self):
         backdoor_port = 59697
 
@@ -492,8 +529,8 @@ class _BaseTestCase(object):
         self.mox.StubOutWithMock(compute_utils, 'notify_about_instance_usage')
 
         notifications.audit_period_bounds(False).AndReturn(('start', 'end'))
-        notifications.bandwidth_usage(instance, 'start', True).AndReturn(
-            'bw_usage')
+        notifications.bandwidth_usage(instance, 'start', True,
+                                      None).AndReturn('bw_usage')
         compute_utils.notify_about_instance_usage(self.context, instance,
                                                   'exists',
                                                   system_metadata={},
@@ -715,6 +752,121 @@ class ConductorTestCase(_BaseTestCase, test.TestCase):
         self.conductor.security_groups_trigger_handler(self.context,
                                                        'event', ['args'])
 
+    def test_instance_update_lean_with_notifications(self):
+        self.flags(notify_on_state_change='vm_state')
+        self.mox.StubOutWithMock(self.conductor, 'instance_update')
+        self.mox.StubOutWithMock(db, 'instance_update_lean')
+        self.conductor.instance_update(self.context, 'fake-uuid',
+                                       {'vm_state': vm_states.STOPPED},
+                                       'compute')
+        self.mox.ReplayAll()
+        self.conductor.instance_update_lean(self.context, 'fake-uuid',
+                                            {'vm_state': vm_states.STOPPED},
+                                            'compute')
+
+    def _start_heartbeat_timer(self):
+        self.stubs.Set(utils, 'FixedIntervalLoopingCall', FakeLoopingCall)
+        self.conductor.post_start_hook()
+        return self.conductor._heartbeat_timer
+
+    def test_post_start_hook_starts_heartbeat_timer(self):
+        self.flags(heartbeat_flush_interval=5, group='conductor')
+        timer = self._start_heartbeat_timer()
+        self.assertEqual(5, timer.interval)
+        self.assertEqual(self.conductor._flush_heartbeats, timer.f)
+
+    def test_cleanup_host_flushes_heartbeats(self):
+        timer = self._start_heartbeat_timer()
+        self.mox.StubOutWithMock(db, 'service_heartbeat_update')
+        db.service_heartbeat_update(mox.IgnoreArg(), {1: 5})
+        self.mox.ReplayAll()
+        self.conductor.service_heartbeat(self.context, 1, 5)
+        self.conductor.cleanup_host()
+        self.assertEqual(None, timer.interval)
+        self.assertEqual(None, self.conductor._heartbeat_timer)
+
+    def test_service_heartbeats_are_batched(self):
+        self._start_heartbeat_timer()
+        self.mox.StubOutWithMock(db, 'service_heartbeat_update')
+        db.service_heartbeat_update(self.context, {1: 6, 2: 3})
+        self.mox.ReplayAll()
+        self.conductor.service_heartbeat(self.context, 1, 5)
+        self.conductor.service_heartbeat(self.context, 2, 3)
+        self.conductor.service_heartbeat(self.context, 1, 6)
+        self.conductor._flush_heartbeats(self.context)
+        # Nothing is left to write
+        self.conductor._flush_heartbeats(self.context)
+
+    def test_service_heartbeats_kept_on_error(self):
+        self._start_heartbeat_timer()
+        self.mox.StubOutWithMock(db, 'service_heartbeat_update')
+        db.service_heartbeat_update(self.context, {1: 5}).AndRaise(
+            test.TestingException())
+        db.service_heartbeat_update(self.context, {1: 6})
+        self.mox.ReplayAll()
+        self.conductor.service_heartbeat(self.context, 1, 5)
+        self.conductor._flush_heartbeats(self.context)
+        self.conductor.service_heartbeat(self.context, 1, 6)
+        self.conductor._flush_heartbeats(self.context)
+
+    def test_service_heartbeat_unbatched(self):
+        self.flags(heartbeat_flush_interval=0, group='conductor')
+        self.assertEqual(None, self._start_heartbeat_timer())
+        self.mox.StubOutWithMock(db, 'service_heartbeat_update')
+        db.service_heartbeat_update(self.context, {1: 5})
+        self.mox.ReplayAll()
+        self.conductor.service_heartbeat(self.context, 1, 5)
+
+    def test_service_heartbeat_without_timer(self):
+        # As when the conductor runs inside another service
+        self.mox.StubOutWithMock(db, 'service_heartbeat_update')
+        db.service_heartbeat_update(self.context, {1: 5})
+        self.mox.ReplayAll()
+        self.conductor.service_heartbeat(self.context, 1, 5)
+
+    def test_roll_up_usage_of_days_not_rolled_up(self):
+        self.flags(usage_rollup_days=3, group='conductor')
+        now = datetime.datetime(2013, 3, 4, 12, 30)
+        timeutils.set_time_override(now)
+        self.addCleanup(timeutils.clear_time_override)
+        day = datetime.timedelta(days=1)
+        today = datetime.datetime(2013, 3, 4)
+        self.mox.StubOutWithMock(db, 'instance_usage_rollup_get_periods')
+        self.mox.StubOutWithMock(compute_utils, 'roll_up_usage')
+        db.instance_usage_rollup_get_periods(self.context, today - 3 * day,
+                                             today).AndReturn(
+                                                 [today - 2 * day])
+        compute_utils.roll_up_usage(self.context, today - 3 * day)
+        compute_utils.roll_up_usage(self.context, today - day).AndRaise(
+            test.TestingException())
+        self.mox.ReplayAll()
+        self.conductor._roll_up_usage(self.context)
+
+    def test_roll_up_usage_rolled_up_elsewhere(self):
+        self.flags(usage_rollup_days=2, group='conductor')
+        now = datetime.datetime(2013, 3, 4, 12, 30)
+        timeutils.set_time_override(now)
+        self.addCleanup(timeutils.clear_time_override)
+        day = datetime.timedelta(days=1)
+        today = datetime.datetime(2013, 3, 4)
+        self.mox.StubOutWithMock(db, 'instance_usage_rollup_get_periods')
+        self.mox.StubOutWithMock(compute_utils, 'roll_up_usage')
+        self.mox.StubOutWithMock(conductor_manager.LOG, 'exception')
+        db.instance_usage_rollup_get_periods(self.context, today - 2 * day,
+                                             today).AndReturn([])
+        compute_utils.roll_up_usage(self.context, today - 2 * day).AndRaise(
+            exc.InstanceUsageRollupExists(
+                period_beginning=today - 2 * day))
+        compute_utils.roll_up_usage(self.context, today - day)
+        self.mox.ReplayAll()
+        self.conductor._roll_up_usage(self.context)
+
+    def test_roll_up_usage_disabled(self):
+        self.flags(usage_rollup_days=0, group='conductor')
+        self.mox.StubOutWithMock(db, 'instance_usage_rollup_get_periods')
+        self.mox.ReplayAll()
+        self.conductor._roll_up_usage(self.context)
+
 
 class ConductorRPCAPITestCase(_BaseTestCase, test.TestCase):
     """Conductor RPC API Tests."""
@@ -839,6 +991,10 @@ class ConductorAPITestCase(_BaseTestCase, test.TestCase):
         return self.conductor.instance_update(self.context, instance_uuid,
                                               **updates)
 
+    def _do_update_lean(self, instance_uuid, **updates):
+        return self.conductor.instance_update_lean(self.context,
+                                                   instance_uuid, **updates)
+
     def test_bw_usage_get(self):
         self.mox.StubOutWithMock(db, 'bw_usage_update')
         self.mox.StubOutWithMock(db, 'bw_usage_get')
@@ -947,6 +1103,14 @@ class ConductorAPITestCase(_BaseTestCase, test.TestCase):
         result = self.conductor.service_update(self.context, {'id': ''}, {})
         self.assertEqual(result, 'fake-result')
 
+    def test_service_heartbeat(self):
+        self.mox.StubOutWithMock(self.conductor_manager, 'service_heartbeat')
+        self.conductor_manager.service_heartbeat(self.context, 'fake-id', 3)
+        self.mox.ReplayAll()
+        service = {'id': 'fake-id', 'report_count': 2}
+        result = self.conductor.service_heartbeat(self.context, service, 3)
+        self.assertEqual({'id': 'fake-id', 'report_count': 3}, result)
+
     def test_instance_get_all_by_host(self):
         self._test_stubbed('instance_get_all_by_host',
                            self.context.elevated(), 'host')
@@ -1004,6 +1168,16 @@ class ConductorLocalAPITestCase(ConductorAPITestCase):
         # Override test in ConductorAPITestCase
         pass
 
+    def test_service_heartbeat(self):
+        # Override test in ConductorAPITestCase
+        self.mox.StubOutWithMock(db, 'service_update')
+        db.service_update(self.context, 'fake-id',
+                          {'report_count': 3}).AndReturn('fake-result')
+        self.mox.ReplayAll()
+        result = self.conductor.service_heartbeat(self.context,
+                                                  {'id': 'fake-id'}, 3)
+        self.assertEqual('fake-result', result)
+
 
 class ConductorImportTest(test.TestCase):
     def test_import_conductor_local(self):
@@ -211,6 +211,8 @@ class _FakeImageService(object):
             except Exception:
                 pass
             image.update(metadata)
+        if data:
+            self._imagedata[image_id] = data.read()
         return self.images[image_id]
 
     def delete(self, context, image_id):
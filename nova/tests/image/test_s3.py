@@ -15,13 +15,16 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import base64
 import binascii
 import eventlet
 import mox
 import os
-import tempfile
+import StringIO
+import tarfile
 
 import fixtures
+from lxml import etree
 
 from nova import context
 import nova.db.api
@@ -29,6 +32,7 @@ from nova import exception
 from nova.image import s3
 from nova import test
 from nova.tests.image import fake
+from nova import utils
 
 
 ami_manifest_xml = """<?xml version="1.0" ?>
@@ -165,7 +169,6 @@ class TestS3ImageService(test.TestCase):
         metadata = {'properties': {
                     'image_location': 'mybucket/my.img.manifest.xml'},
                     'name': 'mybucket/my.img'}
-        handle, tempf = tempfile.mkstemp(dir='/tmp')
 
         ignore = mox.IgnoreArg()
         mockobj = self.mox.CreateMockAnything()
@@ -177,15 +180,19 @@ class TestS3ImageService(test.TestCase):
         mockobj(ignore).AndReturn(mockobj)
         self.stubs.Set(mockobj, 'get_contents_as_string', mockobj)
         mockobj().AndReturn(file_manifest_xml)
-        self.stubs.Set(self.image_service, '_download_file', mockobj)
-        mockobj(ignore, ignore, ignore).AndReturn(tempf)
         self.stubs.Set(binascii, 'a2b_hex', mockobj)
         mockobj(ignore).AndReturn('foo')
         mockobj(ignore).AndReturn('foo')
-        self.stubs.Set(self.image_service, '_decrypt_image', mockobj)
-        mockobj(ignore, ignore, ignore, ignore, ignore).AndReturn(mockobj)
-        self.stubs.Set(self.image_service, '_untarzip_image', mockobj)
-        mockobj(ignore, ignore).AndReturn(tempf)
+        self.stubs.Set(self.image_service, '_decrypt_key', mockobj)
+        mockobj(ignore, ignore, ignore).AndReturn(('key', 'iv'))
+        self.stubs.Set(self.image_service, '_download_parts', mockobj)
+        mockobj(ignore, ['foo']).AndReturn(iter(['part']))
+        self.stubs.Set(s3, 'BundleStream', mockobj)
+        mockobj(ignore, 'key', 'iv').AndReturn(mockobj)
+        self.stubs.Set(mockobj, 'open_image', mockobj)
+        mockobj().AndReturn(StringIO.StringIO('image'))
+        self.stubs.Set(mockobj, 'close', mockobj)
+        mockobj()
         self.mox.ReplayAll()
 
         img = self.image_service._s3_create(self.context, metadata)
@@ -201,10 +208,136 @@ class TestS3ImageService(test.TestCase):
         self.assertEqual(updated_image['properties']['image_state'],
                           'available')
 
+    def _make_bundle(self, image_data, part_size, trailing_data=None):
+        """Return the manifest and parts of a bundle of image_data,
+        followed in the tarball by a file of trailing_data if given.
+        """
+        tar_data = StringIO.StringIO()
+        tar_file = tarfile.open(fileobj=tar_data, mode='w:gz')
+        members = [('my.img', image_data)]
+        if trailing_data is not None:
+            members.append(('trailing', trailing_data))
+        for name, data in members:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar_file.addfile(info, StringIO.StringIO(data))
+        tar_file.close()
+
+        key = '00112233445566778899aabbccddeeff'
+        iv = 'ffeeddccbbaa99887766554433221100'
+        encrypted, _err = utils.execute('openssl', 'enc', '-e',
+                                        '-aes-128-cbc', '-K', key, '-iv', iv,
+                                        process_input=tar_data.getvalue())
+        parts = {}
+        for offset in xrange(0, len(encrypted), part_size):
+            parts['my.img.part.%d' % len(parts)] = \
+                encrypted[offset:offset + part_size]
+
+        manifest = etree.Element('manifest')
+        image = etree.SubElement(manifest, 'image')
+        etree.SubElement(image, 'ec2_encrypted_key').text = \
+            binascii.b2a_hex(key)
+        etree.SubElement(image, 'ec2_encrypted_iv').text = \
+            binascii.b2a_hex(iv)
+        parts_element = etree.SubElement(image, 'parts',
+                                         count=str(len(parts)))
+        for index in xrange(len(parts)):
+            part = etree.SubElement(parts_element, 'part', index=str(index))
+            etree.SubElement(part, 'filename').text = 'my.img.part.%d' % index
+        return etree.tostring(manifest), parts
+
+    def _register_bundle(self, manifest, parts):
+        objects = dict(parts)
+        objects['my.img.manifest.xml'] = manifest
+
+        class FakeKey(object):
+            def __init__(self, name):
+                self.name = name
+
+            def get_contents_as_string(self):
+                return objects[self.name]
+
+        class FakeBucket(object):
+            def get_key(self, name):
+                return FakeKey(name)
+
+        class FakeConnection(object):
+            def get_bucket(self, name):
+                return FakeBucket()
+
+        def fake_decrypt_text(context, project_id, text):
+            return base64.b64decode(text)
+
+        self.stubs.Set(self.image_service, '_conn',
+                       lambda context: FakeConnection())
+        self.stubs.Set(self.image_service.cert_rpcapi, 'decrypt_text',
+                       fake_decrypt_text)
+        self.flags(s3_image_download_parts=2)
+
+        metadata = {'properties': {
+                    'image_location': 'mybucket/my.img.manifest.xml'},
+                    'name': 'mybucket/my.img'}
+        image = self.image_service._s3_create(self.context, metadata)
+        image_uuid = self.image_service._translate_id_to_uuid(
+            self.context, image)['id']
+        image_service = fake.FakeImageService()
+        for i in xrange(1000):
+            image = image_service.show(self.context, image_uuid)
+            if image['properties']['image_state'] not in ('decrypting',
+                                                          'uploading'):
+                break
+            eventlet.sleep(0.01)
+        return image_service, image_uuid, image
+
+    def test_s3_create_streams_bundle(self):
+        image_data = os.urandom(100000)
+        manifest, parts = self._make_bundle(image_data, 8192)
+        image_service, image_uuid, image = self._register_bundle(manifest,
+                                                                 parts)
+
+        self.assertEqual('available', image['properties']['image_state'])
+        self.assertEqual('active', image['status'])
+        data = StringIO.StringIO()
+        image_service.download(self.context, image_uuid, data)
+        self.assertEqual(image_data, data.getvalue())
+
+    def test_s3_create_with_data_after_image(self):
+        image_data = os.urandom(1000)
+        manifest, parts = self._make_bundle(image_data, 8192,
+                                            trailing_data=os.urandom(300000))
+        image_service, image_uuid, image = self._register_bundle(manifest,
+                                                                 parts)
+
+        self.assertEqual('available', image['properties']['image_state'])
+        data = StringIO.StringIO()
+        image_service.download(self.context, image_uuid, data)
+        self.assertEqual(image_data, data.getvalue())
+
+    def test_s3_create_failed_download(self):
+        manifest, parts = self._make_bundle(os.urandom(100000), 8192)
+        del parts['my.img.part.3']
+        image_service, image_uuid, image = self._register_bundle(manifest,
+                                                                 parts)
+        self.assertEqual('failed_download',
+                         image['properties']['image_state'])
+
     def test_s3_malicious_tarballs(self):
-        self.assertRaises(exception.NovaException,
-            self.image_service._test_for_malicious_tarball,
-            "/unused", os.path.join(os.path.dirname(__file__), 'abs.tar.gz'))
-        self.assertRaises(exception.NovaException,
-            self.image_service._test_for_malicious_tarball,
-            "/unused", os.path.join(os.path.dirname(__file__), 'rel.tar.gz'))
+        for name in ('abs.tar.gz', 'rel.tar.gz'):
+            tar_file = tarfile.open(os.path.join(os.path.dirname(__file__),
+                                                 name), 'r|gz')
+            self.assertRaises(exception.NovaException,
+                              self.image_service._image_member, tar_file)
+            tar_file.close()
+
+    def test_image_member_allows_leading_dots(self):
+        tar_data = StringIO.StringIO()
+        tar_file = tarfile.open(fileobj=tar_data, mode='w')
+        info = tarfile.TarInfo('..foo.img')
+        info.size = 5
+        tar_file.addfile(info, StringIO.StringIO('image'))
+        tar_file.close()
+        tar_data.seek(0)
+
+        tar_file = tarfile.open(fileobj=tar_data, mode='r|')
+        member = self.image_service._image_member(tar_file)
+        self.assertEqual('..foo.img', member.name)
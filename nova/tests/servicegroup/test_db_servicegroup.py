@@ -16,6 +16,7 @@ import datetime
 
 import eventlet
 import fixtures
+import mox
 
 from nova import context
 from nova import db
@@ -108,6 +109,71 @@ class DBServiceGroupTestCase(test.TestCase):
         service_id = self.servicegroup_api.get_one(self._topic)
         self.assertTrue(service_id in services)
 
+    def test_get_all_cached(self):
+        now = timeutils.utcnow()
+        services = [{'host': 'foo', 'updated_at': now, 'created_at': now}]
+        driver = self.servicegroup_api._driver
+        self.mox.StubOutWithMock(driver.conductor_api,
+                                 'service_get_all_by_topic')
+        driver.conductor_api.service_get_all_by_topic(
+            mox.IgnoreArg(), self._topic).AndReturn(services)
+        self.mox.ReplayAll()
+
+        self.assertEqual(['foo'], self.servicegroup_api.get_all(self._topic))
+        self.assertEqual(['foo'], self.servicegroup_api.get_all(self._topic))
+
+    def test_get_all_cache_disabled(self):
+        self.flags(servicegroup_db_cache_time=0)
+        driver = self.servicegroup_api._driver
+        self.mox.StubOutWithMock(driver.conductor_api,
+                                 'service_get_all_by_topic')
+        for i in range(2):
+            driver.conductor_api.service_get_all_by_topic(
+                mox.IgnoreArg(), self._topic).AndReturn([])
+        self.mox.ReplayAll()
+
+        self.assertEqual([], self.servicegroup_api.get_all(self._topic))
+        self.assertEqual([], self.servicegroup_api.get_all(self._topic))
+
+    def _fake_service(self):
+        class FakeService(object):
+            service_ref = {'id': 1, 'report_count': 4}
+        return FakeService()
+
+    def test_report_state(self):
+        service = self._fake_service()
+        driver = self.servicegroup_api._driver
+        self.mox.StubOutWithMock(driver.conductor_api, 'service_update')
+        driver.conductor_api.service_update(mox.IgnoreArg(),
+                service.service_ref, {'report_count': 5}).AndReturn(
+                        {'id': 1, 'report_count': 5})
+        self.mox.ReplayAll()
+        driver._report_state(service)
+        self.assertEqual(5, service.service_ref['report_count'])
+
+    def test_report_state_batched(self):
+        self.flags(servicegroup_db_batch_heartbeats=True)
+        service = self._fake_service()
+        driver = self.servicegroup_api._driver
+        self.mox.StubOutWithMock(driver.conductor_api, 'service_heartbeat')
+        driver.conductor_api.service_heartbeat(mox.IgnoreArg(),
+                service.service_ref, 5).AndReturn(
+                        {'id': 1, 'report_count': 5})
+        self.mox.ReplayAll()
+        driver._report_state(service)
+        self.assertEqual(5, service.service_ref['report_count'])
+
+    def test_report_state_model_disconnected(self):
+        service = self._fake_service()
+        driver = self.servicegroup_api._driver
+        self.mox.StubOutWithMock(driver.conductor_api, 'service_update')
+        driver.conductor_api.service_update(mox.IgnoreArg(),
+                service.service_ref, {'report_count': 5}).AndRaise(
+                        test.TestingException())
+        self.mox.ReplayAll()
+        driver._report_state(service)
+        self.assertTrue(service.model_disconnected)
+
     def test_service_is_up(self):
         fts_func = datetime.datetime.fromtimestamp
         fake_now = 1000
@@ -23,13 +23,19 @@ import datetime
 import uuid as stdlib_uuid
 
 from oslo.config import cfg
+from sqlalchemy import event
 from sqlalchemy import MetaData
 from sqlalchemy.schema import Table
 from sqlalchemy.sql.expression import select
 
+from nova.cells import rpcapi as cells_rpcapi
 from nova import context
 from nova import db
+from nova.db.sqlalchemy import models
+from nova.db.sqlalchemy import utils as db_utils
+from nova.db import threadpool as db_threadpool
 from nova import exception
+from nova.openstack.common.db import api as common_db_api
 from nova.openstack.common.db.sqlalchemy import session as db_session
 from nova.openstack.common import timeutils
 from nova import test
@@ -94,6 +100,47 @@ class DbApiTestCase(test.TestCase):
 
         self.flags(osapi_compute_unique_server_name_scope=None)
 
+    def test_instance_create_bulk(self):
+        db.security_group_create(self.context,
+                                 {'name': 'web', 'project_id': self.project_id,
+                                  'user_id': self.user_id,
+                                  'description': 'web'})
+        base = {'reservation_id': 'a', 'image_ref': 1,
+                'project_id': self.project_id, 'vm_state': 'fake',
+                'metadata': {'role': 'web'},
+                'info_cache': {'network_info': '[]'},
+                'security_groups': ['default', 'web']}
+        instances = db.instance_create_bulk(self.context, [
+            dict(base, hostname='web1', system_metadata={'n': '1'}),
+            dict(base, hostname='web2', system_metadata={'n': '2'},
+                 launch_time='not a column')])
+
+        self.assertEqual(['web1', 'web2'],
+                         [inst['hostname'] for inst in instances])
+        for n, inst in enumerate(instances):
+            inst = db.instance_get_by_uuid(self.context, inst['uuid'])
+            self.assertEqual({'role': 'web'},
+                             utils.metadata_to_dict(inst['metadata']))
+            self.assertEqual({'n': str(n + 1)},
+                             utils.metadata_to_dict(inst['system_metadata']))
+            self.assertEqual('[]', inst['info_cache']['network_info'])
+            self.assertEqual(['default', 'web'],
+                             sorted(group['name']
+                                    for group in inst['security_groups']))
+            self.assertTrue(db.get_ec2_instance_id_by_uuid(self.context,
+                                                           inst['uuid']))
+
+    def test_instance_create_bulk_unique_hostname(self):
+        self.create_instances_with_args(hostname='taken')
+        self.flags(osapi_compute_unique_server_name_scope='project')
+        self.assertRaises(exception.InstanceExists,
+                          db.instance_create_bulk, self.context,
+                          [{'hostname': 'free'}, {'hostname': 'taken'}])
+        self.assertRaises(exception.InstanceExists,
+                          db.instance_create_bulk, self.context,
+                          [{'hostname': 'free'}, {'hostname': 'FREE'}])
+        self.assertEqual(1, len(db.instance_get_all(self.context)))
+
     def test_ec2_ids_not_found_are_printable(self):
         def check_exc_format(method):
             try:
@@ -161,6 +208,229 @@ class DbApiTestCase(test.TestCase):
         else:
             self.assertTrue(result[1]['deleted'])
 
+    def test_instance_get_active_by_window_usage(self):
+        now = timeutils.utcnow()
+        hour = datetime.timedelta(hours=1)
+        inst1 = self.create_instances_with_args(launched_at=now - 3 * hour)
+        inst2 = self.create_instances_with_args(launched_at=now - 2 * hour,
+                                                terminated_at=now - hour)
+        self.create_instances_with_args(launched_at=now - 3 * hour,
+                                        terminated_at=now - 2 * hour)
+        self.create_instances_with_args(launched_at=now + hour)
+        inst5 = self.create_instances_with_args(launched_at=now - hour,
+                                                project_id='other')
+        db.instance_destroy(self.context, inst1['uuid'])
+
+        result = db.instance_get_active_by_window_usage(
+            self.context, now - 2 * hour + datetime.timedelta(seconds=1), now)
+        self.assertEqual([inst1['uuid'], inst2['uuid'], inst5['uuid']],
+                         [r['uuid'] for r in result])
+        self.assertEqual(set(['id', 'uuid', 'display_name', 'project_id',
+                              'instance_type_id', 'vm_state', 'launched_at',
+                              'terminated_at']), set(result[0].keys()))
+
+        result = db.instance_get_active_by_window_usage(
+            self.context, now - 2 * hour + datetime.timedelta(seconds=1), now,
+            project_id=self.project_id)
+        self.assertEqual([inst1['uuid'], inst2['uuid']],
+                         [r['uuid'] for r in result])
+
+        result = db.instance_get_active_by_window_usage(
+            self.context, now - 2 * hour + datetime.timedelta(seconds=1), now,
+            marker=inst1['id'], limit=1)
+        self.assertEqual([inst2['uuid']], [r['uuid'] for r in result])
+
+    def test_instance_usage_rollup(self):
+        ctxt = context.get_admin_context()
+        day = datetime.datetime(2013, 3, 1)
+        next_day = day + datetime.timedelta(days=1)
+        hour = datetime.timedelta(hours=1)
+        self.create_instances_with_args(launched_at=day - hour,
+                                        terminated_at=day + 2 * hour,
+                                        instance_type_id=1)
+        self.create_instances_with_args(launched_at=day + 20 * hour,
+                                        instance_type_id=1)
+        self.create_instances_with_args(launched_at=day + hour,
+                                        terminated_at=day + 2 * hour,
+                                        instance_type_id=2,
+                                        project_id='other')
+        self.create_instances_with_args(launched_at=next_day,
+                                        instance_type_id=1)
+
+        def hours(rollups):
+            return sorted((r['project_id'], r['instance_type_id'], r['hours'])
+                          for r in rollups)
+
+        rollups = db.instance_usage_rollup_compute(ctxt, day, next_day)
+        self.assertEqual(sorted([('other', 2, 1.0),
+                                 (self.project_id, 1, 6.0)]), hours(rollups))
+
+        self.assertEqual([], db.instance_usage_rollup_get_periods(
+            ctxt, day, next_day))
+        db.instance_usage_rollup_replace(ctxt, day, rollups)
+        db.instance_usage_rollup_replace(ctxt, next_day, [
+            dict(project_id=self.project_id, instance_type_id=1, hours=24.0)])
+        # Rolling a period up again replaces it
+        db.instance_usage_rollup_replace(ctxt, day, rollups)
+
+        two_days = next_day + datetime.timedelta(days=1)
+        self.assertEqual([day, next_day],
+                         db.instance_usage_rollup_get_periods(ctxt, day,
+                                                              two_days))
+        result = db.instance_usage_rollup_get_by_window(ctxt, day, two_days)
+        self.assertEqual(sorted([('other', 2, 1.0),
+                                 (self.project_id, 1, 30.0)]), hours(result))
+        result = db.instance_usage_rollup_get_by_window(ctxt, day, next_day,
+                                                        project_id='other')
+        self.assertEqual([('other', 2, 1.0)], hours(result))
+
+    def test_instance_usage_rollup_replaced_concurrently(self):
+        ctxt = context.get_admin_context()
+        day = datetime.datetime(2013, 3, 1)
+        rollup = dict(project_id=self.project_id, instance_type_id=1,
+                      hours=6.0)
+        db.instance_usage_rollup_replace(ctxt, day, [rollup])
+
+        # A second replace inserting after the first one committed
+        duplicate = models.InstanceUsageRollup()
+        duplicate.update(rollup)
+        duplicate.period_beginning = day
+        self.assertRaises(db_session.DBDuplicateEntry, duplicate.save)
+
+        # A replace that collides is rolled back as a whole
+        self.assertRaises(exception.InstanceUsageRollupExists,
+                          db.instance_usage_rollup_replace, ctxt, day,
+                          [dict(rollup, hours=1.0), dict(rollup, hours=2.0)])
+        result = db.instance_usage_rollup_get_by_window(
+            ctxt, day, day + datetime.timedelta(days=1))
+        self.assertEqual([6.0], [r['hours'] for r in result])
+        self.assertEqual([day], db.instance_usage_rollup_get_periods(
+            ctxt, day, day + datetime.timedelta(days=1)))
+
+    def test_instance_update_adjusts_usage_rollups(self):
+        ctxt = context.get_admin_context()
+        day = datetime.datetime(2013, 3, 1)
+        one_day = datetime.timedelta(days=1)
+        hour = datetime.timedelta(hours=1)
+        timeutils.set_time_override(day + 2 * one_day + 12 * hour)
+        self.addCleanup(timeutils.clear_time_override)
+        inst1 = self.create_instances_with_args(launched_at=day + 12 * hour,
+                                                instance_type_id=1)
+        inst2 = self.create_instances_with_args(launched_at=day,
+                                                instance_type_id=1)
+        periods = [day, day + one_day]
+        for period in periods:
+            db.instance_usage_rollup_replace(ctxt, period,
+                db.instance_usage_rollup_compute(ctxt, period,
+                                                 period + one_day))
+
+        def rolled_up(period):
+            rollups = db.instance_usage_rollup_get_by_window(
+                ctxt, period, period + one_day)
+            return sorted((r['instance_type_id'], r['hours'])
+                          for r in rollups if r['hours'])
+
+        def assertMatchesInstances():
+            for period in periods:
+                rollups = db.instance_usage_rollup_compute(ctxt, period,
+                                                           period + one_day)
+                self.assertEqual(sorted((r['instance_type_id'], r['hours'])
+                                        for r in rollups),
+                                 rolled_up(period))
+
+        # A resize moves the usage of inst1 to the new flavor
+        db.instance_update(ctxt, inst1['uuid'], {'instance_type_id': 2})
+        assertMatchesInstances()
+        self.assertEqual([(1, 24.0), (2, 24.0)], rolled_up(periods[1]))
+
+        # A rebuild launches it afresh
+        db.instance_update(ctxt, inst1['uuid'],
+                           {'launched_at': day + 2 * one_day})
+        assertMatchesInstances()
+        self.assertEqual([(1, 24.0)], rolled_up(periods[1]))
+
+        # Terminating goes through the full update too
+        db.instance_update_lean(ctxt, inst2['uuid'],
+                                {'terminated_at': day + one_day + 6 * hour})
+        assertMatchesInstances()
+        self.assertEqual([(1, 24.0)], rolled_up(periods[0]))
+        self.assertEqual([(1, 6.0)], rolled_up(periods[1]))
+
+    def test_instance_update_batch(self):
+        inst1 = self.create_instances_with_args()
+        inst2 = self.create_instances_with_args()
+        missing = str(stdlib_uuid.uuid4())
+        values = {'vm_state': 'active', 'system_metadata': {'k': 'v'}}
+        not_found = db.instance_update_batch(self.context, [
+            (inst1['uuid'], values, {'network_info': '[1]'}),
+            (missing, {'vm_state': 'active'}, None),
+            (inst2['uuid'], {'vm_state': 'error'}, None)])
+        self.assertEqual([missing], not_found)
+        # The values passed in are left alone
+        self.assertEqual({'k': 'v'}, values['system_metadata'])
+
+        inst1 = db.instance_get_by_uuid(self.context, inst1['uuid'])
+        self.assertEqual('active', inst1['vm_state'])
+        self.assertEqual({'k': 'v'}, utils.metadata_to_dict(
+            inst1['system_metadata']))
+        self.assertEqual('[1]', inst1['info_cache']['network_info'])
+        inst2 = db.instance_get_by_uuid(self.context, inst2['uuid'])
+        self.assertEqual('error', inst2['vm_state'])
+
+    def test_instance_update_lean(self):
+        inst = self.create_instances_with_args()
+        db.instance_update_lean(self.context, inst['uuid'],
+                                {'task_state': 'rebooting',
+                                 'expected_task_state': [None, 'other']})
+        inst = db.instance_get_by_uuid(self.context, inst['uuid'])
+        self.assertEqual('rebooting', inst['task_state'])
+
+        self.assertRaises(exception.UnexpectedTaskStateError,
+                          db.instance_update_lean, self.context,
+                          inst['uuid'], {'task_state': None,
+                                         'expected_task_state': None})
+        db.instance_update_lean(self.context, inst['uuid'],
+                                {'task_state': None,
+                                 'expected_task_state': 'rebooting'})
+        inst = db.instance_get_by_uuid(self.context, inst['uuid'])
+        self.assertEqual(None, inst['task_state'])
+
+        self.assertRaises(exception.InstanceNotFound,
+                          db.instance_update_lean, self.context,
+                          str(stdlib_uuid.uuid4()), {'vm_state': 'error'})
+
+    def test_instance_update_lean_needs_load(self):
+        inst = self.create_instances_with_args()
+        db.instance_update_lean(self.context, inst['uuid'],
+                                {'vm_state': 'error',
+                                 'system_metadata': {'k': 'v'}})
+        inst = db.instance_get_by_uuid(self.context, inst['uuid'])
+        self.assertEqual('error', inst['vm_state'])
+        self.assertEqual({'k': 'v'}, utils.metadata_to_dict(
+            inst['system_metadata']))
+
+    def test_instance_update_lean_sends_whole_instance_to_cells(self):
+        self.flags(enable=True, group='cells')
+        inst = self.create_instances_with_args()
+        sent = []
+
+        def fake_instance_update_at_top(_self, ctxt, instance):
+            sent.append(instance)
+
+        self.stubs.Set(cells_rpcapi.CellsAPI, 'instance_update_at_top',
+                       fake_instance_update_at_top)
+        db.instance_update_lean(self.context, inst['uuid'],
+                                {'vm_state': 'error'})
+        self.assertEqual(1, len(sent))
+        self.assertEqual(inst['uuid'], sent[0]['uuid'])
+        self.assertEqual('error', sent[0]['vm_state'])
+        self.assertEqual(inst['project_id'], sent[0]['project_id'])
+
+        self.flags(enable=False, group='cells')
+        db.instance_update_lean(self.context, inst['uuid'],
+                                {'vm_state': 'active'})
+        self.assertEqual(1, len(sent))
+
     def test_instance_get_all_by_filters_paginate(self):
         self.flags(sql_connection="notdb://")
         test1 = self.create_instances_with_args(display_name='test1')
@@ -1094,6 +1364,97 @@ def _create_aggregate_with_hosts(context=context.get_admin_context(),
     return result
 
 
+class ServiceHeartbeatTestCase(test.TestCase):
+    def setUp(self):
+        super(ServiceHeartbeatTestCase, self).setUp()
+        self.ctxt = context.get_admin_context()
+
+    def _create_service(self, host):
+        return db.service_create(self.ctxt, dict(host=host, binary='binary',
+                                                 topic='compute',
+                                                 report_count=0))
+
+    def test_service_heartbeat_update(self):
+        services = [self._create_service('host%d' % i) for i in range(3)]
+        timeutils.set_time_override()
+        self.addCleanup(timeutils.clear_time_override)
+
+        db.service_heartbeat_update(self.ctxt, {services[0]['id']: 5,
+                                                services[1]['id']: 7})
+
+        refs = [db.service_get(self.ctxt, s['id']) for s in services]
+        self.assertEqual([5, 7, 0], [ref['report_count'] for ref in refs])
+        self.assertEqual(timeutils.utcnow(), refs[0]['updated_at'])
+        self.assertEqual(timeutils.utcnow(), refs[1]['updated_at'])
+        self.assertEqual(None, refs[2]['updated_at'])
+
+    def test_service_heartbeat_update_nothing(self):
+        db.service_heartbeat_update(self.ctxt, {})
+
+
+class DbApiTpoolTestCase(test.TestCase):
+    def setUp(self):
+        super(DbApiTpoolTestCase, self).setUp()
+        self.context = context.get_admin_context()
+        self.pool_sizes = []
+        self.stubs.Set(db_threadpool, '_set_tpool_size',
+                       lambda tpool, size: self.pool_sizes.append(size))
+        self.addCleanup(CONF.set_default, 'sql_max_pool_size',
+                        CONF.sql_max_pool_size)
+
+    def _make_dbapi(self):
+        return db_threadpool.ThreadPoolDBAPI(common_db_api.DBAPI(
+            backend_mapping={'sqlalchemy': 'nova.db.sqlalchemy.api'}))
+
+    def test_tpool_disabled(self):
+        dbapi = self._make_dbapi()
+        self.assertEqual(None, dbapi.tpool_stats())
+        self.assertEqual([], self.pool_sizes)
+
+    def test_tpool_left_to_dbapi_use_tpool(self):
+        self.flags(dbapi_use_tpool=True, dbapi_tpool_size=4)
+        dbapi = self._make_dbapi()
+        self.assertEqual(None, dbapi.tpool_stats())
+        self.assertEqual([], self.pool_sizes)
+
+    def test_tpool_calls_are_counted(self):
+        self.flags(dbapi_tpool_size=4)
+        from eventlet import tpool
+
+        executed = []
+
+        def fake_execute(meth, *args, **kwargs):
+            executed.append(meth)
+            return meth(*args, **kwargs)
+
+        self.stubs.Set(tpool, 'execute', fake_execute)
+        dbapi = self._make_dbapi()
+        dbapi.instance_create(self.context, {})
+        self.assertEqual(1, len(dbapi.instance_get_all(self.context)))
+
+        self.assertEqual(2, len(executed))
+        self.assertEqual([4], self.pool_sizes)
+        self.assertEqual(4, CONF.sql_max_pool_size)
+        stats = dbapi.tpool_stats()
+        self.assertEqual(2, stats['calls'])
+        self.assertEqual(0, stats['in_flight'])
+        self.assertEqual(1, stats['max_in_flight'])
+        self.assertEqual(0, stats['queue_depth'])
+        self.assertTrue(stats['max_wait'] >= 0)
+
+    def test_tpool_stats_queue_depth(self):
+        stats = db_threadpool.TpoolStats(2)
+        for i in range(5):
+            stats.call_started()
+        self.assertEqual(3, stats.queue_depth)
+        stats.call_finished(0.5)
+        stats.call_finished(1.5)
+        self.assertEqual(1, stats.queue_depth)
+        self.assertEqual(5, stats.to_dict()['max_in_flight'])
+        self.assertEqual(1.0, stats.to_dict()['average_wait'])
+        self.assertEqual(1.5, stats.to_dict()['max_wait'])
+
+
 class AggregateDBApiTestCase(test.TestCase):
     def setUp(self):
         super(AggregateDBApiTestCase, self).setUp()
@@ -1949,6 +2310,79 @@ class ArchiveTestCase(test.TestCase):
         # Verify we still have 4 in shadow
         self.assertEqual(len(rows8), 4)
 
+    def test_archive_deleted_rows_copies_rows(self):
+        tablename = "instance_id_mappings"
+        for uuidstr in self.uuidstrs:
+            insert_statement = self.table1.insert().values(uuid=uuidstr)
+            self.conn.execute(insert_statement)
+        # Delete every other row, so live rows sit between deleted ones
+        update_statement = self.table1.update().\
+                where(self.table1.c.uuid.in_(self.uuidstrs[::2]))\
+                .values(deleted=True)
+        self.conn.execute(update_statement)
+        query1 = select([self.table1]).where(self.table1.c.uuid.in_(
+                                             self.uuidstrs[::2]))
+        deleted_rows = [tuple(row) for row in
+                        self.conn.execute(query1).fetchall()]
+
+        self.assertEqual(2, db.archive_deleted_rows_for_table(
+                self.context, tablename, max_rows=2))
+        self.assertEqual(1, db.archive_deleted_rows_for_table(
+                self.context, tablename, max_rows=2))
+        self.assertEqual(0, db.archive_deleted_rows_for_table(
+                self.context, tablename, max_rows=2))
+
+        query2 = select([self.shadow_table1]).\
+                where(self.shadow_table1.c.uuid.in_(self.uuidstrs)).\
+                order_by(self.shadow_table1.c.id)
+        shadow_rows = [tuple(row) for row in
+                       self.conn.execute(query2).fetchall()]
+        self.assertEqual(sorted(deleted_rows), shadow_rows)
+        query3 = select([self.table1.c.uuid]).where(self.table1.c.uuid.in_(
+                                                    self.uuidstrs))
+        self.assertEqual(sorted(self.uuidstrs[1::2]),
+                         sorted(row[0] for row in
+                                self.conn.execute(query3).fetchall()))
+
+    def test_archive_deleted_rows_keeps_rows_deleted_after_copy(self):
+        tablename = "instance_id_mappings"
+        for uuidstr in self.uuidstrs:
+            insert_statement = self.table1.insert().values(uuid=uuidstr)
+            self.conn.execute(insert_statement)
+        update_statement = self.table1.update().\
+                where(self.table1.c.uuid.in_(self.uuidstrs[1::2]))\
+                .values(deleted=True)
+        self.conn.execute(update_statement)
+
+        # Soft-delete another row once the batch has been copied, as a
+        # concurrent transaction could before the copied rows are deleted.
+        late_delete = self.table1.update().\
+                where(self.table1.c.uuid == self.uuidstrs[0])\
+                .values(deleted=True)
+
+        def after_execute(conn, clauseelement, multiparams, params, result):
+            if isinstance(clauseelement, db_utils.InsertFromSelect):
+                conn.execute(late_delete)
+
+        engine = get_engine()
+        event.listen(engine, 'after_execute', after_execute)
+        try:
+            self.assertEqual(3, db.archive_deleted_rows_for_table(
+                    self.context, tablename))
+        finally:
+            engine.dispatch.after_execute.remove(after_execute, engine)
+
+        query = select([self.table1.c.uuid]).where(
+                self.table1.c.uuid == self.uuidstrs[0])
+        self.assertEqual(1, len(self.conn.execute(query).fetchall()))
+        self.assertEqual(1, db.archive_deleted_rows_for_table(
+                self.context, tablename))
+        query = select([self.shadow_table1.c.uuid]).where(
+                self.shadow_table1.c.uuid.in_(self.uuidstrs))
+        self.assertEqual(sorted(self.uuidstrs[0:1] + self.uuidstrs[1::2]),
+                         sorted(row[0] for row in
+                                self.conn.execute(query).fetchall()))
+
     def test_archive_deleted_rows_no_id_column(self):
         uuidstr0 = self.uuidstrs[0]
         insert_statement = self.table2.insert().values(domain=uuidstr0)
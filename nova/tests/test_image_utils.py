@@ -16,6 +16,8 @@
 
 import os
 
+import fixtures
+
 from nova import test
 from nova import utils
 
@@ -236,3 +238,88 @@ ID        TAG                 VM SIZE                DATE       VM CLOCK
         self.assertEquals(67108864, image_info.virtual_size)
         self.assertEquals(98304, image_info.disk_size)
         self.assertEquals(3, len(image_info.snapshots))
+
+
+class NativeImageProbeTestCase(test.TestCase):
+    def setUp(self):
+        super(NativeImageProbeTestCase, self).setUp()
+        self.tmpdir = self.useFixture(fixtures.TempDir()).path
+        self.mox.StubOutWithMock(utils, 'execute')
+
+    def _write(self, name, data):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def _qcow2_header(self, size, backing_file=None, version=2,
+                      nb_snapshots=0):
+        backing_offset = backing_file and images.QCOW2_HEADER.size or 0
+        header = images.QCOW2_HEADER.pack(
+            images.QCOW2_MAGIC, version, backing_offset,
+            len(backing_file or ''), 16, size, 0, 0, 0, 0, 0,
+            nb_snapshots, 0)
+        return header + (backing_file or '')
+
+    def test_qcow2(self):
+        path = self._write('disk', self._qcow2_header(1 << 30))
+        self.mox.ReplayAll()
+        image_info = images.qemu_img_info(path)
+        self.assertEquals(path, image_info.image)
+        self.assertEquals('qcow2', image_info.file_format)
+        self.assertEquals(1 << 30, image_info.virtual_size)
+        self.assertEquals(65536, image_info.cluster_size)
+        self.assertEquals(None, image_info.backing_file)
+
+    def test_qcow2_v3_backing_file(self):
+        path = self._write('disk', self._qcow2_header(
+            1 << 20, backing_file='/var/lib/nova/_base/abc', version=3))
+        self.mox.ReplayAll()
+        image_info = images.qemu_img_info(path)
+        self.assertEquals('qcow2', image_info.file_format)
+        self.assertEquals('/var/lib/nova/_base/abc', image_info.backing_file)
+
+    def test_qcow2_relative_backing_file(self):
+        path = self._write('disk', self._qcow2_header(
+            1 << 20, backing_file='base'))
+        self.mox.ReplayAll()
+        image_info = images.qemu_img_info(path)
+        self.assertEquals(os.path.join(self.tmpdir, 'base'),
+                          image_info.backing_file)
+
+    def test_vpc_dynamic(self):
+        footer = images.VPC_FOOTER.pack(
+            images.VPC_MAGIC, 2, 0x10000, 512, 0, 'qemu', 0, 0,
+            0, 0, 1024, 16, 63, images.VPC_DISK_DYNAMIC, 0)
+        path = self._write('disk.vhd', footer + '\0' * 444)
+        self.mox.ReplayAll()
+        image_info = images.qemu_img_info(path)
+        self.assertEquals('vpc', image_info.file_format)
+        self.assertEquals(1024 * 16 * 63 * 512, image_info.virtual_size)
+
+    def _assert_falls_back(self, path):
+        utils.execute('env', 'LC_ALL=C', 'LANG=C', 'qemu-img', 'info',
+                      path).AndReturn(('file format: vmdk\n', ''))
+        self.mox.ReplayAll()
+        image_info = images.qemu_img_info(path)
+        self.assertEquals('vmdk', image_info.file_format)
+
+    def test_raw_uses_qemu_img(self):
+        self._assert_falls_back(self._write('disk', '\0' * 4096))
+
+    def test_foreign_format_uses_qemu_img(self):
+        self._assert_falls_back(self._write('disk', 'KDMV' + '\0' * 508))
+
+    def test_unknown_format_uses_qemu_img(self):
+        self._assert_falls_back(self._write('disk', 'NEWFMT' + '\0' * 506))
+
+    def test_qcow2_snapshots_use_qemu_img(self):
+        self._assert_falls_back(self._write('disk', self._qcow2_header(
+            1 << 20, nb_snapshots=1)))
+
+    def test_truncated_qcow2_uses_qemu_img(self):
+        self._assert_falls_back(self._write('disk', images.QCOW2_MAGIC))
+
+    def test_native_probe_disabled(self):
+        self.flags(native_image_probe=False)
+        self._assert_falls_back(self._write('disk', '\0' * 512))
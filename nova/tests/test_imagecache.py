@@ -23,6 +23,8 @@ import json
 import os
 import time
 
+from eventlet import event
+from eventlet import greenthread
 from oslo.config import cfg
 
 from nova.compute import vm_states
@@ -502,6 +504,149 @@ class ImageCacheManagerTestCase(test.TestCase):
             # side effect of creating the checksum
             self.assertTrue(os.path.exists(info_fname))
 
+    def _write_stored_checksum(self, info_fname, testdata):
+        with open(info_fname, 'w') as f:
+            f.write('{"sha1": "%s"}\n' % hashlib.sha1(testdata).hexdigest())
+
+    def test_verify_checksum_resumes(self):
+        img = {'container_format': 'ami', 'id': '42'}
+
+        self.flags(checksum_base_images=True)
+        self.flags(checksum_interval_seconds=0)
+        self.stubs.Set(imagecache, 'CHECKSUM_CHUNK_SIZE', 8)
+
+        with utils.tempdir() as tmpdir:
+            self.flags(instances_path=tmpdir)
+            self.flags(image_info_filename_pattern=('$instances_path/'
+                                                    '%(image)s.info'))
+            fname, info_fname, testdata = self._make_checksum(tmpdir)
+            self._write_stored_checksum(info_fname, testdata)
+
+            # The pass runs out of time after the first chunk
+            image_cache_manager = imagecache.ImageCacheManager()
+            image_cache_manager._checksum_deadline = time.time() - 1
+            res = image_cache_manager._verify_checksum(img, fname)
+            self.assertTrue(res is None)
+            identity, offset, checksum = \
+                image_cache_manager.checksum_progress[fname]
+            self.assertEquals(8, offset)
+
+            # The next pass picks up where the last one stopped
+            image_cache_manager._checksum_deadline = None
+            res = image_cache_manager._verify_checksum(img, fname)
+            self.assertTrue(res)
+            self.assertEquals({}, image_cache_manager.checksum_progress)
+
+    def test_verify_checksum_restarts_for_changed_file(self):
+        img = {'container_format': 'ami', 'id': '42'}
+
+        self.flags(checksum_base_images=True)
+
+        with utils.tempdir() as tmpdir:
+            self.flags(instances_path=tmpdir)
+            self.flags(image_info_filename_pattern=('$instances_path/'
+                                                    '%(image)s.info'))
+            fname, info_fname, testdata = self._make_checksum(tmpdir)
+            self._write_stored_checksum(info_fname, testdata)
+
+            # Progress recorded against an older version of the file
+            stale = hashlib.sha1('garbage')
+            image_cache_manager = imagecache.ImageCacheManager()
+            image_cache_manager.checksum_progress[fname] = ((1, 1), 7, stale)
+            res = image_cache_manager._verify_checksum(img, fname)
+            self.assertTrue(res)
+
+    def test_checksum_bandwidth_limit(self):
+        self.flags(checksum_bandwidth_limit_mb=1)
+        sleeps = []
+        self.stubs.Set(time, 'time', lambda: 100.0)
+        self.stubs.Set(time, 'sleep', sleeps.append)
+
+        image_cache_manager = imagecache.ImageCacheManager()
+        image_cache_manager._throttle(512 * 1024)
+        image_cache_manager._throttle(512 * 1024)
+        image_cache_manager._throttle(1024 * 1024)
+
+        # Each read waits for the bytes booked before it
+        self.assertEquals([0.0, 0.5, 1.0], sleeps)
+
+    def test_verify_checksums_concurrently(self):
+        self.flags(checksum_base_images=True)
+        self.stubs.Set(virtutils, 'chown', lambda x, y: None)
+
+        with self._make_base_file() as fname:
+            image_cache_manager = imagecache.ImageCacheManager()
+            image_cache_manager.used_images = {'123': (1, 0, ['banana-42'])}
+
+            verified = []
+
+            def fake_verify_checksum(img_id, base_file):
+                verified.append((img_id, base_file))
+                return False
+
+            self.stubs.Set(image_cache_manager, '_verify_checksum',
+                           fake_verify_checksum)
+            image_cache_manager._start_checksum_pass(
+                [('123', fname), ('123', fname + '_dne')])
+            image_cache_manager._checksum_pass.wait()
+            self.assertEquals([('123', fname)], verified)
+            self.assertEquals({fname: False},
+                              image_cache_manager.checksum_results)
+
+            # The precomputed result is used rather than hashing again
+            image_cache_manager._handle_base_image('123', fname)
+            self.assertEquals([('123', fname)], verified)
+            self.assertEquals([fname], image_cache_manager.corrupt_base_files)
+
+    def test_checksum_pass_runs_in_background(self):
+        self.flags(checksum_base_images=True)
+        self.stubs.Set(virtutils, 'chown', lambda x, y: None)
+
+        with self._make_base_file() as fname:
+            image_cache_manager = imagecache.ImageCacheManager()
+            image_cache_manager.used_images = {'123': (1, 0, ['banana-42'])}
+            self.flags(remove_unused_resized_minimum_age_seconds=0)
+
+            hashed = event.Event()
+            verified = []
+
+            def fake_verify_checksum(img_id, base_file):
+                verified.append((img_id, base_file))
+                hashed.wait()
+                return False
+
+            self.stubs.Set(image_cache_manager, '_verify_checksum',
+                           fake_verify_checksum)
+            image_cache_manager._start_checksum_pass([('123', fname)])
+            checksum_pass = image_cache_manager._checksum_pass
+            while not verified:
+                greenthread.sleep(0)
+
+            # The cache pass goes on without the result, and leaves the
+            # file being hashed alone
+            image_cache_manager._handle_base_image('123', fname)
+            self.assertEquals([], image_cache_manager.corrupt_base_files)
+            image_cache_manager._remove_base_file(fname)
+            self.assertTrue(os.path.exists(fname))
+
+            # No second pass starts while the first one is running
+            image_cache_manager._start_checksum_pass([('123', fname)])
+            self.assertEquals(checksum_pass,
+                              image_cache_manager._checksum_pass)
+
+            hashed.send()
+            checksum_pass.wait()
+            self.assertEquals(None, image_cache_manager._checksum_pass)
+            self.assertEquals({fname: False},
+                              image_cache_manager.checksum_results)
+
+            # The next cache pass picks the result up
+            image_cache_manager._reset_state()
+            image_cache_manager.used_images = {'123': (1, 0, ['banana-42'])}
+            image_cache_manager._handle_base_image('123', fname)
+            self.assertEquals([fname], image_cache_manager.corrupt_base_files)
+            self.assertEquals([('123', fname)], verified)
+
     @contextlib.contextmanager
     def _make_base_file(self, checksum=True):
         """Make a base file for testing."""
@@ -694,6 +839,8 @@ class ImageCacheManagerTestCase(test.TestCase):
             image_cache_manager = imagecache.ImageCacheManager()
             image_cache_manager.unexplained_images = [fname]
             image_cache_manager.used_images = {'123': (1, 0, ['banana-42'])}
+            image_cache_manager._start_checksum_pass([(img, fname)])
+            image_cache_manager._checksum_pass.wait()
             image_cache_manager._handle_base_image(img, fname)
 
             self.assertEquals(image_cache_manager.unexplained_images, [])
@@ -1053,6 +1053,55 @@ class LibvirtConnTestCase(test.TestCase):
         # None should be listed, since we fake deleted the last one
         self.assertEquals(len(instances), 0)
 
+    def _fake_domain(self, domain_id, name, state):
+        domain = self.mox.CreateMockAnything()
+        domain.ID = lambda: domain_id
+        domain.name = lambda: name
+        domain.info = lambda: [state, 2048, 2048, 1, 0]
+        return domain
+
+    def test_get_power_states(self):
+        domains = [self._fake_domain(0, 'Domain-0',
+                                     libvirt_driver.VIR_DOMAIN_RUNNING),
+                   self._fake_domain(1, 'instance-1',
+                                     libvirt_driver.VIR_DOMAIN_PAUSED),
+                   self._fake_domain(-1, 'instance-2',
+                                     libvirt_driver.VIR_DOMAIN_SHUTOFF)]
+        self.mox.StubOutWithMock(libvirt_driver.LibvirtDriver, '_conn')
+        libvirt_driver.LibvirtDriver._conn.listAllDomains = lambda flags: \
+            domains
+
+        self.mox.ReplayAll()
+        conn = libvirt_driver.LibvirtDriver(fake.FakeVirtAPI(), False)
+        self.assertEqual({'instance-1': power_state.PAUSED,
+                          'instance-2': power_state.SHUTDOWN},
+                         conn.get_power_states())
+
+    def test_get_power_states_without_list_all_domains(self):
+        domains = {0: self._fake_domain(0, 'Domain-0',
+                                        libvirt_driver.VIR_DOMAIN_RUNNING),
+                   1: self._fake_domain(1, 'instance-1',
+                                        libvirt_driver.VIR_DOMAIN_RUNNING)}
+
+        def fake_lookup(domain_id):
+            try:
+                return domains[domain_id]
+            except KeyError:
+                raise libvirt.libvirtError("we deleted an instance!")
+
+        class FakeConnection(object):
+            lookupByID = staticmethod(fake_lookup)
+            numOfDomains = staticmethod(lambda: 3)
+            listDomainsID = staticmethod(lambda: [0, 1, 2])
+            listDefinedDomains = staticmethod(lambda: ['instance-3'])
+
+        self.stubs.Set(libvirt_driver.LibvirtDriver, '_conn',
+                       FakeConnection())
+        conn = libvirt_driver.LibvirtDriver(fake.FakeVirtAPI(), False)
+        self.assertEqual({'instance-1': power_state.RUNNING,
+                          'instance-3': power_state.SHUTDOWN},
+                         conn.get_power_states())
+
     def test_get_all_block_devices(self):
         xml = [
             # NOTE(vish): id 0 is skipped
@@ -901,6 +901,35 @@ class TestNovaMigrations(BaseMigrationTestCase, CommonTestsMixIn):
                     fetchall()
         self.assertEqual(len(rows), 1)
 
+    # migration 159 - add instance_usage_rollups
+    def _pre_upgrade_159(self, engine):
+        self.assertRaises(sqlalchemy.exc.NoSuchTableError, get_table,
+                          engine, 'instance_usage_rollups')
+        return [
+            {'period_beginning': datetime.datetime(2013, 3, 1),
+             'project_id': None, 'instance_type_id': None, 'hours': 0.0,
+             'deleted': 0},
+            {'period_beginning': datetime.datetime(2013, 3, 1),
+             'project_id': 'fake', 'instance_type_id': 1, 'hours': 6.5,
+             'deleted': 0},
+        ]
+
+    def _check_159(self, engine, data):
+        rollups = get_table(engine, 'instance_usage_rollups')
+        engine.execute(rollups.insert(), data)
+        rows = rollups.select().\
+                    order_by(rollups.c.id).\
+                    execute().\
+                    fetchall()
+        self.assertEqual([None, 'fake'], [row.project_id for row in rows])
+        self.assertEqual(6.5, rows[1].hours)
+
+        # A period is marked as rolled up without a project or flavor, and
+        # those rows are not unique
+        engine.execute(rollups.insert(), data[0])
+        self.assertRaises(sqlalchemy.exc.IntegrityError,
+                          engine.execute, rollups.insert(), data[1])
+
 
 class TestBaremetalMigrations(BaseMigrationTestCase, CommonTestsMixIn):
     """Test sqlalchemy-migrate migrations."""
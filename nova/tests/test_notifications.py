@@ -280,6 +280,19 @@ class NotificationsTestCase(test.TestCase):
         self.assertTrue("fixed_ips" in info)
         self.assertEquals(info["fixed_ips"][0]["label"], "test1")
 
+    def test_bandwidth_usage_prefetched(self):
+        def fake_bw_usage_get_by_uuids(*args):
+            self.fail('bandwidth usage was looked up again')
+        self.stubs.Set(db, 'bw_usage_get_by_uuids',
+                       fake_bw_usage_get_by_uuids)
+        mac = self.net_info[0]['address']
+        usages = [dict(mac=mac, bw_in=10, bw_out=20),
+                  dict(mac='unknown', bw_in=30, bw_out=40)]
+
+        bw = notifications.bandwidth_usage(self.instance, 'start',
+                                           bw_usages=usages)
+        self.assertEquals({'test1': dict(bw_in=10, bw_out=20)}, bw)
+
     def test_send_access_ip_update(self):
         notifications.send_update(self.context, self.instance, self.instance)
         self.assertEquals(1, len(test_notifier.NOTIFICATIONS))
@@ -21,6 +21,8 @@ Unittets for S3 objectstore clone.
 """
 
 import boto
+import hashlib
+import httplib
 import os
 import shutil
 import tempfile
@@ -58,9 +60,9 @@ class S3APITestCase(test.TestCase):
         shutil.rmtree(CONF.buckets_path)
         os.mkdir(CONF.buckets_path)
 
-        router = s3server.S3Application(CONF.buckets_path)
+        self.router = s3server.S3Application(CONF.buckets_path)
         self.server = wsgi.Server("S3 Objectstore",
-                                  router,
+                                  self.router,
                                   host=CONF.s3_host,
                                   port=0)
         self.server.start()
@@ -128,6 +130,147 @@ class S3APITestCase(test.TestCase):
 
         self._ensure_no_buckets(bucket.get_all_keys())
 
+    def _request(self, method, path, body=None, headers=None):
+        conn = httplib.HTTPConnection(CONF.s3_host, self.server.port)
+        conn.request(method, path, body, headers or {})
+        response = conn.getresponse()
+        return response, response.read()
+
+    def _put_object(self, contents):
+        self.conn.create_bucket('testbucket')
+        response, body = self._request('PUT', '/testbucket/somekey',
+                                       contents)
+        self.assertEqual(200, response.status)
+        return response
+
+    def test_put_and_get_large_object(self):
+        contents = os.urandom(3 * s3server.CHUNK_SIZE + 10)
+        response = self._put_object(contents)
+        self.assertEqual('"%s"' % hashlib.md5(contents).hexdigest(),
+                         response.getheader('etag'))
+
+        response, body = self._request('GET', '/testbucket/somekey')
+        self.assertEqual(200, response.status)
+        self.assertEqual(contents, body)
+        self.assertEqual(str(len(contents)),
+                         response.getheader('content-length'))
+
+    def test_get_object_etag_matches_put(self):
+        response = self._put_object('somekey')
+        etag = response.getheader('etag')
+        response, body = self._request('GET', '/testbucket/somekey')
+        self.assertEqual(etag, response.getheader('etag'))
+
+        # An object changed behind the index's back has no known MD5
+        path = os.path.join(CONF.buckets_path, 'testbucket', 'somekey')
+        with open(path, 'w') as object_file:
+            object_file.write('changed')
+        os.utime(path, (0, 0))
+        response, body = self._request('GET', '/testbucket/somekey')
+        self.assertEqual('changed', body)
+        self.assertEqual(None, response.getheader('etag'))
+
+    def test_get_object_range(self):
+        self._put_object('0123456789')
+        response, body = self._request('GET', '/testbucket/somekey',
+                                       headers={'Range': 'bytes=2-4'})
+        self.assertEqual(206, response.status)
+        self.assertEqual('234', body)
+        self.assertEqual('bytes 2-4/10', response.getheader('content-range'))
+
+        response, body = self._request('GET', '/testbucket/somekey',
+                                       headers={'Range': 'bytes=-3'})
+        self.assertEqual(206, response.status)
+        self.assertEqual('789', body)
+
+    def test_get_object_if_none_match(self):
+        self._put_object('somekey')
+        response, body = self._request('GET', '/testbucket/somekey')
+        etag = response.getheader('etag')
+
+        response, body = self._request('GET', '/testbucket/somekey',
+                                       headers={'If-None-Match': etag})
+        self.assertEqual(304, response.status)
+        self.assertEqual('', body)
+
+        response, body = self._request('GET', '/testbucket/somekey',
+                                       headers={'If-None-Match': '"other"'})
+        self.assertEqual(200, response.status)
+        self.assertEqual('somekey', body)
+
+    def test_head_object(self):
+        self._put_object('somekey')
+        response, body = self._request('HEAD', '/testbucket/somekey')
+        self.assertEqual(200, response.status)
+        self.assertEqual('7', response.getheader('content-length'))
+        self.assertEqual('', body)
+
+    def _key_names(self, bucket, **kwargs):
+        return [key.name for key in bucket.get_all_keys(**kwargs)]
+
+    def test_list_keys(self):
+        bucket = self.conn.create_bucket('testbucket')
+        for key_name in ('b-2', 'a', 'b-1', 'c', 'b-3'):
+            bucket.new_key(key_name).set_contents_from_string(key_name)
+
+        self.assertEqual(['a', 'b-1', 'b-2', 'b-3', 'c'],
+                         self._key_names(bucket))
+        self.assertEqual(['b-1', 'b-2', 'b-3'],
+                         self._key_names(bucket, prefix='b-'))
+        self.assertEqual(['b-3'],
+                         self._key_names(bucket, prefix='b-', marker='b-2'))
+        self.assertEqual(['b-2', 'b-3', 'c'],
+                         self._key_names(bucket, marker='b-1'))
+
+        keys = bucket.get_all_keys(max_keys=2)
+        self.assertEqual(['a', 'b-1'], [key.name for key in keys])
+        self.assertEqual(1, keys[0].size)
+
+        key = bucket.get_key('b-1')
+        key.delete()
+        self.assertEqual(['a', 'b-2', 'b-3', 'c'], self._key_names(bucket))
+
+    def test_list_keys_indexes_existing_objects(self):
+        bucket = self.conn.create_bucket('testbucket')
+        with open(os.path.join(CONF.buckets_path, 'testbucket', 'old'),
+                  'w') as f:
+            f.write('old')
+        bucket.new_key('new').set_contents_from_string('new')
+
+        self.assertEqual(['new', 'old'], self._key_names(bucket))
+        self._ensure_one_bucket(self.conn.get_all_buckets(), 'testbucket')
+
+    def _change_bucket_behind_index(self, bucket):
+        bucket.new_key('kept').set_contents_from_string('kept')
+        bucket.new_key('gone').set_contents_from_string('gone')
+        self.assertEqual(['gone', 'kept'], self._key_names(bucket))
+        bucket_path = os.path.join(CONF.buckets_path, 'testbucket')
+        os.unlink(os.path.join(bucket_path, 'gone'))
+        with open(os.path.join(bucket_path, 'added'), 'w') as f:
+            f.write('added')
+
+    def test_list_keys_rebuilds_index_after_restart(self):
+        self.flags(s3_index_rebuild_interval=0)
+        bucket = self.conn.create_bucket('testbucket')
+        self._change_bucket_behind_index(bucket)
+        self.assertEqual(['gone', 'kept'], self._key_names(bucket))
+
+        # A new process does not trust the index it finds
+        self.router.indexes_built_at.clear()
+        self.assertEqual(['added', 'kept'], self._key_names(bucket))
+        self.assertEqual('"%s"' % hashlib.md5('kept').hexdigest(),
+                         bucket.get_key('kept').etag)
+
+    def test_list_keys_rebuilds_stale_index(self):
+        self.flags(s3_index_rebuild_interval=60)
+        bucket = self.conn.create_bucket('testbucket')
+        self._change_bucket_behind_index(bucket)
+        self.assertEqual(['gone', 'kept'], self._key_names(bucket))
+
+        # A minute goes by
+        self.router.indexes_built_at['testbucket'] -= 60
+        self.assertEqual(['added', 'kept'], self._key_names(bucket))
+
     def test_unknown_bucket(self):
         bucket_name = 'falalala'
         self.assertRaises(boto_exception.S3ResponseError,
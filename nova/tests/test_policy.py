@@ -21,6 +21,8 @@ import os.path
 import StringIO
 import urllib2
 
+import fixtures
+
 from nova import context
 from nova import exception
 from nova.openstack.common import policy as common_policy
@@ -58,6 +60,30 @@ class PolicyFileTestCase(test.TestCase):
             self.assertRaises(exception.PolicyNotAuthorized, policy.enforce,
                               self.context, action, self.target)
 
+    def test_policy_file_check_rate_limited(self):
+        self.flags(policy_file_check_interval=10)
+        self.useFixture(fixtures.MonkeyPatch('time.time', lambda: self.now))
+        self.now = 100.0
+        with utils.tempdir() as tmpdir:
+            tmpfilename = os.path.join(tmpdir, 'policy')
+            self.flags(policy_file=tmpfilename)
+            policy.reset()
+
+            action = "example:test"
+            with open(tmpfilename, "w") as policyfile:
+                policyfile.write('{"example:test": ""}')
+            policy.enforce(self.context, action, self.target)
+
+            with open(tmpfilename, "w") as policyfile:
+                policyfile.write('{"example:test": "!"}')
+            os.utime(tmpfilename, (0, 0))
+            self.now += 5
+            policy.enforce(self.context, action, self.target)
+
+            self.now += 5
+            self.assertRaises(exception.PolicyNotAuthorized, policy.enforce,
+                              self.context, action, self.target)
+
 
 class PolicyTestCase(test.TestCase):
     def setUp(self):
@@ -147,6 +173,79 @@ class PolicyTestCase(test.TestCase):
         policy.enforce(admin_context, uppercase_action, self.target)
 
 
+class PolicyDecisionCacheTestCase(test.TestCase):
+    def setUp(self):
+        super(PolicyDecisionCacheTestCase, self).setUp()
+        rules = {
+            "example:allowed": '@',
+            "example:get_http": "http://www.example.com",
+            "example:my_file": "role:compute_admin or "
+                               "project_id:%(project_id)s",
+            "example:rule": "rule:example:my_file",
+        }
+        self.policy.set_rules(rules)
+        self.context = context.RequestContext('fake', 'fake', roles=['member'])
+        self.start = policy.cache_stats()
+
+    def _stats(self):
+        stats = policy.cache_stats()
+        return tuple(stats[k] - self.start[k]
+                     for k in ('hits', 'misses', 'uncacheable'))
+
+    def test_decision_cached(self):
+        policy.enforce(self.context, "example:allowed", {})
+        policy.enforce(self.context, "example:allowed", {})
+        self.assertEqual((1, 1, 0), self._stats())
+
+    def test_key_includes_referenced_target(self):
+        action = "example:my_file"
+        policy.enforce(self.context, action, {'project_id': 'fake'})
+        policy.enforce(self.context, action, {'project_id': 'fake',
+                                              'host': 'ignored'})
+        self.assertRaises(exception.PolicyNotAuthorized, policy.enforce,
+                          self.context, action, {'project_id': 'another'})
+        self.assertEqual((1, 2, 0), self._stats())
+
+    def test_key_includes_roles_through_rule(self):
+        action = "example:rule"
+        target = {'project_id': 'another'}
+        self.assertRaises(exception.PolicyNotAuthorized, policy.enforce,
+                          self.context, action, target)
+        self.context.roles = ['member', 'compute_admin']
+        policy.enforce(self.context, action, target)
+        self.assertEqual((0, 2, 0), self._stats())
+
+    def test_http_check_not_cached(self):
+        calls = []
+
+        def fakeurlopen(url, post_data):
+            calls.append(url)
+            return StringIO.StringIO("True")
+        self.stubs.Set(urllib2, 'urlopen', fakeurlopen)
+        policy.enforce(self.context, "example:get_http", {})
+        policy.enforce(self.context, "example:get_http", {})
+        self.assertEqual(2, len(calls))
+        self.assertEqual((0, 0, 2), self._stats())
+
+    def test_mutable_target_not_cached(self):
+        target = {'project_id': object()}
+        self.assertRaises(exception.PolicyNotAuthorized, policy.enforce,
+                          self.context, "example:my_file", target)
+        self.assertEqual((0, 0, 1), self._stats())
+
+    def test_new_rules_invalidate(self):
+        policy.enforce(self.context, "example:allowed", {})
+        self.policy.set_rules({"example:allowed": "!"})
+        self.assertRaises(exception.PolicyNotAuthorized, policy.enforce,
+                          self.context, "example:allowed", {})
+
+    def test_cache_disabled(self):
+        self.flags(policy_cache_size=0)
+        policy.enforce(self.context, "example:allowed", {})
+        policy.enforce(self.context, "example:allowed", {})
+        self.assertEqual((0, 0, 2), self._stats())
+
+
 class DefaultPolicyTestCase(test.TestCase):
 
     def setUp(self):
@@ -0,0 +1,163 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Tests for the queue notification driver."""
+
+import eventlet
+
+from nova import context
+from nova import exception
+from nova.notifier import queue_notifier
+from nova.openstack.common.notifier import api as notifier_api
+from nova.openstack.common.notifier import test_notifier
+from nova.openstack.common import timeutils
+from nova import test
+
+
+class QueuedNotifierTestCase(test.TestCase):
+
+    def setUp(self):
+        super(QueuedNotifierTestCase, self).setUp()
+        notifier_api._reset_drivers()
+        queue_notifier._reset()
+        self.addCleanup(notifier_api._reset_drivers)
+        self.addCleanup(queue_notifier._reset)
+        self.flags(notification_driver=[queue_notifier.__name__],
+                   queued_notification_driver=[test_notifier.__name__],
+                   notification_queue_size=3,
+                   notification_batch_size=2)
+        test_notifier.NOTIFICATIONS = []
+        self.context = context.get_admin_context()
+
+    def _notify(self, *numbers):
+        for number in numbers:
+            notifier_api.notify(self.context, 'compute.host', 'event',
+                                notifier_api.INFO, {'number': number})
+
+    def _sent(self):
+        return [msg['payload']['number']
+                for msg in test_notifier.NOTIFICATIONS]
+
+    def test_notifications_sent_from_background(self):
+        self._notify(1, 2)
+        self.assertEqual([], self._sent())
+        self.assertEqual(2, queue_notifier.queue_stats()['depth'])
+
+        eventlet.sleep(0)
+        self.assertEqual([1, 2], self._sent())
+        stats = queue_notifier.queue_stats()
+        self.assertEqual(2, stats['queued'])
+        self.assertEqual(2, stats['sent'])
+        self.assertEqual(1, stats['batches'])
+        self.assertEqual(0, stats['depth'])
+
+    def test_notifications_sent_in_batches(self):
+        self._notify(1, 2, 3)
+        eventlet.sleep(0)
+        self.assertEqual([1, 2], self._sent())
+        eventlet.sleep(0)
+        self.assertEqual([1, 2, 3], self._sent())
+        self.assertEqual(2, queue_notifier.queue_stats()['batches'])
+
+    def test_overflow_drops_oldest(self):
+        self._notify(1, 2, 3, 4, 5)
+        queue_notifier.flush()
+        self.assertEqual([3, 4, 5], self._sent())
+        stats = queue_notifier.queue_stats()
+        self.assertEqual(2, stats['dropped'])
+        self.assertEqual(3, stats['max_depth'])
+
+    def test_overflow_drops_newest(self):
+        self.flags(notification_queue_overflow='drop_newest')
+        self._notify(1, 2, 3, 4, 5)
+        queue_notifier.flush()
+        self.assertEqual([1, 2, 3], self._sent())
+        self.assertEqual(2, queue_notifier.queue_stats()['dropped'])
+
+    def test_overflow_blocks(self):
+        self.flags(notification_queue_overflow='block')
+        self._notify(1, 2, 3, 4, 5)
+        queue_notifier.flush()
+        self.assertEqual([1, 2, 3, 4, 5], self._sent())
+        self.assertEqual(0, queue_notifier.queue_stats()['dropped'])
+
+    def test_unknown_overflow_policy(self):
+        self.flags(notification_queue_overflow='drop_everything')
+        self.assertRaises(exception.NovaException, queue_notifier.notify,
+                          self.context, {'payload': {'number': 1}})
+        self.assertEqual(0, queue_notifier.queue_stats()['queued'])
+
+    def test_flush(self):
+        self._notify(1, 2, 3)
+        queue_notifier.flush()
+        self.assertEqual([1, 2, 3], self._sent())
+        self.assertEqual(0, queue_notifier.queue_stats()['depth'])
+
+    def test_flush_waits_for_batch_being_sent(self):
+        def slow_notify(_context, message):
+            # Yield in the middle of the batch, as a broker round trip does
+            eventlet.sleep(0)
+            test_notifier.NOTIFICATIONS.append(message)
+
+        self.stubs.Set(test_notifier, 'notify', slow_notify)
+        self._notify(1, 2, 3)
+        # The background greenthread takes 1 and 2 and yields sending 1
+        eventlet.sleep(0)
+        self.assertEqual(1, queue_notifier.queue_stats()['depth'])
+        queue_notifier.flush()
+        self.assertEqual([1, 2, 3], sorted(self._sent()))
+
+    def test_stats_logged_after_interval(self):
+        self.flags(notification_queue_stats_interval=60)
+        logged = []
+        self.stubs.Set(queue_notifier.LOG, 'info',
+                       lambda msg, stats: logged.append(stats))
+        timeutils.set_time_override()
+        self.addCleanup(timeutils.clear_time_override)
+
+        self._notify(1)
+        eventlet.sleep(0)
+        self.assertEqual([], logged)
+
+        timeutils.advance_time_seconds(61)
+        self._notify(2, 3)
+        eventlet.sleep(0)
+        self.assertEqual(1, len(logged))
+        self.assertEqual(3, logged[0]['sent'])
+        self.assertEqual(0, logged[0]['depth'])
+
+        self._notify(4)
+        eventlet.sleep(0)
+        self.assertEqual(1, len(logged))
+
+    def test_stats_not_logged_when_disabled(self):
+        self.flags(notification_queue_stats_interval=0)
+        self.stubs.Set(queue_notifier.LOG, 'info',
+                       lambda msg, stats: self.fail('stats logged'))
+        timeutils.set_time_override()
+        self.addCleanup(timeutils.clear_time_override)
+
+        self._notify(1)
+        timeutils.advance_time_seconds(3600)
+        queue_notifier.flush()
+        self._notify(2)
+        eventlet.sleep(0)
+        self.assertEqual([1, 2], self._sent())
+
+    def test_unlimited_queue(self):
+        self.flags(notification_queue_size=0)
+        self._notify(1, 2, 3, 4, 5)
+        queue_notifier.flush()
+        self.assertEqual([1, 2, 3, 4, 5], self._sent())
+        self.assertEqual(0, queue_notifier.queue_stats()['dropped'])
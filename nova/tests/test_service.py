@@ -29,8 +29,10 @@ from nova import context
 from nova import db
 from nova import exception
 from nova import manager
+from nova import policy
 from nova import service
 from nova import test
+from nova import utils
 from nova import wsgi
 
 test_service_opts = [
@@ -193,6 +195,92 @@ class TestWSGIService(test.TestCase):
         test_service.stop()
 
 
+class DBThreadPoolStatsTestCase(test.TestCase):
+    """Test cases for the DB thread pool statistics reports."""
+
+    def test_log_db_tpool_stats(self):
+        stats = {'pool_size': 4, 'in_flight': 6, 'max_in_flight': 7,
+                 'queue_depth': 2, 'calls': 10, 'average_wait': 0.5,
+                 'max_wait': 1.5}
+        self.mox.StubOutWithMock(db, 'tpool_stats')
+        self.mox.StubOutWithMock(service.LOG, 'info')
+        db.tpool_stats().AndReturn(stats)
+        service.LOG.info(mox.IgnoreArg(), stats)
+        db.tpool_stats().AndReturn(None)
+        self.mox.ReplayAll()
+        service._log_db_tpool_stats()
+        service._log_db_tpool_stats()
+
+    def test_no_stats_without_tpool(self):
+        self.flags(dbapi_tpool_size=0, dbapi_tpool_stats_interval=60)
+        self.assertEqual(None, service._start_db_tpool_stats())
+
+    def test_no_stats_when_disabled(self):
+        self.flags(dbapi_tpool_size=4, dbapi_tpool_stats_interval=0)
+        self.assertEqual(None, service._start_db_tpool_stats())
+
+    def test_start_db_tpool_stats(self):
+        self.flags(dbapi_tpool_size=4, dbapi_tpool_stats_interval=30)
+        timer = self.mox.CreateMockAnything()
+        self.mox.StubOutWithMock(utils, 'FixedIntervalLoopingCall')
+        utils.FixedIntervalLoopingCall(
+            service._log_db_tpool_stats).AndReturn(timer)
+        timer.start(interval=30, initial_delay=30)
+        self.mox.ReplayAll()
+        self.assertEqual(timer, service._start_db_tpool_stats())
+
+    def test_wsgi_service_stops_stats_timers(self):
+        self.stubs.Set(wsgi.Loader, "load_app", mox.MockAnything())
+        db_timer = self.mox.CreateMockAnything()
+        policy_timer = self.mox.CreateMockAnything()
+        self.mox.StubOutWithMock(service, '_start_db_tpool_stats')
+        self.mox.StubOutWithMock(service, '_start_policy_cache_stats')
+        service._start_db_tpool_stats().AndReturn(db_timer)
+        service._start_policy_cache_stats().AndReturn(policy_timer)
+        db_timer.stop()
+        policy_timer.stop()
+        self.mox.ReplayAll()
+        test_service = service.WSGIService("test_service")
+        test_service.start()
+        test_service.stop()
+        self.assertEqual([], test_service.timers)
+
+
+class PolicyCacheStatsTestCase(test.TestCase):
+    """Test cases for the policy decision cache reports."""
+
+    def test_log_policy_cache_stats(self):
+        stats = {'hits': 3, 'misses': 1, 'uncacheable': 0, 'size': 1}
+        self.mox.StubOutWithMock(policy, 'cache_stats')
+        self.mox.StubOutWithMock(service.LOG, 'info')
+        policy.cache_stats().AndReturn(stats)
+        service.LOG.info(mox.IgnoreArg(), stats)
+        self.mox.ReplayAll()
+        service._log_policy_cache_stats()
+
+    def test_no_log_without_policy_checks(self):
+        stats = {'hits': 0, 'misses': 0, 'uncacheable': 0, 'size': 0}
+        self.mox.StubOutWithMock(policy, 'cache_stats')
+        self.mox.StubOutWithMock(service.LOG, 'info')
+        policy.cache_stats().AndReturn(stats)
+        self.mox.ReplayAll()
+        service._log_policy_cache_stats()
+
+    def test_no_stats_when_disabled(self):
+        self.flags(policy_cache_stats_interval=0)
+        self.assertEqual(None, service._start_policy_cache_stats())
+
+    def test_start_policy_cache_stats(self):
+        self.flags(policy_cache_stats_interval=30)
+        timer = self.mox.CreateMockAnything()
+        self.mox.StubOutWithMock(utils, 'FixedIntervalLoopingCall')
+        utils.FixedIntervalLoopingCall(
+            service._log_policy_cache_stats).AndReturn(timer)
+        timer.start(interval=30, initial_delay=30)
+        self.mox.ReplayAll()
+        self.assertEqual(timer, service._start_policy_cache_stats())
+
+
 class TestLauncher(test.TestCase):
 
     def setUp(self):
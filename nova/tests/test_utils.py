@@ -30,6 +30,7 @@ from oslo.config import cfg
 
 import nova
 from nova import exception
+from nova.openstack.common import jsonutils
 from nova.openstack.common import timeutils
 from nova import test
 from nova import utils
@@ -912,6 +913,81 @@ class MetadataToDictTestCase(test.TestCase):
         self.assertEqual(utils.metadata_to_dict([]), {})
 
 
+class OldStyle:
+    pass
+
+
+class WithGetattr(object):
+    def __getattr__(self, name):
+        raise AttributeError(name)
+
+
+class DictLike(object):
+    def __init__(self, **kwargs):
+        self.values = kwargs
+
+    def iteritems(self):
+        return self.values.iteritems()
+
+
+class ToPrimitiveTestCase(test.TestCase):
+    def setUp(self):
+        super(ToPrimitiveTestCase, self).setUp()
+        self.stubs.Set(utils, '_primitive_converters',
+                       dict(utils._primitive_converters))
+        self.delegated = []
+        real_to_primitive = jsonutils.to_primitive
+
+        def fake_to_primitive(value, *args, **kwargs):
+            self.delegated.append(value)
+            return real_to_primitive(value, *args, **kwargs)
+
+        self.stubs.Set(jsonutils, 'to_primitive', fake_to_primitive)
+
+    def test_simple_values(self):
+        for value in ('str', u'unicode', 1, 2L, 1.5, True, None):
+            self.assertTrue(utils.to_primitive(value) is value)
+        self.assertEqual([], self.delegated)
+
+    def test_containers_and_models(self):
+        now = datetime.datetime(2013, 3, 1, 12, 0, 0)
+        value = {'a': [1, 'b', None], 'c': (2.0, now),
+                 'd': DictLike(e=now, f=[u'g'])}
+        self.assertEqual({'a': [1, 'b', None],
+                          'c': [2.0, timeutils.strtime(now)],
+                          'd': {'e': timeutils.strtime(now), 'f': [u'g']}},
+                         utils.to_primitive(value))
+        self.assertEqual(now, utils.to_primitive(now,
+                                                 convert_datetime=False))
+        self.assertEqual([], self.delegated)
+
+    def test_converter_cached_per_type(self):
+        utils.to_primitive(DictLike())
+        self.assertEqual(utils._iteritems_to_primitive,
+                         utils._primitive_converters[DictLike])
+        utils.to_primitive(len)
+        self.assertEqual(jsonutils.to_primitive,
+                         utils._primitive_converters[type(len)])
+
+    def test_untrusted_types_delegated(self):
+        old_style = OldStyle()
+        with_getattr = WithGetattr()
+        utils.to_primitive([old_style, with_getattr, len])
+        self.assertEqual([old_style, with_getattr, len], self.delegated)
+
+    def test_same_as_jsonutils(self):
+        now = datetime.datetime(2013, 3, 1, 12, 0, 0)
+        nested = DictLike(a=DictLike(b=DictLike(c=DictLike(d='deep'))))
+        old_style = OldStyle()
+
+        def payload():
+            return [nested, len, datetime, old_style, {'t': (now, 1)},
+                    iter([1, 2]), set([3])]
+
+        self.assertEqual(jsonutils.to_primitive(payload()),
+                         utils.to_primitive(payload()))
+
+
 class WrappedCodeTestCase(test.TestCase):
     """Test the get_wrapped_function utility method."""
 
@@ -397,6 +397,14 @@ class XenAPIVMTestCase(stubs.XenAPITestBase):
         expected = self.conn.get_diagnostics(instance)
         self.assertThat(fake_diagnostics, matchers.DictMatches(expected))
 
+    def test_get_info_in_one_call(self):
+        instance = self._create_instance()
+        xenapi_fake.reset_call_counts()
+        info = self.conn.get_info(instance)
+        self.assertEqual(power_state.RUNNING, info['state'])
+        self.assertEqual({'VM.get_all_records_where': 1},
+                         xenapi_fake.get_call_counts())
+
     def test_instance_snapshot_fails_with_no_primary_vdi(self):
 
         def create_bad_vbd(session, vm_ref, vdi_ref, userdevice,
@@ -1773,8 +1781,8 @@ class XenAPIBWCountersTestCase(stubs.XenAPITestBase):
         stubs.stubout_session(self.stubs, stubs.FakeSessionForVMTests)
         self.conn = xenapi_conn.XenAPIDriver(fake.FakeVirtAPI(), False)
 
-        def _fake_get_vif_device_map(vm_rec):
-            return vm_rec['_vifmap']
+        def _fake_get_vif_device_map(vm_ref):
+            return self.FAKE_VMS[vm_ref]['_vifmap']
 
         self.stubs.Set(self.conn._vmops, "_get_vif_device_map",
                                          _fake_get_vif_device_map)
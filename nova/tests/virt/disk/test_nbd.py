@@ -24,74 +24,79 @@ import fixtures
 from nova import test
 from nova.virt.disk.mount import nbd
 
-ORIG_EXISTS = os.path.exists
-ORIG_LISTDIR = os.listdir
 
-
-def _fake_exists_no_users(path):
-    if path.startswith('/sys/block/nbd'):
-        if path.endswith('pid'):
-            return False
-        return True
-    return ORIG_EXISTS(path)
-
-
-def _fake_listdir_nbd_devices(path):
-    if path.startswith('/sys/block'):
-        return ['nbd0', 'nbd1']
-    return ORIG_LISTDIR(path)
-
-
-def _fake_exists_all_used(path):
-    if path.startswith('/sys/block/nbd'):
-        return True
-    return ORIG_EXISTS(path)
+def _fake_noop(*args, **kwargs):
+    return
 
 
-def _fake_detect_nbd_devices_none(self):
-    return []
+def _write(path, data):
+    with open(path, 'w') as f:
+        f.write(data)
 
 
-def _fake_detect_nbd_devices(self):
-    return ['nbd0', 'nbd1']
+class FakeQemuNbd(object):
+    """Stands in for qemu-nbd, (dis)connecting devices in a fake sysfs
+    tree.
+    """
 
+    def __init__(self, sysfs_dir, error='', connect=True, size=2097152):
+        self.sysfs_dir = sysfs_dir
+        self.error = error
+        self.connect = connect
+        self.size = size
+        self.calls = []
 
-def _fake_noop(*args, **kwargs):
-    return
+    def __call__(self, *cmd, **kwargs):
+        self.calls.append(cmd)
+        if cmd[0] != 'qemu-nbd':
+            return '', ''
+        device = os.path.join(self.sysfs_dir, os.path.basename(cmd[2]))
+        if cmd[1] == '-c':
+            if self.error:
+                return '', self.error
+            if self.connect:
+                _write(os.path.join(device, 'pid'), '4242\n')
+                _write(os.path.join(device, 'size'), '%d\n' % self.size)
+        elif cmd[1] == '-d':
+            if os.path.exists(os.path.join(device, 'pid')):
+                os.unlink(os.path.join(device, 'pid'))
+            _write(os.path.join(device, 'size'), '0\n')
+        return '', ''
 
 
 class NbdTestCase(test.TestCase):
     def setUp(self):
         super(NbdTestCase, self).setUp()
-        self.stubs.Set(nbd.NbdMount, '_detect_nbd_devices',
-                       _fake_detect_nbd_devices)
-        self.useFixture(fixtures.MonkeyPatch('os.listdir',
-                                             _fake_listdir_nbd_devices))
-
-    def test_nbd_no_devices(self):
+        self.sysfs_dir = self.useFixture(fixtures.TempDir()).path
+        self.pool = nbd.NbdDevicePool(self.sysfs_dir)
+        self.stubs.Set(nbd.NbdMount, 'device_pool', self.pool)
+        self.useFixture(fixtures.MonkeyPatch('random.shuffle', _fake_noop))
+        self.qemu_nbd = FakeQemuNbd(self.sysfs_dir)
+        self.useFixture(fixtures.MonkeyPatch('nova.utils.trycmd',
+                                             self.qemu_nbd))
+        self.useFixture(fixtures.MonkeyPatch('nova.utils.execute',
+                                             self.qemu_nbd))
+
+    def _make_devices(self, devices=('nbd0', 'nbd1'), in_use=()):
+        for device in devices:
+            os.mkdir(os.path.join(self.sysfs_dir, device))
+            _write(os.path.join(self.sysfs_dir, device, 'size'), '0\n')
+        for device in in_use:
+            _write(os.path.join(self.sysfs_dir, device, 'pid'), '1234\n')
+            _write(os.path.join(self.sysfs_dir, device, 'size'), '2048\n')
+
+    def _mount(self):
         tempdir = self.useFixture(fixtures.TempDir()).path
-        self.stubs.Set(nbd.NbdMount, '_detect_nbd_devices',
-                       _fake_detect_nbd_devices_none)
-        n = nbd.NbdMount(None, tempdir)
-        self.assertEquals(None, n._allocate_nbd())
+        return nbd.NbdMount(None, tempdir)
 
     def test_nbd_no_free_devices(self):
-        tempdir = self.useFixture(fixtures.TempDir()).path
-        n = nbd.NbdMount(None, tempdir)
-        self.useFixture(fixtures.MonkeyPatch('os.path.exists',
-                                             _fake_exists_all_used))
+        self._make_devices(in_use=('nbd0', 'nbd1'))
+        n = self._mount()
         self.assertEquals(None, n._allocate_nbd())
+        self.assertEquals('No free nbd devices', n.error)
 
     def test_nbd_not_loaded(self):
-        tempdir = self.useFixture(fixtures.TempDir()).path
-        n = nbd.NbdMount(None, tempdir)
-
-        # Fake out os.path.exists
-        def fake_exists(path):
-            if path.startswith('/sys/block/nbd'):
-                return False
-            return ORIG_EXISTS(path)
-        self.useFixture(fixtures.MonkeyPatch('os.path.exists', fake_exists))
+        n = self._mount()
 
         # This should fail, as we don't have the module "loaded"
         # TODO(mikal): work out how to force english as the gettext language
@@ -100,138 +105,155 @@ class NbdTestCase(test.TestCase):
         self.assertEquals('nbd unavailable: module not loaded', n.error)
 
     def test_nbd_allocation(self):
-        tempdir = self.useFixture(fixtures.TempDir()).path
-        n = nbd.NbdMount(None, tempdir)
-        self.useFixture(fixtures.MonkeyPatch('os.path.exists',
-                                             _fake_exists_no_users))
-        self.useFixture(fixtures.MonkeyPatch('random.shuffle', _fake_noop))
+        self._make_devices()
+        n = self._mount()
 
         # Allocate a nbd device
         self.assertEquals('/dev/nbd0', n._allocate_nbd())
 
     def test_nbd_allocation_one_in_use(self):
-        tempdir = self.useFixture(fixtures.TempDir()).path
-        n = nbd.NbdMount(None, tempdir)
-        self.useFixture(fixtures.MonkeyPatch('random.shuffle', _fake_noop))
-
-        # Fake out os.path.exists
-        def fake_exists(path):
-            if path.startswith('/sys/block/nbd'):
-                if path == '/sys/block/nbd0/pid':
-                    return True
-                if path.endswith('pid'):
-                    return False
-                return True
-            return ORIG_EXISTS(path)
-        self.useFixture(fixtures.MonkeyPatch('os.path.exists', fake_exists))
+        self._make_devices(in_use=('nbd0',))
+        n = self._mount()
 
         # Allocate a nbd device, should not be the in use one
-        # TODO(mikal): Note that there is a leak here, as the in use nbd device
-        # is removed from the list, but not returned so it will never be
-        # re-added. I will fix this in a later patch.
         self.assertEquals('/dev/nbd1', n._allocate_nbd())
 
-    def test_inner_get_dev_no_devices(self):
-        tempdir = self.useFixture(fixtures.TempDir()).path
-        self.stubs.Set(nbd.NbdMount, '_detect_nbd_devices',
-                       _fake_detect_nbd_devices_none)
-        n = nbd.NbdMount(None, tempdir)
-        self.assertFalse(n._inner_get_dev())
+    def test_nbd_allocation_is_leased(self):
+        # Nothing is connected until qemu-nbd runs, so without leases every
+        # mount would pick the same device
+        self._make_devices()
+        mounts = [self._mount() for i in range(3)]
+        self.assertEquals('/dev/nbd0', mounts[0]._allocate_nbd())
+        self.assertEquals('/dev/nbd1', mounts[1]._allocate_nbd())
+        self.assertEquals(None, mounts[2]._allocate_nbd())
+
+    def test_nbd_lease_of_dropped_mount(self):
+        self._make_devices()
+        self.assertEquals('/dev/nbd0', self._mount()._allocate_nbd())
+
+        # The mount went away without giving nbd0 back
+        self.assertEquals('nbd0', self.pool.lease(self))
+
+    def test_nbd_lease_of_dropped_mount_still_connected(self):
+        self._make_devices()
+        self.assertTrue(self._mount()._inner_get_dev())
+
+        # nbd0 is still in use by qemu-nbd, so it stays leased
+        self.assertEquals('nbd1', self.pool.lease(self))
+        self.assertEquals(None, self.pool.lease(self))
 
     def test_inner_get_dev_qemu_fails(self):
-        tempdir = self.useFixture(fixtures.TempDir()).path
-        n = nbd.NbdMount(None, tempdir)
-        self.useFixture(fixtures.MonkeyPatch('os.path.exists',
-                                             _fake_exists_no_users))
+        self._make_devices()
+        n = self._mount()
 
-        # We have a trycmd that always fails
-        def fake_trycmd(*args, **kwargs):
-            return '', 'broken'
-        self.useFixture(fixtures.MonkeyPatch('nova.utils.trycmd', fake_trycmd))
+        # We have a qemu-nbd that always fails
+        self.qemu_nbd.error = 'broken'
 
         # Error logged, no device consumed
         self.assertFalse(n._inner_get_dev())
         self.assertTrue(n.error.startswith('qemu-nbd error'))
+        self.assertEquals('nbd0', self.pool.lease(self))
 
-    def test_inner_get_dev_qemu_timeout(self):
-        tempdir = self.useFixture(fixtures.TempDir()).path
-        n = nbd.NbdMount(None, tempdir)
-        self.useFixture(fixtures.MonkeyPatch('os.path.exists',
-                                             _fake_exists_no_users))
+    def test_inner_get_dev_qemu_raises(self):
+        self._make_devices()
+        n = self._mount()
 
-        # We have a trycmd that always passed
         def fake_trycmd(*args, **kwargs):
-            return '', ''
+            raise OSError('qemu-nbd not found')
         self.useFixture(fixtures.MonkeyPatch('nova.utils.trycmd', fake_trycmd))
-        self.useFixture(fixtures.MonkeyPatch('time.sleep', _fake_noop))
 
-        # Error logged, no device consumed
+        # The device is given back
+        self.assertRaises(OSError, n._inner_get_dev)
+        self.assertEquals('nbd0', self.pool.lease(self))
+
+    def test_inner_get_dev_qemu_timeout(self):
+        self._make_devices()
+        n = self._mount()
+
+        # We have a qemu-nbd that never connects the device
+        self.qemu_nbd.connect = False
+        sleeps = []
+        self.useFixture(fixtures.MonkeyPatch('time.sleep', sleeps.append))
+
+        # Error logged, device disconnected and given back
         self.assertFalse(n._inner_get_dev())
         self.assertTrue(n.error.endswith('did not show up'))
-
-    def fake_exists_one(self, path):
-        # We need the pid file for the device which is allocated to exist, but
-        # only once it is allocated to us
-        if path.startswith('/sys/block/nbd'):
-            if path == '/sys/block/nbd1/pid':
-                return False
-            if path.endswith('pid'):
-                return False
-            return True
-        return ORIG_EXISTS(path)
-
-    def fake_trycmd_creates_pid(self, *args, **kwargs):
-        def fake_exists_two(path):
-            if path.startswith('/sys/block/nbd'):
-                if path == '/sys/block/nbd0/pid':
-                    return True
-                if path.endswith('pid'):
-                    return False
-                return True
-            return ORIG_EXISTS(path)
-        self.useFixture(fixtures.MonkeyPatch('os.path.exists',
-                                            fake_exists_two))
-        return '', ''
+        self.assertEquals(('qemu-nbd', '-d', '/dev/nbd0'),
+                          self.qemu_nbd.calls[-1])
+        self.assertEquals(101, len(sleeps))
+        self.assertEquals('nbd0', self.pool.lease(self))
+
+    def test_inner_get_dev_waits_for_size(self):
+        self._make_devices()
+        n = self._mount()
+        size_path = os.path.join(self.sysfs_dir, 'nbd0', 'size')
+        sleeps = []
+
+        # The kernel only learns the size of the device a little after
+        # qemu-nbd has connected it
+        self.qemu_nbd.size = 0
+
+        def fake_sleep(seconds):
+            sleeps.append(seconds)
+            if len(sleeps) == 3:
+                _write(size_path, '2097152\n')
+
+        self.useFixture(fixtures.MonkeyPatch('time.sleep', fake_sleep))
+        self.assertTrue(n._inner_get_dev())
+        self.assertEquals([nbd.POLL_INTERVAL] * 3, sleeps)
 
     def test_inner_get_dev_works(self):
-        tempdir = self.useFixture(fixtures.TempDir()).path
-        n = nbd.NbdMount(None, tempdir)
-        self.useFixture(fixtures.MonkeyPatch('random.shuffle', _fake_noop))
-        self.useFixture(fixtures.MonkeyPatch('os.path.exists',
-                                             self.fake_exists_one))
-        self.useFixture(fixtures.MonkeyPatch('nova.utils.trycmd',
-                                             self.fake_trycmd_creates_pid))
-        self.useFixture(fixtures.MonkeyPatch('nova.utils.execute', _fake_noop))
+        self._make_devices(in_use=('nbd1',))
+        n = self._mount()
 
         # No error logged, device consumed
         self.assertTrue(n._inner_get_dev())
         self.assertTrue(n.linked)
         self.assertEquals('', n.error)
         self.assertEquals('/dev/nbd0', n.device)
+        self.assertTrue(self.pool.is_connected('nbd0'))
 
         # Free
         n.unget_dev()
         self.assertFalse(n.linked)
         self.assertEquals('', n.error)
         self.assertEquals(None, n.device)
+        self.assertFalse(self.pool.is_connected('nbd0'))
+
+    def test_unget_dev_recycles_device(self):
+        self._make_devices(('nbd0', 'nbd1', 'nbd2'))
+        n = self._mount()
+        self.assertTrue(n._inner_get_dev())
+        self.assertEquals('/dev/nbd0', n.device)
+        self.assertTrue(self._mount()._inner_get_dev())
+
+        # The device given back is offered before scanning for another
+        n.unget_dev()
+        self.useFixture(fixtures.MonkeyPatch('random.shuffle',
+                                             lambda devices:
+                                             devices.sort(reverse=True)))
+        self.assertEquals('/dev/nbd0', self._mount()._allocate_nbd())
+
+    def test_released_device_still_connected(self):
+        self._make_devices()
+        self.assertEquals('nbd0', self.pool.lease(self))
+        _write(os.path.join(self.sysfs_dir, 'nbd0', 'pid'), '4242\n')
+        self.pool.release('nbd0')
+
+        # The kernel has not let go of nbd0 yet
+        self.assertEquals('nbd1', self.pool.lease(self))
+        os.unlink(os.path.join(self.sysfs_dir, 'nbd0', 'pid'))
+        self.assertEquals('nbd0', self.pool.lease(self))
 
     def test_unget_dev_simple(self):
         # This test is just checking we don't get an exception when we unget
         # something we don't have
-        tempdir = self.useFixture(fixtures.TempDir()).path
-        n = nbd.NbdMount(None, tempdir)
-        self.useFixture(fixtures.MonkeyPatch('nova.utils.execute', _fake_noop))
+        n = self._mount()
         n.unget_dev()
 
     def test_get_dev(self):
-        tempdir = self.useFixture(fixtures.TempDir()).path
-        n = nbd.NbdMount(None, tempdir)
-        self.useFixture(fixtures.MonkeyPatch('random.shuffle', _fake_noop))
-        self.useFixture(fixtures.MonkeyPatch('nova.utils.execute', _fake_noop))
-        self.useFixture(fixtures.MonkeyPatch('os.path.exists',
-                                             self.fake_exists_one))
-        self.useFixture(fixtures.MonkeyPatch('nova.utils.trycmd',
-                                             self.fake_trycmd_creates_pid))
+        self._make_devices()
+        n = self._mount()
 
         # No error logged, device consumed
         self.assertTrue(n.get_dev())
@@ -251,15 +273,8 @@ class NbdTestCase(test.TestCase):
             return False
         self.stubs.Set(nbd.NbdMount, '_inner_get_dev', fake_get_dev_fails)
 
-        tempdir = self.useFixture(fixtures.TempDir()).path
-        n = nbd.NbdMount(None, tempdir)
-        self.useFixture(fixtures.MonkeyPatch('random.shuffle', _fake_noop))
+        n = self._mount()
         self.useFixture(fixtures.MonkeyPatch('time.sleep', _fake_noop))
-        self.useFixture(fixtures.MonkeyPatch('nova.utils.execute', _fake_noop))
-        self.useFixture(fixtures.MonkeyPatch('os.path.exists',
-                                             self.fake_exists_one))
-        self.useFixture(fixtures.MonkeyPatch('nova.utils.trycmd',
-                                             self.fake_trycmd_creates_pid))
         self.useFixture(fixtures.MonkeyPatch(('nova.virt.disk.mount.api.'
                                               'MAX_DEVICE_WAIT'), -10))
 
@@ -1,4 +1,9 @@
+import decimal
+import os
+
+import fixtures
 import mox
+
 from nova import context
 from nova import db
 from nova import exception
@@ -105,6 +110,100 @@ class GetInstanceForVdisForSrTestCase(stubs.XenAPITestBase):
         self.assertNotEquals(vdi_uuid, None)
 
 
+class BulkRecordsTestCase(stubs.XenAPITestBase):
+    def setUp(self):
+        super(BulkRecordsTestCase, self).setUp()
+        self.flags(xenapi_connection_url='test_url',
+                   xenapi_connection_password='test_pass')
+        stubs.stubout_session(self.stubs, fake.SessionBase)
+        self.session = xenapi_conn.XenAPIDriver(False)._session
+        self.host_ref = fake.get_all('host')[0]
+        fake.reset_call_counts()
+
+    def test_get_all_vdis_in_sr(self):
+        sr_ref = fake.create_sr()
+        other_sr_ref = fake.create_sr()
+        vdi_refs = [fake.create_vdi('vdi%d' % i, sr_ref) for i in xrange(3)]
+        fake.create_vdi('other', other_sr_ref)
+
+        vdis = dict(vm_utils._get_all_vdis_in_sr(self.session, sr_ref))
+
+        self.assertEqual(set(vdi_refs), set(vdis))
+        self.assertEqual('vdi0', vdis[vdi_refs[0]]['name_label'])
+        self.assertEqual({'VDI.get_all_records_where': 1},
+                         fake.get_call_counts())
+
+    def test_lookup_vm_vdis(self):
+        vm_ref = fake.create_vm('foo', 'Running')
+        sr_ref = fake.create_sr()
+        vdi_refs = [fake.create_vdi('vdi%d' % i, sr_ref) for i in xrange(3)]
+        vbd_refs = [fake.create_vbd(vm_ref, vdi_ref, userdevice)
+                    for userdevice, vdi_ref in enumerate(vdi_refs)]
+        fake.get_record('VBD', vbd_refs[2])['other_config']['osvol'] = True
+
+        result = vm_utils.lookup_vm_vdis(self.session, vm_ref)
+
+        self.assertEqual(set(vdi_refs[:2]), set(result))
+        self.assertEqual({'VBD.get_all_records_where': 1,
+                          'VDI.get_record': 2},
+                         fake.get_call_counts())
+
+    def test_list_vms(self):
+        vm_ref = fake.create_vm('foo', 'Running', resident_on=self.host_ref)
+        fake.create_vm('template', 'Halted', resident_on=self.host_ref,
+                       is_a_template=True)
+        fake.create_vm('elsewhere', 'Running', resident_on='other_host')
+
+        vms = dict(vm_utils.list_vms(self.session))
+
+        self.assertEqual([vm_ref], vms.keys())
+        self.assertEqual({'host.get_by_uuid': 1,
+                          'VM.get_all_records_where': 1},
+                         fake.get_call_counts())
+
+    def test_lookup_rec(self):
+        vm_ref = fake.create_vm('foo', 'Running')
+
+        self.assertEqual(vm_ref,
+                         vm_utils.lookup_rec(self.session, 'foo')[0])
+        self.assertEqual(None, vm_utils.lookup_rec(self.session, 'bar'))
+        self.assertEqual({'VM.get_all_records_where': 2},
+                         fake.get_call_counts())
+
+    def test_lookup_rec_duplicates(self):
+        fake.create_vm('foo', 'Running')
+        fake.create_vm('foo', 'Running')
+
+        self.assertRaises(exception.InstanceExists,
+                          vm_utils.lookup_rec, self.session, 'foo')
+
+    def test_record_snapshot(self):
+        sr_refs = [fake.create_sr() for i in xrange(3)]
+        for sr_ref in sr_refs:
+            fake.create_vdi('vdi', sr_ref)
+        fake.create_vm('foo', 'Running', resident_on=self.host_ref)
+
+        with self.session.record_snapshot():
+            for sr_ref in sr_refs:
+                vdis = dict(vm_utils._get_all_vdis_in_sr(self.session,
+                                                         sr_ref))
+                self.assertEqual(1, len(vdis))
+                self.assertEqual(sr_ref, vdis.values()[0]['SR'])
+            with self.session.record_snapshot():
+                self.assertEqual(1, len(list(vm_utils.list_vms(
+                    self.session))))
+            self.assertEqual(None, vm_utils.lookup_rec(self.session, 'bar'))
+        self.assertEqual({'VDI.get_all_records': 1,
+                          'VM.get_all_records': 1,
+                          'host.get_by_uuid': 1},
+                         fake.get_call_counts())
+
+        fake.reset_call_counts()
+        vm_utils._get_all_vdis_in_sr(self.session, sr_refs[0])
+        self.assertEqual({'VDI.get_all_records_where': 1},
+                         fake.get_call_counts())
+
+
 class VMRefOrRaiseVMFoundTestCase(test.TestCase):
 
     def test_lookup_call(self):
@@ -204,3 +303,145 @@ class BittorrentTestCase(stubs.XenAPITestBase):
 
     def test_create_image_uncached(self):
         self._test_create_image('none')
+
+
+class SparseCopyTestCase(test.TestCase):
+    def setUp(self):
+        super(SparseCopyTestCase, self).setUp()
+        self.tmpdir = self.useFixture(fixtures.TempDir()).path
+        self.src_path = os.path.join(self.tmpdir, 'src')
+        self.dst_path = os.path.join(self.tmpdir, 'dst')
+        self.block = vm_utils.SPARSE_COPY_BLOCK_SIZE
+        open(self.dst_path, 'w').close()
+
+    def _write_src(self, extents, size):
+        with open(self.src_path, 'wb') as f:
+            for offset, data in extents:
+                f.seek(offset)
+                f.write(data)
+            f.truncate(size)
+
+    def _copy(self, size):
+        vm_utils._sparse_copy(self.src_path, self.dst_path, size)
+        with open(self.src_path, 'rb') as src:
+            expected = src.read(size)
+        with open(self.dst_path, 'rb') as dst:
+            self.assertEqual(expected, dst.read())
+
+    def test_dense(self):
+        size = 3 * vm_utils.SPARSE_COPY_BUFFER_SIZE + 1234
+        self._write_src([(0, 'x' * size)], size)
+        self._copy(size)
+
+    def test_sparse(self):
+        size = 2 * vm_utils.SPARSE_COPY_BUFFER_SIZE
+        self._write_src([(self.block - 1, 'ab'),
+                         (5 * self.block, 'c' * self.block),
+                         (size - 10, 'd')], size)
+        self._copy(size)
+
+    def test_trailing_zeros(self):
+        size = 10 * self.block
+        self._write_src([(0, 'a')], size)
+        self._copy(size)
+        self.assertEqual(size, os.path.getsize(self.dst_path))
+
+    def test_written_zeros_are_skipped(self):
+        size = 4 * self.block
+        self._write_src([(0, '\0' * size), (2 * self.block, 'a')], size)
+        writes = []
+
+        def fake_write_nonzero_blocks(dst, offset, view, zeros, length,
+                                      block_size):
+            writes.append((offset, length))
+            return orig_write_nonzero_blocks(dst, offset, view, zeros, length,
+                                             block_size)
+
+        orig_write_nonzero_blocks = vm_utils._write_nonzero_blocks
+        self.stubs.Set(vm_utils, '_write_nonzero_blocks',
+                       fake_write_nonzero_blocks)
+        self._copy(size)
+        self.assertEqual([(0, size)], writes)
+
+    def test_without_hole_detection(self):
+        self.stubs.Set(vm_utils, '_find_data', lambda fd, offset, end: None)
+        size = 3 * self.block
+        self._write_src([(self.block, 'b' * 10)], size)
+        self._copy(size)
+
+    def test_write_nonzero_blocks(self):
+        view = memoryview(bytearray('\0' * 4 + 'ab' + '\0' * 4 + 'c'))
+        zeros = memoryview(bytearray(len(view)))
+        writes = []
+
+        class FakeFile(object):
+            def seek(self, offset):
+                self.offset = offset
+
+            def write(self, data):
+                writes.append((self.offset, data.tobytes()))
+
+        skipped = vm_utils._write_nonzero_blocks(FakeFile(), 100, view,
+                                                 zeros, len(view), 2)
+        self.assertEqual(8, skipped)
+        self.assertEqual([(104, 'ab'), (110, 'c')], writes)
+
+
+class CompileMetricsTestCase(test.TestCase):
+    """The fixture is a recorded rrd_updates of two VMs, with a NaN in a
+    vif column and in a cpu column. The expected values are what the
+    minidom and Decimal parser used to compute for it.
+    """
+    vm_uuid = 'a2d4bd24-8f4e-4c52-9c1d-3ac1bd8b6a0e'
+    other_vm_uuid = '0c9d3b6e-2f6a-4b36-8f1e-5f0bd8e53c17'
+
+    def setUp(self):
+        super(CompileMetricsTestCase, self).setUp()
+        self.flags(xenapi_connection_url='test_url')
+        path = os.path.join(os.path.dirname(__file__), 'rrd_updates.xml')
+        with open(path) as f:
+            self.xml = f.read()
+        self.stubs.Set(vm_utils, '_get_rrd_updates',
+                       lambda server, start_time: self.xml)
+
+    def test_compile_metrics(self):
+        metrics = vm_utils.compile_metrics(1328795500)
+        self.assertEqual(set([self.vm_uuid, self.other_vm_uuid]),
+                         set(metrics))
+        self.assertEqual({'cpu0': decimal.Decimal('0.0265'),
+                          'cpu1': decimal.Decimal('0.0224'),
+                          'memory': decimal.Decimal('4294967296.0000'),
+                          'memory_internal_free':
+                              decimal.Decimal('1444179.1667'),
+                          'vbd_xvda_read': decimal.Decimal('9511.9694'),
+                          'vbd_xvda_write': decimal.Decimal('6840.0461'),
+                          'vif_0_rx': decimal.Decimal('182551.2095'),
+                          'vif_0_tx': decimal.Decimal('132548.8438')},
+                         metrics[self.vm_uuid])
+        # Skips the NaN when averaging, counts it as 0 when integrating
+        self.assertEqual(decimal.Decimal('0.0182'),
+                         metrics[self.other_vm_uuid]['cpu1'])
+        self.assertEqual(decimal.Decimal('129453.7618'),
+                         metrics[self.other_vm_uuid]['vif_0_rx'])
+
+    def test_compile_metrics_until(self):
+        metrics = vm_utils.compile_metrics(1328795500, 1328795540)
+        self.assertEqual(decimal.Decimal('1454581.4286'),
+                         metrics[self.vm_uuid]['memory_internal_free'])
+        self.assertEqual(decimal.Decimal('89286.2538'),
+                         metrics[self.vm_uuid]['vif_0_tx'])
+        self.assertEqual(decimal.Decimal('0.0111'),
+                         metrics[self.other_vm_uuid]['cpu1'])
+
+    def test_compile_metrics_invalid_value(self):
+        self.xml = self.xml.replace('<v>NaN</v>', '<v>bogus</v>')
+        metrics = vm_utils.compile_metrics(1328795500)
+        self.assertEqual(decimal.Decimal('0.0182'),
+                         metrics[self.other_vm_uuid]['cpu1'])
+        self.assertEqual(decimal.Decimal('129453.7618'),
+                         metrics[self.other_vm_uuid]['vif_0_rx'])
+
+    def test_compile_metrics_no_updates(self):
+        self.xml = None
+        self.assertRaises(exception.CouldNotFetchMetrics,
+                          vm_utils.compile_metrics, 1328795500)
@@ -36,6 +36,7 @@ import struct
 import sys
 import tempfile
 import time
+import types
 from xml.dom import minidom
 from xml.parsers import expat
 from xml import sax
@@ -52,6 +53,7 @@ from oslo.config import cfg
 from nova import exception
 from nova.openstack.common import excutils
 from nova.openstack.common import importutils
+from nova.openstack.common import jsonutils
 from nova.openstack.common import log as logging
 from nova.openstack.common.rpc import common as rpc_common
 from nova.openstack.common import timeutils
@@ -1346,6 +1348,92 @@ def metadata_to_dict(metadata):
     return result
 
 
+# Values of these types are returned by to_primitive() as they are
+_simple_types = frozenset([str, unicode, int, long, float, bool,
+                           type(None)])
+
+
+def _list_to_primitive(value, convert_instances, convert_datetime, level,
+                       max_depth):
+    return [to_primitive(v, convert_instances, convert_datetime, level,
+                         max_depth) for v in value]
+
+
+def _dict_to_primitive(value, convert_instances, convert_datetime, level,
+                       max_depth):
+    return dict((k, to_primitive(v, convert_instances, convert_datetime,
+                                 level, max_depth))
+                for k, v in value.iteritems())
+
+
+def _datetime_to_primitive(value, convert_instances, convert_datetime, level,
+                           max_depth):
+    if convert_datetime:
+        return timeutils.strtime(value)
+    return value
+
+
+def _iteritems_to_primitive(value, convert_instances, convert_datetime,
+                            level, max_depth):
+    try:
+        value = dict(value.iteritems())
+    except TypeError:
+        return unicode(value)
+    return to_primitive(value, convert_instances, convert_datetime,
+                        level + 1, max_depth)
+
+
+# How to_primitive() converts values of a given type, filled in as types
+# are seen; see _primitive_converter()
+_primitive_converters = {list: _list_to_primitive,
+                         tuple: _list_to_primitive,
+                         dict: _dict_to_primitive,
+                         datetime.datetime: _datetime_to_primitive}
+
+
+def _primitive_converter(value_type):
+    """Pick how to convert values of value_type, and remember it.
+
+    Types that behave like dicts, such as DB models, are walked here.
+    Anything else goes to jsonutils.to_primitive(), which runs its checks
+    on each value.  That includes old style instances, types with a
+    __getattr__ and mox objects, whose attributes say nothing certain
+    about their type.
+    """
+    if (value_type is not types.InstanceType and
+            not hasattr(value_type, '__getattr__') and
+            getattr(value_type, '__module__', None) != 'mox' and
+            not issubclass(value_type, (list, tuple, dict)) and
+            hasattr(value_type, 'iteritems')):
+        converter = _iteritems_to_primitive
+    else:
+        converter = jsonutils.to_primitive
+    _primitive_converters[value_type] = converter
+    return converter
+
+
+def to_primitive(value, convert_instances=False, convert_datetime=True,
+                 level=0, max_depth=3):
+    """Convert a complex object into primitives, like
+    jsonutils.to_primitive() does.
+
+    Most values in RPC payloads are strings, numbers and None inside
+    lists, dicts and DB models.  Those are converted here, with the way to
+    convert each type worked out once, rather than by running the dozen
+    inspect checks of jsonutils on every value.
+    """
+    value_type = type(value)
+    if level > max_depth:
+        converter = jsonutils.to_primitive
+    elif value_type in _simple_types:
+        return value
+    else:
+        converter = (_primitive_converters.get(value_type) or
+                     _primitive_converter(value_type))
+    return converter(value, convert_instances, convert_datetime, level,
+                     max_depth)
+
+
 def get_wrapped_function(function):
     """Get the method at the bottom of a stack of decorators."""
     if not hasattr(function, 'func_closure') or not function.func_closure:
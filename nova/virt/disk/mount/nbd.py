@@ -19,9 +19,11 @@ import os
 import random
 import re
 import time
+import weakref
 
 from oslo.config import cfg
 
+from nova.openstack.common import lockutils
 from nova.openstack.common import log as logging
 from nova import utils
 from nova.virt.disk.mount import api
@@ -39,79 +41,159 @@ CONF.register_opts(nbd_opts)
 
 NBD_DEVICE_RE = re.compile('nbd[0-9]+')
 
+# Seconds between looks at sysfs while waiting for a device to come up
+POLL_INTERVAL = 0.1
 
-class NbdMount(api.Mount):
-    """qemu-nbd support disk images."""
-    mode = 'nbd'
 
-    def _detect_nbd_devices(self):
+class NbdDevicePool(object):
+    """Leases the NBD devices of the host to NbdMounts.
+
+    Leases are handed out under a lock, so concurrent injections never
+    pick the same device. Devices given back are offered again first,
+    before sysfs is scanned for others. A device whose owner went away
+    without giving it back is taken back by the scan once it is no
+    longer connected.
+    """
+
+    def __init__(self, sysfs_dir='/sys/block'):
+        self.sysfs_dir = sysfs_dir
+        # Weak references to the owners of leased devices, by device
+        self._leased = {}
+        self._released = []
+
+    def _path(self, device, name):
+        return os.path.join(self.sysfs_dir, device, name)
+
+    def loaded(self):
+        """Is the nbd module loaded?"""
+        return os.path.exists(os.path.join(self.sysfs_dir, 'nbd0'))
+
+    def detect_devices(self):
         """Detect nbd device files."""
-        return filter(NBD_DEVICE_RE.match, os.listdir('/sys/block/'))
+        return filter(NBD_DEVICE_RE.match, os.listdir(self.sysfs_dir))
+
+    def is_connected(self, device):
+        return os.path.exists(self._path(device, 'pid'))
+
+    def is_ready(self, device):
+        """A device is ready once it is connected and has a size."""
+        if not self.is_connected(device):
+            return False
+        try:
+            with open(self._path(device, 'size')) as f:
+                return int(f.read()) > 0
+        except (IOError, ValueError):
+            return False
+
+    def _lease(self, device, owner):
+        self._leased[device] = weakref.ref(owner)
+        LOG.debug(_('Leased nbd device %s'), device)
+        return device
+
+    def _is_free(self, device):
+        if device in self._released or self.is_connected(device):
+            return False
+        if device in self._leased:
+            if self._leased[device]() is not None:
+                return False
+            LOG.warn(_('Taking back nbd device %s, its owner went away '
+                       'without giving it back'), device)
+        return True
 
-    def _find_unused(self, devices):
+    @lockutils.synchronized('nbd-device-pool', 'nova-')
+    def lease(self, owner):
+        """Lease a free device to owner and return its name, or None if
+        there are none.  The lease lasts until the device is given back
+        or owner is garbage collected.
+        """
+        for device in self._released:
+            if not self.is_connected(device):
+                self._released.remove(device)
+                return self._lease(device, owner)
+
+        devices = self.detect_devices()
+        random.shuffle(devices)
         for device in devices:
-            if not os.path.exists(os.path.join('/sys/block/', device, 'pid')):
-                return device
-        LOG.warn(_('No free nbd devices'))
+            if self._is_free(device):
+                return self._lease(device, owner)
         return None
 
+    @lockutils.synchronized('nbd-device-pool', 'nova-')
+    def release(self, device):
+        """Give back a device, once it has been asked to disconnect."""
+        if self._leased.pop(device, None) is None:
+            return
+        self._released.insert(0, device)
+
+    def wait_until_ready(self, device, timeout):
+        """Poll sysfs until the device is ready, for up to timeout
+        seconds.
+        """
+        for _i in xrange(int(timeout / POLL_INTERVAL) + 1):
+            if self.is_ready(device):
+                return True
+            time.sleep(POLL_INTERVAL)
+        return False
+
+
+class NbdMount(api.Mount):
+    """qemu-nbd support disk images."""
+    mode = 'nbd'
+
+    device_pool = NbdDevicePool()
+
     def _allocate_nbd(self):
-        if not os.path.exists('/sys/block/nbd0'):
+        if not self.device_pool.loaded():
             LOG.error(_('nbd module not loaded'))
             self.error = _('nbd unavailable: module not loaded')
             return None
 
-        devices = self._detect_nbd_devices()
-        random.shuffle(devices)
-        device = self._find_unused(devices)
+        device = self.device_pool.lease(self)
         if not device:
+            LOG.warn(_('No free nbd devices'))
             # really want to log this info, not raise
             self.error = _('No free nbd devices')
             return None
         return os.path.join('/dev', device)
 
-    def _read_pid_file(self, pidfile):
-        # This is for unit test convenience
-        with open(pidfile) as f:
-            pid = int(f.readline())
-        return pid
-
     def _inner_get_dev(self):
         device = self._allocate_nbd()
         if not device:
             return False
 
-        # NOTE(mikal): qemu-nbd will return an error if the device file is
-        # already in use.
-        LOG.debug(_('Get nbd device %(dev)s for %(imgfile)s'),
-                  {'dev': device, 'imgfile': self.image})
-        _out, err = utils.trycmd('qemu-nbd', '-c', device, self.image,
-                                 run_as_root=True)
-        if err:
-            self.error = _('qemu-nbd error: %s') % err
-            LOG.info(_('NBD mount error: %s'), self.error)
-            return False
-
-        # NOTE(vish): this forks into another process, so give it a chance
-        # to set up before continuing
-        pidfile = "/sys/block/%s/pid" % os.path.basename(device)
-        for _i in range(CONF.timeout_nbd):
-            if os.path.exists(pidfile):
-                self.device = device
-                break
-            time.sleep(1)
-        else:
-            self.error = _('nbd device %s did not show up') % device
-            LOG.info(_('NBD mount error: %s'), self.error)
-
-            # Cleanup
-            _out, err = utils.trycmd('qemu-nbd', '-d', device,
+        linked = False
+        try:
+            # NOTE(mikal): qemu-nbd will return an error if the device file
+            # is already in use.
+            LOG.debug(_('Get nbd device %(dev)s for %(imgfile)s'),
+                      {'dev': device, 'imgfile': self.image})
+            _out, err = utils.trycmd('qemu-nbd', '-c', device, self.image,
                                      run_as_root=True)
             if err:
-                LOG.warn(_('Detaching from erroneous nbd device returned '
-                           'error: %s'), err)
-            return False
-
+                self.error = _('qemu-nbd error: %s') % err
+                LOG.info(_('NBD mount error: %s'), self.error)
+                return False
+
+            # NOTE(vish): this forks into another process, so give it a
+            # chance to set up before continuing
+            if not self.device_pool.wait_until_ready(
+                    os.path.basename(device), CONF.timeout_nbd):
+                self.error = _('nbd device %s did not show up') % device
+                LOG.info(_('NBD mount error: %s'), self.error)
+
+                # Cleanup
+                _out, err = utils.trycmd('qemu-nbd', '-d', device,
+                                         run_as_root=True)
+                if err:
+                    LOG.warn(_('Detaching from erroneous nbd device returned '
+                               'error: %s'), err)
+                return False
+            linked = True
+        finally:
+            if not linked:
+                self.device_pool.release(os.path.basename(device))
+
+        self.device = device
         self.error = ''
         self.linked = True
         return True
@@ -124,6 +206,9 @@ class NbdMount(api.Mount):
         if not self.linked:
             return
         LOG.debug(_('Release nbd device %s'), self.device)
-        utils.execute('qemu-nbd', '-d', self.device, run_as_root=True)
+        try:
+            utils.execute('qemu-nbd', '-d', self.device, run_as_root=True)
+        finally:
+            self.device_pool.release(os.path.basename(self.device))
         self.linked = False
         self.device = None
@@ -201,6 +201,16 @@ class ComputeDriver(object):
         """
         raise NotImplementedError()
 
+    def get_power_states(self):
+        """Return the power states of all the instances on the host.
+
+        Returns a dict mapping the name of each instance known to the
+        virtualization layer to its power_state code. Drivers should get
+        them in as few calls to the hypervisor as they can, rather than
+        with a get_info() call for each instance.
+        """
+        raise NotImplementedError()
+
     def spawn(self, context, instance, image_meta, injected_files,
               admin_password, network_info=None, block_device_info=None):
         """
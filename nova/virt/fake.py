@@ -429,6 +429,10 @@ class FakeDriver(driver.ComputeDriver):
     def list_instance_uuids(self):
         return []
 
+    def get_power_states(self):
+        return dict((name, instance.state)
+                    for name, instance in self.instances.iteritems())
+
     def legacy_nwinfo(self):
         return True
 
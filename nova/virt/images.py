@@ -23,6 +23,8 @@ Handling of VM disk images.
 
 import os
 import re
+import stat
+import struct
 
 from oslo.config import cfg
 
@@ -37,6 +39,11 @@ image_opts = [
     cfg.BoolOpt('force_raw_images',
                 default=True,
                 help='Force backing images to raw format'),
+    cfg.BoolOpt('native_image_probe',
+                default=True,
+                help='Read qcow2 and vpc image headers directly instead '
+                     'of running qemu-img info; raw and other formats are '
+                     'still probed with qemu-img'),
 ]
 
 CONF = cfg.CONF
@@ -49,8 +56,9 @@ class QemuImgInfo(object):
     TOP_LEVEL_RE = re.compile(r"^([\w\d\s\_\-]+):(.*)$")
     SIZE_RE = re.compile(r"\(\s*(\d+)\s+bytes\s*\)", re.I)
 
-    def __init__(self, cmd_output):
-        details = self._parse(cmd_output)
+    def __init__(self, cmd_output=None, details=None):
+        if details is None:
+            details = self._parse(cmd_output)
         self.image = details.get('image')
         self.backing_file = details.get('backing_file')
         self.file_format = details.get('file_format')
@@ -174,11 +182,103 @@ class QemuImgInfo(object):
         return contents
 
 
+# Header layouts as found in qemu's block/qcow2.h and block/vpc.c; all
+# fields are big endian.
+QCOW2_MAGIC = 'QFI\xfb'
+QCOW2_HEADER = struct.Struct('>4sIQIIQIIQQIIQ')
+VPC_MAGIC = 'conectix'
+VPC_FOOTER = struct.Struct('>8sIIQI4sIIQQHBBII')
+VPC_DISK_DYNAMIC = 3
+_PROBE_SIZE = 512
+
+
+def _qcow2_details(image_file, header):
+    (magic, version, backing_offset, backing_size, cluster_bits, size,
+     crypt_method, _l1_size, _l1_offset, _refcount_offset,
+     _refcount_clusters, nb_snapshots, _snapshots_offset) = \
+        QCOW2_HEADER.unpack_from(header)
+    if version not in (2, 3) or crypt_method or nb_snapshots:
+        # qcow1, encrypted images and snapshot tables are rare enough
+        # that qemu-img can keep describing them.
+        return None
+    details = {
+        'file_format': 'qcow2',
+        'virtual_size': size,
+        'cluster_size': 1 << cluster_bits,
+    }
+    if backing_offset:
+        image_file.seek(backing_offset)
+        backing_file = image_file.read(backing_size)
+        if len(backing_file) != backing_size:
+            return None
+        if ':' not in backing_file and not os.path.isabs(backing_file):
+            # Report the same 'actual path' qemu-img would resolve to.
+            backing_file = os.path.join(
+                os.path.dirname(image_file.name), backing_file)
+        details['backing_file'] = backing_file
+    return details
+
+
+def _vpc_details(header):
+    fields = VPC_FOOTER.unpack_from(header)
+    current_size, cylinders, heads, sectors, disk_type = fields[9:14]
+    if disk_type != VPC_DISK_DYNAMIC:
+        # Differencing disks need their parent locators parsed.
+        return None
+    if (cylinders, heads, sectors) == (65535, 16, 255):
+        # The geometry is saturated, so trust the stated size instead.
+        virtual_size = current_size
+    else:
+        virtual_size = cylinders * heads * sectors * 512
+    return {'file_format': 'vpc', 'virtual_size': virtual_size}
+
+
+def _native_img_info(path):
+    """Describe an image from its on-disk header without forking qemu-img.
+
+    Returns a QemuImgInfo, or None when the image is not one we can
+    positively identify as qcow2 or vpc. Raw images have no header to go
+    by, so like every other format they are left to qemu-img rather than
+    assumed from the absence of a known signature.
+    """
+    with open(path, 'rb') as image_file:
+        st = os.fstat(image_file.fileno())
+        if not stat.S_ISREG(st.st_mode):
+            return None
+        header = image_file.read(_PROBE_SIZE)
+        if header.startswith(QCOW2_MAGIC):
+            if len(header) < QCOW2_HEADER.size:
+                return None
+            details = _qcow2_details(image_file, header)
+        elif header.startswith(VPC_MAGIC):
+            if len(header) < VPC_FOOTER.size:
+                return None
+            details = _vpc_details(header)
+        else:
+            return None
+    if details is None:
+        return None
+
+    details['image'] = path
+    details['disk_size'] = st.st_blocks * 512
+    return QemuImgInfo(details=details)
+
+
 def qemu_img_info(path):
     """Return an object containing the parsed output from qemu-img info."""
     if not os.path.exists(path):
         return QemuImgInfo()
 
+    if CONF.native_image_probe:
+        try:
+            info = _native_img_info(path)
+        except (IOError, OSError, struct.error) as e:
+            LOG.debug(_("Native probe of %(path)s failed, falling back to "
+                        "qemu-img: %(e)s"), {'path': path, 'e': e})
+            info = None
+        if info is not None:
+            return info
+
     out, err = utils.execute('env', 'LC_ALL=C', 'LANG=C',
                              'qemu-img', 'info', path)
     return QemuImgInfo(out)
@@ -682,6 +682,35 @@ class LibvirtDriver(driver.ComputeDriver):
         return [self._conn.lookupByName(name).UUIDString()
                 for name in self.list_instances()]
 
+    def get_power_states(self):
+        """Efficient override of base get_power_states method."""
+        states = {}
+        if hasattr(self._conn, 'listAllDomains'):
+            # libvirt >= 0.9.13 lists running and defined domains in one go
+            domains = self._conn.listAllDomains(0)
+        else:
+            domains = []
+            for domain_id in self.list_instance_ids():
+                try:
+                    domains.append(self._conn.lookupByID(domain_id))
+                except libvirt.libvirtError:
+                    # Instance was deleted while listing... ignore it
+                    pass
+            # Domains that are defined but not running are shut off
+            for name in self._conn.listDefinedDomains():
+                states[name] = power_state.SHUTDOWN
+
+        for domain in domains:
+            try:
+                # We skip domains with ID 0 (hypervisors).
+                if domain.ID() != 0:
+                    state = domain.info()[0]
+                    states[domain.name()] = LIBVIRT_POWER_STATE[state]
+            except libvirt.libvirtError:
+                # Instance was deleted while listing... ignore it
+                pass
+        return states
+
     def plug_vifs(self, instance, network_info):
         """Plug VIFs into networks."""
         for (network, mapping) in network_info:
@@ -28,6 +28,9 @@ import os
 import re
 import time
 
+from eventlet import greenpool
+from eventlet import greenthread
+from eventlet import tpool
 from oslo.config import cfg
 
 from nova.compute import task_states
@@ -68,6 +71,18 @@ imagecache_opts = [
     cfg.IntOpt('checksum_interval_seconds',
                default=3600,
                help='How frequently to checksum base images'),
+    cfg.IntOpt('checksum_base_images_workers',
+               default=2,
+               help='How many base images to checksum concurrently'),
+    cfg.IntOpt('checksum_bandwidth_limit_mb',
+               default=0,
+               help='Maximum combined read rate, in MB per second, used '
+                    'when checksumming base images (0 means unlimited)'),
+    cfg.IntOpt('checksum_pass_max_seconds',
+               default=600,
+               help='Maximum time a single background checksum pass runs '
+                    'for; unfinished checksums resume on the next pass '
+                    '(0 means unlimited)'),
     ]
 
 CONF = cfg.CONF
@@ -75,6 +90,10 @@ CONF.register_opts(imagecache_opts)
 CONF.import_opt('host', 'nova.netconf')
 CONF.import_opt('instances_path', 'nova.compute.manager')
 
+# Base images are read in large chunks on a native thread so the hash
+# runs without holding up the eventlet loop.
+CHECKSUM_CHUNK_SIZE = 4 * 1024 * 1024
+
 
 def get_info_filename(base_path):
     """Construct a filename for storing additional information about a base
@@ -210,9 +229,33 @@ def write_stored_checksum(target):
     write_stored_info(target, field='sha1', value=checksum)
 
 
+def _hash_chunk(img_file, checksum):
+    """Feed the next chunk of img_file to checksum.
+
+    Returns the number of bytes consumed, zero at the end of the file.
+    """
+    chunk = img_file.read(CHECKSUM_CHUNK_SIZE)
+    checksum.update(chunk)
+    return len(chunk)
+
+
 class ImageCacheManager(object):
     def __init__(self):
         self.lock_path = os.path.join(CONF.instances_path, 'locks')
+
+        # Partially computed checksums, carried over between passes. Maps a
+        # base file to ((size, mtime), offset, sha1 object).
+        self.checksum_progress = {}
+        self._checksum_deadline = None
+        self._throttle_next = 0
+
+        # Results of the background checksum pass, waiting for the next
+        # image cache pass. Maps a base file to what _verify_checksum
+        # returned for it.
+        self.checksum_results = {}
+        self._checksum_pass = None
+        self._checksumming = set()
+
         self._reset_state()
 
     def _reset_state(self):
@@ -351,6 +394,127 @@ class ImageCacheManager(object):
             if m:
                 yield img, False, True
 
+    def _throttle(self, nbytes):
+        """Sleep long enough to keep checksum reads under the bandwidth cap.
+
+        The budget is shared by all checksum workers: every chunk books the
+        next free slot of time, and the worker sleeps until its slot starts.
+        """
+        limit = CONF.checksum_bandwidth_limit_mb * 1024 * 1024
+        if limit <= 0:
+            # Give other threads a chance to run
+            time.sleep(0)
+            return
+
+        now = time.time()
+        start = max(self._throttle_next, now)
+        self._throttle_next = start + float(nbytes) / limit
+        time.sleep(start - now)
+
+    def _hash_base_file(self, base_file):
+        """Compute the sha1 of a base image.
+
+        Returns the checksum (as hex), or None if this pass ran out of time
+        first. In that case the partial hash is kept so the next pass carries
+        on from the same offset, unless the file has changed in between.
+        """
+        st = os.stat(base_file)
+        identity = (st.st_size, st.st_mtime)
+
+        progress = self.checksum_progress.pop(base_file, None)
+        if progress and progress[0] == identity:
+            offset, checksum = progress[1:]
+            LOG.debug(_('Resuming checksum of %(base_file)s at byte '
+                        '%(offset)d'),
+                      {'base_file': base_file,
+                       'offset': offset})
+        else:
+            offset, checksum = 0, hashlib.sha1()
+
+        with open(base_file, 'rb') as f:
+            f.seek(offset)
+            while True:
+                nbytes = tpool.execute(_hash_chunk, f, checksum)
+                if not nbytes:
+                    return checksum.hexdigest()
+                offset += nbytes
+                self._throttle(nbytes)
+
+                if (self._checksum_deadline and
+                    time.time() > self._checksum_deadline):
+                    LOG.info(_('Checksum of %(base_file)s paused at byte '
+                               '%(offset)d of %(size)d'),
+                             {'base_file': base_file,
+                              'offset': offset,
+                              'size': st.st_size})
+                    self.checksum_progress[base_file] = (identity, offset,
+                                                         checksum)
+                    return None
+
+    def _start_checksum_pass(self, base_images):
+        """Checksum a list of (image id, base file) pairs in the background.
+
+        The pass runs in a greenthread of its own, hashing several images
+        concurrently, and the image cache pass does not wait for it.
+        Results land in checksum_results, where _handle_base_image picks
+        them up on the next image cache pass. No new pass is started while
+        the last one is still running.
+        """
+        if not CONF.checksum_base_images:
+            return
+
+        if self._checksum_pass is not None:
+            LOG.debug(_('Previous checksum pass still running'))
+            return
+
+        # Forget partial checksums and results of images which have gone
+        # away
+        base_files = set(base_file for _img_id, base_file in base_images)
+        for state in (self.checksum_progress, self.checksum_results):
+            for base_file in state.keys():
+                if base_file not in base_files:
+                    del state[base_file]
+
+        base_images = [(img_id, base_file)
+                       for img_id, base_file in base_images
+                       if (base_file not in self.checksum_results and
+                           os.path.exists(base_file) and
+                           os.path.isfile(base_file))]
+        if not base_images:
+            return
+
+        if CONF.checksum_pass_max_seconds > 0:
+            self._checksum_deadline = (time.time() +
+                                       CONF.checksum_pass_max_seconds)
+        else:
+            self._checksum_deadline = None
+
+        self._checksumming = set(base_file
+                                 for _img_id, base_file in base_images)
+        self._checksum_pass = greenthread.spawn(self._run_checksum_pass,
+                                                base_images)
+
+    def _run_checksum_pass(self, base_images):
+        def verify(img_id, base_file):
+            try:
+                self.checksum_results[base_file] = self._verify_checksum(
+                    img_id, base_file)
+            except Exception:
+                LOG.exception(_('image %(id)s at (%(base_file)s): failed '
+                                'to checksum'),
+                              {'id': img_id,
+                               'base_file': base_file})
+            finally:
+                self._checksumming.discard(base_file)
+
+        try:
+            pool = greenpool.GreenPool(CONF.checksum_base_images_workers)
+            for img_id, base_file in base_images:
+                pool.spawn_n(verify, img_id, base_file)
+            pool.waitall()
+        finally:
+            self._checksum_pass = None
+
     def _verify_checksum(self, img_id, base_file, create_if_missing=True):
         """Compare the checksum stored on disk with the current file.
 
@@ -386,8 +550,9 @@ class ImageCacheManager(object):
                     write_stored_info(base_file, field='sha1',
                                       value=stored_checksum)
 
-                with open(base_file, 'r') as f:
-                    current_checksum = utils.hash_file(f)
+                current_checksum = self._hash_base_file(base_file)
+                if current_checksum is None:
+                    return None
 
                 if current_checksum != stored_checksum:
                     LOG.error(_('image %(id)s at (%(base_file)s): image '
@@ -412,7 +577,10 @@ class ImageCacheManager(object):
                     LOG.info(_('%(id)s (%(base_file)s): generating checksum'),
                              {'id': img_id,
                               'base_file': base_file})
-                    write_stored_checksum(base_file)
+                    checksum = self._hash_base_file(base_file)
+                    if checksum is not None:
+                        write_stored_info(base_file, field='sha1',
+                                          value=checksum)
 
                 return None
 
@@ -428,6 +596,11 @@ class ImageCacheManager(object):
                       base_file)
             return
 
+        if base_file in self._checksumming:
+            LOG.info(_('Base file is being checksummed, not removing it '
+                       'yet: %s'), base_file)
+            return
+
         mtime = os.path.getmtime(base_file)
         age = time.time() - mtime
 
@@ -467,8 +640,10 @@ class ImageCacheManager(object):
         if (base_file and os.path.exists(base_file)
             and os.path.isfile(base_file)):
             # _verify_checksum returns True if the checksum is ok, and None if
-            # there is no checksum file
-            checksum_result = self._verify_checksum(img_id, base_file)
+            # there is no checksum file. It runs in the background, so this
+            # is the result of the last checksum pass, if it got to the
+            # image.
+            checksum_result = self.checksum_results.pop(base_file, None)
             if checksum_result is not None:
                 image_bad = not checksum_result
 
@@ -545,11 +720,23 @@ class ImageCacheManager(object):
         self._list_running_instances(context, all_instances)
 
         # Determine what images are on disk because they're in use
+        fingerprints = {}
         for img in self.used_images:
             fingerprint = hashlib.sha1(img).hexdigest()
             LOG.debug(_('Image id %(id)s yields fingerprint %(fingerprint)s'),
                       {'id': img,
                        'fingerprint': fingerprint})
+            fingerprints[img] = fingerprint
+
+        # Checksum in the background so that the hashing of several images
+        # can overlap, without holding up this pass.
+        base_images = []
+        for img, fingerprint in fingerprints.iteritems():
+            for result in self._find_base_file(base_dir, fingerprint):
+                base_images.append((img, result[0]))
+        self._start_checksum_pass(base_images)
+
+        for img, fingerprint in fingerprints.iteritems():
             for result in self._find_base_file(base_dir, fingerprint):
                 base_file, image_small, image_resized = result
                 self._handle_base_image(img, base_file)
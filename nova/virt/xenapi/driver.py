@@ -48,6 +48,7 @@ from oslo.config import cfg
 
 from nova import context
 from nova import exception
+from nova.openstack.common import local
 from nova.openstack.common import log as logging
 from nova.virt import driver
 from nova.virt.xenapi import host
@@ -616,6 +617,7 @@ class XenAPISession(object):
         import XenAPI
         self.XenAPI = XenAPI
         self._sessions = queue.Queue()
+        self._snapshot = local.strong_store()
         self.is_slave = False
         exception = self.XenAPI.Failure(_("Unable to log in to XenAPI "
                                           "(is the Dom0 disk full?)"))
@@ -780,3 +782,58 @@ class XenAPISession(object):
             # been deleted between the get_all call and get_record call
             if rec:
                 yield ref, rec
+
+    def get_all_records_where(self, record_type, **fields):
+        """Return a dict of ref to record of the records of record_type
+        whose fields have the given values, in one call.
+
+        Within record_snapshot() all the records of a type are fetched once
+        and filtered here instead.
+        """
+        records = getattr(self._snapshot, 'records', None)
+        if records is None:
+            expr = ' and '.join('field "%s"="%s"' % (
+                                    _filter_field(field), _filter_value(value))
+                                for field, value in sorted(fields.items()))
+            return self.call_xenapi('%s.get_all_records_where' % record_type,
+                                    expr)
+
+        if record_type not in records:
+            records[record_type] = self.call_xenapi(
+                '%s.get_all_records' % record_type)
+        return dict((ref, rec)
+                    for ref, rec in records[record_type].iteritems()
+                    if all(rec.get(field) == value
+                           for field, value in fields.iteritems()))
+
+    @contextlib.contextmanager
+    def record_snapshot(self):
+        """Serve get_all_records_where from one snapshot of each record type
+        for the scope of the with statement, in this greenthread only.
+
+        Meant for periodic tasks that look at every VM, which can do with
+        records that are a few seconds old.
+        """
+        if getattr(self._snapshot, 'records', None) is not None:
+            # Already in a snapshot
+            yield
+            return
+        self._snapshot.records = {}
+        try:
+            yield
+        finally:
+            self._snapshot.records = None
+
+
+def _filter_field(field):
+    # Fields like name_label are name.label in the API, and name__label in
+    # filter expressions
+    if field.startswith('name_'):
+        return 'name__' + field[len('name_'):]
+    return field
+
+
+def _filter_value(value):
+    if isinstance(value, bool):
+        return str(value).lower()
+    return value
@@ -50,8 +50,10 @@
 A fake XenAPI SDK.
 """
 
+import collections
 import pickle
 import random
+import re
 import uuid
 from xml.sax import saxutils
 
@@ -68,6 +70,10 @@ _CLASSES = ['host', 'network', 'session', 'pool', 'SR', 'VBD',
 
 _db_content = {}
 
+_call_counts = collections.Counter()
+
+_FILTER_TERM = re.compile(r'^field "(\w+)"="([^"]*)"$')
+
 LOG = logging.getLogger(__name__)
 
 
@@ -80,6 +86,7 @@ def log_db_contents(msg=None):
 def reset():
     for c in _CLASSES:
         _db_content[c] = {}
+    reset_call_counts()
     host = create_host('fake')
     create_vm('fake',
               'Running',
@@ -88,6 +95,16 @@ def reset():
               resident_on=host)
 
 
+def reset_call_counts():
+    _call_counts.clear()
+
+
+def get_call_counts():
+    """Return how many times each XenAPI method has been called since the
+    last reset, not counting calls the fake makes itself."""
+    return _call_counts
+
+
 def reset_table(table):
     if table not in _CLASSES:
         return
@@ -201,6 +218,7 @@ def after_VBD_create(vbd_ref, vbd_rec):
     is created."""
     vbd_rec['currently_attached'] = False
     vbd_rec['device'] = ''
+    vbd_rec.setdefault('other_config', {})
 
     vm_ref = vbd_rec['VM']
     vm_rec = _db_content['VM'][vm_ref]
@@ -217,6 +235,7 @@ def after_VBD_create(vbd_ref, vbd_rec):
 def after_VM_create(vm_ref, vm_rec):
     """Create read-only fields in the VM record."""
     vm_rec.setdefault('is_control_domain', False)
+    vm_rec.setdefault('is_a_template', False)
     vm_rec.setdefault('memory_static_max', str(8 * 1024 * 1024 * 1024))
     vm_rec.setdefault('memory_dynamic_max', str(8 * 1024 * 1024 * 1024))
     vm_rec.setdefault('VCPUs_max', str(4))
@@ -347,6 +366,31 @@ def get_all_records(table):
     return _db_content[table]
 
 
+def get_all_records_where(table, expr):
+    """Supports filter expressions of terms like field "SR"="OpaqueRef:1"
+    joined by 'and'."""
+    terms = []
+    for term in expr.split(' and '):
+        match = _FILTER_TERM.match(term)
+        if not match:
+            raise NotImplementedError(
+                _('xenapi.fake does not support the filter %s') % expr)
+        field, value = match.groups()
+        terms.append((field.replace('__', '_'), value))
+
+    def _matches(rec):
+        for field, value in terms:
+            rec_value = rec.get(field)
+            if isinstance(rec_value, bool):
+                rec_value = str(rec_value).lower()
+            if rec_value != value:
+                return False
+        return True
+
+    return dict((ref, rec) for ref, rec in _db_content[table].iteritems()
+                if _matches(rec))
+
+
 def get_record(table, ref):
     if ref in _db_content[table]:
         return _db_content[table].get(ref)
@@ -568,7 +612,7 @@ class SessionBase(object):
 
     def _plugin_migration_transfer_vhd(self, method, args):
         kwargs = pickle.loads(args['params'])['kwargs']
-        vdi_ref = self.xenapi_request('VDI.get_by_uuid',
+        vdi_ref = self._xenapi_request('VDI.get_by_uuid',
                 (kwargs['vdi_uuid'], ))
         assert vdi_ref
         return pickle.dumps(None)
@@ -667,6 +711,10 @@ class SessionBase(object):
         return self.xenapi.network.get_all_records()
 
     def xenapi_request(self, methodname, params):
+        _call_counts[methodname] += 1
+        return self._xenapi_request(methodname, params)
+
+    def _xenapi_request(self, methodname, params):
         if methodname.startswith('login'):
             self._login(methodname, params)
             return None
@@ -761,6 +809,10 @@ class SessionBase(object):
             self._check_arg_count(params, 1)
             return get_all_records(cls)
 
+        if func == 'get_all_records_where':
+            self._check_arg_count(params, 2)
+            return get_all_records_where(cls, params[1])
+
         if func == 'get_record':
             self._check_arg_count(params, 2)
             return get_record(cls, params[1])
@@ -852,7 +904,7 @@ class SessionBase(object):
         task = _db_content['task'][task_ref]
         func = name[len('Async.'):]
         try:
-            result = self.xenapi_request(func, params[1:])
+            result = self._xenapi_request(func, params[1:])
             if result:
                 result = as_value(result)
             task['result'] = result
@@ -21,18 +21,24 @@ Helper methods for operations related to the management of VM records and
 their attributes like VDIs, VIFs, as well as their lookup functions.
 """
 
+import array
 import contextlib
 import decimal
+import errno
+import io
+import math
+import operator
 import os
 import re
+import stat
+import sys
 import time
 import urllib
 import urlparse
 import uuid
-from xml.dom import minidom
-from xml.parsers import expat
 
 from eventlet import greenthread
+from lxml import etree
 from oslo.config import cfg
 
 from nova.api.metadata import base as instance_metadata
@@ -141,6 +147,17 @@ SECTOR_SIZE = 512
 MBR_SIZE_SECTORS = 63
 MBR_SIZE_BYTES = MBR_SIZE_SECTORS * SECTOR_SIZE
 KERNEL_DIR = '/boot/guest'
+
+# Sparse copies read this much at a time and look for zeros in pieces of
+# SPARSE_COPY_BLOCK_SIZE within each read.
+SPARSE_COPY_BUFFER_SIZE = 4 * 1024 * 1024
+SPARSE_COPY_BLOCK_SIZE = 64 * 1024
+# Let other greenthreads run at least this often (in seconds) while copying
+SPARSE_COPY_YIELD_INTERVAL = 0.1
+# lseek() whence values for finding the holes in a sparse file; Linux only,
+# and not exposed by the os module on Python 2.
+SEEK_DATA = 3
+SEEK_HOLE = 4
 MAX_VDI_CHAIN_SIZE = 16
 
 
@@ -1344,34 +1361,31 @@ def set_vm_name_label(session, vm_ref, name_label):
 
 
 def list_vms(session):
-    for vm_ref, vm_rec in session.get_all_refs_and_recs('VM'):
-        if (vm_rec["resident_on"] != session.get_xenapi_host() or
-            vm_rec["is_a_template"] or vm_rec["is_control_domain"]):
-            continue
-        else:
-            yield vm_ref, vm_rec
+    vms = session.get_all_records_where('VM',
+                                        resident_on=session.get_xenapi_host(),
+                                        is_a_template=False,
+                                        is_control_domain=False)
+    return vms.iteritems()
 
 
 def lookup_vm_vdis(session, vm_ref):
     """Look for the VDIs that are attached to the VM."""
     # Firstly we get the VBDs, then the VDIs.
     # TODO(Armando): do we leave the read-only devices?
-    vbd_refs = session.call_xenapi("VM.get_VBDs", vm_ref)
+    vbd_recs = session.get_all_records_where('VBD', VM=vm_ref).values()
     vdi_refs = []
-    if vbd_refs:
-        for vbd_ref in vbd_refs:
-            try:
-                vdi_ref = session.call_xenapi("VBD.get_VDI", vbd_ref)
-                # Test valid VDI
-                record = session.call_xenapi("VDI.get_record", vdi_ref)
-                LOG.debug(_('VDI %s is still available'), record['uuid'])
-                vbd_other_config = session.call_xenapi("VBD.get_other_config",
-                                                       vbd_ref)
-                if not vbd_other_config.get('osvol'):
-                    # This is not an attached volume
-                    vdi_refs.append(vdi_ref)
-            except session.XenAPI.Failure, exc:
-                LOG.exception(exc)
+    for vbd_rec in vbd_recs:
+        if vbd_rec['other_config'].get('osvol'):
+            # This is an attached volume
+            continue
+        vdi_ref = vbd_rec['VDI']
+        try:
+            # Test valid VDI
+            record = session.call_xenapi("VDI.get_record", vdi_ref)
+            LOG.debug(_('VDI %s is still available'), record['uuid'])
+            vdi_refs.append(vdi_ref)
+        except session.XenAPI.Failure, exc:
+            LOG.exception(exc)
     return vdi_refs
 
 
@@ -1387,6 +1401,17 @@ def lookup(session, name_label):
         return vm_refs[0]
 
 
+def lookup_rec(session, name_label):
+    """Look the instance up and return its ref and record, or None if it is
+    not available, in one call.
+    """
+    vms = session.get_all_records_where('VM', name_label=name_label)
+    if len(vms) > 1:
+        raise exception.InstanceExists(name=name_label)
+    for vm_ref, vm_rec in vms.iteritems():
+        return vm_ref, vm_rec
+
+
 def preconfigure_instance(session, instance, vdi_ref, network_info):
     """Makes alterations to the image before launching as part of spawn.
     """
@@ -1437,29 +1462,32 @@ def compile_diagnostics(record):
         vm_uuid = record["uuid"]
         xml = _get_rrd(_get_rrd_server(), vm_uuid)
         if xml:
-            rrd = minidom.parseString(xml)
-            for i, node in enumerate(rrd.firstChild.childNodes):
+            last_row = None
+            for _event, node in etree.iterparse(io.BytesIO(xml)):
+                parent = node.getparent()
                 # Provide the last update of the information
-                if node.localName == 'lastupdate':
-                    diags['last_update'] = node.firstChild.data
+                if node.tag == 'lastupdate' and parent.tag == 'rrd':
+                    diags['last_update'] = node.text
 
                 # Create a list of the diagnostic keys (in their order)
-                if node.localName == 'ds':
-                    ref = node.childNodes
+                elif node.tag == 'ds' and parent.tag == 'rrd':
                     # Name and Value
-                    if len(ref) > 6:
-                        keys.append(ref[0].firstChild.data)
+                    if len(node) > 6:
+                        keys.append(node[0].text)
+
+                elif node.tag == 'row':
+                    if last_row is not None:
+                        last_row.clear()
+                    last_row = node
 
                 # Read the last row of the first RRA to get the latest info
-                if node.localName == 'rra':
-                    rows = node.childNodes[4].childNodes
-                    last_row = rows[rows.length - 1].childNodes
+                elif node.tag == 'rra':
                     for j, value in enumerate(last_row):
-                        diags[keys[j]] = value.firstChild.data
+                        diags[keys[j]] = value.text
                     break
 
         return diags
-    except expat.ExpatError as e:
+    except etree.XMLSyntaxError as e:
         LOG.exception(_('Unable to parse rrd of %(vm_uuid)s') % locals())
         return {"Unable to retrieve diagnostics": e}
 
@@ -1478,8 +1506,7 @@ def compile_metrics(start_time, stop_time=None):
 
     xml = _get_rrd_updates(_get_rrd_server(), start_time)
     if xml:
-        doc = minidom.parseString(xml)
-        return _parse_rrd_update(doc, start_time, stop_time)
+        return _parse_rrd_update(xml, start_time, stop_time)
 
     raise exception.CouldNotFetchMetrics()
 
@@ -1620,94 +1647,118 @@ def _get_rrd_updates(server, start_time):
         return None
 
 
-def _parse_rrd_meta(doc):
-    data = {}
-    meta = doc.getElementsByTagName('meta')[0]
-    for tag in ('start', 'end', 'step'):
-        data[tag] = int(meta.getElementsByTagName(tag)[0].firstChild.data)
-    legend = meta.getElementsByTagName('legend')[0]
-    data['legend'] = [child.firstChild.data for child in legend.childNodes]
-    return data
+def _rrd_float(text):
+    try:
+        return float(text)
+    except (TypeError, ValueError):
+        # (mdragon) Xenserver occasionally returns odd values in the data
+        # (see bug 918490). Treat them as missing, so we don't break
+        # reporting of other statistics.
+        LOG.error(_("Invalid statistics data from Xenserver: %s") % text)
+        return float('nan')
 
 
-def _parse_rrd_data(doc):
-    dnode = doc.getElementsByTagName('data')[0]
-    return [dict(
-            time=int(child.getElementsByTagName('t')[0].firstChild.data),
-            values=[decimal.Decimal(valnode.firstChild.data)
-                  for valnode in child.getElementsByTagName('v')])
-            for child in dnode.childNodes]
+def _parse_rrd_columns(xml):
+    """Stream the rows of rrd_updates XML into one array per column.
 
+    Returns the legend, the sample times and the columns, with the rows in
+    the order XenServer sent them (newest first).
+    """
+    legend = []
+    times = array.array('l')
+    columns = None
+    for _event, node in etree.iterparse(io.BytesIO(xml)):
+        if node.tag == 'entry':
+            legend.append(node.text)
+        elif node.tag == 'row':
+            if columns is None:
+                columns = [array.array('d') for entry in legend]
+            values = iter(node)
+            times.append(int(next(values).text))
+            for column, value in zip(columns, values):
+                column.append(_rrd_float(value.text))
+            node.clear()
+    return legend, times, columns or [array.array('d') for entry in legend]
+
+
+def _parse_rrd_update(xml, start, until=None):
+    legend, times, columns = _parse_rrd_columns(xml)
+    if until:
+        rows = [i for i, t in enumerate(times) if t <= until]
+        if len(rows) < len(times):
+            times = [times[i] for i in rows]
+            columns = [[column[i] for i in rows] for column in columns]
+    weights = _integration_weights(times, start)
 
-def _parse_rrd_update(doc, start, until=None):
     sum_data = {}
-    meta = _parse_rrd_meta(doc)
-    data = _parse_rrd_data(doc)
-    for col, collabel in enumerate(meta['legend']):
+    for collabel, column in zip(legend, columns):
         _datatype, _objtype, uuid, name = collabel.split(':')
-        vm_data = sum_data.get(uuid, dict())
+        vm_data = sum_data.setdefault(uuid, {})
         if name.startswith('vif'):
-            vm_data[name] = _integrate_series(data, col, start, until)
+            vm_data[name] = _integrate_series(column, weights)
         else:
-            vm_data[name] = _average_series(data, col, until)
-        sum_data[uuid] = vm_data
+            vm_data[name] = _average_series(column)
     return sum_data
 
 
-def _average_series(data, col, until=None):
-    vals = [row['values'][col] for row in data
-            if (not until or (row['time'] <= until)) and
-                row['values'][col].is_finite()]
-    if vals:
-        try:
-            return (sum(vals) / len(vals)).quantize(decimal.Decimal('1.0000'))
-        except decimal.InvalidOperation:
-            # (mdragon) Xenserver occasionally returns odd values in
-            # data that will throw an error on averaging (see bug 918490)
-            # These are hard to find, since, whatever those values are,
-            # Decimal seems to think they are a valid number, sortof.
-            # We *think* we've got the the cases covered, but just in
-            # case, log and return NaN, so we don't break reporting of
-            # other statistics.
-            LOG.error(_("Invalid statistics data from Xenserver: %s")
-                      % str(vals))
-            return decimal.Decimal('NaN')
-    else:
-        return decimal.Decimal('0.0000')
+def _rrd_decimal(value):
+    # Round off the float error first, so halves round as they used to
+    value = decimal.Decimal('%.6f' % value)
+    if value.is_finite():
+        value = value.quantize(decimal.Decimal('1.0000'))
+    return value
 
 
-def _integrate_series(data, col, start, until=None):
-    total = decimal.Decimal('0.0000')
+def _is_finite(value):
+    return not (math.isinf(value) or math.isnan(value))
+
+
+def _integration_weights(times, start):
+    """Return the weights that integrate a series sampled at times (newest
+    first) from start with the trapezoid rule, as a dot product with the
+    series. The first sample is taken to hold back to start.
+    """
+    weights = array.array('d', [0.0]) * len(times)
     prev_time = int(start)
-    prev_val = None
-    for row in reversed(data):
-        if not until or (row['time'] <= until):
-            time = row['time']
-            val = row['values'][col]
-            if val.is_nan():
-                val = decimal.Decimal('0.0000')
-            if prev_val is None:
-                prev_val = val
-            if prev_val >= val:
-                total += ((val * (time - prev_time)) +
-                          (decimal.Decimal('0.5000') * (prev_val - val) *
-                          (time - prev_time)))
-            else:
-                total += ((prev_val * (time - prev_time)) +
-                          (decimal.Decimal('0.5000') * (val - prev_val) *
-                          (time - prev_time)))
-            prev_time = time
-            prev_val = val
-    return total.quantize(decimal.Decimal('1.0000'))
+    prev = None
+    for i in reversed(xrange(len(times))):
+        half_step = 0.5 * (times[i] - prev_time)
+        weights[i] += half_step
+        weights[i if prev is None else prev] += half_step
+        prev_time = times[i]
+        prev = i
+    return weights
+
+
+def _average_series(values):
+    """Return the mean of the finite values, 0 if there are none."""
+    try:
+        total = math.fsum(values)
+    except ValueError:
+        # Both +Infinity and -Infinity are in there
+        total = float('nan')
+    if not _is_finite(total):
+        values = [value for value in values if _is_finite(value)]
+        total = math.fsum(values)
+    if not values:
+        return decimal.Decimal('0.0000')
+    return _rrd_decimal(total / len(values))
+
+
+def _integrate_series(values, weights):
+    """Integrate values with weights from _integration_weights, counting
+    missing (NaN) values as 0.
+    """
+    total = math.fsum(map(operator.mul, weights, values))
+    if math.isnan(total):
+        total = math.fsum(weight * value
+                          for weight, value in zip(weights, values)
+                          if not math.isnan(value))
+    return _rrd_decimal(total)
 
 
 def _get_all_vdis_in_sr(session, sr_ref):
-    for vdi_ref in session.call_xenapi('SR.get_VDIs', sr_ref):
-        try:
-            vdi_rec = session.call_xenapi('VDI.get_record', vdi_ref)
-            yield vdi_ref, vdi_rec
-        except session.XenAPI.Failure:
-            continue
+    return session.get_all_records_where('VDI', SR=sr_ref).iteritems()
 
 
 def get_instance_vdis_for_sr(session, vm_ref, sr_ref):
@@ -2047,13 +2098,70 @@ def _resize_part_and_fs(dev, start, old_sectors, new_sectors):
     utils.execute('tune2fs', '-j', partition_path, run_as_root=True)
 
 
-def _sparse_copy(src_path, dst_path, virtual_size, block_size=4096):
-    """Copy data, skipping long runs of zeros to create a sparse file."""
+def _find_data(fd, offset, end):
+    """Find the next run of data at or after offset in a sparse file.
+
+    Returns a (start, end) tuple clamped to end, or None if the file cannot
+    tell its holes apart from its data.
+    """
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        data_start = os.lseek(fd, offset, SEEK_DATA)
+    except OSError as e:
+        if e.errno == errno.ENXIO:
+            # Nothing but holes up to the end of the file
+            return end, end
+        return None
+    data_end = os.lseek(fd, data_start, SEEK_HOLE)
+    return min(data_start, end), min(data_end, end)
+
+
+def _write_nonzero_blocks(dst, offset, view, zeros, length, block_size):
+    """Write the blocks of view[:length] which are not all zeros to dst,
+    starting at offset. Adjacent blocks are written together.
+
+    Returns the number of bytes skipped.
+    """
+    if view[:length] == zeros[:length]:
+        return length
+
+    skipped = 0
+    run_start = None
+    for pos in xrange(0, length, block_size):
+        end = min(pos + block_size, length)
+        if view[pos:end] == zeros[:end - pos]:
+            if run_start is not None:
+                dst.seek(offset + run_start)
+                dst.write(view[run_start:pos])
+                run_start = None
+            skipped += end - pos
+        elif run_start is None:
+            run_start = pos
+
+    if run_start is not None:
+        dst.seek(offset + run_start)
+        dst.write(view[run_start:length])
+    return skipped
+
+
+def _sparse_copy(src_path, dst_path, virtual_size,
+                 block_size=SPARSE_COPY_BLOCK_SIZE):
+    """Copy data, skipping long runs of zeros to create a sparse file.
+
+    The source is read in large chunks; zero blocks are compared against a
+    preallocated buffer and seeked over in the destination. Where the
+    source can report its holes (SEEK_DATA/SEEK_HOLE) they are not read at
+    all.
+    """
     start_time = time.time()
-    EMPTY_BLOCK = '\0' * block_size
+    buffer_size = max(block_size,
+                      SPARSE_COPY_BUFFER_SIZE -
+                      SPARSE_COPY_BUFFER_SIZE % block_size)
+    view = memoryview(bytearray(buffer_size))
+    zeros = memoryview(bytearray(buffer_size))
     bytes_read = 0
     skipped_bytes = 0
-    left = virtual_size
 
     LOG.debug(_("Starting sparse_copy src=%(src_path)s dst=%(dst_path)s "
                 "virtual_size=%(virtual_size)d block_size=%(block_size)d"),
@@ -2064,32 +2172,53 @@ def _sparse_copy(src_path, dst_path, virtual_size, block_size=4096):
     # ownership of the devices.
     with utils.temporary_chown(src_path):
         with utils.temporary_chown(dst_path):
-            with open(src_path, "r") as src:
-                with open(dst_path, "w") as dst:
-                    data = src.read(min(block_size, left))
-                    while data:
-                        if data == EMPTY_BLOCK:
-                            dst.seek(block_size, os.SEEK_CUR)
-                            left -= block_size
-                            bytes_read += block_size
-                            skipped_bytes += block_size
-                        else:
-                            dst.write(data)
-                            data_len = len(data)
-                            left -= data_len
-                            bytes_read += data_len
-
-                        if left <= 0:
+            with io.open(src_path, "rb", buffering=0) as src:
+                with io.open(dst_path, "wb") as dst:
+                    offset = 0
+                    data_end = 0
+                    find_holes = True
+                    last_yield = start_time
+                    while offset < virtual_size:
+                        if offset >= data_end:
+                            extent = None
+                            if find_holes:
+                                extent = _find_data(src.fileno(), offset,
+                                                    virtual_size)
+                            if extent is None:
+                                find_holes = False
+                                data_end = virtual_size
+                            else:
+                                data_start, data_end = extent
+                                skipped_bytes += data_start - offset
+                                offset = data_start
+                                if offset >= virtual_size:
+                                    break
+
+                        src.seek(offset)
+                        length = src.readinto(
+                            view[:min(buffer_size, data_end - offset)])
+                        if not length:
                             break
+                        skipped_bytes += _write_nonzero_blocks(
+                            dst, offset, view, zeros, length, block_size)
+                        offset += length
+                        bytes_read += length
+
+                        now = time.time()
+                        if now - last_yield >= SPARSE_COPY_YIELD_INTERVAL:
+                            greenthread.sleep(0)
+                            last_yield = now
 
-                        data = src.read(min(block_size, left))
-                        greenthread.sleep(0)
+                    # Holes at the end leave a regular file short
+                    if stat.S_ISREG(os.fstat(dst.fileno()).st_mode):
+                        dst.truncate(offset)
 
     duration = time.time() - start_time
-    compression_pct = float(skipped_bytes) / bytes_read * 100
+    compression_pct = float(skipped_bytes) / max(offset, 1) * 100
 
     LOG.debug(_("Finished sparse_copy in %(duration).2f secs, "
-                "%(compression_pct).2f%% reduction in size"), locals())
+                "%(compression_pct).2f%% reduction in size, "
+                "%(bytes_read)d bytes read"), locals())
 
 
 def _copy_partition(session, src_ref, dst_ref, partition, virtual_size):
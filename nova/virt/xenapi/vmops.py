@@ -1269,8 +1269,15 @@ class VMOps(object):
 
     def get_info(self, instance, vm_ref=None):
         """Return data about VM instance."""
-        vm_ref = vm_ref or self._get_vm_opaque_ref(instance)
-        vm_rec = self._session.call_xenapi("VM.get_record", vm_ref)
+        if vm_ref:
+            vm_rec = self._session.call_xenapi("VM.get_record", vm_ref)
+            return vm_utils.compile_info(vm_rec)
+
+        vm = vm_utils.lookup_rec(self._session, instance['name'])
+        if vm is None:
+            raise exception.NotFound(_('Could not find VM with name %s') %
+                                     instance['name'])
+        vm_ref, vm_rec = vm
         return vm_utils.compile_info(vm_rec)
 
     def get_diagnostics(self, instance):
@@ -1279,10 +1286,10 @@ class VMOps(object):
         vm_rec = self._session.call_xenapi("VM.get_record", vm_ref)
         return vm_utils.compile_diagnostics(vm_rec)
 
-    def _get_vif_device_map(self, vm_rec):
+    def _get_vif_device_map(self, vm_ref):
         vif_map = {}
-        for vif in [self._session.call_xenapi("VIF.get_record", vrec)
-                    for vrec in vm_rec['VIFs']]:
+        vifs = self._session.get_all_records_where('VIF', VM=vm_ref)
+        for vif in vifs.itervalues():
             vif_map[vif['device']] = vif['MAC']
         return vif_map
 
@@ -1291,19 +1298,20 @@ class VMOps(object):
            running VM"""
         counters = vm_utils.fetch_bandwidth(self._session)
         bw = {}
-        for vm_ref, vm_rec in vm_utils.list_vms(self._session):
-            vif_map = self._get_vif_device_map(vm_rec)
-            name = vm_rec['name_label']
-            if 'nova_uuid' not in vm_rec['other_config']:
-                continue
-            dom = vm_rec.get('domid')
-            if dom is None or dom not in counters:
-                continue
-            vifs_bw = bw.setdefault(name, {})
-            for vif_num, vif_data in counters[dom].iteritems():
-                mac = vif_map[vif_num]
-                vif_data['mac_address'] = mac
-                vifs_bw[mac] = vif_data
+        with self._session.record_snapshot():
+            for vm_ref, vm_rec in vm_utils.list_vms(self._session):
+                vif_map = self._get_vif_device_map(vm_ref)
+                name = vm_rec['name_label']
+                if 'nova_uuid' not in vm_rec['other_config']:
+                    continue
+                dom = vm_rec.get('domid')
+                if dom is None or dom not in counters:
+                    continue
+                vifs_bw = bw.setdefault(name, {})
+                for vif_num, vif_data in counters[dom].iteritems():
+                    mac = vif_map[vif_num]
+                    vif_data['mac_address'] = mac
+                    vifs_bw[mac] = vif_data
         return bw
 
     def get_console_output(self, instance):
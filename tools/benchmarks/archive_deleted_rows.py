@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Time archiving soft-deleted rows into the shadow tables.
+
+Fills instance_system_metadata in a scratch sqlite database with --rows
+rows, every --deleted-every'th of them soft-deleted, then archives them
+--max-rows at a time until none are left, both the way
+archive_deleted_rows_for_table used to (selecting the rows into Python,
+inserting them and deleting them by key) and with INSERT ... SELECT and a
+keyed DELETE. Each runs against its own copy of the database.
+
+    python tools/benchmarks/archive_deleted_rows.py --rows 1000000
+"""
+
+import argparse
+import gettext
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from oslo.config import cfg
+from sqlalchemy import MetaData
+from sqlalchemy.schema import Table
+from sqlalchemy.sql.expression import select
+
+POSSIBLE_TOPDIR = os.path.normpath(os.path.join(os.path.abspath(__file__),
+                                                os.pardir, os.pardir,
+                                                os.pardir))
+sys.path.insert(0, POSSIBLE_TOPDIR)
+
+gettext.install('nova', unicode=1)
+
+from nova import config
+from nova import context
+from nova.db.sqlalchemy import api as db_api
+from nova.db.sqlalchemy import migration
+from nova.openstack.common.db.sqlalchemy import session as db_session
+
+CONF = cfg.CONF
+
+TABLE = 'instance_system_metadata'
+
+
+def legacy_archive(engine, tablename, max_rows):
+    """The archive_deleted_rows_for_table used before, kept for
+    comparison.
+    """
+    conn = engine.connect()
+    metadata = MetaData()
+    metadata.bind = engine
+    table = Table(tablename, metadata, autoload=True)
+    shadow_table = Table('shadow_' + tablename, metadata, autoload=True)
+    rows_archived = 0
+    with conn.begin():
+        column = table.c.id
+        query = select([table], table.c.deleted != 0).\
+                order_by(column).limit(max_rows)
+        rows = conn.execute(query).fetchall()
+        if rows:
+            conn.execute(shadow_table.insert(), rows)
+            keys = [row.id for row in rows]
+            result = conn.execute(table.delete(column.in_(keys)))
+            rows_archived = result.rowcount
+    return rows_archived
+
+
+def fill(engine, rows, deleted_every):
+    metadata = MetaData()
+    metadata.bind = engine
+    table = Table(TABLE, metadata, autoload=True)
+    batch = []
+    for i in xrange(rows):
+        batch.append({'instance_uuid': 'instance-%08d' % (i / 10),
+                      'key': 'key%d' % (i % 10),
+                      'value': 'value %d' % i,
+                      'deleted': (i % deleted_every == 0) and i + 1 or 0})
+        if len(batch) == 10000:
+            engine.execute(table.insert(), batch)
+            batch = []
+    if batch:
+        engine.execute(table.insert(), batch)
+
+
+def run(archive, max_rows):
+    start = time.time()
+    batches = total = 0
+    archived = archive(max_rows)
+    while archived:
+        batches += 1
+        total += archived
+        archived = archive(max_rows)
+    return time.time() - start, batches, total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--rows', type=int, default=1000000,
+                        help='number of rows in the table')
+    parser.add_argument('--deleted-every', type=int, default=2,
+                        help='soft-delete one row in this many')
+    parser.add_argument('--max-rows', type=int, default=5000,
+                        help='rows archived by each call')
+    parser.add_argument('--dir', default=None,
+                        help='directory for the scratch databases')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(dir=args.dir)
+    try:
+        db_path = os.path.join(workdir, 'nova.db')
+        legacy_db_path = os.path.join(workdir, 'legacy.db')
+        config.parse_args([])
+        CONF.set_override('sql_connection', 'sqlite:///%s' % db_path)
+        migration.db_sync()
+        fill(db_session.get_engine(), args.rows, args.deleted_every)
+        shutil.copyfile(db_path, legacy_db_path)
+        legacy_engine = db_session.create_engine('sqlite:///%s' %
+                                                 legacy_db_path)
+
+        ctxt = context.get_admin_context()
+        print '%-14s %10s %10s %10s %12s' % ('archive', 'seconds', 'batches',
+                                             'rows', 'rows/s')
+        for name, archive in (
+                ('legacy', lambda max_rows: legacy_archive(
+                    legacy_engine, TABLE, max_rows)),
+                ('insert-select', lambda max_rows:
+                    db_api.archive_deleted_rows_for_table(ctxt, TABLE,
+                                                          max_rows))):
+            elapsed, batches, total = run(archive, args.max_rows)
+            print '%-14s %10.2f %10d %10d %12.0f' % (name, elapsed, batches,
+                                                     total, total / elapsed)
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
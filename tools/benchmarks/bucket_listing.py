@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Time listing a page of a big bucket in nova-objectstore.
+
+Fills a scratch bucket with --objects empty objects, then times GETs of the
+bucket with prefix, marker and max-keys set, both walking the bucket on
+every request as the server used to and reading the bucket index.
+
+    python tools/benchmarks/bucket_listing.py --objects 100000
+"""
+
+import argparse
+import bisect
+import datetime
+import gettext
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+POSSIBLE_TOPDIR = os.path.normpath(os.path.join(os.path.abspath(__file__),
+                                                os.pardir, os.pardir,
+                                                os.pardir))
+sys.path.insert(0, POSSIBLE_TOPDIR)
+
+gettext.install('nova', unicode=1)
+
+import webob
+
+from nova.objectstore import s3server
+
+
+class LegacyBucketHandler(s3server.BucketHandler):
+    """The bucket listing used before, kept for comparison."""
+
+    def get(self, bucket_name):
+        prefix = self.get_argument("prefix", u"")
+        marker = self.get_argument("marker", u"")
+        max_keys = int(self.get_argument("max-keys", 50000))
+        path = os.path.abspath(os.path.join(self.application.directory,
+                                            bucket_name))
+        terse = int(self.get_argument("terse", 0))
+        object_names = []
+        for root, dirs, files in os.walk(path):
+            for file_name in files:
+                object_names.append(os.path.join(root, file_name))
+        skip = len(path) + 1
+        for i in range(self.application.bucket_depth):
+            skip += 2 * (i + 1) + 1
+        object_names = [n[skip:] for n in object_names]
+        object_names.sort()
+        contents = []
+
+        start_pos = 0
+        if marker:
+            start_pos = bisect.bisect_right(object_names, marker, start_pos)
+        if prefix:
+            start_pos = bisect.bisect_left(object_names, prefix, start_pos)
+
+        truncated = False
+        for object_name in object_names[start_pos:]:
+            if not object_name.startswith(prefix):
+                break
+            if len(contents) >= max_keys:
+                truncated = True
+                break
+            object_path = self._object_path(bucket_name, object_name)
+            c = {"Key": object_name}
+            if not terse:
+                info = os.stat(object_path)
+                c.update({
+                    "LastModified": datetime.datetime.utcfromtimestamp(
+                        info.st_mtime),
+                    "Size": info.st_size,
+                })
+            contents.append(c)
+            marker = object_name
+        self.render_xml({"ListBucketResult": {
+            "Name": bucket_name,
+            "Prefix": prefix,
+            "Marker": marker,
+            "MaxKeys": max_keys,
+            "IsTruncated": truncated,
+            "Contents": contents,
+        }})
+
+
+def list_bucket(application, query):
+    request = webob.Request.blank('/bench/?' + query)
+    response = request.get_response(application)
+    assert response.status_int == 200, response.status
+    return response.body
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--objects', type=int, default=100000,
+                        help='number of objects in the bucket')
+    parser.add_argument('--requests', type=int, default=10,
+                        help='number of listings to time for each handler')
+    parser.add_argument('--dir', default=None,
+                        help='directory for the buckets')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(dir=args.dir)
+    try:
+        bucket = os.path.join(workdir, 'bench')
+        os.mkdir(bucket)
+        for i in xrange(args.objects):
+            open(os.path.join(bucket, 'object-%08d' % i), 'w').close()
+        application = s3server.S3Application(workdir)
+
+        queries = ['prefix=object-%05d&max-keys=100' % (i * 7 % 1000)
+                   for i in xrange(args.requests)]
+        queries += ['marker=object-%08d&max-keys=100' %
+                    (i * 7919 % args.objects)
+                    for i in xrange(args.requests)]
+
+        print '%-10s %12s %12s' % ('listing', 'first (s)', 'requests/s')
+        results = {}
+        for name, handler in (('walk', LegacyBucketHandler),
+                              ('index', s3server.BucketHandler)):
+            # S3Application routes to whatever BucketHandler is when the
+            # request comes in
+            s3server.BucketHandler = handler
+            start = time.time()
+            list_bucket(application, queries[0])
+            first = time.time() - start
+            start = time.time()
+            results[name] = [list_bucket(application, query)
+                             for query in queries]
+            elapsed = time.time() - start
+            print '%-10s %12.3f %12.1f' % (name, first,
+                                           len(queries) / elapsed)
+        assert results['walk'] == results['index']
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Time the cell capacity computation done on every cell DB sync.
+
+Computes the capacities of --hosts compute nodes for --flavors instance
+types with the host by flavor loop the cells state manager used before, and
+with CellStateManager._update_our_capacity on its first sync and on syncs
+where --changed of the hosts have different free space.
+
+    python tools/benchmarks/cell_capacity.py --hosts 5000 --flavors 200
+"""
+
+import argparse
+import gettext
+import os
+import random
+import sys
+import time
+
+from oslo.config import cfg
+
+POSSIBLE_TOPDIR = os.path.normpath(os.path.join(os.path.abspath(__file__),
+                                                os.pardir, os.pardir,
+                                                os.pardir))
+sys.path.insert(0, POSSIBLE_TOPDIR)
+
+gettext.install('nova', unicode=1)
+
+from nova.cells import state
+from nova import config
+from nova import context
+
+CONF = cfg.CONF
+
+
+def legacy_capacities(compute_nodes, instance_types):
+    """The loop _update_our_capacity used before, kept for comparison."""
+    ram_mb_free_units = {}
+    disk_mb_free_units = {}
+    total_ram_mb_free = 0
+    total_disk_mb_free = 0
+    for compute in compute_nodes:
+        free_ram_mb = compute['free_ram_mb']
+        free_disk_mb = compute['free_disk_gb'] * 1024
+        total_ram_mb_free += free_ram_mb
+        total_disk_mb_free += free_disk_mb
+        for instance_type in instance_types:
+            memory_mb = instance_type['memory_mb']
+            disk_mb = (instance_type['root_gb'] +
+                       instance_type['ephemeral_gb']) * 1024
+            ram_mb_free_units.setdefault(str(memory_mb), 0)
+            disk_mb_free_units.setdefault(str(disk_mb), 0)
+            ram_mb_free_units[str(memory_mb)] += max(0, int(free_ram_mb /
+                                                            memory_mb))
+            disk_mb_free_units[str(disk_mb)] += max(0, int(free_disk_mb /
+                                                           disk_mb))
+    return {'ram_free': {'total_mb': total_ram_mb_free,
+                         'units_by_mb': ram_mb_free_units},
+            'disk_free': {'total_mb': total_disk_mb_free,
+                          'units_by_mb': disk_mb_free_units}}
+
+
+class FakeDB(object):
+    def __init__(self, compute_nodes, instance_types):
+        self.compute_nodes = compute_nodes
+        self.instance_types = instance_types
+
+    def compute_node_get_all(self, ctxt):
+        return self.compute_nodes
+
+    def instance_type_get_all(self, ctxt):
+        return self.instance_types
+
+
+class BenchCellStateManager(state.CellStateManager):
+    """Never syncs from the DB by itself, so no DB is needed."""
+    def _time_to_sync(self):
+        return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--hosts', type=int, default=5000,
+                        help='number of compute nodes')
+    parser.add_argument('--flavors', type=int, default=200,
+                        help='number of instance types')
+    parser.add_argument('--changed', type=float, default=0.01,
+                        help='fraction of hosts changed between syncs')
+    parser.add_argument('--syncs', type=int, default=10,
+                        help='number of syncs to time')
+    args = parser.parse_args()
+
+    config.parse_args([])
+    rand = random.Random(0)
+    instance_types = [dict(memory_mb=rand.choice([512, 1024, 2048, 4096,
+                                                  8192, 16384, 32768]),
+                           root_gb=rand.choice([10, 20, 40, 80, 160]),
+                           ephemeral_gb=rand.choice([0, 10, 100, 500]))
+                      for i in xrange(args.flavors)]
+    compute_nodes = [dict(free_ram_mb=rand.randint(0, 256) * 512,
+                          free_disk_gb=rand.randint(0, 2000),
+                          service=dict(host='host%d' % i, disabled=False))
+                     for i in xrange(args.hosts)]
+
+    manager = BenchCellStateManager()
+    manager.db = FakeDB(compute_nodes, instance_types)
+    ctxt = context.get_admin_context()
+
+    start = time.time()
+    expected = legacy_capacities(compute_nodes, instance_types)
+    print 'legacy loop:     %8.3fs' % (time.time() - start)
+
+    start = time.time()
+    manager._update_our_capacity(ctxt)
+    print 'first sync:      %8.3fs' % (time.time() - start)
+    assert manager.my_cell_state.capacities == expected
+
+    elapsed = 0
+    for i in xrange(args.syncs):
+        for compute in rand.sample(compute_nodes,
+                                   int(args.hosts * args.changed)):
+            compute['free_ram_mb'] = rand.randint(0, 256) * 512
+            compute['free_disk_gb'] = rand.randint(0, 2000)
+        start = time.time()
+        manager._update_our_capacity(ctxt)
+        elapsed += time.time() - start
+    print 'later syncs:     %8.3fs each' % (elapsed / args.syncs)
+    assert (manager.my_cell_state.capacities ==
+            legacy_capacities(compute_nodes, instance_types))
+
+
+if __name__ == '__main__':
+    main()
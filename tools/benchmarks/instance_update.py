@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Time task state transitions on instances.
+
+Runs --greenthreads greenthreads that each flip the task state of their own
+instance back and forth with expected_task_state, --updates times, first
+with instance_update (which loads and writes back the whole instance) and
+then with instance_update_lean (one conditional UPDATE), against a scratch
+sqlite database.
+
+    python tools/benchmarks/instance_update.py --greenthreads 20
+"""
+
+import argparse
+import gettext
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import eventlet
+from oslo.config import cfg
+
+POSSIBLE_TOPDIR = os.path.normpath(os.path.join(os.path.abspath(__file__),
+                                                os.pardir, os.pardir,
+                                                os.pardir))
+sys.path.insert(0, POSSIBLE_TOPDIR)
+
+gettext.install('nova', unicode=1)
+
+from nova.compute import task_states
+from nova import config
+from nova import context
+from nova.db.sqlalchemy import api as db_api
+from nova.db.sqlalchemy import models
+from nova.openstack.common.db.sqlalchemy import session as db_session
+
+CONF = cfg.CONF
+
+
+def flip_task_state(update, ctxt, instance_uuid, updates):
+    for i in xrange(updates):
+        update(ctxt, instance_uuid,
+               {'task_state': task_states.REBOOTING,
+                'expected_task_state': None})
+        update(ctxt, instance_uuid,
+               {'task_state': None,
+                'expected_task_state': task_states.REBOOTING})
+
+
+def run(update, ctxt, instance_uuids, updates):
+    pool = eventlet.GreenPool(len(instance_uuids))
+    start = time.time()
+    for instance_uuid in instance_uuids:
+        pool.spawn_n(flip_task_state, update, ctxt, instance_uuid, updates)
+    pool.waitall()
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--greenthreads', type=int, default=20,
+                        help='number of greenthreads, one per instance')
+    parser.add_argument('--updates', type=int, default=50,
+                        help='transitions made by each greenthread')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    try:
+        config.parse_args([])
+        CONF.set_override('sql_connection',
+                          'sqlite:///%s' % os.path.join(workdir, 'nova.db'))
+        models.BASE.metadata.create_all(db_session.get_engine())
+
+        ctxt = context.get_admin_context()
+        flavor = db_api.instance_type_create(ctxt, dict(name='bench',
+                memory_mb=512, vcpus=1, root_gb=10, ephemeral_gb=0,
+                flavorid='b', swap=0))
+        instance_uuids = [db_api.instance_create(ctxt, dict(
+                              instance_type_id=flavor['id'],
+                              project_id='bench', user_id='bench',
+                              system_metadata=dict(('key%d' % n, 'value')
+                                                   for n in xrange(10)),
+                              metadata={'role': 'bench'}))['uuid']
+                          for i in xrange(args.greenthreads)]
+
+        total = args.greenthreads * args.updates * 2
+        print '%-22s %10s %12s' % ('update', 'seconds', 'updates/s')
+        for name, update in (('instance_update', db_api.instance_update),
+                             ('instance_update_lean',
+                              db_api.instance_update_lean)):
+            elapsed = run(update, ctxt, instance_uuids, args.updates)
+            print '%-22s %10.2f %12.0f' % (name, elapsed, total / elapsed)
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Time the API side of booting many instances with one request.
+
+Calls compute API.create with max_count set to each of --counts against a
+scratch sqlite database, with the scheduler cast going to the fake RPC
+driver, both creating the instances one at a time as the API used to and
+with db.instance_create_bulk.
+
+    python tools/benchmarks/multi_boot.py --counts 1,10,100,500
+"""
+
+import argparse
+import gettext
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from oslo.config import cfg
+
+POSSIBLE_TOPDIR = os.path.normpath(os.path.join(os.path.abspath(__file__),
+                                                os.pardir, os.pardir,
+                                                os.pardir))
+sys.path.insert(0, POSSIBLE_TOPDIR)
+
+gettext.install('nova', unicode=1)
+
+from nova.compute import api as compute_api
+from nova.compute import instance_types
+from nova import config
+from nova import context
+from nova.db.sqlalchemy import migration
+
+CONF = cfg.CONF
+
+
+def legacy_create_db_entries(self, context, instance_type, image,
+                             base_options, security_group,
+                             block_device_mapping, num_instances):
+    """The loop the API used before, kept for comparison."""
+    instances = []
+    for i in xrange(num_instances):
+        options = base_options.copy()
+        instances.append(self.create_db_entry_for_new_instance(
+                context, instance_type, image, options, security_group,
+                block_device_mapping, num_instances, i))
+    return instances
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--counts', default='1,10,100,500',
+                        help='values of max_count to time, comma separated')
+    args = parser.parse_args()
+    counts = [int(count) for count in args.counts.split(',')]
+
+    workdir = tempfile.mkdtemp()
+    try:
+        config.parse_args([])
+        CONF.set_override('sql_connection',
+                          'sqlite:///%s' % os.path.join(workdir, 'nova.db'))
+        CONF.set_override('rpc_backend',
+                          'nova.openstack.common.rpc.impl_fake')
+        CONF.set_override('policy_file', os.path.join(POSSIBLE_TOPDIR, 'etc',
+                                                      'nova', 'policy.json'))
+        for quota in ('quota_instances', 'quota_cores', 'quota_ram'):
+            CONF.set_override(quota, -1)
+        migration.db_sync()
+
+        ctxt = context.RequestContext('bench-user', 'bench-project')
+        instance_type = instance_types.get_default_instance_type()
+        api = compute_api.API()
+        bulk_create_db_entries = api._create_db_entries_for_new_instances
+
+        print '%-10s %-8s %10s %14s' % ('max_count', 'create', 'seconds',
+                                        'instances/s')
+        for count in counts:
+            for name, create_db_entries in (
+                    ('legacy', legacy_create_db_entries.__get__(api)),
+                    ('bulk', bulk_create_db_entries)):
+                api._create_db_entries_for_new_instances = create_db_entries
+                start = time.time()
+                instances, resv_id = api.create(ctxt, instance_type, None,
+                                                min_count=count,
+                                                max_count=count,
+                                                display_name='bench',
+                                                metadata={'role': 'bench'})
+                elapsed = time.time() - start
+                assert len(instances) == count
+                print '%-10d %-8s %10.2f %14.0f' % (count, name, elapsed,
+                                                    count / elapsed)
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Push objects bigger than its memory limit through nova-objectstore.
+
+Starts the S3 server in a child process whose address space is limited to
+what it uses once started plus --memory-mb, then PUTs and GETs a --size-mb
+object through it, checking the ETag, the MD5 of what comes back and a
+Range request for the end of the object.
+
+    python tools/benchmarks/objectstore_stream.py --size-mb 1024
+"""
+
+import argparse
+import gettext
+import hashlib
+import httplib
+import os
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from oslo.config import cfg
+
+POSSIBLE_TOPDIR = os.path.normpath(os.path.join(os.path.abspath(__file__),
+                                                os.pardir, os.pardir,
+                                                os.pardir))
+sys.path.insert(0, POSSIBLE_TOPDIR)
+
+gettext.install('nova', unicode=1)
+
+from nova import config
+from nova.objectstore import s3server
+from nova import wsgi
+
+CONF = cfg.CONF
+
+MB = 1024 * 1024
+
+
+def address_space():
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith('VmSize:'):
+                return int(line.split()[1]) * 1024
+
+
+def serve(buckets_path, port, memory_mb):
+    config.parse_args([])
+    server = wsgi.Server("S3 Objectstore",
+                         s3server.S3Application(buckets_path),
+                         port=port, host='127.0.0.1')
+    server.start()
+    limit = address_space() + memory_mb * MB
+    resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    print 'server limited to %d MB of address space' % (limit / MB)
+    sys.stdout.flush()
+    server.wait()
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def wait_for_server(port, child):
+    for i in xrange(100):
+        if child.poll() is not None:
+            raise Exception('server exited')
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return
+        except socket.error:
+            time.sleep(0.1)
+    raise Exception('server did not start')
+
+
+def make_object(path, size):
+    md5 = hashlib.md5()
+    chunk = os.urandom(MB)
+    with open(path, 'wb') as f:
+        for offset in xrange(0, size, MB):
+            data = chunk[:size - offset]
+            md5.update(data)
+            f.write(data)
+    return md5.hexdigest()
+
+
+def request(port, method, path, body=None, headers=None):
+    conn = httplib.HTTPConnection('127.0.0.1', port)
+    conn.request(method, path, body, headers or {})
+    return conn.getresponse()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--size-mb', type=int, default=1024,
+                        help='size of the object to push through')
+    parser.add_argument('--memory-mb', type=int, default=256,
+                        help='address space the server may use once started')
+    parser.add_argument('--dir', default=None,
+                        help='directory for the object and the buckets')
+    parser.add_argument('--serve', default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, default=0,
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve, args.port, args.memory_mb)
+        return
+
+    size = args.size_mb * MB
+    workdir = tempfile.mkdtemp(dir=args.dir)
+    child = None
+    try:
+        source = os.path.join(workdir, 'object')
+        buckets = os.path.join(workdir, 'buckets')
+        os.mkdir(buckets)
+        md5 = make_object(source, size)
+
+        port = free_port()
+        child = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                                  '--serve', buckets, '--port', str(port),
+                                  '--memory-mb', str(args.memory_mb)])
+        wait_for_server(port, child)
+        request(port, 'PUT', '/bench/').read()
+
+        start = time.time()
+        with open(source, 'rb') as f:
+            response = request(port, 'PUT', '/bench/object', f,
+                               {'Content-Length': str(size)})
+            response.read()
+        elapsed = time.time() - start
+        assert response.status == 200, response.status
+        assert response.getheader('etag') == '"%s"' % md5
+        print 'PUT %d MB: %8.2fs %8.1f MB/s' % (args.size_mb, elapsed,
+                                                  args.size_mb / elapsed)
+
+        start = time.time()
+        response = request(port, 'GET', '/bench/object')
+        got = hashlib.md5()
+        chunk = response.read(MB)
+        while chunk:
+            got.update(chunk)
+            chunk = response.read(MB)
+        elapsed = time.time() - start
+        assert response.status == 200, response.status
+        assert got.hexdigest() == md5
+        print 'GET %d MB: %8.2fs %8.1f MB/s' % (args.size_mb, elapsed,
+                                                  args.size_mb / elapsed)
+
+        response = request(port, 'GET', '/bench/object',
+                           headers={'Range': 'bytes=-%d' % MB})
+        tail = response.read()
+        assert response.status == 206, response.status
+        with open(source, 'rb') as f:
+            f.seek(-MB, os.SEEK_END)
+            assert tail == f.read()
+        print 'Range GET of the last MB ok'
+        assert child.poll() is None, 'server died'
+    finally:
+        if child is not None and child.poll() is None:
+            child.kill()
+            child.wait()
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
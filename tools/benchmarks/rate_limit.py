@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Load the API rate limiters with requests from many distinct users.
+
+Replays random requests from --users users against the in-memory Limiter
+and, when --memcached is given, the SharedLimiter, reporting the checks per
+second and how many users each limiter keeps state for.
+
+    python tools/benchmarks/rate_limit.py --users 10000 \\
+        --memcached 127.0.0.1:11211
+"""
+
+import argparse
+import gettext
+import os
+import random
+import sys
+import time
+
+from oslo.config import cfg
+
+POSSIBLE_TOPDIR = os.path.normpath(os.path.join(os.path.abspath(__file__),
+                                                os.pardir, os.pardir,
+                                                os.pardir))
+sys.path.insert(0, POSSIBLE_TOPDIR)
+
+gettext.install('nova', unicode=1)
+
+from nova.api.openstack.compute import limits
+from nova import config
+from nova.openstack.common import uuidutils
+
+CONF = cfg.CONF
+
+
+VERBS = ['GET', 'GET', 'GET', 'POST', 'PUT', 'DELETE']
+PATHS = ['/servers', '/servers/detail', '/images', '/flavors',
+         '/servers/detail?changes-since=2013-01-01', '/os-fping']
+
+
+def run(limiter, users, requests):
+    rand = random.Random(0)
+    limited = 0
+    start = time.time()
+    for i in xrange(requests):
+        delay, error = limiter.check_for_delay(rand.choice(VERBS),
+                                               rand.choice(PATHS),
+                                               rand.choice(users))
+        if delay:
+            limited += 1
+    return time.time() - start, limited
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--users', type=int, default=10000,
+                        help='number of distinct users')
+    parser.add_argument('--requests', type=int, default=100000,
+                        help='number of requests to check')
+    parser.add_argument('--max-users', type=int, default=None,
+                        help='osapi_rate_limit_max_users for the Limiter')
+    parser.add_argument('--memcached', default=None,
+                        help='memcached servers to run the SharedLimiter '
+                             'against, comma separated')
+    args = parser.parse_args()
+
+    config.parse_args([])
+    if args.max_users is not None:
+        CONF.set_override('osapi_rate_limit_max_users', args.max_users)
+
+    users = [uuidutils.generate_uuid() for i in xrange(args.users)]
+    limiters = [('Limiter', limits.Limiter(limits.DEFAULT_LIMITS))]
+    if args.memcached:
+        CONF.set_override('memcached_servers', args.memcached.split(','))
+        limiters.append(('SharedLimiter',
+                         limits.SharedLimiter(limits.DEFAULT_LIMITS)))
+
+    print '%-14s %10s %12s %10s %8s' % ('limiter', 'seconds', 'checks/s',
+                                        'limited', 'users')
+    for name, limiter in limiters:
+        elapsed, limited = run(limiter, users, args.requests)
+        print '%-14s %10.2f %12.0f %10d %8d' % (
+            name, elapsed, args.requests / elapsed, limited,
+            len(limiter.levels))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Time converting instance payloads to primitives for RPC.
+
+Builds --instances instance dicts shaped like the ones conductor and compute
+send each other (system_metadata, info_cache, security groups, metadata and
+datetimes), then times nova.utils.to_primitive on them against
+jsonutils.to_primitive, which runs every inspect check on every value, and
+the JSON encoding done by the RPC envelope.
+
+    python tools/benchmarks/rpc_serialization.py --instances 1000
+"""
+
+import argparse
+import datetime
+import functools
+import gettext
+import inspect
+import itertools
+import os
+import sys
+import time
+import xmlrpclib
+
+POSSIBLE_TOPDIR = os.path.normpath(os.path.join(os.path.abspath(__file__),
+                                                os.pardir, os.pardir,
+                                                os.pardir))
+sys.path.insert(0, POSSIBLE_TOPDIR)
+
+gettext.install('nova', unicode=1)
+
+from nova.openstack.common import jsonutils
+from nova.openstack.common import timeutils
+from nova.openstack.common import uuidutils
+from nova import utils
+
+
+def legacy_to_primitive(value, convert_instances=False,
+                        convert_datetime=True, level=0, max_depth=3):
+    """jsonutils.to_primitive as synced from oslo, kept for comparison."""
+    nasty = [inspect.ismodule, inspect.isclass, inspect.ismethod,
+             inspect.isfunction, inspect.isgeneratorfunction,
+             inspect.isgenerator, inspect.istraceback, inspect.isframe,
+             inspect.iscode, inspect.isbuiltin, inspect.isroutine,
+             inspect.isabstract]
+    for test in nasty:
+        if test(value):
+            return unicode(value)
+
+    if type(value) == itertools.count:
+        return unicode(value)
+
+    if getattr(value, '__module__', None) == 'mox':
+        return 'mock'
+
+    if level > max_depth:
+        return '?'
+
+    try:
+        recursive = functools.partial(legacy_to_primitive,
+                                      convert_instances=convert_instances,
+                                      convert_datetime=convert_datetime,
+                                      level=level,
+                                      max_depth=max_depth)
+        if isinstance(value, xmlrpclib.DateTime):
+            value = datetime.datetime(*tuple(value.timetuple())[:6])
+
+        if isinstance(value, (list, tuple)):
+            return [recursive(v) for v in value]
+        elif isinstance(value, dict):
+            return dict((k, recursive(v)) for k, v in value.iteritems())
+        elif convert_datetime and isinstance(value, datetime.datetime):
+            return timeutils.strtime(value)
+        elif hasattr(value, 'iteritems'):
+            return recursive(dict(value.iteritems()), level=level + 1)
+        elif hasattr(value, '__iter__'):
+            return recursive(list(value))
+        elif convert_instances and hasattr(value, '__dict__'):
+            return recursive(value.__dict__, level=level + 1)
+        else:
+            return value
+    except TypeError:
+        return unicode(value)
+
+
+def fake_instance(i):
+    now = datetime.datetime(2013, 3, 1, 12, 0, 0)
+    uuid = uuidutils.generate_uuid()
+    network_info = [{'id': uuidutils.generate_uuid(),
+                     'address': 'fa:16:3e:00:00:%02x' % (i % 256),
+                     'network': {'id': uuidutils.generate_uuid(),
+                                 'bridge': 'br100', 'label': 'private',
+                                 'subnets': [{'cidr': '10.0.0.0/24',
+                                              'gateway': {'address':
+                                                          '10.0.0.1'},
+                                              'ips': [{'address': '10.0.0.%d'
+                                                       % (i % 250 + 2),
+                                                       'floating_ips': []}],
+                                              'dns': [{'address':
+                                                       '8.8.8.8'}]}]}}]
+    system_metadata = [{'key': key, 'value': value, 'deleted': False,
+                        'created_at': now, 'updated_at': None,
+                        'deleted_at': None, 'id': n,
+                        'instance_uuid': uuid}
+                       for n, (key, value) in enumerate([
+                           ('instance_type_id', '2'),
+                           ('instance_type_name', 'm1.small'),
+                           ('instance_type_memory_mb', '2048'),
+                           ('instance_type_vcpus', '1'),
+                           ('instance_type_root_gb', '20'),
+                           ('instance_type_ephemeral_gb', '0'),
+                           ('instance_type_flavorid', '2'),
+                           ('instance_type_swap', '0'),
+                           ('instance_type_rxtx_factor', '1.0'),
+                           ('instance_type_vcpu_weight', ''),
+                           ('image_kernel_id', uuidutils.generate_uuid()),
+                           ('image_ramdisk_id', uuidutils.generate_uuid()),
+                           ('image_base_image_ref',
+                            uuidutils.generate_uuid())])]
+    return {'id': i, 'uuid': uuid, 'name': 'instance-%08x' % i,
+            'hostname': 'server-%d' % i, 'display_name': 'server-%d' % i,
+            'display_description': None, 'user_id': 'fake-user',
+            'project_id': 'fake-project', 'image_ref':
+            uuidutils.generate_uuid(), 'kernel_id': '', 'ramdisk_id': '',
+            'host': 'compute%d' % (i % 100), 'node': 'compute%d' % (i % 100),
+            'launched_on': 'compute%d' % (i % 100),
+            'instance_type_id': 2, 'memory_mb': 2048, 'vcpus': 1,
+            'root_gb': 20, 'ephemeral_gb': 0, 'power_state': 1,
+            'vm_state': 'active', 'task_state': None, 'locked': False,
+            'created_at': now, 'updated_at': now, 'launched_at': now,
+            'terminated_at': None, 'deleted_at': None, 'deleted': False,
+            'scheduled_at': now, 'availability_zone': 'nova',
+            'access_ip_v4': None, 'access_ip_v6': None,
+            'config_drive': '', 'key_name': 'default', 'key_data':
+            'ssh-rsa ' + 'A' * 372 + ' fake@example.com',
+            'metadata': [{'key': 'role', 'value': 'web', 'deleted': False,
+                          'created_at': now, 'updated_at': None,
+                          'deleted_at': None, 'id': i,
+                          'instance_uuid': uuid}],
+            'system_metadata': system_metadata,
+            'security_groups': [{'id': 1, 'name': 'default',
+                                 'description': 'default',
+                                 'user_id': 'fake-user',
+                                 'project_id': 'fake-project',
+                                 'created_at': now, 'updated_at': None,
+                                 'deleted_at': None, 'deleted': False,
+                                 'rules': []}],
+            'info_cache': {'instance_uuid': uuid, 'created_at': now,
+                           'updated_at': now, 'deleted_at': None,
+                           'deleted': False, 'id': i,
+                           'network_info': jsonutils.dumps(network_info)}}
+
+
+def timed(func, *args, **kwargs):
+    start = time.time()
+    result = func(*args, **kwargs)
+    return time.time() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--instances', type=int, default=1000,
+                        help='number of instances in the payload')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='number of times to convert the payload')
+    args = parser.parse_args()
+
+    instances = [fake_instance(i) for i in xrange(args.instances)]
+
+    print '%-26s %10s %14s' % ('conversion', 'seconds', 'instances/s')
+    results = {}
+    for name, func in (('legacy to_primitive', legacy_to_primitive),
+                       ('to_primitive', utils.to_primitive)):
+        elapsed = 0
+        for i in xrange(args.repeat):
+            seconds, results[name] = timed(func, instances)
+            elapsed += seconds
+        print '%-26s %10.3f %14.0f' % (name, elapsed / args.repeat,
+                                      args.repeat * args.instances / elapsed)
+    assert results['to_primitive'] == results['legacy to_primitive']
+
+    primitive = results['to_primitive']
+    elapsed = 0
+    for i in xrange(args.repeat):
+        seconds, data = timed(jsonutils.dumps, primitive)
+        elapsed += seconds
+    print '%-26s %10.3f %14.0f' % ('dumps', elapsed / args.repeat,
+                                  args.repeat * args.instances / elapsed)
+    print 'payload size: %d bytes' % len(data)
+
+
+if __name__ == '__main__':
+    main()
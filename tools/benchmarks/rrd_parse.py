@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Time parsing XenServer rrd_updates for compile_metrics.
+
+Makes rrd_updates XML like a host with --vms VMs sends, --rows samples of
+cpus, memory, disks and vifs for each, then parses it both the way
+vm_utils used to (minidom and Decimal) and with the streaming parser,
+checking that both give the same metrics.
+
+    python tools/benchmarks/rrd_parse.py --vms 300
+"""
+
+import argparse
+import decimal
+import gettext
+import os
+import random
+import sys
+import time
+import uuid
+from xml.dom import minidom
+
+POSSIBLE_TOPDIR = os.path.normpath(os.path.join(os.path.abspath(__file__),
+                                                os.pardir, os.pardir,
+                                                os.pardir))
+sys.path.insert(0, POSSIBLE_TOPDIR)
+
+gettext.install('nova', unicode=1)
+
+from nova.virt.xenapi import vm_utils
+
+COLUMNS = ['cpu0', 'cpu1', 'memory', 'memory_internal_free',
+           'vbd_xvda_read', 'vbd_xvda_write', 'vif_0_rx', 'vif_0_tx',
+           'vif_1_rx', 'vif_1_tx']
+
+
+def make_rrd_updates(vms, rows, step, end):
+    """Return rrd_updates XML for vms VMs and the start time it covers."""
+    start = end - rows * step
+    legend = ['AVERAGE:vm:%s:%s' % (uuid.uuid4(), name)
+              for vm in xrange(vms) for name in COLUMNS]
+    xml = ['<xport><meta><start>%d</start><step>%d</step><end>%d</end>'
+           '<rows>%d</rows><columns>%d</columns><legend>' %
+           (start, step, end, rows, len(legend))]
+    xml.extend('<entry>%s</entry>' % entry for entry in legend)
+    xml.append('</legend></meta><data>')
+    for row in xrange(rows):
+        xml.append('<row><t>%d</t>' % (end - row * step))
+        for entry in legend:
+            if random.random() < 0.001:
+                value = 'NaN'
+            else:
+                value = '%.4f' % random.uniform(0, 100000)
+            xml.append('<v>%s</v>' % value)
+        xml.append('</row>')
+    xml.append('</data></xport>')
+    return ''.join(xml), start
+
+
+def _parse_rrd_meta(doc):
+    data = {}
+    meta = doc.getElementsByTagName('meta')[0]
+    for tag in ('start', 'end', 'step'):
+        data[tag] = int(meta.getElementsByTagName(tag)[0].firstChild.data)
+    legend = meta.getElementsByTagName('legend')[0]
+    data['legend'] = [child.firstChild.data for child in legend.childNodes]
+    return data
+
+
+def _parse_rrd_data(doc):
+    dnode = doc.getElementsByTagName('data')[0]
+    return [dict(
+            time=int(child.getElementsByTagName('t')[0].firstChild.data),
+            values=[decimal.Decimal(valnode.firstChild.data)
+                  for valnode in child.getElementsByTagName('v')])
+            for child in dnode.childNodes]
+
+
+def _average_series(data, col, until=None):
+    vals = [row['values'][col] for row in data
+            if (not until or (row['time'] <= until)) and
+                row['values'][col].is_finite()]
+    if vals:
+        return (sum(vals) / len(vals)).quantize(decimal.Decimal('1.0000'))
+    else:
+        return decimal.Decimal('0.0000')
+
+
+def _integrate_series(data, col, start, until=None):
+    total = decimal.Decimal('0.0000')
+    prev_time = int(start)
+    prev_val = None
+    for row in reversed(data):
+        if not until or (row['time'] <= until):
+            time = row['time']
+            val = row['values'][col]
+            if val.is_nan():
+                val = decimal.Decimal('0.0000')
+            if prev_val is None:
+                prev_val = val
+            if prev_val >= val:
+                total += ((val * (time - prev_time)) +
+                          (decimal.Decimal('0.5000') * (prev_val - val) *
+                          (time - prev_time)))
+            else:
+                total += ((prev_val * (time - prev_time)) +
+                          (decimal.Decimal('0.5000') * (val - prev_val) *
+                          (time - prev_time)))
+            prev_time = time
+            prev_val = val
+    return total.quantize(decimal.Decimal('1.0000'))
+
+
+def legacy_parse_rrd_update(xml, start, until=None):
+    """The minidom and Decimal parser used before, kept for comparison."""
+    doc = minidom.parseString(xml)
+    sum_data = {}
+    meta = _parse_rrd_meta(doc)
+    data = _parse_rrd_data(doc)
+    for col, collabel in enumerate(meta['legend']):
+        _datatype, _objtype, uuid, name = collabel.split(':')
+        vm_data = sum_data.get(uuid, dict())
+        if name.startswith('vif'):
+            vm_data[name] = _integrate_series(data, col, start, until)
+        else:
+            vm_data[name] = _average_series(data, col, until)
+        sum_data[uuid] = vm_data
+    return sum_data
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--vms', type=int, default=300,
+                        help='number of VMs on the host')
+    parser.add_argument('--rows', type=int, default=60,
+                        help='samples of each column')
+    parser.add_argument('--step', type=int, default=5,
+                        help='seconds between samples')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='parses to time for each parser')
+    args = parser.parse_args()
+
+    random.seed(0)
+    xml, start = make_rrd_updates(args.vms, args.rows, args.step,
+                                  int(time.time()))
+    print 'rrd_updates of %d VMs, %d rows: %.1f MB' % (
+        args.vms, args.rows, len(xml) / 1024.0 / 1024.0)
+
+    print '%-10s %10s' % ('parser', 'seconds')
+    results = {}
+    for name, parse in (('legacy', legacy_parse_rrd_update),
+                        ('streaming', vm_utils._parse_rrd_update)):
+        elapsed = []
+        for i in xrange(args.repeat):
+            started = time.time()
+            results[name] = parse(xml, start)
+            elapsed.append(time.time() - started)
+        print '%-10s %10.3f' % (name, min(elapsed))
+    assert results['legacy'] == results['streaming']
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Time registering a bundled image from s3.
+
+Makes a bundle like ec2-bundle-image does (a gzipped tarball of a --size-mb
+image, encrypted with AES-128-CBC and split into --part-mb parts, plus a
+manifest), then registers it both the way S3ImageService used to, writing
+every stage out to disk, and with the streaming pipeline. Parts are served
+from the bundle directory with --latency seconds added to each download,
+and the image is uploaded to a sink that only counts the bytes.
+
+    python tools/benchmarks/s3_image_register.py --size-mb 512
+
+With --bundle-only DIR it just writes the bundle into DIR.
+"""
+
+import argparse
+import base64
+import binascii
+import gettext
+import hashlib
+import os
+import resource
+import shutil
+import sys
+import tarfile
+import tempfile
+import time
+
+import eventlet
+from lxml import etree
+from oslo.config import cfg
+
+POSSIBLE_TOPDIR = os.path.normpath(os.path.join(os.path.abspath(__file__),
+                                                os.pardir, os.pardir,
+                                                os.pardir))
+sys.path.insert(0, POSSIBLE_TOPDIR)
+
+gettext.install('nova', unicode=1)
+
+from nova import config
+from nova import context
+from nova.image import s3
+from nova import utils
+
+CONF = cfg.CONF
+
+MB = 1024 * 1024
+
+
+def make_bundle(directory, size, part_size):
+    """Write a bundle of a size byte image into directory.
+
+    Returns the name of the manifest and the MD5 of the image.
+    """
+    image_path = os.path.join(directory, 'bench.img')
+    md5 = hashlib.md5()
+    chunk = os.urandom(MB)
+    with open(image_path, 'wb') as f:
+        for offset in xrange(0, size, MB):
+            data = chunk[:size - offset]
+            md5.update(data)
+            f.write(data)
+
+    tar_path = os.path.join(directory, 'bench.img.tar.gz')
+    tar_file = tarfile.open(tar_path, 'w:gz')
+    tar_file.add(image_path, 'bench.img')
+    tar_file.close()
+    os.unlink(image_path)
+
+    key = binascii.b2a_hex(os.urandom(16))
+    iv = binascii.b2a_hex(os.urandom(16))
+    encrypted_path = os.path.join(directory, 'bench.img.encrypted')
+    utils.execute('openssl', 'enc', '-e', '-aes-128-cbc', '-K', key,
+                  '-iv', iv, '-in', tar_path, '-out', encrypted_path)
+    os.unlink(tar_path)
+
+    manifest = etree.Element('manifest')
+    image = etree.SubElement(manifest, 'image')
+    # The benchmark's nova-cert "decrypts" these by base64 decoding them
+    etree.SubElement(image, 'ec2_encrypted_key').text = binascii.b2a_hex(key)
+    etree.SubElement(image, 'ec2_encrypted_iv').text = binascii.b2a_hex(iv)
+    parts = etree.SubElement(image, 'parts')
+    index = 0
+    with open(encrypted_path, 'rb') as encrypted:
+        data = encrypted.read(part_size)
+        while data:
+            filename = 'bench.img.part.%d' % index
+            with open(os.path.join(directory, filename), 'wb') as f:
+                f.write(data)
+            part = etree.SubElement(parts, 'part', index=str(index))
+            etree.SubElement(part, 'filename').text = filename
+            index += 1
+            data = encrypted.read(part_size)
+    parts.set('count', str(index))
+    os.unlink(encrypted_path)
+
+    with open(os.path.join(directory, 'bench.img.manifest.xml'), 'w') as f:
+        f.write(etree.tostring(manifest))
+    return 'bench.img.manifest.xml', md5.hexdigest()
+
+
+class FakeKey(object):
+    def __init__(self, path, latency):
+        self.path = path
+        self.latency = latency
+
+    def get_contents_as_string(self):
+        eventlet.sleep(self.latency)
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def get_contents_to_filename(self, filename):
+        eventlet.sleep(self.latency)
+        shutil.copyfile(self.path, filename)
+
+
+class FakeBucket(object):
+    def __init__(self, directory, latency):
+        self.directory = directory
+        self.latency = latency
+
+    def get_key(self, name):
+        return FakeKey(os.path.join(self.directory, name), self.latency)
+
+
+class SinkImageService(object):
+    """Stands in for glance, counting and summing what is uploaded."""
+
+    def __init__(self):
+        self.md5 = None
+
+    def update(self, context, image_id, metadata, data=None,
+               purge_props=True):
+        md5 = hashlib.md5()
+        chunk = data.read(MB)
+        while chunk:
+            md5.update(chunk)
+            chunk = data.read(MB)
+        self.md5 = md5.hexdigest()
+
+
+def legacy_register(service, ctxt, bucket, manifest, scratch_dir):
+    """The stages delayed_create used to run, kept for comparison.
+
+    Returns the number of bytes written to disk under scratch_dir.
+    """
+    image_path = tempfile.mkdtemp(dir=scratch_dir)
+
+    parts = []
+    for fn_element in manifest.find('image').getiterator('filename'):
+        key = bucket.get_key(fn_element.text)
+        part = os.path.join(image_path, os.path.basename(fn_element.text))
+        key.get_contents_to_filename(part)
+        parts.append(part)
+
+    enc_filename = os.path.join(image_path, 'image.encrypted')
+    with open(enc_filename, 'w') as combined:
+        for filename in parts:
+            with open(filename) as part:
+                shutil.copyfileobj(part, combined)
+
+    encrypted_key = binascii.a2b_hex(
+        manifest.find('image/ec2_encrypted_key').text)
+    encrypted_iv = binascii.a2b_hex(
+        manifest.find('image/ec2_encrypted_iv').text)
+    key, iv = service._decrypt_key(ctxt, encrypted_key, encrypted_iv)
+    dec_filename = os.path.join(image_path, 'image.tar.gz')
+    utils.execute('openssl', 'enc', '-d', '-aes-128-cbc',
+                  '-in', enc_filename, '-K', key, '-iv', iv,
+                  '-out', dec_filename)
+
+    tar_file = tarfile.open(dec_filename, 'r|gz')
+    tar_file.extractall(image_path)
+    image_file = tar_file.getnames()[0]
+    tar_file.close()
+
+    with open(os.path.join(image_path, image_file)) as image_data:
+        service.service.update(ctxt, 'bench', {}, image_data,
+                               purge_props=False)
+
+    written = 0
+    for root, dirs, files in os.walk(image_path):
+        for name in files:
+            written += os.path.getsize(os.path.join(root, name))
+    shutil.rmtree(image_path)
+    return written
+
+
+def streaming_register(service, ctxt, bucket, manifest, scratch_dir):
+    """What delayed_create does now, returning the bytes it wrote."""
+    encrypted_key = binascii.a2b_hex(
+        manifest.find('image/ec2_encrypted_key').text)
+    encrypted_iv = binascii.a2b_hex(
+        manifest.find('image/ec2_encrypted_iv').text)
+    key, iv = service._decrypt_key(ctxt, encrypted_key, encrypted_iv)
+    elements = manifest.find('image').getiterator('filename')
+    parts = service._download_parts(bucket, [fn_element.text
+                                             for fn_element in elements])
+    bundle = s3.BundleStream(parts, key, iv)
+    service.service.update(ctxt, 'bench', {}, bundle.open_image(),
+                           purge_props=False)
+    bundle.close()
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--size-mb', type=int, default=512,
+                        help='size of the image in the bundle')
+    parser.add_argument('--part-mb', type=int, default=10,
+                        help='size of the parts of the bundle')
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='seconds added to the download of each part')
+    parser.add_argument('--parts', type=int, default=4,
+                        help='parts downloaded at once by the pipeline')
+    parser.add_argument('--dir', default=None,
+                        help='directory for the bundle and scratch files')
+    parser.add_argument('--bundle-only', default=None, metavar='DIR',
+                        help='just write a bundle into DIR')
+    args = parser.parse_args()
+
+    config.parse_args([])
+    if args.bundle_only:
+        manifest, md5 = make_bundle(args.bundle_only, args.size_mb * MB,
+                                    args.part_mb * MB)
+        print 'wrote %s, image md5 %s' % (manifest, md5)
+        return
+
+    CONF.set_override('s3_image_download_parts', args.parts)
+    workdir = tempfile.mkdtemp(dir=args.dir)
+    try:
+        bundle_dir = os.path.join(workdir, 'bundle')
+        scratch_dir = os.path.join(workdir, 'scratch')
+        os.mkdir(bundle_dir)
+        os.mkdir(scratch_dir)
+        manifest_name, md5 = make_bundle(bundle_dir, args.size_mb * MB,
+                                         args.part_mb * MB)
+        with open(os.path.join(bundle_dir, manifest_name)) as f:
+            manifest = etree.fromstring(f.read())
+
+        ctxt = context.RequestContext('bench-user', 'bench-project',
+                                      is_admin=False)
+        bucket = FakeBucket(bundle_dir, args.latency)
+        sink = SinkImageService()
+        service = s3.S3ImageService(sink)
+        service.cert_rpcapi.decrypt_text = (
+            lambda ctxt, project_id, text: base64.b64decode(text))
+
+        print '%-10s %10s %14s %12s' % ('register', 'seconds',
+                                        'disk MB', 'max RSS MB')
+        for name, register in (('legacy', legacy_register),
+                               ('streaming', streaming_register)):
+            start = time.time()
+            written = register(service, ctxt, bucket, manifest, scratch_dir)
+            elapsed = time.time() - start
+            assert sink.md5 == md5, name
+            max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            print '%-10s %10.2f %14.1f %12.1f' % (name, elapsed,
+                                                  float(written) / MB,
+                                                  max_rss / 1024.0)
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Measure the throughput of the XenAPI sparse partition copy.
+
+Copies a sparse image (mostly holes), a dense image written full of data,
+and an image whose blocks are allocated but zero, with both the current
+nova.virt.xenapi.vm_utils._sparse_copy and the previous 4K-at-a-time loop.
+
+    python tools/benchmarks/sparse_copy.py --size-mb 512
+"""
+
+import argparse
+import gettext
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+POSSIBLE_TOPDIR = os.path.normpath(os.path.join(os.path.abspath(__file__),
+                                                os.pardir, os.pardir,
+                                                os.pardir))
+sys.path.insert(0, POSSIBLE_TOPDIR)
+
+gettext.install('nova', unicode=1)
+
+from nova.virt.xenapi import vm_utils
+
+
+def legacy_sparse_copy(src_path, dst_path, virtual_size, block_size=4096):
+    """The copy loop _sparse_copy used before, kept for comparison."""
+    empty_block = '\0' * block_size
+    left = virtual_size
+    with open(src_path, "r") as src:
+        with open(dst_path, "w") as dst:
+            data = src.read(min(block_size, left))
+            while data:
+                if data == empty_block:
+                    dst.seek(block_size, os.SEEK_CUR)
+                else:
+                    dst.write(data)
+                left -= len(data)
+                if left <= 0:
+                    break
+                data = src.read(min(block_size, left))
+                time.sleep(0)
+
+
+def make_image(path, size, kind):
+    chunk = 1024 * 1024
+    with open(path, 'wb') as f:
+        if kind == 'sparse':
+            # A little data every 64MB, holes everywhere else
+            for offset in xrange(0, size, 64 * chunk):
+                f.seek(offset)
+                f.write(os.urandom(chunk))
+        elif kind == 'dense':
+            data = os.urandom(chunk)
+            for offset in xrange(0, size, chunk):
+                f.write(data)
+        else:
+            zeros = '\0' * chunk
+            for offset in xrange(0, size, chunk):
+                f.write(zeros)
+        f.truncate(size)
+
+
+def time_copy(copy, src_path, dst_path, size):
+    open(dst_path, 'w').close()
+    start = time.time()
+    copy(src_path, dst_path, size)
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--size-mb', type=int, default=256,
+                        help='size of each test image')
+    parser.add_argument('--dir', default=None,
+                        help='directory for the test images')
+    args = parser.parse_args()
+
+    size = args.size_mb * 1024 * 1024
+    workdir = tempfile.mkdtemp(dir=args.dir)
+    try:
+        src_path = os.path.join(workdir, 'src')
+        dst_path = os.path.join(workdir, 'dst')
+        print '%-8s %-8s %10s %10s' % ('image', 'copy', 'seconds', 'MB/s')
+        for kind in ('sparse', 'dense', 'zeroed'):
+            make_image(src_path, size, kind)
+            for name, copy in (('new', vm_utils._sparse_copy),
+                               ('legacy', legacy_sparse_copy)):
+                elapsed = time_copy(copy, src_path, dst_path, size)
+                print '%-8s %-8s %10.2f %10.1f' % (kind, name, elapsed,
+                                                   args.size_mb / elapsed)
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
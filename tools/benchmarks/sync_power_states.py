@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Time the compute manager's power state sync.
+
+Creates --instances active instances on one host in a scratch sqlite
+database and in the fake virt driver, with --out-of-sync of them stopped
+behind nova's back, then runs _sync_power_states against a local conductor,
+both the way it used to (a get_info and a conductor call per instance) and
+with driver.get_power_states(). --latency seconds are added to each driver
+call to stand in for the hypervisor.
+
+    python tools/benchmarks/sync_power_states.py --instances 1000
+"""
+
+import argparse
+import collections
+import gettext
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from oslo.config import cfg
+
+POSSIBLE_TOPDIR = os.path.normpath(os.path.join(os.path.abspath(__file__),
+                                                os.pardir, os.pardir,
+                                                os.pardir))
+sys.path.insert(0, POSSIBLE_TOPDIR)
+
+gettext.install('nova', unicode=1)
+
+from nova.compute import manager as compute_manager
+from nova.compute import power_state
+from nova.compute import vm_states
+from nova import config
+from nova import context
+from nova import db
+from nova.db.sqlalchemy import migration
+from nova.virt import fake
+
+CONF = cfg.CONF
+
+
+def legacy_sync_power_states(self, context):
+    """The _sync_power_states loop used before, kept for comparison."""
+    db_instances = self.conductor_api.instance_get_all_by_host(context,
+                                                               self.host)
+    for db_instance in db_instances:
+        if db_instance['task_state'] is not None:
+            continue
+        try:
+            vm_instance = self.driver.get_info(db_instance)
+            vm_power_state = vm_instance['state']
+        except Exception:
+            vm_power_state = power_state.NOSTATE
+        self._sync_instance_power_state(context, db_instance, vm_power_state)
+
+
+class Counted(object):
+    """Counts the calls made through it to the methods of obj."""
+
+    def __init__(self, obj, latency=0, counts=None):
+        self._obj = obj
+        self._latency = latency
+        self.counts = counts if counts is not None else collections.Counter()
+
+    def __getattr__(self, name):
+        attr = getattr(self._obj, name)
+        if not callable(attr):
+            return attr
+
+        def counted(*args, **kwargs):
+            self.counts[name] += 1
+            if self._latency:
+                time.sleep(self._latency)
+            return attr(*args, **kwargs)
+        return counted
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--instances', type=int, default=1000,
+                        help='number of instances on the host')
+    parser.add_argument('--out-of-sync', type=int, default=10,
+                        help='instances stopped behind nova\'s back')
+    parser.add_argument('--latency', type=float, default=0.001,
+                        help='seconds added to each driver call')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    try:
+        config.parse_args([])
+        CONF.set_override('sql_connection',
+                          'sqlite:///%s' % os.path.join(workdir, 'nova.db'))
+        CONF.set_override('compute_driver', 'fake.FakeDriver')
+        CONF.set_override('use_local', True, 'conductor')
+        migration.db_sync()
+
+        ctxt = context.get_admin_context()
+        compute = compute_manager.ComputeManager()
+        compute.driver.instances.clear()
+        for i in xrange(args.instances):
+            instance = db.instance_create(ctxt, {
+                'host': compute.host, 'node': fake._FAKE_NODES[0],
+                'vm_state': vm_states.ACTIVE,
+                'power_state': power_state.RUNNING,
+                'project_id': 'bench', 'user_id': 'bench'})
+            compute.driver.instances[instance['name']] = fake.FakeInstance(
+                instance['name'], power_state.RUNNING)
+
+        # The stop API is not what is being timed
+        compute.conductor_api.compute_stop = lambda context, instance: None
+
+        conductor_api = compute.conductor_api
+        driver = compute.driver
+        print '%-10s %10s %12s %14s' % ('sync', 'seconds', 'driver calls',
+                                        'conductor calls')
+        stopped = driver.instances.keys()[:args.out_of_sync]
+        for instance_name in stopped:
+            driver.instances[instance_name].state = power_state.SHUTDOWN
+        for name, sync in (('legacy', legacy_sync_power_states),
+                           ('bulk', lambda self, context:
+                                    self._sync_power_states(context))):
+            for instance in db.instance_get_all_by_host(ctxt, compute.host):
+                if instance['name'] in stopped:
+                    db.instance_update(ctxt, instance['uuid'],
+                                       {'power_state': power_state.RUNNING})
+
+            compute.conductor_api = Counted(conductor_api)
+            compute.driver = Counted(driver, args.latency)
+            start = time.time()
+            sync(compute, ctxt)
+            elapsed = time.time() - start
+            shutdown = [instance for instance in
+                        db.instance_get_all_by_host(ctxt, compute.host)
+                        if instance['power_state'] == power_state.SHUTDOWN]
+            assert len(shutdown) == args.out_of_sync, len(shutdown)
+            print '%-10s %10.2f %12d %14d' % (
+                name, elapsed, sum(compute.driver.counts.values()),
+                sum(compute.conductor_api.counts.values()))
+            compute.conductor_api = conductor_api
+            compute.driver = driver
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Time os-simple-tenant-usage over a large instances table.
+
+Fills a scratch database with --instances instance rows spread over
+--tenants tenants and a month, then times loading them the way the usage
+report used to (every instance as a joined model) against the paged,
+column-only aggregation it does now.
+
+    python tools/benchmarks/tenant_usage.py --instances 500000
+"""
+
+import argparse
+import datetime
+import gettext
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from oslo.config import cfg
+
+POSSIBLE_TOPDIR = os.path.normpath(os.path.join(os.path.abspath(__file__),
+                                                os.pardir, os.pardir,
+                                                os.pardir))
+sys.path.insert(0, POSSIBLE_TOPDIR)
+
+gettext.install('nova', unicode=1)
+
+from nova.api.openstack.compute.contrib import simple_tenant_usage
+from nova import config
+from nova import context
+from nova import db
+from nova.db.sqlalchemy import models
+from nova.openstack.common.db.sqlalchemy import session as db_session
+from nova.openstack.common import uuidutils
+
+CONF = cfg.CONF
+
+
+def populate(instances, tenants, start, stop):
+    engine = db_session.get_engine()
+    models.BASE.metadata.create_all(engine)
+
+    ctxt = context.get_admin_context()
+    flavor = db.instance_type_create(ctxt, dict(name='bench', memory_mb=512,
+                                                vcpus=1, root_gb=10,
+                                                ephemeral_gb=0, flavorid='b',
+                                                swap=0))
+
+    rand = random.Random(0)
+    seconds = int((stop - start).total_seconds())
+    table = models.Instance.__table__
+    rows = []
+    for i in xrange(instances):
+        launched = start + datetime.timedelta(seconds=rand.randint(0,
+                                                                   seconds))
+        terminated = None
+        if rand.random() < 0.5:
+            terminated = launched + datetime.timedelta(hours=rand.randint(1,
+                                                                          48))
+        rows.append(dict(uuid=uuidutils.generate_uuid(),
+                         project_id='tenant-%d' % (i % tenants),
+                         user_id='user', display_name='server-%d' % i,
+                         instance_type_id=flavor['id'], vm_state='active',
+                         launched_at=launched, terminated_at=terminated,
+                         created_at=launched, deleted=0))
+        if len(rows) == 10000:
+            engine.execute(table.insert(), rows)
+            rows = []
+    if rows:
+        engine.execute(table.insert(), rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--instances', type=int, default=500000,
+                        help='number of instance rows')
+    parser.add_argument('--tenants', type=int, default=1000,
+                        help='number of tenants owning them')
+    parser.add_argument('--sql-connection', default=None,
+                        help='database to use instead of a scratch sqlite '
+                             'file; it must be empty')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    try:
+        config.parse_args([])
+        CONF.set_override('sql_connection', args.sql_connection or
+                          'sqlite:///%s' % os.path.join(workdir, 'nova.db'))
+
+        stop = datetime.datetime(2013, 2, 1)
+        start = stop - datetime.timedelta(days=31)
+        begin = time.time()
+        populate(args.instances, args.tenants, start, stop)
+        print 'populated %d instances in %.1fs' % (args.instances,
+                                                    time.time() - begin)
+
+        ctxt = context.get_admin_context()
+        controller = simple_tenant_usage.SimpleTenantUsageController()
+
+        begin = time.time()
+        db.instance_get_active_by_window_joined(ctxt, start, stop)
+        print 'load joined models:   %8.2fs' % (time.time() - begin)
+
+        for detailed in (False, True):
+            begin = time.time()
+            usages = controller._tenant_usages_for_period(ctxt, start, stop,
+                                                          detailed=detailed)
+            print 'aggregate%-12s %8.2fs (%d tenants)' % (
+                detailed and ' detailed:' or ':', time.time() - begin,
+                len(usages))
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()